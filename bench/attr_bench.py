@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Simulates the lookups of repeated `ls -lR` runs against Sha1FS (readdir, then getattr and access on
+# every entry) and counts the stat-family syscalls it makes, with and without the attribute cache.
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import shutil
+import tempfile
+
+from optparse import OptionParser
+from stat import S_ISDIR
+
+import benchutil
+
+COUNTED = ("stat", "lstat", "access", "listdir")
+
+class SyscallCounter:
+  """Wraps the os functions in COUNTED so that calls to them are counted."""
+  def __init__(self):
+    self.count = 0
+    self.originals = {}
+
+  def __enter__(self):
+    for name in COUNTED:
+      self.originals[name] = getattr(os, name)
+      setattr(os, name, self._wrap(self.originals[name]))
+    return self
+
+  def __exit__(self, type, value, trace):
+    for (name, func) in self.originals.items():
+      setattr(os, name, func)
+
+  def _wrap(self, func):
+    def counted(*args):
+      self.count += 1
+      return func(*args)
+    return counted
+
+def lsR(fs, path):
+  for entry in fs.readdir(path, 0):
+    child = path.rstrip("/") + "/" + entry.name
+    st = fs.getattr(child)
+    fs.access(child, os.F_OK)
+    if not isinstance(st, int) and S_ISDIR(st.st_mode):
+      lsR(fs, child)
+
+def run(name, root, database, ttl, passes):
+  fs = benchutil.makeSha1FS(root, database, attrCacheTtl=ttl)
+  samples = benchutil.Samples(name)
+  with SyscallCounter() as counter:
+    for i in xrange(passes):
+      samples.timed(lsR, fs, "/")
+  samples.stop()
+  benchutil.printSummary(samples.summary())
+  print "%-24s %8d stat/lstat/access/listdir calls" % (name, counter.count)
+  return counter.count
+
+def main():
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("--dirs", dest = "dirs", type = "int", default = 20,
+                    help = "number of directories [default: %default]")
+  parser.add_option("--files", dest = "files", type = "int", default = 100,
+                    help = "files per directory [default: %default]")
+  parser.add_option("--passes", dest = "passes", type = "int", default = 5,
+                    help = "number of ls -lR runs [default: %default]")
+  (options, args) = parser.parse_args()
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    root = os.path.join(tmpdir, "root")
+    for d in xrange(options.dirs):
+      os.makedirs(os.path.join(root, "dir%d" % d))
+      for f in xrange(options.files):
+        open(os.path.join(root, "dir%d" % d, "file%d" % f), "w").close()
+    database = os.path.join(tmpdir, "bench.db")
+    uncached = run("uncached", root, database, 0, options.passes)
+    cached = run("cached", root, database, 60, options.passes)
+    print "cached run made %.1f%% of the uncached syscalls" % (100.0 * cached / max(uncached, 1))
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,149 @@
+# Helpers shared by the fuse-sha1 benchmarks
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import json
+import math
+import os
+import platform
+import sys
+import time
+
+# the benchmarks live one directory below the fuse-sha1 modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+def percentile(samples, pct):
+  """Returns the pct'th percentile (0-100) of an already sorted list of samples."""
+  if not samples:
+    return 0.0
+  index = int(round((pct / 100.0) * (len(samples) - 1)))
+  return samples[index]
+
+class Samples:
+  """Collects per-operation latencies (in seconds) and bytes moved for one benchmark."""
+  def __init__(self, name):
+    self.name = name
+    self.latencies = []
+    self.nbytes = 0
+    self.started = time.time()
+    self.elapsed = None
+
+  def add(self, latency, nbytes=0):
+    self.latencies.append(latency)
+    self.nbytes += nbytes
+
+  def timed(self, func, *args):
+    """Calls func(*args), recording how long it took; returns its result."""
+    start = time.time()
+    result = func(*args)
+    self.latencies.append(time.time() - start)
+    return result
+
+  def stop(self):
+    self.elapsed = time.time() - self.started
+
+  def summary(self):
+    """Returns a dict with ops/sec, MB/s and latency percentiles (in milliseconds)."""
+    elapsed = self.elapsed
+    if None == elapsed:
+      elapsed = time.time() - self.started
+    elapsed = max(elapsed, 1e-9)
+    latencies = sorted(self.latencies)
+    return {
+      "name": self.name,
+      "ops": len(latencies),
+      "seconds": elapsed,
+      "ops_per_sec": len(latencies) / elapsed,
+      "mb_per_sec": self.nbytes / elapsed / (1 << 20),
+      "p50_ms": percentile(latencies, 50) * 1000,
+      "p99_ms": percentile(latencies, 99) * 1000,
+      "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+def printSummary(summary, out=sys.stdout):
+  out.write("%-24s %8d ops %10.1f ops/s %9.2f MB/s  p50 %8.3fms  p99 %8.3fms  max %8.3fms\n" % 
+    (summary["name"], summary["ops"], summary["ops_per_sec"], summary["mb_per_sec"],
+     summary["p50_ms"], summary["p99_ms"], summary["max_ms"]))
+
+def saveResults(path, summaries, **info):
+  """Writes the summaries of a run as JSON to path, along with info (e.g. the options) and where
+  and when it ran, for compareResults."""
+  with open(path, "w") as f:
+    json.dump({"time": time.time(), "host": platform.node(), "python": platform.python_version(),
+               "info": info, "results": summaries}, f, indent=2, sort_keys=True)
+
+def loadResults(path):
+  """Returns the summaries saved by saveResults, keyed by name."""
+  with open(path) as f:
+    return dict((summary["name"], summary) for summary in json.load(f)["results"])
+
+def compareResults(summaries, baseline, tolerance):
+  """Returns a message for every benchmark of summaries that did more than tolerance (a fraction)
+  fewer ops/sec than the same benchmark in baseline (as returned by loadResults).  Benchmarks
+  missing from either side are ignored."""
+  regressions = []
+  for summary in summaries:
+    before = baseline.get(summary["name"])
+    if None == before or before["ops_per_sec"] <= 0:
+      continue
+    change = summary["ops_per_sec"] / before["ops_per_sec"] - 1
+    if change < -tolerance:
+      regressions.append("%s: %.1f ops/s, %.1f%% below the baseline's %.1f ops/s" %
+                         (summary["name"], summary["ops_per_sec"], -change * 100,
+                          before["ops_per_sec"]))
+  return regressions
+
+def sizeDistribution(spec):
+  """Parses a file size distribution: a comma separated list of SIZE (always that size), MIN-MAX
+  (uniformly distributed) or lognormal:MEDIAN:SIGMA, each optionally followed by *WEIGHT (1 by
+  default) to mix them, e.g. "4K*80,64K-1M*15,lognormal:8M:1*5".  Returns a function that draws a
+  size using the random.Random it is given."""
+  from fusesha1util import parseSize
+  choices = []
+  for part in spec.split(","):
+    (dist, sep, weight) = part.strip().partition("*")
+    weight = float(weight) if sep else 1.0
+    if dist.startswith("lognormal:"):
+      (median, sigma) = dist[len("lognormal:"):].split(":")
+      (mu, sigma) = (math.log(parseSize(median)), float(sigma))
+      draw = lambda rand, mu=mu, sigma=sigma: int(rand.lognormvariate(mu, sigma))
+    elif "-" in dist:
+      (low, high) = [parseSize(size) for size in dist.split("-")]
+      draw = lambda rand, low=low, high=high: rand.randint(low, high)
+    else:
+      size = parseSize(dist)
+      draw = lambda rand, size=size: size
+    choices.append((weight, draw))
+  total = sum(weight for (weight, draw) in choices)
+  def sample(rand):
+    point = rand.random() * total
+    for (weight, draw) in choices:
+      point -= weight
+      if point < 0:
+        break
+    return draw(rand)
+  return sample
+
+def makeSha1FS(root, database, **options):
+  """Creates a Sha1FS serving root (an absolute path) with its checksums in database, without
+  mounting it, so benchmarks can call its operations directly.  options are set as attributes
+  before the database is opened, just like the command line options would be."""
+  from sha1fs import Sha1FS
+  fs = Sha1FS()
+  fs.root = os.path.abspath(root)
+  fs.database = database
+  for (name, value) in options.items():
+    setattr(fs, name, value)
+  fs.initDB()
+  return fs
+
+def writeFile(path, size, chunk=1 << 20):
+  """Creates path with size bytes of random data."""
+  with open(path, "wb") as f:
+    while size > 0:
+      f.write(os.urandom(min(chunk, size)))
+      size -= chunk
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Measures how Sha1FS scales with parallel clients by calling its operations from several threads
+# at once, the way the multithreaded FUSE loop does.  Each client repeatedly stats and reads whole
+# files; optionally a writer keeps rewriting a large file, so every release hashes it, to show
+# whether one slow release stalls everybody else.
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+
+import benchutil
+from fusesha1util import parseSize
+
+READ_SIZE = 128 * 1024
+
+def client(fs, paths, duration, getattrs, reads):
+  deadline = time.time() + duration
+  i = 0
+  while time.time() < deadline:
+    path = paths[i % len(paths)]
+    i += 1
+    getattrs.add(*timed(fs.getattr, path))
+    start = time.time()
+    fh = fs.open(path, os.O_RDONLY)
+    offset = 0
+    while True:
+      data = fs.read(path, READ_SIZE, offset, fh)
+      if not data:
+        break
+      offset += len(data)
+    fs.release(path, os.O_RDONLY, fh)
+    reads.add(time.time() - start, offset)
+
+def writer(fs, path, size, stop):
+  buf = os.urandom(READ_SIZE)
+  while not stop.is_set():
+    fh = fs.open(path, os.O_WRONLY)
+    for offset in xrange(0, size, READ_SIZE):
+      fs.write(path, buf, offset, fh)
+    fs.release(path, os.O_WRONLY, fh)
+
+def timed(func, *args):
+  start = time.time()
+  func(*args)
+  return (time.time() - start, )
+
+def run(fs, paths, threads, duration, writerPath, writerSize):
+  getattrs = benchutil.Samples("getattr x%d" % threads)
+  reads = benchutil.Samples("open+read+release x%d" % threads)
+  stop = threading.Event()
+  workers = [threading.Thread(target=client, args=(fs, paths, duration, getattrs, reads))
+             for t in xrange(threads)]
+  if None != writerPath:
+    background = threading.Thread(target=writer, args=(fs, writerPath, writerSize, stop))
+    background.start()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  getattrs.stop()
+  reads.stop()
+  stop.set()
+  if None != writerPath:
+    background.join()
+  benchutil.printSummary(getattrs.summary())
+  benchutil.printSummary(reads.summary())
+
+def main():
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("--files", dest = "files", type = "int", default = 200,
+                    help = "number of files to read [default: %default]")
+  parser.add_option("--size", dest = "size", default = "256K",
+                    help = "size of each file [default: %default]")
+  parser.add_option("--threads", dest = "threads", default = "1,2,4,8",
+                    help = "comma separated client thread counts [default: %default]")
+  parser.add_option("--duration", dest = "duration", type = "float", default = 5.0,
+                    help = "seconds per thread count [default: %default]")
+  parser.add_option("--writer-size", dest = "writerSize", default = "0",
+                    help = "size of a file rewritten (and re-hashed) in the background; 0 for no "
+                           "writer [default: %default]")
+  (options, args) = parser.parse_args()
+  size = parseSize(options.size)
+  writerSize = parseSize(options.writerSize)
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    root = os.path.join(tmpdir, "root")
+    os.mkdir(root)
+    paths = []
+    for i in xrange(options.files):
+      paths.append("/file%d" % i)
+      benchutil.writeFile(root + paths[-1], size)
+    writerPath = None
+    if writerSize > 0:
+      writerPath = "/writer"
+      benchutil.writeFile(root + writerPath, writerSize)
+
+    fs = benchutil.makeSha1FS(root, os.path.join(tmpdir, "bench.db"), rescan=True)
+    for threads in [int(t) for t in options.threads.split(",")]:
+      run(fs, paths, threads, options.duration, writerPath, writerSize)
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# Generates synthetic corpora for benchmarking Sha1DB at scale: a database with a files table of
+# any size and, for some or all of its entries, the files themselves under a root directory.
+# Files on disk are sparse (a short header making their contents unique, then a hole up to their
+# size), so a large tree takes little space, and the database holds their real checksums.
+#
+# Paths are spread over a randomly grown directory tree (--max-depth deep, about --files-per-dir
+# files per directory).  --dup-ratio of the files duplicate an earlier one; --hot-share of those are
+# copies of one of the --hot checksums (the empty file, licenses, icons...), picked so that a few of
+# them have very many copies, and the rest copy any earlier file.  --tree-fraction of the distinct
+# contents are written to disk, with all their copies; the other entries only exist in the database,
+# which keeps corpora of tens of millions of entries feasible.
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import array
+import hashlib
+import os
+import random
+import time
+
+from optparse import OptionParser
+
+import benchutil
+from fusesha1util import parseSize
+from sha1db import Sha1DB
+from sha1store import Entry, BACKENDS
+
+# entries inserted per transaction
+BATCH_SIZE = 10000
+EXTENSIONS = [".jpg", ".txt", ".c", ".h", ".mp3", ".pdf", ".html", ".png", ".py", ""]
+ZEROS = "\0" * (1 << 20)
+# entries were last verified and modified up to this many seconds ago
+MAX_AGE = 365 * 86400
+
+def addCorpusOptions(parser):
+  """Adds the options shaping a corpus (shared by corpus.py and scale_bench.py) to an OptionParser."""
+  parser.add_option("--sizes", dest = "sizes", default = "0*5,lognormal:4K:2*95",
+                    help = "file size distribution, as in fs_bench.py [default: %default]")
+  parser.add_option("--max-size", dest = "maxSize", default = "16M",
+                    help = "cap on the file sizes drawn [default: %default]")
+  parser.add_option("--dup-ratio", dest = "dupRatio", type = "float", default = 0.2,
+                    help = "fraction of files that duplicate an earlier one [default: %default]")
+  parser.add_option("--hot", dest = "hot", type = "int", default = 100,
+                    help = "number of hot checksums [default: %default]")
+  parser.add_option("--hot-share", dest = "hotShare", type = "float", default = 0.3,
+                    help = "fraction of the duplicates that copy a hot checksum [default: %default]")
+  parser.add_option("--files-per-dir", dest = "filesPerDir", type = "float", default = 20,
+                    help = "average number of files per directory [default: %default]")
+  parser.add_option("--max-depth", dest = "maxDepth", type = "int", default = 12,
+                    help = "maximum directory depth [default: %default]")
+  parser.add_option("--tree-fraction", dest = "treeFraction", type = "float", default = 1.0,
+                    help = "fraction of the distinct contents written to disk [default: %default]")
+  parser.add_option("--seed", dest = "seed", type = "int", default = 1,
+                    help = "random seed [default: %default]")
+  parser.add_option("--shards", dest = "shards", type = "int", default = 1,
+                    help = "number of database shards [default: %default]")
+  parser.add_option("--shard-depth", dest = "shardDepth", type = "int", default = None,
+                    help = "route entries by the first DEPTH components of their directory "
+                           "[default: the whole directory]", metavar = "DEPTH")
+  parser.add_option("--backend", dest = "backend", type = "choice", choices = BACKENDS,
+                    default = "sqlite", help = "database store backend [default: %default]")
+
+def corpusFromOptions(root, rows, options):
+  """Creates a Corpus of rows entries under root using the options added by addCorpusOptions."""
+  return Corpus(root, rows, benchutil.sizeDistribution(options.sizes), parseSize(options.maxSize),
+                options.dupRatio, options.hot, options.hotShare, options.filesPerDir,
+                options.maxDepth, options.treeFraction, options.seed)
+
+class Corpus:
+  """A synthetic set of rows files below root (see the top of the file for the model).  Contents
+  are numbered; a content's bytes are its number (as a header cut to its size) followed by zeros.
+  Only the size and whether it is on disk are kept per content, so memory grows by a few bytes per
+  entry, plus the checksums of the contents on disk."""
+  def __init__(self, root, rows, sizes, maxSize, dupRatio, hot, hotShare, filesPerDir, maxDepth,
+               treeFraction, seed):
+    self.root = os.path.abspath(root)
+    self.rows = rows
+    self.sizes = sizes
+    self.maxSize = maxSize
+    self.dupRatio = dupRatio
+    self.hot = hot
+    self.hotShare = hotShare
+    self.filesPerDir = filesPerDir
+    self.maxDepth = maxDepth
+    self.treeFraction = treeFraction
+    self.rand = random.Random(seed)
+    self.contentSizes = array.array("l")
+    self.onDisk = bytearray()
+    self.digests = {}
+    # the directories created on disk so far
+    self.made = set()
+    # what was generated
+    self.dirs = 0
+    self.files = 0
+    self.duplicates = 0
+    self.bytes = 0
+    # paths of a sample of the duplicates on disk, with their checksum, and of the directories
+    self.duplicateSample = []
+    self.dirSample = []
+    self.sampleSize = 1000
+
+  def generate(self, sha1db):
+    """Adds the entries to sha1db (a new database) and writes the files on disk.  The entries are
+    left out of the journal, so the database starts out with an empty journal, as if it had been
+    compacted, rather than spending half the time journaling."""
+    self.checksum = sha1db.checksum
+    for i in xrange(self.hot):
+      self._newContent(0 if 0 == i else None)
+    batch = []
+    for entry in self.entries():
+      batch.append(entry)
+      if len(batch) >= BATCH_SIZE:
+        sha1db.addEntries(batch, journal=False)
+        batch = []
+    sha1db.addEntries(batch, journal=False)
+
+  def entries(self):
+    """Yields every entry (an Entry), writing the files of those that are on disk as it goes."""
+    rand = self.rand
+    now = time.time()
+    dirs = [(self.root, 0)]
+    (directory, depth) = dirs[0]
+    for row in xrange(self.rows):
+      if rand.random() * self.filesPerDir < 1 or 0 == row:
+        (directory, depth) = self._newDirectory(dirs)
+      (content, duplicate) = self._pickContent()
+      path = "%s/f%x%s" % (directory, row, rand.choice(EXTENSIONS))
+      size = self.contentSizes[content]
+      mtime = now - rand.random() * MAX_AGE
+      if self.onDisk[content]:
+        self._write(path, content, size, mtime)
+      chksum = self._digest(content)
+      self.files += 1
+      self.bytes += size
+      if duplicate:
+        self.duplicates += 1
+        if self.onDisk[content]:
+          self._sample(self.duplicateSample, (path, chksum), self.duplicates)
+      yield Entry(path, chksum, last_verified=mtime + rand.random() * (now - mtime), size=size,
+                  mtime=mtime)
+
+  def _newDirectory(self, dirs):
+    (parent, depth) = self.rand.choice(dirs)
+    if depth >= self.maxDepth:
+      (parent, depth) = dirs[0]
+    dirs.append(("%s/d%x" % (parent, len(dirs)), depth + 1))
+    self.dirs += 1
+    self._sample(self.dirSample, dirs[-1][0], self.dirs)
+    return dirs[-1]
+
+  # Returns the number of the content of the next file and whether it is a copy: of a hot or any
+  # earlier content, or else a new one.  Hot contents are picked log-uniformly, so the first few get
+  # most of the copies
+  def _pickContent(self):
+    rand = self.rand
+    if len(self.contentSizes) > 0 and rand.random() < self.dupRatio:
+      if self.hot > 0 and rand.random() < self.hotShare:
+        return (int(self.hot ** rand.random()) - 1, True)
+      return (rand.randrange(len(self.contentSizes)), True)
+    return (self._newContent(), False)
+
+  def _newContent(self, size=None):
+    if None == size:
+      size = min(max(self.sizes(self.rand), 0), self.maxSize)
+    self.contentSizes.append(size)
+    self.onDisk.append(self.rand.random() < self.treeFraction)
+    return len(self.contentSizes) - 1
+
+  # The checksum of a content.  Those of contents on disk are the real ones, cached; the others
+  # have a made-up one, which nothing can tell apart
+  def _digest(self, content):
+    chksum = self.digests.get(content)
+    if None != chksum:
+      return chksum
+    size = self.contentSizes[content]
+    if not self.onDisk[content]:
+      return self.checksum("%d:%d" % (content, size)).hexdigest()
+    header = self._header(content, size)
+    digest = self.checksum(header)
+    remaining = size - len(header)
+    while remaining > 0:
+      digest.update(buffer(ZEROS, 0, min(remaining, len(ZEROS))))
+      remaining -= len(ZEROS)
+    chksum = self.digests[content] = digest.hexdigest()
+    return chksum
+
+  def _header(self, content, size):
+    return ("content %d\n" % content)[:size]
+
+  def _write(self, path, content, size, mtime):
+    directory = os.path.dirname(path)
+    if not directory in self.made:
+      os.makedirs(directory)
+      self.made.add(directory)
+    with open(path, "wb") as f:
+      f.write(self._header(content, size))
+      f.truncate(size)
+    os.utime(path, (mtime, mtime))
+
+  # Keeps a uniform sample of sampleSize of the count items seen so far (reservoir sampling)
+  def _sample(self, sample, item, count):
+    if len(sample) < self.sampleSize:
+      sample.append(item)
+    else:
+      index = self.rand.randrange(count)
+      if index < self.sampleSize:
+        sample[index] = item
+
+  def summary(self):
+    """Returns what was generated as a dict."""
+    return {"files": self.files, "dirs": self.dirs, "duplicates": self.duplicates,
+            "contents": len(self.contentSizes), "bytes": self.bytes,
+            "contents_on_disk": sum(1 for flag in self.onDisk if flag)}
+
+def main():
+  parser = OptionParser(usage = "%prog [options] DIR")
+  parser.add_option("--rows", dest = "rows", type = "int", default = 100000,
+                    help = "number of files [default: %default]")
+  parser.add_option("--md5", action = "store_true", dest = "useMd5", default = False,
+                    help = "create an MD5 database")
+  addCorpusOptions(parser)
+  (options, args) = parser.parse_args()
+  if 1 != len(args):
+    parser.error("DIR is required")
+  os.makedirs(args[0])
+  corpus = corpusFromOptions(os.path.join(args[0], "root"), options.rows, options)
+  started = time.time()
+  corpus.generate(Sha1DB(os.path.join(args[0], "corpus.db"), options.useMd5, shards=options.shards,
+                         shardDepth=options.shardDepth, backend=options.backend))
+  summary = corpus.summary()
+  print ("%(files)d files (%(duplicates)d duplicates; %(contents_on_disk)d of %(contents)d contents "
+         "on disk) in %(dirs)d directories, %(bytes)d bytes" % summary)
+  print "generated in %.1fs" % (time.time() - started)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# Benchmarks the Sha1FS operations behind everyday file handling: creating files (mknod, open, write
+# and release, which hashes them), getattr, readdir, rename and unlink.  Operations are called on a
+# Sha1FS serving a temp root, without a kernel mount, from several threads at once like the
+# multithreaded FUSE loop does; --mount repeats the workloads through a real mount where FUSE is
+# available.  Results can be saved as JSON (--save) and compared with a saved run (--baseline), in
+# which case falling more than --tolerance below the baseline's ops/sec fails the run.
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from optparse import OptionParser
+from stat import S_IFREG
+
+import benchutil
+from fusesha1util import parseSize
+
+WRITE_SIZE = 128 * 1024
+SHA1FS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sha1fs.py")
+MOUNT_TIMEOUT = 10.0
+
+def check(result):
+  """Raises the OSError for results that are negative errnos, the way FUSE would report them."""
+  if isinstance(result, int) and result < 0:
+    raise OSError(-result, os.strerror(-result))
+  return result
+
+class DirectOps:
+  """Calls the Sha1FS operations with the arguments the FUSE loop would pass."""
+  def __init__(self, fs):
+    self.fs = fs
+
+  def mkdir(self, path):
+    check(self.fs.mkdir(path, 0755))
+
+  def create(self, path, data):
+    check(self.fs.mknod(path, S_IFREG | 0644, 0))
+    fh = check(self.fs.open(path, os.O_WRONLY))
+    for offset in xrange(0, len(data), WRITE_SIZE):
+      check(self.fs.write(path, data[offset:offset + WRITE_SIZE], offset, fh))
+    check(self.fs.flush(path, fh))
+    check(self.fs.release(path, os.O_WRONLY, fh))
+
+  def getattr(self, path):
+    check(self.fs.getattr(path))
+
+  def readdir(self, path):
+    return sum(1 for entry in self.fs.readdir(path, 0))
+
+  def rename(self, old, new):
+    check(self.fs.rename(old, new))
+
+  def unlink(self, path):
+    check(self.fs.unlink(path))
+
+class MountOps:
+  """The same operations as system calls on the mount point."""
+  def __init__(self, mountpoint):
+    self.mountpoint = mountpoint
+
+  def mkdir(self, path):
+    os.mkdir(self.mountpoint + path)
+
+  def create(self, path, data):
+    fd = os.open(self.mountpoint + path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+    try:
+      for offset in xrange(0, len(data), WRITE_SIZE):
+        os.write(fd, data[offset:offset + WRITE_SIZE])
+    finally:
+      os.close(fd)
+
+  def getattr(self, path):
+    os.lstat(self.mountpoint + path)
+
+  def readdir(self, path):
+    return len(os.listdir(self.mountpoint + path))
+
+  def rename(self, old, new):
+    os.rename(self.mountpoint + old, self.mountpoint + new)
+
+  def unlink(self, path):
+    os.unlink(self.mountpoint + path)
+
+class Contents:
+  """Makes file contents of the sizes drawn from a distribution.  Every file gets different
+  contents (a counter followed by a slice of a random pool), so no two are duplicates."""
+  def __init__(self, sizes, maxSize):
+    self.sizes = sizes
+    self.maxSize = maxSize
+    self.pool = os.urandom(maxSize + (1 << 20))
+    self.counter = 0
+    self.lock = threading.Lock()
+
+  def make(self, rand):
+    size = min(max(self.sizes(rand), 0), self.maxSize)
+    with self.lock:
+      self.counter += 1
+      header = struct.pack(">Q", self.counter)
+    offset = rand.randint(0, len(self.pool) - size)
+    return (header + self.pool[offset:offset + size])[:size]
+
+# Each client thread works in a directory of its own; the phases below are run by all clients at
+# once, one phase at a time, and each phase gets its own Samples
+def phases(ops, contents, directory, files, rounds):
+  rand = random.Random(directory)
+  names = ["%s/file%d" % (directory, i) for i in xrange(files)]
+  moved = ["%s/moved%d" % (directory, i) for i in xrange(files)]
+  def create(samples):
+    for name in names:
+      data = contents.make(rand)
+      start = time.time()
+      ops.create(name, data)
+      samples.add(time.time() - start, len(data))
+  def getattr(samples):
+    for r in xrange(rounds):
+      for name in names:
+        samples.timed(ops.getattr, name)
+  def readdir(samples):
+    for r in xrange(rounds):
+      samples.timed(ops.readdir, directory)
+  def rename(samples):
+    for (old, new) in zip(names, moved):
+      samples.timed(ops.rename, old, new)
+  def unlink(samples):
+    for name in moved:
+      samples.timed(ops.unlink, name)
+  return [("create", create), ("getattr", getattr), ("readdir", readdir), ("rename", rename),
+          ("unlink", unlink)]
+
+def run(ops, mode, contents, threads, options):
+  """Runs every phase with threads clients; returns the summaries."""
+  directories = ["/bench-%s-%d-%d" % (mode, threads, t) for t in xrange(threads)]
+  for directory in directories:
+    ops.mkdir(directory)
+  clients = [phases(ops, contents, directory, options.files, options.rounds)
+             for directory in directories]
+  summaries = []
+  errors = []
+  for (index, (name, phase)) in enumerate(clients[0]):
+    samples = benchutil.Samples("%s x%d (%s)" % (name, threads, mode))
+    def client(phase):
+      try:
+        phase(samples)
+      except Exception, e:
+        errors.append(e)
+    workers = [threading.Thread(target=client, args=(steps[index][1], )) for steps in clients]
+    for worker in workers:
+      worker.start()
+    for worker in workers:
+      worker.join()
+    samples.stop()
+    if errors:
+      raise errors[0]
+    summaries.append(samples.summary())
+    benchutil.printSummary(summaries[-1])
+  return summaries
+
+def mount(root, database, mountpoint, workdir):
+  """Mounts a Sha1FS of root at mountpoint in a child process (with its LOG in workdir); returns
+  the process, or None if FUSE isn't available."""
+  if not os.path.exists("/dev/fuse"):
+    return None
+  process = subprocess.Popen([sys.executable, os.path.abspath(SHA1FS), "-f", "-o", "root=" + root,
+                              "--database=" + database, mountpoint], cwd=workdir)
+  deadline = time.time() + MOUNT_TIMEOUT
+  while not os.path.ismount(mountpoint):
+    if None != process.poll() or time.time() > deadline:
+      unmount(process, mountpoint)
+      return None
+    time.sleep(0.1)
+  return process
+
+def unmount(process, mountpoint):
+  if os.path.ismount(mountpoint):
+    subprocess.call(["fusermount", "-u", mountpoint])
+  if None == process.poll():
+    time.sleep(0.5)
+    if None == process.poll():
+      process.terminate()
+  process.wait()
+
+def main():
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("--files", dest = "files", type = "int", default = 200,
+                    help = "files each client creates, renames and deletes [default: %default]")
+  parser.add_option("--sizes", dest = "sizes", default = "4K*70,64K-1M*25,lognormal:1M:1*5",
+                    help = "file size distribution: comma separated SIZE, MIN-MAX or "
+                           "lognormal:MEDIAN:SIGMA, each optionally *WEIGHT [default: %default]")
+  parser.add_option("--max-size", dest = "maxSize", default = "64M",
+                    help = "cap on the file sizes drawn [default: %default]")
+  parser.add_option("--threads", dest = "threads", default = "1,4",
+                    help = "comma separated client thread counts [default: %default]")
+  parser.add_option("--rounds", dest = "rounds", type = "int", default = 5,
+                    help = "passes of getattr and readdir over each client's files [default: %default]")
+  parser.add_option("--attr-cache-ttl", dest = "attrCacheTtl", type = "float", default = None,
+                    help = "Sha1FS attribute cache TTL in seconds [default: Sha1FS's]")
+  parser.add_option("--mount", action = "store_true", dest = "mount", default = False,
+                    help = "also run the workloads through a FUSE mount, if FUSE is available")
+  parser.add_option("--dir", dest = "dir", default = None,
+                    help = "create the files in DIR [default: a temp dir]", metavar = "DIR")
+  parser.add_option("--save", dest = "save", default = None,
+                    help = "save the results as JSON to FILE", metavar = "FILE")
+  parser.add_option("--baseline", dest = "baseline", default = None,
+                    help = "fail if ops/sec fell more than --tolerance below the results saved in "
+                           "FILE", metavar = "FILE")
+  parser.add_option("--tolerance", dest = "tolerance", type = "float", default = 0.2,
+                    help = "fraction ops/sec may fall below the baseline [default: %default]")
+  (options, args) = parser.parse_args()
+  sizes = benchutil.sizeDistribution(options.sizes)
+  contents = Contents(sizes, parseSize(options.maxSize))
+  threadCounts = [int(t) for t in options.threads.split(",")]
+
+  summaries = []
+  tmpdir = tempfile.mkdtemp(dir = options.dir)
+  try:
+    root = os.path.join(tmpdir, "root")
+    os.mkdir(root)
+    fsOptions = {}
+    if None != options.attrCacheTtl:
+      fsOptions["attrCacheTtl"] = options.attrCacheTtl
+    fs = benchutil.makeSha1FS(root, os.path.join(tmpdir, "bench.db"), **fsOptions)
+    for threads in threadCounts:
+      summaries.extend(run(DirectOps(fs), "direct", contents, threads, options))
+
+    if options.mount:
+      mountpoint = os.path.join(tmpdir, "mnt")
+      os.mkdir(mountpoint)
+      process = mount(root, os.path.join(tmpdir, "mount.db"), mountpoint, tmpdir)
+      if None == process:
+        print >> sys.stderr, "FUSE isn't available here; skipping the mounted runs"
+      else:
+        try:
+          for threads in threadCounts:
+            summaries.extend(run(MountOps(mountpoint), "mount", contents, threads, options))
+        finally:
+          unmount(process, mountpoint)
+  finally:
+    shutil.rmtree(tmpdir)
+
+  if None != options.save:
+    benchutil.saveResults(options.save, summaries, **vars(options))
+  if None != options.baseline:
+    regressions = benchutil.compareResults(summaries, benchutil.loadResults(options.baseline),
+                                           options.tolerance)
+    for regression in regressions:
+      print >> sys.stderr, "REGRESSION %s" % regression
+    if regressions:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Read/write throughput of the Sha1FS file handle (pread/pwrite on a raw descriptor) compared with
+# the old seek + read/write on a Python file object, without going through the kernel.
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import shutil
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import benchutil
+from fusesha1util import parseSize
+from sha1fs import Sha1Handle
+
+# the old Sha1FS.read/write, for comparison
+def fileRead(fobj, size, offset):
+  fobj.seek(offset)
+  return fobj.read(size)
+
+def fileWrite(fobj, buf, offset):
+  fobj.seek(offset)
+  fobj.write(buf)
+  return len(buf)
+
+def run(name, op, chunk, size, rounds):
+  """Calls op(offset) for every chunk of the file, rounds times over.  op returns the number of
+  bytes it moved."""
+  samples = benchutil.Samples(name)
+  for r in xrange(rounds):
+    for offset in xrange(0, size, chunk):
+      start = time.time()
+      nbytes = op(offset)
+      samples.add(time.time() - start, nbytes)
+  samples.stop()
+  benchutil.printSummary(samples.summary())
+
+def main():
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("--size", dest = "size", default = "64M", 
+                    help = "size of the test file [default: %default]")
+  parser.add_option("--chunk", dest = "chunk", default = "128K",
+                    help = "bytes per read/write request, as FUSE would send them [default: %default]")
+  parser.add_option("--rounds", dest = "rounds", type = "int", default = 5,
+                    help = "passes over the file per benchmark [default: %default]")
+  parser.add_option("--dir", dest = "dir", default = None,
+                    help = "create the test file in DIR [default: a temp dir]", metavar = "DIR")
+  (options, args) = parser.parse_args()
+  size = parseSize(options.size)
+  chunk = parseSize(options.chunk)
+
+  tmpdir = tempfile.mkdtemp(dir = options.dir)
+  try:
+    path = os.path.join(tmpdir, "bench.dat")
+    with open(path, "wb") as f:
+      f.write(os.urandom(size))
+    buf = os.urandom(chunk)
+
+    with os.fdopen(os.open(path, os.O_RDWR), "r+b") as fobj:
+      run("file object read", lambda offset: len(fileRead(fobj, chunk, offset)), 
+          chunk, size, options.rounds)
+      run("file object write", lambda offset: fileWrite(fobj, buf, offset), 
+          chunk, size, options.rounds)
+
+    fh = Sha1Handle(os.open(path, os.O_RDWR), os.O_RDWR)
+    try:
+      run("Sha1Handle read", lambda offset: len(fh.read(chunk, offset)), 
+          chunk, size, options.rounds)
+      run("Sha1Handle write", lambda offset: fh.write(buf, offset), 
+          chunk, size, options.rounds)
+    finally:
+      fh.close()
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
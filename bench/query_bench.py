@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# Load test for the query socket: fills a database with synthetic entries, serves it with a
+# QueryServer and has several client processes fire batched checksum lookups at it, reporting batch
+# latencies and lookups/sec.  --direct runs the same lookups against the database file from each
+# client instead, which is what the socket is meant to replace.  Clients are separate processes,
+# like the services using the socket would be, so they don't compete with the server for the GIL.
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import hashlib
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import benchutil
+from sha1db import Sha1DB
+from sha1store import Entry
+from sha1query import QueryServer, QueryClient
+
+def populate(sha1db, entries, copies):
+  """Adds entries rows (with copies paths per checksum) for files that don't exist; returns the
+  checksums."""
+  chksums = [hashlib.sha1(str(i)).hexdigest() for i in xrange(entries // copies)]
+  now = time.time()
+  sha1db.addEntries(Entry("/bench/%d/file%d" % (copy, i), chksum, last_verified=now, size=0,
+                          mtime=now)
+                    for (i, chksum) in enumerate(chksums) for copy in xrange(copies))
+  return chksums
+
+def batches(chksums, batch, hitRatio, duration):
+  """Yields batches of checksums to look up until duration runs out; about hitRatio of them exist."""
+  deadline = time.time() + duration
+  rand = random.Random()
+  while time.time() < deadline:
+    yield [rand.choice(chksums) if rand.random() < hitRatio else "%040x" % rand.getrandbits(160)
+           for i in xrange(batch)]
+
+# The clients run in their own processes and send their batch latencies back through results
+def socketClient(path, chksums, options, results):
+  samples = benchutil.Samples("socket")
+  with QueryClient(path) as client:
+    for keys in batches(chksums, options.batch, options.hitRatio, options.duration):
+      samples.timed(client.checksums, keys)
+  results.put(samples.latencies)
+
+def directClient(database, chksums, options, results):
+  samples = benchutil.Samples("direct")
+  sha1db = Sha1DB(database)
+  for keys in batches(chksums, options.batch, options.hitRatio, options.duration):
+    samples.timed(sha1db.entriesForChecksums, keys)
+  results.put(samples.latencies)
+
+def run(name, target, args, clients, batch):
+  samples = benchutil.Samples("%s x%d" % (name, clients))
+  results = multiprocessing.Queue()
+  workers = [multiprocessing.Process(target=target, args=args + (results, )) 
+             for c in xrange(clients)]
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    samples.latencies.extend(results.get())
+  for worker in workers:
+    worker.join()
+  samples.stop()
+  summary = samples.summary()
+  summary["name"] = "%s (batches)" % summary["name"]
+  benchutil.printSummary(summary)
+  print "%-24s %10.0f lookups/s" % ("", summary["ops_per_sec"] * batch)
+
+def main():
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("--entries", dest = "entries", type = "int", default = 200000,
+                    help = "number of database entries [default: %default]")
+  parser.add_option("--copies", dest = "copies", type = "int", default = 2,
+                    help = "paths per checksum [default: %default]")
+  parser.add_option("--batch", dest = "batch", type = "int", default = 100,
+                    help = "checksums per request [default: %default]")
+  parser.add_option("--hit-ratio", dest = "hitRatio", type = "float", default = 0.5,
+                    help = "fraction of lookups for checksums that exist [default: %default]")
+  parser.add_option("--clients", dest = "clients", default = "1,4,16",
+                    help = "comma separated client process counts [default: %default]")
+  parser.add_option("--duration", dest = "duration", type = "float", default = 5.0,
+                    help = "seconds per client count [default: %default]")
+  parser.add_option("--direct", action = "store_true", dest = "direct", default = False,
+                    help = "also query the database directly from every client, for comparison")
+  (options, args) = parser.parse_args()
+
+  tmpdir = tempfile.mkdtemp()
+  try:
+    database = os.path.join(tmpdir, "bench.db")
+    sha1db = Sha1DB(database)
+    chksums = populate(sha1db, options.entries, options.copies)
+    path = os.path.join(tmpdir, "query.sock")
+    server = QueryServer(path, sha1db)
+    server.start()
+    for clients in [int(c) for c in options.clients.split(",")]:
+      run("socket", socketClient, (path, chksums, options), clients, options.batch)
+      if options.direct:
+        run("direct", directClient, (database, chksums, options), clients, options.batch)
+    server.stop()
+  finally:
+    shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+  main()
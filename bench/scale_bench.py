@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# How Sha1DB scales with the number of files: for each --rows count, generates a corpus (see
+# corpus.py) and times opening the database, updatePath (renaming directories), _hardlinkDup on
+# duplicates, vacuum, updateAllChecksums over the tree, the duplicate report (its first page of
+# groups, and the whole directory rollup) and dedup, in that order, each working on what the
+# previous ones left behind.  Records the database size and the peak RSS, and at the end
+# prints how each operation's time grew with the row count (an exponent of 1 is linear).
+#
+# Every row count runs in a process of its own, so that the peak RSS is its own.  Logging is turned
+# down to warnings, so the LOG doesn't get a line per file.  --shards and --shard-depth split the
+# database (see sha1shard.py), and --backend picks its store (see sha1store.py), to compare layouts
+# at the same row counts.
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+
+from optparse import OptionParser
+
+import benchutil
+from corpus import addCorpusOptions, corpusFromOptions
+from sha1db import Sha1DB
+
+# how many times the database is opened, how many directory renames are timed, and how many times
+# the first page of REPORT_PAGE duplicate groups is read
+OPENS = 5
+RENAMES = 20
+REPORT_PAGES = 5
+REPORT_PAGE = 100
+
+def databaseBytes(database):
+  """Returns the size of database, with its shards and their WAL and shared memory files."""
+  directory = os.path.dirname(database)
+  return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+             if name.startswith(os.path.basename(database)))
+
+def peakRssMb():
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# Runs the benchmarks for one row count, in a process of its own; puts the summaries on results
+def measure(rows, options, results):
+  logging.getLogger().setLevel(logging.WARNING)
+  summaries = []
+  def record(samples, ops=None):
+    samples.stop()
+    summary = samples.summary()
+    summary["calls"] = summary["ops"]
+    if None != ops:
+      # operations that work through many files are timed once and counted per file
+      summary["ops"] = ops
+      summary["ops_per_sec"] = ops / max(summary["seconds"], 1e-9)
+    summary.update({"rows": rows, "db_mb": databaseBytes(database) / float(1 << 20),
+                    "rss_mb": peakRssMb()})
+    summaries.append(summary)
+    benchutil.printSummary(summary)
+
+  tmpdir = tempfile.mkdtemp(dir = options.dir)
+  try:
+    database = os.path.join(tmpdir, "corpus.db")
+    corpus = corpusFromOptions(os.path.join(tmpdir, "root"), rows, options)
+    samples = benchutil.Samples("generate @%d" % rows)
+    samples.timed(corpus.generate, Sha1DB(database, shards=options.shards,
+                                          shardDepth=options.shardDepth, backend=options.backend))
+    record(samples, rows)
+
+    samples = benchutil.Samples("open @%d" % rows)
+    for i in xrange(OPENS):
+      sha1db = samples.timed(Sha1DB, database)
+    record(samples)
+
+    samples = benchutil.Samples("updatePath @%d" % rows)
+    for directory in corpus.dirSample[:RENAMES]:
+      samples.timed(sha1db.updatePath, directory + "/", directory + ".moved/")
+      sha1db.updatePath(directory + ".moved/", directory + "/")
+    record(samples)
+
+    samples = benchutil.Samples("_hardlinkDup @%d" % rows)
+    for (path, chksum) in corpus.duplicateSample:
+      with sha1db._transactions() as transactions:
+        samples.timed(sha1db._hardlinkDup, path, chksum, transactions)
+    record(samples)
+
+    samples = benchutil.Samples("vacuum @%d" % rows)
+    samples.timed(sha1db.vacuum)
+    record(samples, rows)
+
+    samples = benchutil.Samples("updateAllChecksums @%d" % rows)
+    samples.timed(sha1db.updateAllChecksums, corpus.root)
+    record(samples, corpus.summary()["files"])
+
+    samples = benchutil.Samples("duplicateGroups @%d" % rows)
+    for i in xrange(REPORT_PAGES):
+      samples.timed(lambda: list(itertools.islice(sha1db.duplicateGroups(), REPORT_PAGE)))
+    record(samples)
+
+    samples = benchutil.Samples("duplicatesByDirectory @%d" % rows)
+    samples.timed(sha1db.duplicatesByDirectory)
+    record(samples, rows)
+
+    samples = benchutil.Samples("dedup @%d" % rows)
+    samples.timed(sha1db.dedup, os.path.join(tmpdir, "dups"), False)
+    record(samples, rows)
+  except:
+    # let the parent know rather than have it wait forever
+    results.put(None)
+    raise
+  finally:
+    shutil.rmtree(tmpdir)
+  results.put(summaries)
+
+def printScaling(summaries):
+  """Prints, per operation, the exponent k of (time per call) ~ rows ** k between consecutive row
+  counts: 0 for calls that take as long however big the database, 1 for ones that grow linearly."""
+  byOp = {}
+  for summary in summaries:
+    byOp.setdefault(summary["name"].split(" @")[0], []).append(summary)
+  print
+  print "scaling exponents of the time per call"
+  for (op, runs) in sorted(byOp.iteritems()):
+    steps = []
+    for (before, after) in zip(runs, runs[1:]):
+      (perCallBefore, perCallAfter) = [run["seconds"] / max(run["calls"], 1) for run in (before, after)]
+      if perCallBefore > 0 and perCallAfter > 0 and after["rows"] != before["rows"]:
+        steps.append("%d->%d: %.2f" % (before["rows"], after["rows"],
+          math.log(perCallAfter / perCallBefore) / math.log(float(after["rows"]) / before["rows"])))
+    print "%-20s %s" % (op, "  ".join(steps))
+
+def main():
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("--rows", dest = "rows", default = "10000,100000,1000000",
+                    help = "comma separated row counts [default: %default]")
+  parser.add_option("--dir", dest = "dir", default = None,
+                    help = "create the corpora in DIR [default: a temp dir]", metavar = "DIR")
+  parser.add_option("--save", dest = "save", default = None,
+                    help = "save the results as JSON to FILE", metavar = "FILE")
+  parser.add_option("--baseline", dest = "baseline", default = None,
+                    help = "fail if ops/sec fell more than --tolerance below the results saved in "
+                           "FILE", metavar = "FILE")
+  parser.add_option("--tolerance", dest = "tolerance", type = "float", default = 0.2,
+                    help = "fraction ops/sec may fall below the baseline [default: %default]")
+  addCorpusOptions(parser)
+  (options, args) = parser.parse_args()
+
+  summaries = []
+  for rows in [int(r) for r in options.rows.split(",")]:
+    results = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=measure, args=(rows, options, results))
+    worker.start()
+    measured = results.get()
+    worker.join()
+    if None == measured:
+      sys.exit("Benchmarking %d rows failed" % rows)
+    summaries.extend(measured)
+  for summary in summaries:
+    print "%-28s %10.1f MB database %10.1f MB peak RSS" % (summary["name"], summary["db_mb"],
+                                                           summary["rss_mb"])
+  printScaling(summaries)
+
+  if None != options.save:
+    benchutil.saveResults(options.save, summaries, **vars(options))
+  if None != options.baseline:
+    regressions = benchutil.compareResults(summaries, benchutil.loadResults(options.baseline),
+                                           options.tolerance)
+    for regression in regressions:
+      print >> sys.stderr, "REGRESSION %s" % regression
+    if regressions:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Compares the Sha1DB store backends (see sha1store.py) on the same synthetic entries: ingest, both
+# in --batch sized transactions and one entry per transaction (the way files are added while
+# mounted), lookups of single paths and checksums, and reopening the database, which for the log
+# means reading it back into memory.  Prints ops/sec and latency percentiles per backend, and the
+# size of each database.
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from optparse import OptionParser
+
+import benchutil
+from sha1db import Sha1DB
+from sha1store import Entry, BACKENDS
+
+# how many times each database is reopened
+OPENS = 3
+
+def entries(count, copies, prefix="/bench"):
+  """Yields count entries spread over directories of 100 files, with copies paths per checksum."""
+  now = time.time()
+  for i in xrange(count):
+    yield Entry("%s/d%d/f%d" % (prefix, i // 100, i), hashlib.sha1(str(i // copies)).hexdigest(),
+                last_verified=now, size=i, mtime=now)
+
+def measure(backend, options, tmpdir):
+  """Runs every benchmark against a new database of backend; returns their summaries."""
+  summaries = []
+  database = os.path.join(tmpdir, "%s.db" % backend)
+  def record(samples, ops=None):
+    samples.stop()
+    summary = samples.summary()
+    if None != ops:
+      # batches are timed once and counted per entry
+      summary["ops"] = ops
+      summary["ops_per_sec"] = ops / max(summary["seconds"], 1e-9)
+    summaries.append(summary)
+    benchutil.printSummary(summary)
+
+  sha1db = Sha1DB(database, backend=backend)
+  samples = benchutil.Samples("ingest batched/%s" % backend)
+  batch = []
+  for entry in entries(options.entries, options.copies):
+    batch.append(entry)
+    if len(batch) >= options.batch:
+      samples.timed(sha1db.addEntries, batch)
+      batch = []
+  samples.timed(sha1db.addEntries, batch)
+  record(samples, options.entries)
+
+  samples = benchutil.Samples("ingest commits/%s" % backend)
+  for entry in entries(options.commits, options.copies, "/single"):
+    samples.timed(sha1db.addEntries, [entry])
+  record(samples)
+
+  rand = random.Random(options.seed)
+  samples = benchutil.Samples("getChecksum/%s" % backend)
+  for i in xrange(options.lookups):
+    n = rand.randrange(options.entries)
+    samples.timed(sha1db.getChecksum, "/bench/d%d/f%d" % (n // 100, n))
+  record(samples)
+
+  samples = benchutil.Samples("pathsForChecksum/%s" % backend)
+  for i in xrange(options.lookups):
+    chksum = hashlib.sha1(str(rand.randrange(options.entries // options.copies))).hexdigest()
+    samples.timed(sha1db.pathsForChecksum, chksum)
+  record(samples)
+
+  sha1db.flush()
+  sha1db.close()
+  samples = benchutil.Samples("open/%s" % backend)
+  for i in xrange(OPENS):
+    sha1db = samples.timed(Sha1DB, database)
+    sha1db.getChecksum("/bench/d0/f0")
+    sha1db.close()
+  record(samples)
+
+  size = sum(os.path.getsize(os.path.join(tmpdir, name)) for name in os.listdir(tmpdir)
+             if name.startswith(os.path.basename(database)))
+  print "%-24s %10.1f MB" % ("size/%s" % backend, size / float(1 << 20))
+  return summaries
+
+def main():
+  parser = OptionParser(usage = "%prog [options]")
+  parser.add_option("--backends", dest = "backends", default = ",".join(BACKENDS),
+                    help = "comma separated backends to compare [default: %default]")
+  parser.add_option("--entries", dest = "entries", type = "int", default = 200000,
+                    help = "number of entries ingested in batches [default: %default]")
+  parser.add_option("--batch", dest = "batch", type = "int", default = 1000,
+                    help = "entries per batch [default: %default]")
+  parser.add_option("--commits", dest = "commits", type = "int", default = 2000,
+                    help = "entries then ingested one per transaction [default: %default]")
+  parser.add_option("--copies", dest = "copies", type = "int", default = 2,
+                    help = "paths per checksum [default: %default]")
+  parser.add_option("--lookups", dest = "lookups", type = "int", default = 20000,
+                    help = "lookups of each kind [default: %default]")
+  parser.add_option("--seed", dest = "seed", type = "int", default = 1,
+                    help = "random seed [default: %default]")
+  parser.add_option("--dir", dest = "dir", default = None,
+                    help = "create the databases in DIR [default: a temp dir]", metavar = "DIR")
+  parser.add_option("--save", dest = "save", default = None,
+                    help = "save the results as JSON to FILE", metavar = "FILE")
+  parser.add_option("--baseline", dest = "baseline", default = None,
+                    help = "fail if ops/sec fell more than --tolerance below the results saved in "
+                           "FILE", metavar = "FILE")
+  parser.add_option("--tolerance", dest = "tolerance", type = "float", default = 0.2,
+                    help = "fraction ops/sec may fall below the baseline [default: %default]")
+  (options, args) = parser.parse_args()
+  backends = options.backends.split(",")
+  for backend in backends:
+    if not backend in BACKENDS:
+      parser.error("unknown backend %s" % backend)
+  logging.getLogger().setLevel(logging.WARNING)
+
+  summaries = []
+  tmpdir = tempfile.mkdtemp(dir = options.dir)
+  try:
+    for backend in backends:
+      summaries.extend(measure(backend, options, tmpdir))
+  finally:
+    shutil.rmtree(tmpdir)
+
+  if None != options.save:
+    benchutil.saveResults(options.save, summaries, **vars(options))
+  if None != options.baseline:
+    regressions = benchutil.compareResults(summaries, benchutil.loadResults(options.baseline),
+                                           options.tolerance)
+    for regression in regressions:
+      print >> sys.stderr, "REGRESSION %s" % regression
+    if regressions:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
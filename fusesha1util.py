@@ -9,22 +9,186 @@
 import hashlib
 import logging
 import os
+import threading
+import time
 
+from collections import OrderedDict
 from contextlib import contextmanager
+from errno import ERANGE, ENOTSUP
 from pysqlite2 import dbapi2 as sqlite
 
+import sha1trace
+import sha1profile
+
 LOG_FILENAME = "LOG"
 logging.basicConfig(filename=LOG_FILENAME,level=logging.WARN,)
 
-def fileChecksum(path, checksum_func=hashlib.sha1):
+# posix_fadvise(2) advice values.  These are the Linux values; os only exposes them from Python 3.3 on
+POSIX_FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", 2)
+POSIX_FADV_DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", 4)
+
+# libc via ctypes, for the few syscalls the os module of older Pythons doesn't expose
+try:
+  import ctypes
+  import ctypes.util
+  _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except (ImportError, OSError):
+  _libc = None
+
+# Returns the named libc function, or None if it (or libc itself) isn't available
+def _libcFunc(name, argtypes, restype=None):
+  func = getattr(_libc, name, None)
+  if None != func:
+    func.argtypes = argtypes
+    if None != restype:
+      func.restype = restype
+  return func
+
+_posixFadvise = getattr(os, "posix_fadvise", None)
+if None == _posixFadvise and None != _libc:
+  _posixFadvise = _libcFunc("posix_fadvise", 
+    [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int])
+
+_pread = None
+_pwrite = None
+if not hasattr(os, "pread") and None != _libc:
+  _pread = _libcFunc("pread64", 
+    [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_longlong], ctypes.c_ssize_t)
+  _pwrite = _libcFunc("pwrite64", 
+    [ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_longlong], ctypes.c_ssize_t)
+
+# extended attributes; os has these from Python 3.3 on.  The l* variants don't follow symlinks
+_lgetxattr = None
+_llistxattr = None
+_lsetxattr = None
+_lremovexattr = None
+if not hasattr(os, "getxattr") and None != _libc:
+  _lgetxattr = _libcFunc("lgetxattr", 
+    [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t], ctypes.c_ssize_t)
+  _llistxattr = _libcFunc("llistxattr", 
+    [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t], ctypes.c_ssize_t)
+  _lsetxattr = _libcFunc("lsetxattr", 
+    [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int], ctypes.c_int)
+  _lremovexattr = _libcFunc("lremovexattr", [ctypes.c_char_p, ctypes.c_char_p], ctypes.c_int)
+
+def fadvise(fd, offset, length, advice):
+  '''Passes an access pattern hint for the open file descriptor fd to the kernel.  This is only
+  a hint, so it silently does nothing on platforms without posix_fadvise.
+  '''
+  if None != _posixFadvise:
+    try:
+      _posixFadvise(fd, offset, length, advice)
+    except OSError:
+      pass
+
+def _raiseErrno():
+  errno = ctypes.get_errno()
+  raise OSError(errno, os.strerror(errno))
+
+def pread(fd, size, offset):
+  '''Reads up to size bytes from fd at offset without moving the file position, so concurrent 
+  reads on the same descriptor don't interfere.  Uses os.pread where available and libc otherwise.
+  '''
+  if hasattr(os, "pread"):
+    return os.pread(fd, size, offset)
+  if None == _pread:
+    # no way to do a positioned read here; fall back to seeking, which is not thread safe
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+  buf = ctypes.create_string_buffer(size)
+  count = _pread(fd, buf, size, offset)
+  if count < 0:
+    _raiseErrno()
+  return ctypes.string_at(buf, count)
+  
+def pwrite(fd, data, offset):
+  '''Writes data to fd at offset without moving the file position, returning the number of bytes
+  written (which may be less than len(data)).  See pread.
+  '''
+  if hasattr(os, "pwrite"):
+    return os.pwrite(fd, data, offset)
+  if None == _pwrite:
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+  count = _pwrite(fd, data, len(data), offset)
+  if count < 0:
+    _raiseErrno()
+  return count
+
+def _xattrUnsupported():
+  raise OSError(ENOTSUP, os.strerror(ENOTSUP))
+
+# Calls one of the sizing libc xattr functions (lgetxattr, llistxattr) with args, asking for the 
+# size first, and returns the data.  Tries again if the value grows in between.
+def _xattrBuffer(func, *args):
+  while True:
+    size = func(*(args + (None, 0)))
+    if size < 0:
+      _raiseErrno()
+    buf = ctypes.create_string_buffer(max(size, 1))
+    count = func(*(args + (buf, size)))
+    if count >= 0:
+      return buf.raw[:count]
+    if ctypes.get_errno() != ERANGE:
+      _raiseErrno()
+
+def getxattr(path, name):
+  '''Returns the value of the extended attribute name of path, without following symlinks.  Raises
+  OSError if there is no such attribute (ENODATA) or the platform has no xattrs (ENOTSUP).
+  '''
+  if hasattr(os, "getxattr"):
+    return os.getxattr(path, name, follow_symlinks=False)
+  if None == _lgetxattr:
+    _xattrUnsupported()
+  return _xattrBuffer(_lgetxattr, path, name)
+
+def listxattr(path):
+  '''Returns the names of the extended attributes of path, without following symlinks.'''
+  if hasattr(os, "listxattr"):
+    return os.listxattr(path, follow_symlinks=False)
+  if None == _llistxattr:
+    _xattrUnsupported()
+  return [name for name in _xattrBuffer(_llistxattr, path).split("\0") if name]
+
+def setxattr(path, name, value, flags=0):
+  '''Sets the extended attribute name of path to value, without following symlinks.  flags are
+  XATTR_CREATE/XATTR_REPLACE, as for setxattr(2).
+  '''
+  if hasattr(os, "setxattr"):
+    return os.setxattr(path, name, value, flags, follow_symlinks=False)
+  if None == _lsetxattr:
+    _xattrUnsupported()
+  if _lsetxattr(path, name, value, len(value), flags) < 0:
+    _raiseErrno()
+
+def removexattr(path, name):
+  '''Removes the extended attribute name from path, without following symlinks.'''
+  if hasattr(os, "removexattr"):
+    return os.removexattr(path, name, follow_symlinks=False)
+  if None == _lremovexattr:
+    _xattrUnsupported()
+  if _lremovexattr(path, name) < 0:
+    _raiseErrno()
+
+def fileChecksum(path, checksum_func=hashlib.sha1, dropCache=False, throttle=None):
   '''Returns a hash for the file located at the given path.
 
     path - The path to the file
     checksum_func - the checksum function to call.  Defaults to hashlib.sha1.
+    dropCache - if True, the file is read with a sequential access hint and its pages are dropped
+      from the page cache once hashed, so bulk scans don't evict everybody else's working set.
+    throttle - if given, called with the size of every chunk read so that the caller can rate 
+      limit the hashing (e.g. by sleeping).
   '''
   if None == path:
     raise IOError("fileChecksum requires a path to be specified")
+  tracer = sha1trace.tracer
+  if None != tracer:
+    started = time.time()
+    nbytes = 0
   with open(path, 'rb') as fobj:
+    if dropCache:
+      fadvise(fobj.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
     m = checksum_func()
     chunksize = 128 * m.block_size
     while True:
@@ -32,8 +196,39 @@ def fileChecksum(path, checksum_func=hashlib.sha1):
       if not d:
         break
       m.update(d)
-    return m.hexdigest()
+      if None != throttle:
+        if None != tracer:
+          # time spent throttled isn't hashing
+          paused = time.time()
+          throttle(len(d))
+          started += time.time() - paused
+        else:
+          throttle(len(d))
+      if None != tracer:
+        nbytes += len(d)
+    if dropCache:
+      fadvise(fobj.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+  if None != tracer:
+    tracer.category(sha1trace.HASH, time.time() - started, nbytes)
+  return m.hexdigest()
  
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+def parseSize(size):
+  '''Returns the number of bytes for a human readable size such as "512", "64K", "10M" or "1.5G"
+  (binary multiples).  Raises ValueError if size can't be parsed.
+  '''
+  if None == size:
+    raise ValueError("parseSize requires a size to be specified")
+  size = str(size).strip().upper()
+  if size.endswith("B"):
+    size = size[:-1]
+  multiplier = 1
+  if size and size[-1] in SIZE_SUFFIXES:
+    multiplier = SIZE_SUFFIXES[size[-1]]
+    size = size[:-1]
+  return int(float(size) * multiplier)
+  
 def safeMakedirs(path):
   """Checks the parent of the path (via dirname) and makes sure it exists by calling os.makedirs.
   Returns the parent directory name."""
@@ -153,12 +348,190 @@ op succeeds or rolled back if it does not.  Can be used with the Python 'with' k
       if cursor != None:
         cursor.close()
 
-# Wraps a code block so that if an exception occurs, it is logged
-class ewrap:
+class ThreadConnections:
+  """Keeps one open SQLite connection per thread for a database file, so that a multithreaded
+  filesystem neither shares connections between threads nor pays for opening the database on every
+  operation.  cursor() has the same commit/rollback semantics as sqliteConn."""
+  def __init__(self, database):
+    self.database = database
+    self._local = threading.local()
+    # every thread's connection, so that close can close them all (FUSE worker threads never get
+    # the chance to close their own); they are only ever used by the thread that opened them
+    self._connections = set()
+    self._connectionsLock = threading.Lock()
+    # bumped by close, so that a thread whose connection was closed opens a new one
+    self._generation = 0
+    # transactions that changed something, committed on any thread, for the stats
+    self.commits = 0
+    self._commitsLock = threading.Lock()
+
+  def connection(self):
+    """Returns the calling thread's connection, opening it on first use."""
+    (connection, generation) = getattr(self._local, "connection", (None, None))
+    if None == connection or generation != self._generation:
+      connection = sqlite.connect(self.database, timeout=30.0, check_same_thread=False)
+      try:
+        # lets readers carry on while another thread holds the write lock.  With WAL, normal
+        # sync can only lose the last few commits on power loss (never corrupt the database),
+        # and saves an fsync per commit, which otherwise serializes every release
+        connection.execute("pragma journal_mode=wal;")
+        connection.execute("pragma synchronous=normal;")
+      except sqlite.DatabaseError as einst:
+        logging.warn("Unable to use WAL journaling for %s: %s" % (self.database, einst))
+      with self._connectionsLock:
+        self._connections.add(connection)
+        self._local.connection = (connection, self._generation)
+    return connection
+
+  def close(self):
+    """Closes every thread's connection.  No other thread may be using the database meanwhile; 
+    threads that use it afterwards open a new connection."""
+    with self._connectionsLock:
+      connections = self._connections
+      self._connections = set()
+      self._generation += 1
+    for connection in connections:
+      connection.close()
+
+  @contextmanager
+  def cursor(self):
+    """Provides a cursor on the calling thread's connection, committing if the block succeeds
+    and rolling back if it raises.  Can be used with the Python 'with' keyword."""
+    connection = self.connection()
+    cursor = connection.cursor()
+    changes = connection.total_changes
+    tracer = sha1trace.tracer
+    if None != tracer:
+      started = time.time()
+    try:
+      yield cursor
+    except:
+      connection.rollback()
+      raise
+    else:
+      connection.commit()
+      if connection.total_changes != changes:
+        with self._commitsLock:
+          self.commits += 1
+    finally:
+      cursor.close()
+      if None != tracer:
+        tracer.category(sha1trace.SQLITE, time.time() - started)
+
+class LruCache:
+  """Thread safe least-recently-used cache whose entries expire ttl seconds after they were put.
+  Holds at most maxSize entries; a ttl of 0 disables the cache.  Values must not be None, since 
+  that is what get returns for a miss."""
+  def __init__(self, maxSize, ttl):
+    self.maxSize = maxSize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = sha1trace.TracedLock()
+
+  def get(self, key):
+    """Returns the cached value for key, or None if there is none or it expired."""
+    if self.ttl <= 0:
+      return None
+    with self._lock:
+      # re-inserted below to mark the entry as recently used
+      entry = self._entries.pop(key, None)
+      if None == entry or entry[0] < time.time():
+        self.misses += 1
+        return None
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[1]
+
+  def put(self, key, value):
+    if self.ttl <= 0:
+      return
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + self.ttl, value)
+      if len(self._entries) > self.maxSize:
+        self._entries.popitem(last=False)
+
+  def getMany(self, keys):
+    """Returns a dict of the cached values of those of keys that are cached.  Cheaper than a get per
+    key for batches, as the lock is only taken once."""
+    found = {}
+    if self.ttl <= 0:
+      return found
+    now = time.time()
+    with self._lock:
+      for key in keys:
+        entry = self._entries.pop(key, None)
+        if None != entry and entry[0] >= now:
+          self._entries[key] = entry
+          found[key] = entry[1]
+      self.hits += len(found)
+      self.misses += len(keys) - len(found)
+    return found
+
+  def putMany(self, items):
+    """Caches each (key, value) pair of items; see getMany."""
+    if self.ttl <= 0:
+      return
+    expires = time.time() + self.ttl
+    with self._lock:
+      for (key, value) in items:
+        self._entries.pop(key, None)
+        self._entries[key] = (expires, value)
+      while len(self._entries) > self.maxSize:
+        self._entries.popitem(last=False)
+
+  def pop(self, key):
+    """Removes and returns the cached value for key, or None; atomic, so only one caller gets it."""
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if None == entry or entry[0] < time.time():
+        return None
+      return entry[1]
+
+  def invalidate(self, *keys):
+    with self._lock:
+      for key in keys:
+        self._entries.pop(key, None)
+
+  def invalidatePrefix(self, prefix):
+    """Drops prefix and every path below it, e.g. after a directory was renamed."""
+    below = prefix.rstrip("/") + "/"
+    with self._lock:
+      for key in [k for k in self._entries if k == prefix or k.startswith(below)]:
+        del self._entries[key]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def __len__(self):
+    return len(self._entries)
+
+# Wraps a code block so that if an exception occurs, it is logged.  While tracing (see sha1trace),
+# the block is also timed as an operation called funcName; blocks that move data can set nbytes on
+# the ewrap they get from the with statement.  While an OpProfiler (see sha1profile) is running, blocks
+# with its funcName are run under cProfile.
+class ewrap(object):
+  __slots__ = ("funcName", "nbytes", "tracer", "started", "profile")
+
   def __init__(self, funcName):
     self.funcName = funcName
+    self.nbytes = 0
+    self.tracer = sha1trace.tracer
+    self.profile = None
   def __enter__(self):
-    return self.funcName
+    if None != self.tracer:
+      self.tracer.opStarted()
+      self.started = time.time()
+    if None != sha1profile.opProfiler:
+      self.profile = sha1profile.opProfiler.opStarted(self.funcName)
+    return self
   def __exit__(self, type, value, trace):
+    if None != self.profile:
+      self.profile.disable()
+    if None != self.tracer:
+      self.tracer.opFinished(self.funcName, time.time() - self.started, self.nbytes, None != value)
     if None != value:
       logging.error("!! Exception in %s: %s" % (self.funcName, value))
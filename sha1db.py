@@ -8,47 +8,151 @@
 #
 
 import os
+import sys
 import logging
 import hashlib
-from fusesha1util import fileChecksum, moveFile, sqliteConn, symlinkFile
+import time
+import shutil
+import threading
+import tempfile
+import heapq
+import itertools
+from collections import namedtuple
+from stat import S_ISREG
+from fusesha1util import fileChecksum, moveFile, symlinkFile, LruCache
 from fusesha1util import isLinkAsNum, linkFile, dstWithSubdirectory
 
 from optparse import OptionParser
+from sha1rules import ExcludeRules, DEFAULT_EXCLUDES, addRuleOptions, rulesFromOptions
+from sha1manifest import ManifestReader, writeManifest, escapeField
+from sha1scrub import addScrubOptions, scrubberFromOptions, pendingHasherFromOptions
+from sha1watch import Watcher
+from sha1shard import ShardRouter, ShardTransactions, FanOut, shardFile, MAX_FAN_OUT_THREADS
+from sha1store import Entry, BACKENDS, openStore, storeBackend, sumDigests, prefixEnd, splitRename
 
 LOG_FILENAME = "LOG"
 logging.basicConfig(filename=LOG_FILENAME,level=logging.INFO,)
-CHECKSUM_UPDATE = "insert or replace into files(path, chksum, symlink) values(?, ?, ?);"
-LINK_UPDATE = "update files set link = ? where path = ?;"
-# old path, new path, old path with %
-PATH_UPDATE = "update files set path = replace(path, ?, ?) where path like ?;"
-REMOVE_ROW = "delete from files where path = ?;"
+# the checksum stored for files that haven't been hashed yet; such entries have pending = 1
+PENDING_CHECKSUM = ""
+# the pending value of entries whose checksum was imported from a manifest (see importManifest) and
+# hasn't been confirmed by hashing the file yet.  They are left out of dedup and linking like 
+# pending entries, and are confirmed by the next verification (scrub or full read) or rehash
+UNVERIFIED = 2
+# how many manifest entries are inserted per transaction, and exported per query
+IMPORT_BATCH_SIZE = 50000
+EXPORT_BATCH_SIZE = 10000
+# how many checksums' move candidates diff keeps around
+DIFF_MOVE_CACHE_SIZE = 1000
+# how many journal entries (see sha1store.Transaction) changesSince reads at a time
+JOURNAL_BATCH_SIZE = 1000
+# how many duplicate groups are read at a time, and listed by the report by default
+DUPLICATE_BATCH_SIZE = 1000
+REPORT_GROUPS = 20
+# how many entries are read at a time when listing the files of a directory; the entries of a
+# subdirectory read along with them are skipped
+DIRECTORY_BATCH_SIZE = 100
+
+# the trusted entries with one checksum, of which some take up space (see sha1store.ChecksumStats):
+# copies files of their own and linked files linked to one of them, all of size bytes; reclaimable
+# is what linking all the copies to one would free
+DuplicateGroup = namedtuple("DuplicateGroup", ["chksum", "size", "copies", "linked", "reclaimable"])
+# the duplicates in a directory (see duplicatesByDirectory): the bytes reclaimable and number of
+# copies that would go, and the bytes already saved and number of files linked to a copy
+DirectoryDuplicates = namedtuple("DirectoryDuplicates", ["directory", "reclaimable", "duplicates",
+                                                         "saved", "linked"])
+
+class JournalGap(Exception):
+  """Raised by changesSince when some of the changes asked for were already compacted away."""
+  pass
+
+# sort key used to hash a directory's files in on-disk (inode) order
+def _inodeOf(path):
+  try:
+    return os.lstat(path).st_ino
+  except OSError:
+    return 0
     
+# the size of a file a rescan skips, for the rules' skipped bytes
+def _sizeOf(path):
+  try:
+    return os.lstat(path).st_size
+  except OSError:
+    return 0
+    
+# whether an entry's checksum can be trusted: it isn't pending and the file matched when last
+# verified
+def _isTrusted(entry):
+  return 0 == entry.mismatch and 0 == entry.pending
+
+# whether an entry's file can stand in for its copies; files that failed verification never do,
+# since linking over a good copy would spread the corruption
+def _isLinkTarget(entry):
+  return 0 == entry.symlink and _isTrusted(entry)
+
+# path as unicode, which is how paths come back from the stores; str paths (as the mount and the 
+# command line give them) are UTF-8.  Prefixes are decoded before anything is sliced off by their 
+# length or compared with them
+def _unicodePath(path):
+  return path.decode("utf-8") if isinstance(path, str) else path
+
+# whether an entry is a copy of its own, rather than a symlink or a link to another copy
+def _isOwnCopy(entry):
+  return not entry.symlink and not entry.link
+
+# the directory prefix ends with (or is), without the trailing slash except for the root
+def _directoryPath(prefix):
+  return _unicodePath(prefix).rstrip("/") or "/"
+
+# the directory of path, cut down to its first depth components if depth isn't None (as by
+# ShardRouter)
+def _directoryAtDepth(path, depth):
+  directory = os.path.dirname(path)
+  if None != depth:
+    directory = "/".join(directory.split("/")[:depth + 1]) or "/"
+  return directory
+
 class Sha1DB:
-  # Creates a new Sha1DB.  If the database given does not exist, it will be created.
-  def __init__(self, database, useMd5=False):
+  # Creates a new Sha1DB.  If the database given does not exist, it will be created, as a store of
+  # the given backend (see sha1store).  A Sha1DB can be shared between threads.  rules is an
+  # ExcludeRules deciding which files are kept out of the database; it defaults to the default
+  # excludes.  Files larger than lazyThreshold bytes (if not 0) aren't hashed when they are updated;
+  # they are recorded as pending and hashed later by hashPending.  A new database is split into 
+  # shards files (see sha1shard), routed by the first shardDepth components of the parent 
+  # directories if given; an existing one keeps the backend and layout it has (see reshard).
+  def __init__(self, database, useMd5=False, rules=None, lazyThreshold=0, shards=1, 
+               shardDepth=None, backend="sqlite"):
     self.database = database
+    self.rules = rules if None != rules else ExcludeRules(DEFAULT_EXCLUDES)
+    self.lazyThreshold = lazyThreshold
+    # files (and bytes) hashed to store their checksum, for the stats; guarded by statsLock
+    self.filesHashed = 0
+    self.bytesHashed = 0
+    self.statsLock = threading.Lock()
 
-    dbExists = os.path.exists(database)
-    
-    usingMd5 = useMd5
+    dbExists = None != storeBackend(database)
+    metadata = None
     if not dbExists:
       logging.info("Sha1DB initialized with connection string %s" % database)
-      self._execSql("""create table if not exists files(
-path varchar not null primary key,
-chksum varchar not null,
-symlink boolean default 0);""")
-      self._execSql("create index csum_idx on files(chksum);")
-      self._execSql("create table if not exists versioning(chksum_type varchar not null)");
-      self._execSql("insert into versioning(chksum_type) values(?)", ("md5" if useMd5 else "sha1", ));
-    else:
-      # pull the checksum type out of the database
-      with sqliteConn(self.database) as cursor:
-        cursor.execute("select chksum_type from versioning")
-        for row in cursor:
-          (chksum_type, ) = row
-          usingMd5 = "md5" == chksum_type
-
-    self.checksum = hashlib.md5 if usingMd5 else hashlib.sha1
+      metadata = {"chksum_type": "md5" if useMd5 else "sha1"}
+      if shards > 1:
+        metadata.update(shards=shards, depth=shardDepth, file_prefix=os.path.basename(database),
+                        generation=0)
+    # the stores of each shard; shard 0 is database itself, and holds the checksum type and the 
+    # shard layout
+    self.shards = [openStore(database, backend, metadata)]
+    self.backend = self.shards[0].backend
+    metadata = self.shards[0].metadata()
+    # how many times the database was resharded
+    self.shardGeneration = metadata.get("generation", 0)
+    shards = metadata.get("shards", 1)
+    self.router = ShardRouter(shards, metadata.get("depth"))
+    for shard in xrange(1, shards):
+      path = os.path.join(os.path.dirname(database), shardFile(metadata["file_prefix"], shard))
+      if dbExists and not os.path.exists(path):
+        raise Exception("Shard %d of %s (%s) is missing" % (shard, database, path))
+      self.shards.append(openStore(path, self.backend))
+    self.fanOut = FanOut(min(shards, MAX_FAN_OUT_THREADS))
+    self.checksum = hashlib.md5 if "md5" == metadata.get("chksum_type") else hashlib.sha1
       
   def dedup(self, dupdir, doSymlink):
     """ Moves duplicate entries (based on checksum) into the dupdir.  Uses the entry's path to 
@@ -56,76 +160,88 @@ symlink boolean default 0);""")
     between dupdir and the file path itself so as to make a useful subdirectory structure.
     If doSymlink is true, then the original paths of the files that were moved will be symlinked 
     back to the canonical file; in addition, it will keep the file entry in the database rather than
-    removing it."""
+    removing it.  Files whose checksum is still pending are hashed first; any that can't be are
+    left alone."""
     logging.info("De-duping database")
   
     if os.path.exists(dupdir) and not len(os.listdir(dupdir)) <= 0:
       raise Exception("%s is not empty; refusing to move files" % dupdir)
       
+    self.hashAllPending()
     try:
       pathmap = {} # store duplicate paths keyed by file checksum
       
-      with sqliteConn(self.database) as cursor:
-        cursor.execute("""select chksum, path, link from files 
-where chksum in(
-select chksum from files where symlink = 0 group by chksum having count(chksum) > 1) 
-and symlink = 0 
-and link = 1
-order by chksum, link;""")
-        for row in cursor:
-          (chksum, path, islink) = row
-          if not chksum in pathmap: 
+      # linked files are copies of another one, but whether that one is still there (and still
+      # counts) has to be checked; with shards, the copies may be in any of them
+      def linked(transaction, shard):
+        return transaction.linked()
+      for entries in self._fanOut(linked):
+        for entry in entries:
+          if not entry.chksum in pathmap: 
             # ensure existence of list for checksum
-            pathmap[chksum] = [] 
-          paths = pathmap[chksum]
-          paths.append(path)
+            pathmap[entry.chksum] = [] 
+          pathmap[entry.chksum].append(entry.path)
+      targets = self._entriesIn("chksum", pathmap.keys(), _isLinkTarget)
           
+      with self._transactions() as transactions:
         for chksum, paths in pathmap.iteritems():
+          if len(targets.get(chksum, [])) <= 1:
+            continue
           # the query above will result in single rows for symlinked files, so fix that here
           # rather than mucking about with temp tables
-          paths = filter(lambda path: not os.path.islink(path), paths)
+          paths = filter(lambda path: not os.path.islink(path) and not self.rules.excluded(path), 
+                         paths)
           
-          # we'll have at least two elements due to the inner part of the query above
           for path in paths: 
+            transaction = transactions.transaction(self.router.shardOf(path))
             dst = dstWithSubdirectory(path, dupdir)
             moveFile(path, dst, (not doSymlink)) # don't rm empty dirs if we are symlinking
             if not doSymlink:
-              cursor.execute(REMOVE_ROW, (path, ))
+              transaction.remove(path)
             else:
-              cursor.execute("update files set symlink = 1 where path = ?;", (path, ))
-              symlinkFile(canonicalPath, path)
+              transaction.update(path, {"symlink": 1})
+              symlinkFile(self._canonicalPath(chksum, transactions), path)
       logging.info("De-duping complete")
     except Exception as einst:
       logging.error("Unable to de-dup database: %s" % einst)
       raise
     
   def vacuum(self):
-    """ Check the paths in the database, removing entries for which no actual file exists """
+    """ Check the paths in the database, removing entries for which no actual file exists, as well
+    as entries for files that the exclude rules leave out """
     logging.info("Vacuuming database")
     
-    try:
-      paths = [] # store nonexistent paths
-      with sqliteConn(self.database) as cursor:
-        cursor.execute("select path from files;")
-        for row in cursor:
-          (path, ) = row
+    # shards are vacuumed at the same time, each in one transaction but read a batch at a time
+    def vacuumShard(transaction, shard):
+      last = None
+      while True:
+        entries = transaction.pathRange("", after=last, limit=EXPORT_BATCH_SIZE)
+        for entry in entries:
+          path = entry.path
           if not os.path.exists(path):
-            paths.append(path)
-          
-        for path in paths:
-          logging.info("Removing entry for %s; file does not exist" % path)
-          cursor.execute("delete from files where path = ?;", (path, ))
-        logging.info("Vacuum complete")
+            logging.info("Removing entry for %s; file does not exist" % path)
+            transaction.remove(path)
+          elif self.rules.excluded(path):
+            logging.info("Removing entry for %s; file is excluded" % path)
+            transaction.remove(path)
+        if len(entries) < EXPORT_BATCH_SIZE:
+          return
+        last = entries[-1].path
+        
+    try:
+      self._fanOut(vacuumShard)
+      logging.info("Vacuum complete")
     except Exception as einst:
       logging.error("Unable to vacuum database: %s" % einst)
       raise
 
-  def updateChecksum(self, path):
+  def updateChecksum(self, path, chksum=None):
     """ Update/insert checksums for a given path.  If the path points at a symlink, the entry will 
-    be marked as being a symlink."""
+    be marked as being a symlink.  If the caller already knows the file's checksum (e.g. because it
+    just read the whole file) it can pass it as chksum to avoid hashing the file again."""
     try:
-      with sqliteConn(self.database) as cursor:
-        self._updateChecksumAndLink(path, cursor)
+      with self._transactions() as transactions:
+        self._updateChecksumAndLink(path, transactions, chksum=chksum)
     except Exception as einst:
       logging.error("Unable to update checksum for %s: %s" % (path, einst))
       raise
@@ -133,59 +249,796 @@ order by chksum, link;""")
   def updatePath(self, old, new):
     """Updates the path in the database for a given file.  This is meant to be used by functions
     like rename, which may use directories rather than individual files for renames, thus old and
-    new may be directories."""
+    new may be directories.  With shards, entries whose new path belongs in another shard are moved
+    there: inserted into the new shard first and then removed from the old one, so that nothing is
+    lost if that is interrupted (vacuum removes the entries left at the old paths)."""
     try:
-      with sqliteConn(self.database) as cursor:
-        cursor.execute(PATH_UPDATE, (old, new, old + '%'))
+      if 1 == len(self.shards):
+        with self._transaction() as transaction:
+          transaction.renamePrefix(old, new)
+        return
+      for shard in self.router.shardsFor(old):
+        self._updateShardPaths(shard, old, new)
     except Exception as einst:
       logging.error("Unable to update path for %s to %s: %s" % (old, new, einst))
       raise
       
-  def updateAllChecksums(self, fsroot):
-    logging.info("Updating all checksums under %s" % fsroot)
+  # updatePath for the entries in one shard: that of old itself and those below it, but not those of
+  # its siblings sharing the prefix (/ab when renaming /a)
+  def _updateShardPaths(self, shard, old, new):
+    moving = {} # entries leaving the shard, keyed by their new shard
+    moved = [] # their old paths
+    (pair, oldBelow, newBelow) = splitRename(old, new)
+    with self._transaction(shard) as transaction:
+      renamed = [(newBelow + entry.path[len(oldBelow):], entry) 
+                 for entry in transaction.pathRange(oldBelow, prefixEnd(oldBelow))]
+      entry = transaction.get(pair[1]) if None != pair else None
+      if None != entry:
+        renamed.append((pair[0], entry))
+      staying = []
+      for (path, entry) in renamed:
+        target = self.router.shardOf(path)
+        if shard == target:
+          staying.append((path, entry.path))
+        else:
+          moving.setdefault(target, []).append(entry._replace(path=path))
+          moved.append(entry.path)
+      transaction.rename(staying)
+    for (target, entries) in sorted(moving.iteritems()):
+      with self._transaction(target) as transaction:
+        transaction.load(entries)
+    if moved:
+      with self._transaction(shard) as transaction:
+        for path in moved:
+          transaction.remove(path)
+    
+  def updateAllChecksums(self, fsroot, inodeOrder=False):
     """ Update/insert checksums for all of the files located under fsroot.  This is meant as an
-    optimization for rescanning the database, as it uses a single connection and transaction."""
-    with sqliteConn(self.database) as cursor:
+    optimization for rescanning the database, as it uses a single transaction (per shard).
+    Files are read with a sequential access hint and dropped from the page cache after hashing,
+    and each inode is only hashed once, so hardlinked paths reuse the digest of the first path
+    seen.  If inodeOrder is true, the files in each directory are hashed in inode order, which
+    roughly follows their on-disk layout and cuts down on seeking for spinning disks.  Files and
+    directories excluded by the rules are skipped, and added to the rules' skipped counts."""
+    logging.info("Updating all checksums under %s" % fsroot)
+    seen = {} # checksums keyed by (st_dev, st_ino)
+    skipped = [0, 0, 0] # files, bytes and directories
+    with self._transactions() as transactions:
+      path = fsroot
       try:
         for root, dirs, files in os.walk(fsroot):
-          for name in files:
-            path = os.path.join(root, name)
+          paths = self._skipExcluded(root, dirs, files, skipped)
+          if inodeOrder:
+            paths.sort(key=_inodeOf)
+          for path in paths:
             logging.info("Updating %s" % path)
-            self._updateChecksumAndLink(path, cursor)
+            self._updateChecksumAndLink(path, transactions, seen)
       except Exception as einst:
         logging.error("Unable to update checksum for %s: %s" % (path, einst))
         raise
-    logging.info("Done updating all checksums")
+      finally:
+        self.rules.skipped(*skipped)
+    logging.info("Done updating all checksums; skipped %d excluded files (%d bytes) and %d "
+      "directories" % tuple(skipped))
+    
+  # For the rescans: prunes the directories excluded by the rules from dirs in place (which keeps
+  # os.walk out of them) and returns the paths of the files that aren't excluded, adding what was
+  # left out to skipped, a list of files, bytes and directories
+  def _skipExcluded(self, root, dirs, files, skipped):
+    kept = [name for name in dirs if not self.rules.excludedPath(os.path.join(root, name))]
+    skipped[2] += len(dirs) - len(kept)
+    dirs[:] = kept
+    paths = []
+    for name in files:
+      path = os.path.join(root, name)
+      if self.rules.excluded(path):
+        skipped[0] += 1
+        skipped[1] += _sizeOf(path)
+      else:
+        paths.append(path)
+    return paths
+  
+  def getChecksum(self, path, hashPending=True):
+    """ Returns the stored checksum for path, or None if there is no entry for it.  If the checksum
+    is pending, the file is hashed now, unless hashPending is false, in which case PENDING_CHECKSUM
+    is returned.  None is also returned if a pending file can't be hashed right now."""
+    with self._transaction(self.router.shardOf(path)) as transaction:
+      entry = transaction.get(path)
+    if None == entry:
+      return None
+    if 1 == entry.pending and hashPending:
+      return self.hashPending(path)
+    return entry.chksum
+    
+  def canonicalPath(self, chksum):
+    """ Returns the path of a file with the given checksum that can stand in for all of them (not a
+    symlink, pending or failing verification), preferring files that weren't linked to another 
+    one.  Returns None if there is no such file."""
+    return self._canonicalPath(chksum)
+    
+  # canonicalPath, looking at the shards open in transactions (if given) through them
+  def _canonicalPath(self, chksum, transactions=None):
+    def query(transaction, shard):
+      return [(entry.link, entry.path) for entry in transaction.withChecksums([chksum]) 
+              if _isLinkTarget(entry)]
+    rows = [row for rows in self._fanOut(query, transactions=transactions) for row in rows]
+    return min(rows)[1] if rows else None
+      
+  def pathsForChecksum(self, chksum):
+    """ Returns the paths of every entry with the given checksum, including symlinks and files that
+    failed verification."""
+    def query(transaction, shard):
+      return [entry.path for entry in transaction.withChecksums([chksum]) if 0 == entry.pending]
+    return sorted(itertools.chain(*self._fanOut(query)))
+    
+  def entriesForChecksums(self, chksums):
+    """ Returns a dict mapping each of chksums that is in the database to its (path, checksum) 
+    entries, leaving out files that failed verification.  Looks them all up in as few queries as
+    possible."""
+    return self._entriesIn("chksum", chksums, _isTrusted)
+    
+  def entriesForPaths(self, paths):
+    """ Returns a dict mapping each of paths that is in the database to a list holding its (path,
+    checksum) entry.  The checksum of a pending entry is PENDING_CHECKSUM."""
+    return self._entriesIn("path", paths)
+    
+  def entriesUnderPrefix(self, prefix, limit):
+    """ Returns up to limit (path, checksum) entries for the paths starting with prefix, in path 
+    order.  This is a range scan on the path index."""
+    if not prefix:
+      return []
+    prefix = _unicodePath(prefix)
+    def query(transaction, shard):
+      return [(entry.path, entry.chksum) for entry in 
+              transaction.pathRange(prefix, prefixEnd(prefix), limit=limit)]
+    entries = heapq.merge(*self._fanOut(query, self.router.shardsFor(prefix)))
+    return list(itertools.islice(entries, limit if limit >= 0 else None))
+    
+  # Looks up the (path, checksum) entries whose column is one of values, returning them in a dict
+  # of lists keyed by the value.  Only entries that accept (if given) returns true for are kept.
+  # Paths are only looked up in their shard, checksums in all of them at once
+  def _entriesIn(self, column, values, accept=None):
+    entries = {}
+    byShard = {}
+    for value in values:
+      shard = self.router.shardOf(value) if "path" == column else None
+      byShard.setdefault(shard, []).append(value)
+    def query(transaction, shard):
+      if "path" == column:
+        found = transaction.withPaths(byShard.get(shard, []))
+      else:
+        found = transaction.withChecksums(byShard.get(None, []))
+      return [(entry.path, entry.chksum) for entry in found if None == accept or accept(entry)]
+    shards = sorted(byShard) if "path" == column else None
+    for rows in self._fanOut(query, shards):
+      for (path, chksum) in rows:
+        key = chksum if "chksum" == column else path
+        entries.setdefault(key, []).append((path, chksum))
+    return entries
+    
+  def lastSequence(self, shard=0):
+    """ Returns the sequence number of the latest journal entry (see sha1store.Transaction), or 0 if
+    nothing was ever journaled.  A consumer starting from scratch reads the entries and then follows
+    the journal from here.  Every shard of a sharded database has a journal of its own, numbered
+    separately; entries moved from one shard to another by a rename show up as a delete in the old
+    shard and an insert in the new one."""
+    with self._transaction(shard) as transaction:
+      return transaction.lastSequence()
+      
+  def changesSince(self, seq, batchSize=JOURNAL_BATCH_SIZE, shard=0):
+    """ Returns an iterator over the journal entries (of shard; see lastSequence) after sequence
+    number seq, oldest first, as (seq, op, path, old path, checksum, time) tuples.  The entries are
+    read batchSize at a time, so following a long journal neither holds it all in memory nor keeps
+    a read transaction open.  Raises JournalGap if entries after seq have been compacted away."""
+    with self._transaction(shard) as transaction:
+      first = transaction.firstSequence()
+    if None == first:
+      first = self.lastSequence(shard) + 1
+    if seq + 1 < first:
+      raise JournalGap("journal entries %d to %d were compacted away" % (seq + 1, first - 1))
+    return self._changes(seq, batchSize, shard)
+    
+  def _changes(self, seq, batchSize, shard):
+    while True:
+      with self._transaction(shard) as transaction:
+        rows = transaction.changes(seq, batchSize)
+      for row in rows:
+        yield row
+      if len(rows) < batchSize:
+        return
+      seq = rows[-1][0]
+      
+  def compactJournal(self, before=None, maxEntries=None):
+    """ Deletes the journal entries made before the time before, and all but the latest maxEntries 
+    entries (of every shard).  Returns the number of entries deleted.  Consumers that fall behind
+    the compacted entries get a JournalGap."""
+    deleted = 0
+    for shard in xrange(len(self.shards)):
+      with self._transaction(shard) as transaction:
+        deleted += transaction.compactJournal(before, maxEntries)
+    logging.info("Compacted %d journal entries" % deleted)
+    return deleted
+    
+  def importManifest(self, entries, statFiles=False, batchSize=IMPORT_BATCH_SIZE):
+    """ Adds entries for the (checksum, path) pairs in entries (e.g. a ManifestReader) without 
+    hashing anything.  The checksums are recorded as UNVERIFIED.  Paths that already have an entry
+    or are excluded are skipped.  With statFiles, paths that aren't regular files (or symlinks to 
+    them) are skipped as well, and the size and mtime of the others are recorded.  Entries are 
+    inserted batchSize per transaction.  Returns the number of entries added and skipped."""
+    imported = 0
+    skipped = 0
+    batch = []
+    for (chksum, path) in entries:
+      if self.rules.excluded(path):
+        skipped += 1
+        continue
+      if statFiles:
+        try:
+          st = os.stat(path)
+        except OSError:
+          st = None
+        if None == st or not S_ISREG(st.st_mode):
+          logging.info("Not importing checksum for %s; not a file" % path)
+          skipped += 1
+          continue
+        batch.append(Entry(path, chksum, isLinkAsNum(path), size=st.st_size, mtime=st.st_mtime, 
+                           pending=UNVERIFIED))
+      else:
+        batch.append(Entry(path, chksum, pending=UNVERIFIED))
+      if len(batch) >= batchSize:
+        added = self._importBatch(batch)
+        imported += added
+        skipped += len(batch) - added
+        batch = []
+    if batch:
+      added = self._importBatch(batch)
+      imported += added
+      skipped += len(batch) - added
+    logging.info("Imported %d checksums, skipped %d" % (imported, skipped))
+    return (imported, skipped)
+    
+  # Adds one batch of imported entries, returning how many were new
+  def _importBatch(self, batch):
+    byShard = {}
+    for entry in batch:
+      byShard.setdefault(self.router.shardOf(entry.path), []).append(entry)
+    added = 0
+    with self._transactions() as transactions:
+      for (shard, entries) in sorted(byShard.iteritems()):
+        added += transactions.transaction(shard).putIfAbsent(entries)
+    return added
+    
+  def addEntries(self, entries, journal=True):
+    """ Stores entries (sha1store.Entry tuples) as they are, without looking at the files, replacing
+    any with the same paths.  Without journal they are left out of the journal, which is only meant
+    for filling a new database."""
+    byShard = {}
+    for entry in entries:
+      byShard.setdefault(self.router.shardOf(entry[0]), []).append(entry)
+    for (shard, shardEntries) in sorted(byShard.iteritems()):
+      with self._transaction(shard) as transaction:
+        transaction.load(shardEntries, journal)
+    
+  def manifestEntries(self, prefix="", batchSize=EXPORT_BATCH_SIZE):
+    """ Yields the (checksum, path) pair of every entry under prefix that has a checksum (i.e. isn't
+    pending), in path order, for writeManifest.  The entries are read batchSize at a time, so a 
+    whole database can be exported without holding it in memory or keeping a transaction open."""
+    for (path, chksum) in self._pathOrdered(prefix, lambda entry: 1 != entry.pending, batchSize):
+      yield (chksum, path)
+      
+  # Yields the (path, checksum) entries under prefix that accept (if given) returns true for, in 
+  # path order, reading them batchSize at a time by seeking past the last path of the previous 
+  # batch.  The shards are read side by side and merged
+  def _pathOrdered(self, prefix, accept=None, batchSize=EXPORT_BATCH_SIZE):
+    prefix = _unicodePath(prefix)
+    shards = self.router.shardsFor(prefix) if prefix else range(len(self.shards))
+    if 1 == len(shards):
+      return self._shardPathOrdered(shards[0], prefix, accept, batchSize)
+    return heapq.merge(*[self._shardPathOrdered(shard, prefix, accept, batchSize) 
+                         for shard in shards])
+    
+  def _shardPathOrdered(self, shard, prefix, accept, batchSize):
+    (low, high) = (prefix, prefixEnd(prefix)) if prefix else ("", None)
+    last = None
+    while True:
+      with self._transaction(shard) as transaction:
+        entries = transaction.pathRange(low, high, last, batchSize)
+      for entry in entries:
+        if None == accept or accept(entry):
+          yield (entry.path, entry.chksum)
+      if len(entries) < batchSize:
+        return
+      last = entries[-1].path
+      
+  def diff(self, other, prefix="/", otherPrefix=None):
+    """ Compares the entries under prefix with those under otherPrefix (default: prefix) in the 
+    Sha1DB other, yielding an (op, checksum, name, detail) tuple per difference, with names relative
+    to the prefixes:
+      add - name only has an entry in other
+      remove - name only has an entry here
+      change - name has a different checksum in other; detail is the checksum here
+      move - the file at detail here is at name in other: the checksums match, and neither name has
+             an entry on the other side.  The other name isn't reported as added or removed
+    If both prefixes are directories (end with "/"), only the directories whose digests (see 
+    directoryDigest) differ are read, a level at a time, so two copies that differ in a few places
+    are compared by reading little more than those places.  Otherwise both sides are read in path 
+    order and merged, so memory use doesn't grow with their size.  Move candidates are looked up 
+    through the checksum indexes.  Files whose checksum is pending on either side are only compared
+    by name.  Differences come in name order."""
+    if None == otherPrefix:
+      otherPrefix = prefix
+    (prefix, otherPrefix) = (_unicodePath(prefix), _unicodePath(otherPrefix))
+    candidates = LruCache(DIFF_MOVE_CACHE_SIZE, 24 * 60 * 60)
+    
+    # Returns the (sources, targets) of moves of files with checksum chksum: the names that have it
+    # only here and only in other, sorted, so that the i-th source moved to the i-th target
+    def moves(chksum):
+      found = candidates.get(chksum)
+      if None == found:
+        here = set(path[len(prefix):] for (path, ignored) in 
+                   self._entriesIn("chksum", [chksum]).get(chksum, []) if path.startswith(prefix))
+        there = set(path[len(otherPrefix):] for (path, ignored) in 
+                    other._entriesIn("chksum", [chksum]).get(chksum, []) 
+                    if path.startswith(otherPrefix))
+        found = (sorted(here - there), sorted(there - here))
+        candidates.put(chksum, found)
+      return found
+      
+    if not prefix.endswith("/") or not otherPrefix.endswith("/"):
+      files = self._mergedFiles(other, prefix, otherPrefix)
+    elif self.directoryDigest(prefix) != other.directoryDigest(otherPrefix):
+      files = self._treeFiles(other, prefix, otherPrefix)
+    else:
+      files = []
+    for (name, ours, theirs) in files:
+      if None == theirs:
+        # only here: removed, unless it was moved (which is reported at its new name)
+        (sources, targets) = moves(ours) if PENDING_CHECKSUM != ours else ([], [])
+        if not name in sources or sources.index(name) >= len(targets):
+          yield ("remove", ours, name, None)
+      elif None == ours:
+        (sources, targets) = moves(theirs) if PENDING_CHECKSUM != theirs else ([], [])
+        if name in targets and targets.index(name) < len(sources):
+          yield ("move", theirs, name, sources[targets.index(name)])
+        else:
+          yield ("add", theirs, name, None)
+      elif ours != theirs and not PENDING_CHECKSUM in (ours, theirs):
+        yield ("change", theirs, name, ours)
+        
+  # Yields a (name, checksum here, checksum in other) tuple for every name under prefix here or 
+  # otherPrefix in other, in name order, with a checksum of None on the side that doesn't have it.
+  # Both sides are read in path order and merged
+  def _mergedFiles(self, other, prefix, otherPrefix):
+    ours = self._pathOrdered(prefix)
+    theirs = other._pathOrdered(otherPrefix)
+    ourEntry = next(ours, None)
+    theirEntry = next(theirs, None)
+    while None != ourEntry or None != theirEntry:
+      name = ourEntry[0][len(prefix):] if None != ourEntry else None
+      theirName = theirEntry[0][len(otherPrefix):] if None != theirEntry else None
+      if None != ourEntry and (None == theirEntry or name < theirName):
+        yield (name, ourEntry[1], None)
+        ourEntry = next(ours, None)
+      elif None == ourEntry or theirName < name:
+        yield (theirName, None, theirEntry[1])
+        theirEntry = next(theirs, None)
+      else:
+        yield (name, ourEntry[1], theirEntry[1])
+        ourEntry = next(ours, None)
+        theirEntry = next(theirs, None)
+        
+  # _mergedFiles for the directories prefix and otherPrefix (ending with "/"), leaving out the 
+  # subdirectories (below name, relative to the prefixes) whose digests are the same on both sides.
+  # Listing a directory's files and subdirectories in name order, with a "/" after the name of a 
+  # subdirectory, puts its entries in path order
+  def _treeFiles(self, other, prefix, otherPrefix, name=""):
+    ours = self._directoryListing(prefix + name)
+    theirs = other._directoryListing(otherPrefix + name)
+    for key in sorted(set(ours) | set(theirs)):
+      (ourValue, theirValue) = (ours.get(key), theirs.get(key))
+      if not key.endswith("/"):
+        yield (name + key, ourValue, theirValue)
+      elif ourValue != theirValue:
+        for row in self._treeFiles(other, prefix, otherPrefix, name + key):
+          yield row
+          
+  # The entries directly in the directory prefix (ending with "/"): the checksums of its files and
+  # the digests of its subdirectories, keyed by name, with a "/" after the names of subdirectories
+  def _directoryListing(self, prefix):
+    listing = dict((entry.path[len(prefix):], entry.chksum) for entry in self._directoryFiles(prefix))
+    for (name, (digest, files)) in self.subdirectoryDigests(prefix).iteritems():
+      listing[name + "/"] = digest
+    return listing
+    
+  # Yields the entries of the files directly in the directory prefix (ending with "/"), in path 
+  # order, seeking past the entries of each subdirectory it comes across.  They are all in one shard
+  def _directoryFiles(self, prefix):
+    shard = self.router.shardOf(prefix)
+    (low, high) = (prefix, prefixEnd(prefix))
+    last = None
+    while True:
+      with self._transaction(shard) as transaction:
+        entries = transaction.pathRange(low, high, last, DIRECTORY_BATCH_SIZE)
+      for entry in entries:
+        slash = entry.path.find("/", len(prefix))
+        if slash >= 0:
+          # "0" is the character after "/"
+          (low, last) = (entry.path[:slash] + "0", None)
+          break
+        yield entry
+        last = entry.path
+      else:
+        if len(entries) < DIRECTORY_BATCH_SIZE:
+          return
+        
+  def directoryDigest(self, directory):
+    """ Returns a (digest, files) pair for the entries below directory (a trailing slash makes no
+    difference): the number of entries and a digest of their paths relative to directory and their
+    checksums (see sha1store), as a hex string.  Directories holding the same files with the same
+    checksums have the same digest wherever they are; one without any entries has a digest of 
+    zeros.  The digests are kept up to date as entries change, so this reads one row per shard 
+    rather than the entries."""
+    directory = _directoryPath(directory)
+    def query(transaction, shard):
+      return transaction.directories([directory])
+    rows = [row for rows in self._fanOut(query, self.router.shardsFor(directory.rstrip("/") + "/"))
+            for row in rows]
+    return (sumDigests(row.digest for row in rows), sum(row.files for row in rows))
+    
+  def subdirectoryDigests(self, directory):
+    """ Returns a dict mapping the name of every directory directly in directory that has entries
+    below it to its (digest, files) pair (see directoryDigest)."""
+    directory = _directoryPath(directory)
+    prefix = directory.rstrip("/") + "/"
+    def query(transaction, shard):
+      return transaction.subdirectories(directory)
+    found = {}
+    for rows in self._fanOut(query, self.router.shardsFor(prefix)):
+      for row in rows:
+        found.setdefault(row.path[len(prefix):], []).append(row)
+    return dict((name, (sumDigests(row.digest for row in rows), sum(row.files for row in rows)))
+                for (name, rows) in found.iteritems())
+    
+  def getEntry(self, path):
+    """ Returns (checksum, pending, mismatch, last verified, size, mtime) for path, or None if there
+    is no entry for it.  Nothing is hashed; see getChecksum."""
+    with self._transaction(self.router.shardOf(path)) as transaction:
+      entry = transaction.get(path)
+    if None == entry:
+      return None
+    return (entry.chksum, entry.pending, entry.mismatch, entry.last_verified, entry.size, 
+            entry.mtime)
+    
+  def hashPending(self, path, throttle=None):
+    """ Hashes a file whose checksum is pending and stores the result, returning the checksum.  If
+    the file is gone or changes while it is hashed, it stays pending (and goes to the back of the
+    queue) and None is returned.  throttle is passed on to fileChecksum."""
+    shard = self.router.shardOf(path)
+    try:
+      before = os.stat(path)
+      chksum = fileChecksum(path, self.checksum, dropCache=True, throttle=throttle)
+      after = os.stat(path)
+      self._countHashed(after.st_size)
+    except (IOError, OSError) as einst:
+      logging.warn("Unable to hash pending file %s: %s" % (path, einst))
+      self._attemptedPending(path, shard)
+      return None
+      
+    if (before.st_size, before.st_mtime) != (after.st_size, after.st_mtime):
+      logging.info("Not storing checksum for %s; modified while hashing" % path)
+      self._attemptedPending(path, shard)
+      return None
+      
+    with self._transactions() as transactions:
+      if transactions.transaction(shard).update(path, {"chksum": chksum, "pending": 0, 
+          "last_verified": time.time(), "size": after.st_size, "mtime": after.st_mtime}, 
+          {"pending": 1}):
+        self._hardlinkDup(path, chksum, transactions)
+    return chksum
+    
+  # Sends a pending file that couldn't be hashed to the back of the queue
+  def _attemptedPending(self, path, shard):
+    with self._transaction(shard) as transaction:
+      transaction.update(path, {"last_verified": time.time()}, {"pending": 1})
+    
+  def hashAllPending(self, throttle=None):
+    """ Hashes every file whose checksum is pending, returning the number that were hashed."""
+    hashed = 0
+    for (path, size) in self.pendingFiles():
+      if None != self.hashPending(path, throttle):
+        hashed += 1
+    return hashed
+    
+  def pendingFiles(self, limit=-1, attemptedBefore=None):
+    """ Returns up to limit (path, size) pairs for files whose checksum is pending, least recently
+    attempted first.  With attemptedBefore, files that hashPending gave up on since then are left 
+    out."""
+    if None == attemptedBefore:
+      attemptedBefore = time.time()
+    return self._leastRecentlyVerified(
+      lambda transaction: transaction.pendingQueue(attemptedBefore, limit), 
+      lambda entry: (entry.path, entry.size), limit)
+      
+  def pendingBacklog(self):
+    """ Returns the number of files whose checksum is pending and their total size in bytes."""
+    def query(transaction, shard):
+      return transaction.pendingBacklog()
+    backlogs = self._fanOut(query)
+    return (sum(count for (count, size) in backlogs), sum(size for (count, size) in backlogs))
+      
+  def scrubCandidates(self, limit, verifiedBefore):
+    """ Returns up to limit (path, checksum) pairs for files (not symlinks) that have not been 
+    verified since verifiedBefore, least recently verified first.  Files that were never verified 
+    (including those whose checksum was imported) come first of all."""
+    return self._leastRecentlyVerified(
+      lambda transaction: transaction.scrubQueue(verifiedBefore, limit), 
+      lambda entry: (entry.path, entry.chksum), limit)
+    
+  # Takes the entries queue(transaction) returns, ordered by verification time, from every shard 
+  # and returns columns(entry) for the first limit of them all
+  def _leastRecentlyVerified(self, queue, columns, limit):
+    def query(transaction, shard):
+      return [(entry.last_verified, columns(entry)) for entry in queue(transaction)]
+    rows = heapq.merge(*self._fanOut(query))
+    return [row for (verified, row) in itertools.islice(rows, limit if limit >= 0 else None)]
+      
+  def recordVerification(self, path, chksum, matched, verifiedAt=None):
+    """ Records that the file at path was re-hashed at verifiedAt (default: now) and whether the
+    result matched chksum.  A matched of None only records that the file was looked at (e.g. it 
+    could not be read), keeping its mismatch flag as it is.  Nothing is recorded if the entry's 
+    checksum changed in the meantime.  A verification with a result confirms an UNVERIFIED 
+    checksum, whichever way it went."""
+    changes = {"last_verified": verifiedAt if None != verifiedAt else time.time()}
+    if None != matched:
+      changes.update(mismatch=0 if matched else 1, pending=0)
+    with self._transaction(self.router.shardOf(path)) as transaction:
+      transaction.update(path, changes, {"chksum": chksum})
+    
+  def mismatches(self):
+    """ Returns the (path, checksum) pairs of all entries whose file no longer matched its stored 
+    checksum when last verified."""
+    def query(transaction, shard):
+      return [(entry.path, entry.chksum) for entry in transaction.mismatches()]
+    return list(heapq.merge(*self._fanOut(query)))
+    
+  def duplicateGroups(self, after=None, batchSize=DUPLICATE_BATCH_SIZE):
+    """ Yields a DuplicateGroup for every checksum with more than one trusted entry (neither pending
+    nor failing verification) of which some take up space, the most reclaimable bytes first and
+    then in checksum order.  The groups are read batchSize at a time from the index each store keeps
+    of them, so the biggest come straight away however large the database, and a whole report
+    neither scans the entries nor holds the groups in memory.  To carry on where an earlier stream
+    stopped, pass the (reclaimable, checksum) of the last group it yielded as after.
+    
+    The copies of a checksum can be in several shards, so a sharded database is read differently:
+    the shards' checksums are read side by side, most space taken up first, and a group is yielded
+    once no checksum still unread can free as much.  That reads the checksums taking up more space 
+    than the groups yielded free, single files included, and carrying on after a group reads them 
+    again up to it."""
+    if 1 == len(self.shards):
+      return self._duplicateGroups(after, batchSize)
+    return self._shardedDuplicateGroups(after, batchSize)
+    
+  def _duplicateGroups(self, after, batchSize):
+    while True:
+      with self._transaction() as transaction:
+        rows = transaction.duplicates(after, batchSize)
+      for row in rows:
+        yield DuplicateGroup(row.chksum, row.size, row.copies, row.linked, row.reclaimable)
+      if len(rows) < batchSize:
+        return
+      after = (rows[-1].reclaimable, rows[-1].chksum)
+      
+  # duplicateGroups of a sharded database.  Any checksum whose counts haven't been read can at most
+  # free the space taken up by the next unread checksum of every shard together (less its size),
+  # so the groups read are yielded once they free at least that much
+  def _shardedDuplicateGroups(self, after, batchSize):
+    readers = [self._occupying(shard, batchSize) for shard in xrange(len(self.shards))]
+    heads = [next(reader, None) for reader in readers]
+    groups = []
+    seen = set()
+    while True:
+      bound = sum(head.occupied for head in heads if None != head)
+      while groups and -groups[0][0][0] >= bound:
+        yield heapq.heappop(groups)[1]
+      if not any(heads):
+        # the bound was 0, so that was every group
+        return
+      # the most occupied checksums go first, bringing the bound down fastest
+      chksums = set()
+      while len(chksums) < batchSize and any(heads):
+        shard = max((head.occupied, shard) for (shard, head) in enumerate(heads) if None != head)[1]
+        if not heads[shard].chksum in seen:
+          chksums.add(heads[shard].chksum)
+        heads[shard] = next(readers[shard], None)
+      totals = {}
+      for rows in self._fanOut(lambda transaction, shard: transaction.checksumStats(chksums)):
+        for row in rows:
+          (size, copies, linked) = totals.get(row.chksum, (0, 0, 0))
+          totals[row.chksum] = (max(size, row.size), copies + row.copies, linked + row.linked)
+      for (chksum, (size, copies, linked)) in totals.iteritems():
+        if copies + linked <= 1:
+          continue
+        seen.add(chksum)
+        group = DuplicateGroup(chksum, size, copies, linked, size * max(copies - 1, 0))
+        key = (-group.reclaimable, chksum)
+        if None == after or key > (-after[0], after[1]):
+          heapq.heappush(groups, (key, group))
+          
+  # Yields the checksum counts of shard that take up space, most first, read batchSize at a time
+  def _occupying(self, shard, batchSize):
+    after = None
+    while True:
+      with self._transaction(shard) as transaction:
+        rows = transaction.occupying(after, batchSize)
+      for row in rows:
+        yield row
+      if len(rows) < batchSize:
+        return
+      after = (rows[-1].occupied, rows[-1].chksum)
+      
+  def duplicateEntries(self, groups, batchSize=DUPLICATE_BATCH_SIZE):
+    """ Yields a (group, entries) pair for each of groups (DuplicateGroups, e.g. from 
+    duplicateGroups), entries being the trusted entries (sha1store.Entry tuples) of its checksum: 
+    the copy that would stay (see canonicalPath) first, then the other copies and then the linked 
+    files, each in path order.  The entries are looked up by checksum batchSize groups at a time."""
+    groups = iter(groups)
+    while True:
+      batch = list(itertools.islice(groups, batchSize))
+      if not batch:
+        return
+      def query(transaction, shard):
+        return [entry for entry in transaction.withChecksums([group.chksum for group in batch])
+                if _isTrusted(entry)]
+      byChecksum = {}
+      for entries in self._fanOut(query):
+        for entry in entries:
+          byChecksum.setdefault(entry.chksum, []).append(entry)
+      for group in batch:
+        entries = byChecksum.get(group.chksum, [])
+        entries.sort(key=lambda entry: (not _isOwnCopy(entry), entry.path))
+        yield (group, entries)
+        
+  def duplicatesByDirectory(self, depth=None, batchSize=DUPLICATE_BATCH_SIZE):
+    """ Returns a DirectoryDuplicates for every directory holding copies that would go or files 
+    already linked, the most reclaimable bytes first (then the most bytes saved).  A file counts 
+    towards its directory or, with depth, towards the first depth components of it, so that whole 
+    subtrees add up into one.  Of the copies of each group the one that would stay doesn't count 
+    (see duplicateEntries).  Only the duplicate groups and their entries are read (see 
+    duplicateGroups), and only the directories are kept in memory."""
+    counts = {}
+    for (group, entries) in self.duplicateEntries(self.duplicateGroups(batchSize=batchSize), 
+                                                  batchSize):
+      for (index, entry) in enumerate(entries):
+        if 0 == index and _isOwnCopy(entry):
+          continue
+        directory = counts.setdefault(_directoryAtDepth(entry.path, depth), [0, 0, 0, 0])
+        if _isOwnCopy(entry):
+          directory[0] += group.size
+          directory[1] += 1
+        else:
+          directory[2] += group.size
+          directory[3] += 1
+    rollup = [DirectoryDuplicates(directory, *values) for (directory, values) in counts.iteritems()]
+    rollup.sort(key=lambda row: (-row.reclaimable, -row.saved, row.directory))
+    return rollup
   
   def removeChecksum(self, path):
     """ Remove the checksum/path entry for the given path from the database """
-    self._execSql(REMOVE_ROW, (path, ))
+    with self._transaction(self.router.shardOf(path)) as transaction:
+      transaction.remove(path)
+    
+  def removeTree(self, path):
+    """ Removes the entries of path and of everything below it, e.g. for a directory that was 
+    deleted."""
+    path = path.rstrip("/")
+    shards = set(self.router.shardsFor(path + "/") + [self.router.shardOf(path)])
+    for shard in sorted(shards):
+      with self._transaction(shard) as transaction:
+        transaction.remove(path)
+        # "0" is the character after "/"
+        transaction.removeRange(path + "/", path + "0")
+    
+  def syncTree(self, fsroot):
+    """ Brings the entries of the files under fsroot in line with the files themselves, without 
+    hashing the ones that didn't change: files whose size or mtime differ from their entry, or that
+    have none, are hashed (or marked pending), and entries of files that are gone (or excluded) are
+    removed.  Like updateAllChecksums, but for a subtree that is known to have changed in ways that
+    weren't followed; the excluded files and directories count as skipped the same way.  Returns the number of files updated and of entries removed."""
+    prefix = fsroot.rstrip("/") + "/"
+    # (size, mtime) keyed by path, as UTF-8 like the paths os.walk returns
+    known = {}
+    def query(transaction, shard):
+      return [(entry.path, entry.size, entry.mtime) for entry in 
+              transaction.pathRange(prefix, prefix[:-1] + "0")]
+    for rows in self._fanOut(query, self.router.shardsFor(prefix)):
+      for (path, size, mtime) in rows:
+        known[path.encode("utf-8") if isinstance(path, unicode) else path] = (size, mtime)
+    updated = 0
+    skipped = [0, 0, 0]
+    with self._transactions() as transactions:
+      for root, dirs, files in os.walk(fsroot):
+        for path in self._skipExcluded(root, dirs, files, skipped):
+          entry = known.pop(path, None)
+          try:
+            st = os.stat(path)
+          except OSError:
+            continue
+          if None != entry and entry == (st.st_size, st.st_mtime):
+            continue
+          self._updateChecksumAndLink(path, transactions)
+          updated += 1
+      for path in known:
+        transactions.transaction(self.router.shardOf(path)).remove(path)
+    self.rules.skipped(*skipped)
+    logging.info("Synced %s: %d files updated, %d entries removed" % (fsroot, updated, len(known)))
+    return (updated, len(known))
     
   # Calculates the checksum and link status for the given path, then updates the DB entry
   # and creates a hard link if the file has the same checksum as another file
-  # If path is nonexistent, this will log an error
-  def _updateChecksumAndLink(self, path, cursor):
-    if os.path.exists(path):
-      chksum = fileChecksum(path, self.checksum)
-      cursor.execute(CHECKSUM_UPDATE, (path, chksum, isLinkAsNum(path)))
-      self._hardlinkDup(path, chksum, cursor)
-    else:
+  # If path is nonexistent, this will log an error.  If seen is given, it maps (st_dev, st_ino)
+  # to already calculated checksums so that bulk scans hash each inode once, bypassing the page
+  # cache as they go.  A precalculated chksum skips hashing altogether.  Files over lazyThreshold
+  # that would need hashing are marked pending instead.  transactions is the ShardTransactions of 
+  # the update.
+  def _updateChecksumAndLink(self, path, transactions, seen=None, chksum=None):
+    try:
+      st = os.stat(path)
+    except OSError:
       # this happens for broken symlinks
       logging.error("Path %s does not exist; skipping update" % path)
+      return
+      
+    transaction = transactions.transaction(self.router.shardOf(path))
+    key = (st.st_dev, st.st_ino)
+    if None == chksum and None != seen:
+      chksum = seen.get(key)
+    if None == chksum:
+      if self.lazyThreshold > 0 and st.st_size > self.lazyThreshold:
+        self._markPending(path, st, transaction)
+        return
+      chksum = fileChecksum(path, self.checksum, dropCache=(None != seen))
+      self._countHashed(st.st_size)
+      if None != seen:
+        seen[key] = chksum
+    # a freshly calculated checksum counts as verified
+    transaction.put(Entry(path, chksum, isLinkAsNum(path), last_verified=time.time(), 
+                          size=st.st_size, mtime=st.st_mtime))
+    self._hardlinkDup(path, chksum, transactions)
     
-  # internal helper to link a path using an existing cursor.  This is in some sense an
+  # Records that path (with stat result st) needs hashing.  An entry whose size and mtime still 
+  # match the file is kept as it is, so rescans don't throw away checksums of unchanged files
+  def _markPending(self, path, st, transaction):
+    entry = transaction.get(path)
+    if None != entry and (entry.size, entry.mtime) == (st.st_size, st.st_mtime):
+      return
+    logging.info("Checksum for %s (%d bytes) pending" % (path, st.st_size))
+    transaction.put(Entry(path, PENDING_CHECKSUM, isLinkAsNum(path), size=st.st_size, 
+                          mtime=st.st_mtime, pending=1))
+    
+  def _countHashed(self, size):
+    with self.statsLock:
+      self.filesHashed += 1
+      self.bytesHashed += size
+    
+  # internal helper to link a path within an existing unit of work.  This is in some sense an
   # antipattern method, but I really don't want to deal with this as a duplicated code
-  # block.  Note that this will skip any paths given to it that are symlinks
-  def _hardlinkDup(self, path, chksum, cursor):
+  # block.  Note that this will skip any paths given to it that are symlinks.  The copies are
+  # looked up in every shard at once; those in shards that transactions has open are seen through
+  # it, uncommitted changes included.  Copies that weren't linked to another one come first, so 
+  # that the canonical file stays the same whichever shard it is in
+  def _hardlinkDup(self, path, chksum, transactions):
     if not os.path.islink(path):
       pathInode = os.stat(path).st_ino
       links = []
-      cursor.execute("select path from files where chksum = ? and path != ? and symlink = 0;", 
-            (chksum, path))
+      own = _unicodePath(path)
+      def query(transaction, shard):
+        return [(entry.link, entry.path) for entry in transaction.withChecksums([chksum]) 
+                if entry.path != own and _isLinkTarget(entry)]
+      copies = [row for rows in self._fanOut(query, transactions=transactions) for row in rows]
+      copies.sort(key=lambda (islink, link): islink)
           
       # i.e. find all different files with the same checksum
-      for row in cursor:
-        (link, ) = row
+      for (islink, link) in copies:
         if os.stat(link).st_ino != pathInode:
           links.append(link) # only hardlink files that don't point at the same inode
       
@@ -198,30 +1051,166 @@ order by chksum, link;""")
 
         # clean up any links with different inodes
         for link in links:
-          cursor.execute(LINK_UPDATE, (1, link))
+          transactions.write(self.router.shardOf(link), 
+                             lambda transaction, link=link: transaction.update(link, {"link": 1}))
           linkFile(canonicalLink, link)
     
-  # Makes sure the SQL statement has a "; at the end"
-  def _formatSql(self, sql):
-    if not sql.endswith(";"):
-      sql = sql + ";"
-    return sql
-
-  # internal method used to run arbitrary SQL on the SQLite database
-  def _execSql(self, sql, sqlargs = None):
-    sql = self._formatSql(sql)
-    logging.debug("Running SQL %s with args %s" % (sql, sqlargs))
+  # a transaction on shard; commits on success, rolls back on failure
+  def _transaction(self, shard=0):
+    return self.shards[shard].transaction()
     
-    try:
-      with sqliteConn(self.database) as cursor:
-        if sqlargs != None: 
-          cursor.execute(sql, sqlargs)
-        else:
-          cursor.execute(sql)
-    except Exception as einst:
-      logging.error("Unable to exec %s with args %s: %s" % (sql, sqlargs, einst))
-      raise
+  # the ShardTransactions of a unit of work spanning shards, to be used with 'with'
+  def _transactions(self):
+    return ShardTransactions(self._transaction)
+    
+  # Runs query(transaction, shard) on each of shards (default: all of them) and returns the results
+  # in the order of shards.  Shards that transactions (a ShardTransactions) has open are queried 
+  # through it on the calling thread, so that uncommitted changes are seen; the others in 
+  # transactions of their own, at the same time from the fan-out threads if there are several
+  def _fanOut(self, query, shards=None, transactions=None):
+    if None == shards:
+      shards = range(len(self.shards))
+    results = {}
+    remote = []
+    for shard in shards:
+      if None != transactions and transactions.isOpen(shard):
+        results[shard] = query(transactions.transaction(shard), shard)
+      else:
+        remote.append(shard)
+    def run(shard):
+      with self._transaction(shard) as transaction:
+        return query(transaction, shard)
+    if 1 == len(remote):
+      results[remote[0]] = run(remote[0])
+    elif remote:
+      results.update(zip(remote, self.fanOut.map(run, remote)))
+    return [results[shard] for shard in shards]
+    
+  def commits(self):
+    """ Returns the number of transactions that changed something, in all shards."""
+    return sum(shard.commits() for shard in self.shards)
+    
+  def flush(self):
+    """ Makes sure everything committed is in the database files, and on disk."""
+    for shard in self.shards:
+      shard.flush()
+    
+  def close(self):
+    """ Closes every thread's connections to the database, or (for logs) the database itself once 
+    everything that opened it closed it.  Nothing may be using the database meanwhile."""
+    for shard in self.shards:
+      shard.close()
         
+# Prints the differences between the entries under root in sha1db and under otherRoot in other, a
+# database or a manifest (which is imported into a temporary database first, so that both sides 
+# can be merged in path order)
+def diffDatabases(sha1db, other, root, otherRoot=None):
+  root = os.path.abspath(root).rstrip("/") + "/"
+  otherRoot = os.path.abspath(otherRoot).rstrip("/") + "/" if None != otherRoot else root
+  tmpdir = None
+  try:
+    if None != storeBackend(other):
+      otherDB = Sha1DB(other, rules=sha1db.rules)
+    else:
+      tmpdir = tempfile.mkdtemp()
+      otherDB = Sha1DB(os.path.join(tmpdir, "manifest.db"), useMd5=(hashlib.md5 == sha1db.checksum),
+                       rules=sha1db.rules)
+      with open(other, "rb") as manifest:
+        otherDB.importManifest(ManifestReader(manifest, otherRoot, 
+                                              2 * sha1db.checksum().digest_size))
+    for (op, chksum, name, detail) in sha1db.diff(otherDB, root, otherRoot):
+      fields = [op, chksum, escapeField(name)]
+      if None != detail:
+        fields.append(escapeField(detail) if "move" == op else detail)
+      print "\t".join(fields)
+  finally:
+    if None != tmpdir:
+      shutil.rmtree(tmpdir)
+
+# Prints where the space duplicates take goes, as tab separated lines: first the totals ("total", 
+# then the reclaimable bytes, duplicate copies, bytes saved by linking and linked files), then the 
+# limit most reclaimable groups ("group", reclaimable bytes, size, copies, linked files and 
+# checksum), each followed by its files ("keep" for the copy that would stay, "copy" or "link", and 
+# the path), then the limit directories with the most reclaimable bytes ("directory", then the 
+# fields of DirectoryDuplicates), rolled up depth components deep if depth isn't None
+def printDuplicateReport(sha1db, limit=REPORT_GROUPS, depth=None, out=sys.stdout):
+  rollup = sha1db.duplicatesByDirectory(depth)
+  totals = [sum(row[column] for row in rollup) for column in xrange(1, 5)]
+  print >> out, "\t".join(["total"] + [str(total) for total in totals])
+  for (group, entries) in sha1db.duplicateEntries(itertools.islice(sha1db.duplicateGroups(), limit)):
+    print >> out, "group\t%d\t%d\t%d\t%d\t%s" % (group.reclaimable, group.size, group.copies, 
+                                                 group.linked, group.chksum)
+    for (index, entry) in enumerate(entries):
+      kind = "link" if not _isOwnCopy(entry) else ("keep" if 0 == index else "copy")
+      print >> out, "%s\t%s" % (kind, escapeField(entry.path))
+  for row in rollup[:limit]:
+    print >> out, "directory\t%d\t%d\t%d\t%d\t%s" % (row.reclaimable, row.duplicates, row.saved,
+                                                      row.linked, escapeField(row.directory))
+
+def reshard(database, shards, depth=None, batchSize=IMPORT_BATCH_SIZE, backend=None):
+  """ Splits the entries of the database at the path database into shards shards (1 merges them
+  back into one file), routed by depth components of the parent directory (see ShardRouter), and
+  moves them into stores of backend if given (see sha1store).  The new layout is written next to 
+  the old one and only replaces it, with a rename of the main file, once it is complete, so an 
+  interrupted reshard leaves the database as it was.  Nothing else may have the database open 
+  meanwhile.  The journals start over (consumers get a JournalGap)."""
+  old = Sha1DB(database)
+  generation = old.shardGeneration + 1
+  staging = "%s.%d" % (database, generation)
+  for path in _newDatabaseFiles(staging, shards):
+    if os.path.exists(path):
+      os.remove(path)
+  new = Sha1DB(staging, useMd5=(hashlib.md5 == old.checksum), shards=shards, shardDepth=depth,
+               backend=backend or old.backend)
+  logging.info("Resharding %s (%d shards) into %d %s shards" % (database, len(old.shards), shards,
+    new.backend))
+  # the copies aren't changes; the journals of the new shards start after every old entry
+  lastSequence = max(old.lastSequence(shard) for shard in xrange(len(old.shards)))
+  for shard in xrange(shards):
+    with new._transaction(shard) as transaction:
+      transaction.startJournalAfter(lastSequence)
+  if shards > 1:
+    metadata = new.shards[0].metadata()
+    metadata["generation"] = generation
+    new.shards[0].setMetadata(metadata)
+  
+  copied = 0
+  for shard in xrange(len(old.shards)):
+    last = None
+    while True:
+      with old._transaction(shard) as transaction:
+        entries = transaction.pathRange("", after=last, limit=batchSize)
+      new.addEntries(entries, journal=False)
+      copied += len(entries)
+      if len(entries) < batchSize:
+        break
+      last = entries[-1].path
+  
+  # everything has to be in the database files themselves before they are moved
+  for sha1db in (old, new):
+    sha1db.flush()
+    sha1db.close()
+  oldFiles = [shard.database for shard in old.shards]
+  for path in oldFiles:
+    if os.path.exists(path + "-wal") and os.path.getsize(path + "-wal") > 0:
+      raise Exception("%s is in use; not resharding" % path)
+  os.rename(staging, database)
+  for path in oldFiles[1:]:
+    os.remove(path)
+  for path in oldFiles + [staging]:
+    for suffix in ("-wal", "-shm"):
+      if os.path.exists(path + suffix):
+        os.remove(path + suffix)
+  logging.info("Resharded %d entries of %s into %d shards" % (copied, database, shards))
+  return copied
+
+# The files a new database with shards shards is made of: the main database first, then the other
+# shards
+def _newDatabaseFiles(database, shards):
+  return [database] + [os.path.join(os.path.dirname(database), 
+                                    shardFile(os.path.basename(database), shard)) 
+                       for shard in xrange(1, shards)]
+
 def main():
   usage = """%prog perform operations on the FUSE SHA1 filesystem database.  [options] database."""
   parser = OptionParser(usage = usage)
@@ -241,25 +1230,256 @@ def main():
                     dest = "vacuum",
                     default = False,
                     help = "Remove entries for nonexistent files")
+  
+  parser.add_option("--scrub",
+                    action = "store_true",
+                    dest = "scrub",
+                    default = False,
+                    help = "Re-hash every file once, comparing against the stored checksums")
+  parser.add_option("--hash-pending",
+                    action = "store_true",
+                    dest = "hashPending",
+                    default = False,
+                    help = "Hash the files whose checksums are pending (uses the scrub rate limits)")
+  addScrubOptions(parser)
+  addRuleOptions(parser)
+  
+  parser.add_option("--mismatches",
+                    action = "store_true",
+                    dest = "mismatches",
+                    default = False,
+                    help = "List the files that failed their last verification")
+  parser.add_option("--changes-since",
+                    dest = "changesSince",
+                    type = "int",
+                    help = "Print the changes made after journal entry SEQ, one per line: sequence "
+                           "number, operation, checksum, path and (for renames) old path, separated "
+                           "by tabs.  0 prints the whole journal",
+                    metavar = "SEQ")
+  parser.add_option("--journal-retention",
+                    dest = "journalRetention",
+                    type = "float",
+                    help = "Delete journal entries older than DAYS",
+                    metavar = "DAYS")
+  parser.add_option("--journal-max-entries",
+                    dest = "journalMaxEntries",
+                    type = "int",
+                    help = "Delete all but the latest COUNT journal entries",
+                    metavar = "COUNT")
+  parser.add_option("--import",
+                    dest = "importManifest",
+                    help = "Add the checksums listed in MANIFEST (in the format of sha1sum or md5sum, "
+                           "- for standard input) without hashing the files; they are verified by the "
+                           "next scrub.  The database is created if it doesn't exist",
+                    metavar = "MANIFEST")
+  parser.add_option("--export",
+                    dest = "exportManifest",
+                    help = "Write the stored checksums to MANIFEST (- for standard output) in the "
+                           "format of sha1sum or md5sum",
+                    metavar = "MANIFEST")
+  parser.add_option("--manifest-root",
+                    dest = "manifestRoot",
+                    default = ".",
+                    help = "The directory the file names in manifests are relative to; --export only "
+                           "writes the files under it [default: the current directory]",
+                    metavar = "DIR")
+  parser.add_option("--import-stat",
+                    action = "store_true",
+                    dest = "importStat",
+                    default = False,
+                    help = "Skip manifest entries for files that don't exist, and record the size and "
+                           "mtime of the others")
+  parser.add_option("--md5",
+                    action = "store_true",
+                    dest = "useMd5",
+                    default = False,
+                    help = "Use MD5 rather than SHA1 checksums if --import creates the database")
+  parser.add_option("--diff",
+                    dest = "diff",
+                    help = "Compare the entries under --manifest-root with those under --other-root in "
+                           "OTHER (another database, or a manifest in the format of sha1sum) and print "
+                           "what changed from here to there, one difference per line: add, remove, "
+                           "change or move, the checksum, the name and (for changes) the old checksum "
+                           "or (for moves) the old name, separated by tabs.  Names are relative to the "
+                           "roots, with tabs, newlines and backslashes escaped",
+                    metavar = "OTHER")
+  parser.add_option("--other-root",
+                    dest = "otherRoot",
+                    help = "The directory in OTHER that corresponds to --manifest-root [default: "
+                           "--manifest-root]",
+                    metavar = "DIR")
+  parser.add_option("--shard",
+                    dest = "shard",
+                    type = "int",
+                    default = 0,
+                    help = "The shard whose journal --changes-since prints; each shard of a sharded "
+                           "database has its own [default: %default]",
+                    metavar = "SHARD")
+  parser.add_option("--shards",
+                    dest = "shards",
+                    type = "int",
+                    default = 1,
+                    help = "Split the database into COUNT files if --import creates it [default: "
+                           "%default]",
+                    metavar = "COUNT")
+  parser.add_option("--reshard",
+                    dest = "reshard",
+                    type = "int",
+                    help = "Move the entries of the database into COUNT shards (1 for a single file) "
+                           "before doing anything else.  Nothing else may use the database meanwhile",
+                    metavar = "COUNT")
+  parser.add_option("--shard-depth",
+                    dest = "shardDepth",
+                    type = "int",
+                    help = "With --shards or --reshard, route entries by the first DEPTH components "
+                           "of their directory, so that the subtrees below that depth each stay in one "
+                           "shard [default: the whole directory]",
+                    metavar = "DEPTH")
+  parser.add_option("--backend",
+                    dest = "backend",
+                    type = "choice",
+                    choices = BACKENDS,
+                    help = "Keep the entries in BACKEND stores (sqlite or log; see sha1store.py) if "
+                           "--import creates the database, or move them into such stores with "
+                           "--reshard [default: sqlite, or what the database uses]",
+                    metavar = "BACKEND")
+  parser.add_option("--watch",
+                    dest = "watch",
+                    help = "Keep the entries under ROOT up to date as files there change, until "
+                           "interrupted (for writers that bypass the mount)",
+                    metavar = "ROOT")
+  parser.add_option("--pending",
+                    action = "store_true",
+                    dest = "pending",
+                    default = False,
+                    help = "Show how many files are waiting to be hashed")
+  parser.add_option("--report",
+                    action = "store_true",
+                    dest = "report",
+                    default = False,
+                    help = "Show where duplicates take up space: the bytes linking them would free "
+                           "and linking already saved, the duplicate groups freeing the most and the "
+                           "directories holding the most, as tab separated lines")
+  parser.add_option("--report-limit",
+                    dest = "reportLimit",
+                    type = "int",
+                    default = REPORT_GROUPS,
+                    help = "The number of groups and of directories --report lists [default: "
+                           "%default]",
+                    metavar = "COUNT")
+  parser.add_option("--report-depth",
+                    dest = "reportDepth",
+                    type = "int",
+                    help = "Add up the directories of --report by their first DEPTH components "
+                           "[default: every directory on its own]",
+                    metavar = "DEPTH")
+  parser.add_option("--digest",
+                    dest = "digest",
+                    help = "Print the digest of the files under DIR (of their names relative to DIR "
+                           "and their checksums) and how many there are, separated by a tab.  Copies "
+                           "of a tree have the same digest wherever they are",
+                    metavar = "DIR")
 
   (options, args) = parser.parse_args()
   
   if len(args) != 1:
-    parser.error("You must give the path to the SQLite database to use.")
+    parser.error("You must give the path to the database to use.")
   
   database = args[0]
   
-  if not os.path.exists(database):
+  if not os.path.exists(database) and None == options.importManifest:
     parser.error("%s does not exist" % database)
     
-  sha1db = Sha1DB(database)
+  if None != options.reshard:
+    if not os.path.exists(database):
+      parser.error("%s does not exist" % database)
+    reshard(database, options.reshard, options.shardDepth, backend=options.backend)
+    
+  sha1db = Sha1DB(database, useMd5=options.useMd5, rules=rulesFromOptions(options), 
+                  shards=options.shards, shardDepth=options.shardDepth, 
+                  backend=options.backend or "sqlite")
   
-  # vacuum first, then dedup
+  if None != options.importManifest:
+    manifest = sys.stdin if "-" == options.importManifest else open(options.importManifest, "rb")
+    try:
+      reader = ManifestReader(manifest, options.manifestRoot, 2 * sha1db.checksum().digest_size)
+      (imported, skipped) = sha1db.importManifest(reader, options.importStat)
+    finally:
+      if manifest != sys.stdin:
+        manifest.close()
+    print "%d checksums imported, %d skipped, %d malformed lines" % (imported, skipped, 
+      reader.malformed)
+  
+  # vacuum first, then hash pending files, then scrub, then dedup (so dedup knows about any 
+  # corrupted files)
   if options.vacuum:
     sha1db.vacuum()
+    
+  if options.hashPending:
+    hasher = pendingHasherFromOptions(sha1db, options)
+    hasher.scrubPass()
+    logging.info("Hashed %d pending files" % hasher.filesVerified)
+    
+  if options.scrub:
+    scrubber = scrubberFromOptions(sha1db, options)
+    scrubber.scrubPass()
+    logging.info("Scrub complete: %d files verified, %d mismatches" % 
+      (scrubber.filesVerified, scrubber.mismatches))
   
   if None != options.dupdir:
     sha1db.dedup(options.dupdir, options.doSymlink)
+    
+  if options.mismatches:
+    for (path, chksum) in sha1db.mismatches():
+      print "%s  %s" % (chksum, path)
+      
+  if None != options.exportManifest:
+    manifest = sys.stdout if "-" == options.exportManifest else open(options.exportManifest, "wb")
+    try:
+      root = os.path.abspath(options.manifestRoot)
+      writeManifest(manifest, sha1db.manifestEntries(root.rstrip("/") + "/"), root)
+    finally:
+      if manifest != sys.stdout:
+        manifest.close()
+      
+  if None != options.diff:
+    diffDatabases(sha1db, options.diff, options.manifestRoot, options.otherRoot)
+      
+  if options.pending:
+    (count, size) = sha1db.pendingBacklog()
+    print "%d files (%d bytes) waiting to be hashed" % (count, size)
+    
+  if options.report:
+    printDuplicateReport(sha1db, options.reportLimit, options.reportDepth)
+    
+  if None != options.digest:
+    print "%s\t%d" % sha1db.directoryDigest(os.path.abspath(options.digest))
+    
+  if None != options.changesSince:
+    try:
+      for (seq, op, path, oldPath, chksum, changedAt) in sha1db.changesSince(options.changesSince, 
+                                                                             shard=options.shard):
+        fields = [str(seq), op, chksum or "", path] + ([oldPath] if None != oldPath else [])
+        print "\t".join(fields).encode("utf-8")
+    except JournalGap as einst:
+      print >> sys.stderr, "%s; start over from the files table" % einst
+      sys.exit(1)
+      
+  if None != options.journalRetention or None != options.journalMaxEntries:
+    before = None
+    if None != options.journalRetention:
+      before = time.time() - options.journalRetention * 24 * 60 * 60
+    sha1db.compactJournal(before, options.journalMaxEntries)
+    
+  if None != options.watch:
+    watcher = Watcher(sha1db, options.watch)
+    watcher.start()
+    try:
+      # a timeout keeps the main thread interruptible
+      while watcher.is_alive():
+        watcher.join(1.0)
+    except KeyboardInterrupt:
+      watcher.stop()
   
 
 if __name__ == '__main__':
@@ -16,7 +16,12 @@
 #    See the file COPYING.
 #
 
+import math
 import os, sys
+import signal
+import tempfile
+import threading
+import time
 from os.path import join
 from errno import *
 from stat import *
@@ -28,13 +33,30 @@ except ImportError:
   pass
 import fuse
 from fuse import Fuse
+# os.scandir is Python 3.5+; older Pythons can use the scandir package, or fall back on os.listdir
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
 
 import xmp
 from xmp import Xmp
 from xmp import flag2mode
 
-from fusesha1util import ewrap
-from sha1db import Sha1DB
+from fusesha1util import ewrap, pread, pwrite, LruCache, parseSize
+from fusesha1util import getxattr, listxattr, setxattr, removexattr
+from sha1db import Sha1DB, PENDING_CHECKSUM, UNVERIFIED
+from sha1scrub import ActivityMonitor, ReadVerifier, DEFAULT_SCRUB_INTERVAL
+from sha1scrub import addScrubOptions, scrubberFromOptions, pendingHasherFromOptions
+from sha1rules import addRuleOptions, rulesFromOptions
+from sha1virtual import ByHash, ControlNamespace, VirtualHandle
+from sha1query import QueryServer, DEFAULT_CACHE_SIZE as QUERY_CACHE_SIZE, DEFAULT_CACHE_TTL
+import sha1trace
+from sha1watch import Watcher
+from sha1profile import SamplingProfiler, OpProfiler, SignalTrigger, DEFAULT_SAMPLE_SECONDS
 
 from pysqlite2 import dbapi2 as sqlite
 import logging
@@ -43,7 +65,20 @@ import logging
 
 LOG_FILENAME = "LOG"
 logging.basicConfig(filename=LOG_FILENAME,level=logging.INFO,)
+
+# seconds that attributes are cached for, by us and by the kernel, and how many paths we cache
+DEFAULT_ATTR_CACHE_TTL = 5.0
+DEFAULT_ATTR_CACHE_SIZE = 100000
+DEFAULT_KERNEL_TIMEOUT = 5.0
+# how many half-read directory listings are kept around for the next readdir call to pick up
+DIR_CURSOR_CACHE_SIZE = 64
+DIR_CURSOR_TTL = 30.0
   
+# the namespace our checksum xattrs live in, so that getfattr -d shows them
+XATTR_PREFIX = "user."
+# cached in Sha1FS.entryCache for files without a database entry (None means not cached)
+NO_ENTRY = ()
+
 # Converts OS R/W flags to filesystem R/W flags; here to support access controls
 def flag2accessflag(flags):
   md = {os.O_RDONLY: os.R_OK, os.O_WRONLY: os.W_OK, os.O_RDWR: (os.W_OK | os.R_OK)}
@@ -51,6 +86,59 @@ def flag2accessflag(flags):
 
   return m
 
+# Returns the file type of a scandir entry as a stat.S_IF* constant, without a stat call where the 
+# directory entry's d_type tells us (which is most filesystems), or 0 if unknown
+def direntType(entry):
+  if entry.is_symlink():
+    return S_IFLNK
+  if entry.is_dir(follow_symlinks=False):
+    return S_IFDIR
+  if entry.is_file(follow_symlinks=False):
+    return S_IFREG
+  return 0
+
+# The file handle returned by Sha1FS.open.  This is deliberately tiny: reads and writes go straight
+# to the raw descriptor with pread/pwrite, so each FUSE request is a single syscall with no Python
+# level buffering, and requests on the same handle can't interfere through a shared file position.
+class Sha1Handle(object):
+  # keep_cache is only set when the page cache should survive reopening the file (see
+  # Sha1FS.keepCache); fuse-python looks for the attribute on the object open returns
+  __slots__ = ("fd", "flags", "dirty", "verifier", "keep_cache")
+
+  def __init__(self, fd, flags, verifier=None):
+    self.fd = fd
+    self.flags = flags
+    # set once the file was changed through this handle, so release knows to update its checksum
+    self.dirty = bool(flags & os.O_TRUNC)
+    # running checksum of sequential reads; dropped as soon as the handle writes
+    self.verifier = verifier
+
+  def read(self, size, offset):
+    data = pread(self.fd, size, offset)
+    if None != self.verifier:
+      self.verifier.update(offset, data)
+    return data
+
+  def write(self, buf, offset):
+    self.dirty = True
+    self.verifier = None
+    written = 0
+    while written < len(buf):
+      count = pwrite(self.fd, buf[written:], offset + written)
+      if count <= 0:
+        # no progress (e.g. a device that is full but doesn't say so); retrying would spin forever
+        raise IOError(EIO, os.strerror(EIO))
+      written += count
+    return written
+
+  def truncate(self, size):
+    self.dirty = True
+    self.verifier = None
+    os.ftruncate(self.fd, size)
+
+  def close(self):
+    os.close(self.fd)
+
 # The required FUSE class
 class Sha1FS(Xmp):
   def __init__(self, *args, **kw):
@@ -58,18 +146,85 @@ class Sha1FS(Xmp):
        
     # Initialize so we can look for this option even if the user didn't specify it
     self.rescan = False
+    self.inodeOrder = False
     # Null all the other options so we can correctly handle errors if they are missing
     self.database = None
     self.root = None
     self.useMd5 = False
+    self.scrub = False
+    self.scrubInterval = DEFAULT_SCRUB_INTERVAL
+    self.scrubRate = "0"
+    self.scrubIops = 0
+    self.scrubber = None
+    # files larger than this are hashed in the background by pendingHasher rather than on release
+    self.lazyThreshold = "0"
+    self.pendingHasher = None
+    # the shard layout of a new database (see sha1shard)
+    self.shards = 1
+    self.shardDepth = None
+    # the store backend of a new database (see sha1store)
+    self.backend = "sqlite"
+    # whether changes made to the root directly are followed (see sha1watch)
+    self.watch = False
+    self.watcher = None
+    # Unix socket path for the QueryServer, if any
+    self.querySocket = None
+    self.queryServer = None
+    self.queryCacheTtl = DEFAULT_CACHE_TTL
+    # whether operations are traced (see sha1trace); the report is logged at unmount
+    self.trace = False
+    # where profiles are written, the running SamplingProfiler and OpProfiler (see sha1profile) and
+    # the SignalTrigger starting the former on SIGUSR2
+    self.profileDir = tempfile.gettempdir()
+    self.sampler = None
+    self.opProfiler = None
+    self.signalTrigger = None
+    self.profileLock = threading.Lock()
+    # client requests touch this so that background work can back off while we're busy
+    self.activity = ActivityMonitor()
+    self.readsVerified = 0
+    self.readMismatches = 0
+    # guards the counters above; requests are served by several threads unless mounted with -s
+    self.statsLock = threading.Lock()
+    # lstat results (or negative errnos) keyed by mount path; see getattr
+    self.attrCacheTtl = DEFAULT_ATTR_CACHE_TTL
+    self.attrCacheSize = DEFAULT_ATTR_CACHE_SIZE
+    self.attrCache = None
+    # database entries (or NO_ENTRY) keyed by mount path, for the checksum xattrs
+    self.entryCache = None
+    # the checksum xattr, e.g. user.sha1; set once the database tells us the algorithm
+    self.xattrName = None
+    # VirtualNamespaces (e.g. /.by-hash) served on top of the mirrored tree
+    self.namespaces = []
+    # the lookups of /.by-hash, cached
+    self.byHashCache = None
+    # for the rates in /.sha1fs/stats
+    self.mountedAt = time.time()
+    # kernel side caching, see main
+    self.entryTimeout = DEFAULT_KERNEL_TIMEOUT
+    self.attrTimeout = DEFAULT_KERNEL_TIMEOUT
+    self.keepCache = False
+    # whether readdir stats the entries it lists to fill the attribute cache; off by default, since
+    # that costs an lstat per entry, which is what passing d_type along saves the kernel
+    self.readdirPrime = False
+    # scandir iterators of listings that didn't fit into one readdir call, keyed by (path, offset)
+    self.dirCursors = LruCache(DIR_CURSOR_CACHE_SIZE, DIR_CURSOR_TTL)
     
   # Initializes the database for this class.  If rescan is enabled, this will scan for new/updated files
   # The latter operates on the root filesystem directly here as it is basically a non FUSE operation
   def initDB(self):
-    self.sha1db = Sha1DB(self.database, self.useMd5)
+    self.sha1db = Sha1DB(self.database, self.useMd5, rulesFromOptions(self), 
+                         parseSize(self.lazyThreshold), self.shards, self.shardDepth, 
+                         self.backend)
+    self.attrCache = LruCache(self.attrCacheSize, self.attrCacheTtl)
+    self.entryCache = LruCache(self.attrCacheSize, self.attrCacheTtl)
+    self.xattrName = XATTR_PREFIX + self.sha1db.checksum().name.lower()
+    self.byHashCache = LruCache(self.attrCacheSize, self.attrCacheTtl)
+    self.namespaces = [ByHash(self.sha1db, self.root, self.byHashCache),
+                       ControlNamespace(self._stats, self._settings())]
     
     if (self.rescan):
-      self.sha1db.updateAllChecksums(self.root)
+      self.sha1db.updateAllChecksums(self.root, self.inodeOrder)
 
   def getattr(self, path):
     """
@@ -79,13 +234,20 @@ class Sha1FS(Xmp):
     Returns -errno.ENOENT if the file is not found, or another negative
     errno code if another error occurs.
     """
+    # lstat results are cached for a short while, since the kernel tends to ask for the same paths 
+    # over and over; every operation that changes a path invalidates it.  A miss costs one lstat
     with ewrap("getattr"):
-      if os.path.exists("." + path):
-        logging.debug("getattr: %s" % path)
-        return Xmp.getattr(self, path)
-      else:
-        logging.debug("Skipping getattr for nonexistent path %s" % path)
-        return -ENOENT
+      self.activity.touch()
+      st = self.attrCache.get(path)
+      if None == st:
+        logging.debug("getattr: %s", path)
+        try:
+          namespace = self._synthetic(path)
+          st = namespace.stat(path) if None != namespace else os.lstat(self._real(path))
+        except OSError as einst:
+          st = -einst.errno
+        self.attrCache.put(path, st)
+      return st
 
   def readlink(self, path):
     """
@@ -94,8 +256,8 @@ class Sha1FS(Xmp):
     May also return an int error code.
     """
     with ewrap("readlink"):
-      logging.debug("readlink: %s" % path)
-      return Xmp.readlink(self, path)
+      logging.debug("readlink: %s", path)
+      return os.readlink(self._real(path))
 
   def readdir(self, path, offset):
     """
@@ -105,26 +267,78 @@ class Sha1FS(Xmp):
     Should yield nothing if the file is not a directory or does not exist.
     (Does not need to raise an error).
     
-    offset: I don't know what this does, but I think it allows the OS to
-    request starting the listing partway through (which I clearly don't
-    yet support). Seems to always be 0 anyway.
+    offset: the offset of the last entry the kernel got from the previous
+    call, when a listing doesn't fit into one call.  Each entry we yield
+    carries its position as its offset.
+    
+    Entries are streamed from scandir, with their inode and file type
+    from the directory itself, so the kernel doesn't need a getattr just
+    to tell files from directories.  A listing that is cut short is kept
+    open so the next call can carry on where it stopped, rather than
+    reading the directory again from the start.
     """
     with ewrap("readdir"):
-      logging.debug("readdir: %s (offset %s)" % (path, offset))
-      return Xmp.readdir(self, path, offset)
+      self.activity.touch()
+      logging.debug("readdir: %s (offset %s)", path, offset)
+      cursor = self.dirCursors.pop((path, offset))
+      if None == cursor:
+        namespace = self._synthetic(path)
+        if None != namespace:
+          entries = iter(namespace.listdir(path))
+        else:
+          entries = iter(scandir(self._real(path)) if None != scandir else os.listdir(self._real(path)))
+        for skipped in xrange(offset):
+          next(entries, None)
+        cursor = (entries, None)
+      return self._readdirEntries(path, offset, *cursor)
+
+  # Generator behind readdir, yielding the entries after offset.  pending is an entry that was
+  # taken from entries but may not have made it to the kernel.  Not wrapped in ewrap, as closing
+  # the generator early (which is how the kernel stops reading) is not an error
+  def _readdirEntries(self, path, offset, entries, pending):
+    index = offset
+    entry = pending
+    try:
+      while True:
+        if None == entry:
+          entry = next(entries, None)
+          if None == entry:
+            break
+        index += 1
+        yield self._direntry(path, entry, index)
+        entry = None
+    finally:
+      if None != entry:
+        # the kernel stopped reading (its buffer was full) after the last entry we gave it,
+        # which it may not have taken; it will ask again from the entry before that
+        self.dirCursors.put((path, index - 1), (entries, entry))
+
+  # Converts a scandir (or listdir) entry into a fuse.Direntry, with the type and inode the directory
+  # entry itself carries.  With readdirPrime, the entry is also stat'ed to prime the attribute cache
+  def _direntry(self, path, entry, index):
+    if isinstance(entry, basestring):
+      return fuse.Direntry(entry, offset=index)
+    if self.readdirPrime and self.attrCache.ttl > 0:
+      try:
+        self.attrCache.put(path.rstrip("/") + "/" + entry.name, entry.stat(follow_symlinks=False))
+      except OSError:
+        pass
+    return fuse.Direntry(entry.name, type=direntType(entry), ino=entry.inode(), offset=index)
 
   def unlink(self, path):
     """Deletes a file."""
     with ewrap("unlink"):
-      logging.debug("unlink: %s" % path)
-      Xmp.unlink(self, path)
-      self.sha1db.removeChecksum(self.root + path)
+      logging.debug("unlink: %s", path)
+      os.unlink(self._real(path, write=True))
+      self._invalidate(path)
+      self.sha1db.removeChecksum(self._real(path))
 
   def rmdir(self, path):
     """Deletes a directory."""
     with ewrap("rmdir"):
-      logging.debug("rmdir: %s" % path)
-      Xmp.rmdir(self, path)
+      logging.debug("rmdir: %s", path)
+      os.rmdir(self._real(path, write=True))
+      self._invalidate(path)
 
   def symlink(self, target, name):
     """
@@ -146,8 +360,9 @@ class Sha1FS(Xmp):
     on the target system unless followed).
     """
     with ewrap("symlink"):
-      logging.debug("symlink: target %s, name: %s" % (target, name))
-      Xmp.symlink(self, target, name)
+      logging.debug("symlink: target %s, name: %s", target, name)
+      os.symlink(target, self._real(name, write=True))
+      self._invalidate(name)
 
   def rename(self, old, new):
     """
@@ -159,9 +374,11 @@ class Sha1FS(Xmp):
     manually copy and delete the file, and this method will not be called.
     """
     with ewrap("rename"):
-      logging.debug("rename: target %s, name: %s" % (self.root + old, self.root + new))
-      Xmp.rename(self, old, new)
-      self.sha1db.updatePath(self.root + old, self.root + new)
+      logging.debug("rename: target %s, name: %s", old, new)
+      os.rename(self._real(old, write=True), self._real(new, write=True))
+      # only a directory has cached paths below it, and dropping those scans the whole cache
+      self._invalidate(old, new, tree=S_ISDIR(os.lstat(self._real(new)).st_mode))
+      self.sha1db.updatePath(self._real(old), self._real(new))
 
   def link(self, target, name):
     """
@@ -170,26 +387,38 @@ class Sha1FS(Xmp):
     supported.
     """
     with ewrap("link"):
-      logging.debug("link: target %s, name: %s" % (target, name))
-      Xmp.link(self, target, name)
+      logging.debug("link: target %s, name: %s", target, name)
+      os.link(self._real(target), self._real(name, write=True))
+      self._invalidate(target, name)
 
   def chmod(self, path, mode):
     """Changes the mode of a file or directory."""
     with ewrap("chmod"):
-      logging.debug("chmod: %s (mode %s)" % (path, oct(mode)))
-      Xmp.chmod(self, path, mode)
+      logging.debug("chmod: %s (mode %#o)", path, mode)
+      os.chmod(self._real(path, write=True), mode)
+      self._invalidate(path, parent=False)
 
   def chown(self, path, user, group):
     """Changes the owner of a file or directory."""
     with ewrap("chown"):
-      logging.debug("chown: %s (uid %s, gid %s)" % (path, user, group))
-      Xmp.chown(self, path, user, group)
+      logging.debug("chown: %s (uid %s, gid %s)", path, user, group)
+      os.chown(self._real(path, write=True), user, group)
+      self._invalidate(path, parent=False)
 
   def truncate(self, path, len):
     # rewritten to ensure file closing
     with ewrap("truncate"):
-      with file("." + path, "a") as f:
+      namespace = self._synthetic(path)
+      if None != namespace:
+        return namespace.truncate(path, len)
+      with file(self._real(path, write=True), "a") as f:
         f.truncate(len)
+      self._invalidate(path, parent=False)
+      # there may not be a dirty handle to update the checksum on release
+      if self._blacklisted(path, len):
+        self.sha1db.rules.skipped(1, len)
+      else:
+        self._saveChecksum(path)
 
   def mknod(self, path, mode, rdev):
     """
@@ -218,8 +447,9 @@ class Sha1FS(Xmp):
     #   new files and directories, because they should be owned by this
     #   user/group.
     with ewrap("mknod"):
-      logging.debug("mknod: %s (mode %s, rdev %s)" % (path, oct(mode), rdev))
-      Xmp.mknod(self, path, mode, rdev)
+      logging.debug("mknod: %s (mode %#o, rdev %s)", path, mode, rdev)
+      os.mknod(self._real(path, write=True), mode, rdev)
+      self._invalidate(path)
 
   def mkdir(self, path, mode):
     """
@@ -230,8 +460,9 @@ class Sha1FS(Xmp):
     # Should be S_IDIR (040000); I guess you can assume this.
     # Also see note about self.GetContext() in mknod.
     with ewrap("mkdir"):
-      logging.debug("mkdir: %s (mode %s)" % (path, oct(mode)))
-      Xmp.mkdir(self, path, mode)
+      logging.debug("mkdir: %s (mode %#o)", path, mode)
+      os.mkdir(self._real(path, write=True), mode)
+      self._invalidate(path)
 
   def utime(self, path, times):
     """
@@ -241,8 +472,9 @@ class Sha1FS(Xmp):
     """
     with ewrap("utime"):
       atime, mtime = times
-      logging.debug("utime: %s (atime %s, mtime %s)" % (path, atime, mtime))
-      Xmp.utime(self, path, times)
+      logging.debug("utime: %s (atime %s, mtime %s)", path, atime, mtime)
+      os.utime(self._real(path, write=True), times)
+      self._invalidate(path, parent=False)
 
   def access(self, path, flags):
     """
@@ -257,12 +489,83 @@ class Sha1FS(Xmp):
     """
     # rewritten to use flag2accessflag and explicitly return 0 in the case of allowed access
     with ewrap("access"):
-      logging.debug("access: %s (flags %s)" % (path, oct(flags)))
-      if not os.access("." + path, flag2accessflag(flags)):
+      logging.debug("access: %s (flags %#o)", path, flags)
+      if flags == os.F_OK:
+        # existence is answered from the attribute cache
+        st = self.getattr(path)
+        return st if isinstance(st, int) else 0
+      namespace = self._synthetic(path)
+      if None != namespace:
+        return -EACCES if flags & os.W_OK and not namespace.writable(path) else 0
+      if not os.access(self._real(path), flag2accessflag(flags)):
         return -EACCES
       else:
         return 0
 
+  def getxattr(self, path, name, size):
+    """
+    Gets the value of an extended attribute.
+    size: the size of the caller's buffer; if 0, the length of the value
+        is returned instead.
+    Returns the value, its length, or a negative errno (-ERANGE if it is
+    bigger than size, -ENODATA if there is no such attribute).
+    
+    The checksum xattrs (see _checksumXattrs) come from the database;
+    everything else is passed through to the file in the root.
+    """
+    with ewrap("getxattr"):
+      logging.debug("getxattr: %s (name %s, size %s)", path, name, size)
+      if None != self._synthetic(path):
+        return -ENODATA
+      if name.startswith(self.xattrName):
+        value = self._checksumXattrs(path).get(name)
+        if None == value:
+          return -ENODATA
+      else:
+        value = getxattr(self._real(path), name)
+      if size == 0:
+        return len(value)
+      if len(value) > size:
+        return -ERANGE
+      return value
+
+  def listxattr(self, path, size):
+    """
+    Lists the names of the extended attributes of a file.
+    size: as for getxattr; if 0, the length of the list (names plus null
+        separators) is returned instead.
+    """
+    with ewrap("listxattr"):
+      logging.debug("listxattr: %s (size %s)", path, size)
+      if None != self._synthetic(path):
+        return 0 if size == 0 else []
+      try:
+        names = [name for name in listxattr(self._real(path)) if not name.startswith(self.xattrName)]
+      except OSError as einst:
+        if einst.errno != ENOTSUP:
+          raise
+        names = []
+      names.extend(sorted(self._checksumXattrs(path)))
+      if size == 0:
+        return len("".join(names)) + len(names)
+      return names
+
+  def setxattr(self, path, name, value, flags):
+    """Sets an extended attribute.  The checksum xattrs are read-only."""
+    with ewrap("setxattr"):
+      logging.debug("setxattr: %s (name %s, flags %s)", path, name, flags)
+      if name.startswith(self.xattrName):
+        return -EPERM
+      setxattr(self._real(path, write=True), name, value, flags)
+
+  def removexattr(self, path, name):
+    """Removes an extended attribute.  The checksum xattrs can't be removed."""
+    with ewrap("removexattr"):
+      logging.debug("removexattr: %s (name %s)", path, name)
+      if name.startswith(self.xattrName):
+        return -EPERM
+      removexattr(self._real(path, write=True), name)
+
   def statfs(self):
     """
     Should return an object with statvfs attributes (f_bsize, f_frsize...).
@@ -282,7 +585,7 @@ class Sha1FS(Xmp):
         - f_ffree - nunber of free file inodes
     """
     with ewrap("statfs"):
-      return Xmp.statfs(self)
+      return os.statvfs(self.root)
 
   def fsinit(self):
     """
@@ -297,7 +600,7 @@ class Sha1FS(Xmp):
     The mountpoint is not stored in cmdline.
     """
     with ewrap("fsinit"):
-      logging.debug("Nonoption arguments: " + str(self.cmdline[1]))
+      logging.debug("Nonoption arguments: %s", self.cmdline[1])
       
       
       #self.xyz = self.cmdline[0].xyz
@@ -307,7 +610,48 @@ class Sha1FS(Xmp):
       #   logging.debug("xyz not set")
       
       Xmp.fsinit(self)
-      logging.debug("Filesystem %s mounted" % self.root)
+      logging.debug("Filesystem %s mounted", self.root)
+      self.mountedAt = time.time()
+      if self.trace:
+        sha1trace.enable()
+      
+      if None != self.signalTrigger:
+        self.signalTrigger.start(lambda: self._startSampling(DEFAULT_SAMPLE_SECONDS))
+      # started here rather than at mount time so the thread survives daemonizing
+      if self.scrub:
+        self.scrubber = scrubberFromOptions(self.sha1db, self, self.scrubInterval, 
+                                            self.activity.busy)
+        self.scrubber.start()
+      if self.sha1db.lazyThreshold > 0:
+        self.pendingHasher = pendingHasherFromOptions(self.sha1db, self, self.activity.busy)
+        self.pendingHasher.start()
+      if self.watch:
+        self.watcher = Watcher(self.sha1db, self.root, changed=self._changedOutside)
+        self.watcher.start()
+      if None != self.querySocket:
+        self.queryServer = QueryServer(self.querySocket, self.sha1db, 
+                                       LruCache(QUERY_CACHE_SIZE, self.queryCacheTtl))
+        self.queryServer.start()
+        
+  def fsdestroy(self):
+    """
+    Called when the filesystem is unmounted, to clean up.
+    """
+    with ewrap("fsdestroy"):
+      if None != self.queryServer:
+        self.queryServer.stop()
+      # everything that works on the database in the background has to be done with it before it
+      # is closed (which is when a log store is synced for the last time)
+      workers = [worker for worker in (self.watcher, self.scrubber, self.pendingHasher) 
+                 if None != worker]
+      for worker in workers:
+        worker.stop()
+      for worker in workers:
+        worker.join()
+      self.sha1db.close()
+      self._stopTracing()
+      self._setProfile("0")
+      self._setProfileOp("")
 
   ### FILE OPERATION METHODS ###
   # Methods in this section are operations for opening files and working on
@@ -338,18 +682,25 @@ class Sha1FS(Xmp):
     Should return -errno.EACCES if disallowed.
     """
     with ewrap("open"):
-      mode = flag2mode(flags)
-      logging.debug("open: %s (flags %s) (mode %s)" % (path, oct(flags), mode))
+      self.activity.touch()
+      logging.debug("open: %s (flags %#o)", path, flags)
+      writing = bool(flags & (os.O_WRONLY | os.O_RDWR | os.O_TRUNC))
+      namespace = self._synthetic(path)
+      if None != namespace:
+        return -EROFS if writing and not namespace.writable(path) else namespace.open(path, flags)
   
-      fh = os.fdopen(os.open("." + path, flags), flag2mode(flags))
-      
-      if fh is None:
-        return -ENOENT
+      fh = Sha1Handle(os.open(self._real(path, write=writing), flags), flags, 
+                      ReadVerifier(self.sha1db.checksum))
+      if fh.dirty or (flags & os.O_CREAT):
+        self._invalidate(path)
+      if self.keepCache:
+        fh.keep_cache = True
       
       context = self.GetContext()
       accessflags = flag2accessflag(flags)
       #if not fh.stat.check_permission(context['uid'], context['gid'], accessflags):
-      if not os.access("." + path, accessflags):
+      if not os.access(self._real(path), accessflags):
+        fh.close()
         return -EACCES
   
       return fh
@@ -387,10 +738,12 @@ class Sha1FS(Xmp):
     available (and it is a non-blocking read), return -errno.EAGAIN.
     If it is a blocking read, just block until ready.
     """
-    with ewrap("read"):
-      logging.debug("read: %s (size %s, offset %s, fh %s)" % (path, size, offset, fh))
-      fh.seek(offset)
-      return fh.read(size)
+    with ewrap("read") as op:
+      self.activity.touch()
+      logging.debug("read: %s (size %s, offset %s, fh %s)", path, size, offset, fh)
+      data = fh.read(size, offset)
+      op.nbytes = len(data)
+      return data
     
   def write(self, path, buf, offset, fh=None):
     """
@@ -406,12 +759,14 @@ class Sha1FS(Xmp):
     be equal to len(buf) unless an error occured). May also be a negative
     int, which is an errno code.
     """
-    with ewrap("write"):
-      logging.debug("write: %s (offset %s, fh %s)" % (path, offset, fh))
-      logging.debug("  buf: %r" % buf)
-      fh.seek(offset)
-      fh.write(buf)
-      return len(buf)
+    with ewrap("write") as op:
+      self.activity.touch()
+      logging.debug("write: %s (%d bytes at offset %s, fh %s)", path, len(buf), offset, fh)
+      op.nbytes = len(buf)
+      written = fh.write(buf, offset)
+      # after the write, or a getattr racing with it could cache the old size and times again
+      self._invalidate(path, parent=False)
+      return written
     
   def fgetattr(self, path, fh=None):
     """
@@ -420,8 +775,10 @@ class Sha1FS(Xmp):
     so it can use that instead of having to look up the path.
     """
     with ewrap("fgetattr"):
-      logging.debug("fgetattr: %s (fh %s)" % (path, fh))
-      return os.fstat(fh.fileno())
+      logging.debug("fgetattr: %s (fh %s)", path, fh)
+      if isinstance(fh, VirtualHandle):
+        return fh.stat()
+      return os.fstat(fh.fd)
     
   def ftruncate(self, path, size, fh=None):
     """
@@ -430,12 +787,9 @@ class Sha1FS(Xmp):
     so it can use that instead of having to look up the path.
     """
     with ewrap("ftruncate"):
-      logging.debug("ftruncate: %s (size %s, fh %s)" % (path, size, fh))
+      logging.debug("ftruncate: %s (size %s, fh %s)", path, size, fh)
       fh.truncate(size)
-    
-  def _fflush(self, fh):
-    if 'w' in fh.mode or 'a' in fh.mode:
-      fh.flush()
+      self._invalidate(path, parent=False)
     
   def flush(self, path, fh=None):
     """
@@ -444,10 +798,11 @@ class Sha1FS(Xmp):
     while flush is just one-way).
     """
     with ewrap("flush"):
-      logging.debug("flush: %s (fh %s)" % (path, fh))
-      self._fflush(fh)
+      logging.debug("flush: %s (fh %s)", path, fh)
+      if isinstance(fh, VirtualHandle):
+        return fh.flush()
       # cf. xmp_flush() in fusexmp_fh.c
-      os.close(os.dup(fh.fileno()))
+      os.close(os.dup(fh.fd))
     
   def release(self, path, flags, fh=None):
     """
@@ -455,22 +810,101 @@ class Sha1FS(Xmp):
     flags: The same flags the file was opened with (see open).
     """
     with ewrap("release"):
-      logging.debug("release: %s (flags %s, fh %s)" % (path, oct(flags), fh))
+      self.activity.touch()
+      logging.debug("release: %s (flags %#o, fh %s)", path, flags, fh)
+      if isinstance(fh, VirtualHandle):
+        return
+      st = os.fstat(fh.fd)
       fh.close()
+      if fh.dirty:
+        self._invalidate(path, parent=False)
       
-      if not self._blacklisted(path):
-        saved = False
-        count = 0
-        while (not saved and count < 5):
-          count += 1
-          try:
-            self.sha1db.updateChecksum(self.root + path)
-            saved = True
-          except Exception as einst:
-            logging.warn("Update failed; trying again")
-            
-        if not saved:
-          logging.error("Unable to update checksum; quitting")
+      if self._blacklisted(path, st.st_size):
+        if fh.dirty:
+          # a release that would have hashed the file
+          self.sha1db.rules.skipped(1, st.st_size)
+      elif fh.dirty:
+        self._saveChecksum(path)
+      else:
+        self._verifyRead(path, st, fh.verifier)
+          
+  # Called when a handle that didn't change the file is released, so there is no need to hash it 
+  # again; if the client read all of it from the start, compare what it read against the stored 
+  # checksum instead, which verifies the file without any extra I/O
+  def _verifyRead(self, path, st, verifier):
+    complete = (None != verifier and S_ISREG(st.st_mode) and verifier.complete(st.st_size)
+                and st.st_mtime < verifier.openedAt)
+    stored = self.sha1db.getChecksum(self._real(path), hashPending=False)
+    if None == stored:
+      # not in the database yet, e.g. created outside of the mount
+      self._saveChecksum(path, verifier.hexdigest() if complete else None)
+    elif PENDING_CHECKSUM == stored:
+      # a large file the pending hasher hasn't got to yet; the client just did its work for it
+      if complete:
+        self._saveChecksum(path, verifier.hexdigest())
+    elif complete:
+      matched = (verifier.hexdigest() == stored)
+      with self.statsLock:
+        if matched:
+          self.readsVerified += 1
+        else:
+          self.readMismatches += 1
+      if not matched:
+        logging.error("Checksum mismatch reading %s: expected %s, found %s" % 
+          (self._real(path), stored, verifier.hexdigest()))
+      self.sha1db.recordVerification(self._real(path), stored, matched)
+      self.entryCache.invalidate(path)
+      
+  # The checksum xattrs of path, as a dict of name to value.  With the default user.sha1:
+  #   user.sha1 - the stored checksum (missing while pending)
+  #   user.sha1.verified - when the checksum was last calculated or verified, in seconds since epoch
+  #   user.sha1.state - ok, pending (not hashed yet), unverified (imported from a manifest and not 
+  #     verified yet), mismatch (failed verification) or stale (the file changed since it was hashed
+  #     and the new checksum hasn't been stored yet)
+  # Files without a database entry have none.  Entries are cached like attributes, so they may lag
+  # behind the background scrubber by up to --attr-cache-ttl seconds.
+  def _checksumXattrs(self, path):
+    entry = self.entryCache.get(path)
+    if None == entry:
+      entry = self.sha1db.getEntry(self._real(path)) or NO_ENTRY
+      self.entryCache.put(path, entry)
+    if NO_ENTRY == entry:
+      return {}
+    (chksum, pending, mismatch, verified, size, mtime) = entry
+    
+    if UNVERIFIED == pending:
+      state = "unverified"
+    elif pending:
+      state = "pending"
+    elif mismatch:
+      state = "mismatch"
+    else:
+      state = "ok"
+      st = self.getattr(path)
+      if not isinstance(st, int) and None != size and (st.st_size, st.st_mtime) != (size, mtime):
+        state = "stale"
+        
+    xattrs = {self.xattrName + ".state": state}
+    if PENDING_CHECKSUM != chksum:
+      xattrs[self.xattrName] = str(chksum)
+    if None != verified:
+      xattrs[self.xattrName + ".verified"] = "%.6f" % verified
+    return xattrs
+    
+  def _saveChecksum(self, path, chksum=None):
+    saved = False
+    count = 0
+    while (not saved and count < 5):
+      count += 1
+      try:
+        self.sha1db.updateChecksum(self._real(path), chksum)
+        saved = True
+      except Exception as einst:
+        logging.warn("Update failed; trying again")
+        
+    if not saved:
+      logging.error("Unable to update checksum; quitting")
+    self.entryCache.invalidate(path)
     
   def fsync(self, path, datasync, fh=None):
     """
@@ -478,19 +912,217 @@ class Sha1FS(Xmp):
     datasync: If True, only flush user data, not metadata.
     """
     with ewrap("fsync"):
-      logging.debug("fsync: %s (datasync %s, fh %s)" % (path, datasync, fh))
-      self._fflush(fh)
+      logging.debug("fsync: %s (datasync %s, fh %s)", path, datasync, fh)
+      if isinstance(fh, VirtualHandle):
+        return
       if datasync and hasattr(os, 'fdatasync'):
-        os.fdatasync(fh.fileno())
+        os.fdatasync(fh.fd)
       else:
-        os.fsync(fh.fileno())
+        os.fsync(fh.fd)
         
-  def _blacklisted(self, path):
-    """Returns true if the path should not be kept in the checksum list."""
-    return path.find(".Trash") >= 0
+  # The contents of /.sha1fs/stats.  Rates are averages since the filesystem was mounted; operation
+  # counts and latencies are only there while tracing
+  def _stats(self):
+    uptime = max(time.time() - self.mountedAt, 1e-9)
+    (pendingFiles, pendingBytes) = self.sha1db.pendingBacklog()
+    tracer = sha1trace.tracer
+    commits = self.sha1db.commits()
+    caches = [("attr", self.attrCache), ("entry", self.entryCache), ("by_hash", self.byHashCache),
+              ("dir_cursors", self.dirCursors)]
+    if None != self.queryServer:
+      caches.append(("query", self.queryServer.cache))
+    stats = {
+      "uptime": uptime,
+      "operations": tracer.snapshot() if None != tracer else None,
+      "hashing": {
+        "files": self.sha1db.filesHashed,
+        "bytes": self.sha1db.bytesHashed,
+        "bytes_per_sec": self.sha1db.bytesHashed / uptime,
+        "pending_files": pendingFiles,
+        "pending_bytes": pendingBytes,
+        "skipped_files": self.sha1db.rules.skippedFiles,
+        "skipped_bytes": self.sha1db.rules.skippedBytes,
+        "skipped_directories": self.sha1db.rules.skippedDirectories,
+      },
+      "database": {"commits": commits, "commits_per_sec": commits / uptime},
+      "caches": dict((name, self._cacheStats(cache)) for (name, cache) in caches),
+      "reads": {"verified": self.readsVerified, "mismatches": self.readMismatches},
+      "scrubber": self._hasherStats(self.scrubber, uptime),
+      "pending_hasher": self._hasherStats(self.pendingHasher, uptime),
+      "query_server": None,
+      "watcher": None,
+    }
+    if None != self.queryServer:
+      stats["query_server"] = {"requests": self.queryServer.requests, 
+                               "lookups": self.queryServer.lookups}
+    if None != self.watcher:
+      stats["watcher"] = {"watches": len(self.watcher.paths), "updated": self.watcher.filesUpdated,
+                          "removed": self.watcher.entriesRemoved, "moved": self.watcher.moved,
+                          "overflows": self.watcher.overflows}
+    return stats
+    
+  def _cacheStats(self, cache):
+    lookups = cache.hits + cache.misses
+    return {"hits": cache.hits, "misses": cache.misses, "entries": len(cache),
+            "hit_rate": float(cache.hits) / lookups if lookups else None}
+            
+  # Progress of a Scrubber (or PendingHasher), or None if it isn't running
+  def _hasherStats(self, hasher, uptime):
+    if None == hasher:
+      return None
+    return {"files": hasher.filesVerified, "bytes": hasher.bytesVerified, 
+            "bytes_per_sec": hasher.bytesVerified / uptime, "mismatches": hasher.mismatches,
+            "rate_limit": hasher.limiter.bytesPerSec, "iops_limit": hasher.limiter.iops}
+    
+  # The settings that can be changed through /.sha1fs/control, as name: (get, set)
+  def _settings(self):
+    return {
+      "scrub-rate": (lambda: str(parseSize(self.scrubRate)), self._setScrubRate),
+      "scrub-iops": (lambda: str(self.scrubIops), self._setScrubIops),
+      "log-level": (lambda: logging.getLevelName(logging.getLogger().getEffectiveLevel()), 
+                    self._setLogLevel),
+      "trace": (lambda: "1" if None != sha1trace.tracer else "0", self._setTrace),
+      "profile": (lambda: "%d" % math.ceil(self.sampler.remaining() if None != self.sampler else 0),
+                  self._setProfile),
+      "profile-op": (lambda: self.opProfiler.opName if None != self.opProfiler else "",
+                     self._setProfileOp),
+    }
+    
+  # The background hashers, whose rate limits the scrub settings change
+  def _hashers(self):
+    return [hasher for hasher in (self.scrubber, self.pendingHasher) if None != hasher]
+    
+  def _setScrubRate(self, value):
+    rate = parseSize(value)
+    self.scrubRate = value
+    for hasher in self._hashers():
+      hasher.limiter.bytesPerSec = rate
+      
+  def _setScrubIops(self, value):
+    self.scrubIops = int(value)
+    for hasher in self._hashers():
+      hasher.limiter.iops = self.scrubIops
+      
+  def _setLogLevel(self, value):
+    level = logging.getLevelName(value.upper())
+    if not isinstance(level, int):
+      raise ValueError("unknown log level %s" % value)
+    logging.getLogger().setLevel(level)
+    
+  def _setTrace(self, value):
+    if not value in ("0", "1"):
+      raise ValueError("trace is 0 or 1")
+    self.trace = ("1" == value)
+    if self.trace:
+      sha1trace.enable()
+    else:
+      self._stopTracing()
+      
+  # Turns tracing off, logging what it found
+  def _stopTracing(self):
+    tracer = sha1trace.disable()
+    if None != tracer:
+      logging.info("Operation trace:\n%s" % "\n".join(tracer.report()))
+      
+  # Returns the path of a new profile called sha1fs-PID-TIME with suffix
+  def _profilePath(self, suffix):
+    return os.path.join(self.profileDir, "sha1fs-%d-%s%s" % 
+                        (os.getpid(), time.strftime("%Y%m%d-%H%M%S"), suffix))
+    
+  # Samples all stacks for seconds, unless that is already happening
+  def _startSampling(self, seconds):
+    with self.profileLock:
+      if None != self.sampler and self.sampler.remaining() > 0:
+        logging.info("Already sampling stacks into %s" % self.sampler.output)
+        return
+      self.sampler = SamplingProfiler(self._profilePath(".collapsed"), seconds)
+      self.sampler.start()
+    logging.info("Sampling stacks for %ds into %s" % (seconds, self.sampler.output))
+      
+  def _setProfile(self, value):
+    seconds = int(value)
+    if seconds < 0:
+      raise ValueError("profile is a number of seconds")
+    if seconds > 0:
+      self._startSampling(seconds)
+    else:
+      with self.profileLock:
+        (sampler, self.sampler) = (self.sampler, None)
+      if None != sampler and sampler.is_alive():
+        sampler.stop()
+        sampler.join()
+    
+  # Profiles operations named value with cProfile from now on (or none if value is empty), writing
+  # the profile of the previous one
+  def _setProfileOp(self, value):
+    if value and not callable(getattr(self, value, None)):
+      raise ValueError("unknown operation %s" % value)
+    with self.profileLock:
+      previous = self.opProfiler
+      self.opProfiler = None
+      if value:
+        self.opProfiler = OpProfiler(value, self._profilePath("-%s.pstats" % value))
+        self.opProfiler.start()
+    if None != previous:
+      previous.stop()
+    
+  # Drops the cached attributes (and database entries) of paths after they were changed, along with
+  # those of their parent directories (whose size, times and link counts change when entries are added
+  # or removed) unless parent is False.  tree also drops everything below the paths, for renamed
+  # directories.
+  def _invalidate(self, *paths, **kw):
+    for path in paths:
+      if kw.get("tree", False):
+        self.attrCache.invalidatePrefix(path)
+        self.entryCache.invalidatePrefix(path)
+      else:
+        self.attrCache.invalidate(path)
+        self.entryCache.invalidate(path)
+      if kw.get("parent", True):
+        self.attrCache.invalidate(os.path.dirname(path))
+    
+  # Called by the watcher with the root path of anything changed outside of the mount, so that we
+  # stop serving cached attributes for it
+  def _changedOutside(self, real, isdir):
+    self._invalidate(real[len(self.root.rstrip("/")):] or "/", tree=isdir)
+    
+  # Returns the path in the root filesystem for a path in the mount.  Every operation goes through
+  # here rather than relying on the current directory (as Xmp does), so that nothing depends on
+  # process-wide state when requests are served by several threads at once.  This is also the path
+  # stored in the database.  Paths in a virtual namespace map to the real file they stand in for;
+  # they are read-only, so operations that change path pass write=True to get EROFS for those.
+  def _real(self, path, write=False):
+    namespace = self._namespace(path)
+    if None != namespace:
+      if write:
+        raise OSError(EROFS, os.strerror(EROFS))
+      return namespace.real(path)
+    return self.root + path
+    
+  # Returns the virtual namespace path is in, or None for paths in the mirrored tree
+  def _namespace(self, path):
+    if path.startswith("/."):
+      for namespace in self.namespaces:
+        if namespace.contains(path):
+          return namespace
+    return None
+    
+  # Returns the namespace serving path if path is a synthetic virtual node (see VirtualNamespace)
+  def _synthetic(self, path):
+    namespace = self._namespace(path)
+    if None != namespace and namespace.synthetic(path):
+      return namespace
+    return None
+    
+  def _blacklisted(self, path, size=None):
+    """Returns true if the path should not be kept in the checksum list, according to the exclude
+    rules given at mount time.  size is the file's size, if known."""
+    return self.sha1db.rules.excluded(self._real(path), size)
 
   def main(self, *a, **kw):
     #self.file_class = self.Sha1File
+    # this is the main thread, the only one signal handlers can be installed from
+    self.signalTrigger = SignalTrigger(signal.SIGUSR2)
     return Fuse.main(self, *a, **kw)
 
 def main():
@@ -515,6 +1147,11 @@ Userspace SHA1 checksum FS: mirror the filesystem tree, adding and updating file
                          dest = "rescan",
                          default = False,
                          help = "(Re)calculate checksums at mount time.")
+  server.parser.add_option("--inode-order",
+                         action = "store_true",
+                         dest = "inodeOrder",
+                         default = False,
+                         help = "Hash each directory's files in inode order during --rescan (fewer seeks on spinning disks).")
 
   server.parser.add_option("--use-md5",
                          action = "store_true",
@@ -522,6 +1159,118 @@ Userspace SHA1 checksum FS: mirror the filesystem tree, adding and updating file
                          default = False,
                          help = "Use the (faster) MD5 checksum instead of SHA1.")
 
+  server.parser.add_option("--scrub",
+                         action = "store_true",
+                         dest = "scrub",
+                         default = False,
+                         help = "Re-verify stored checksums in the background while mounted.")
+  server.parser.add_option("--scrub-interval",
+                         dest = "scrubInterval",
+                         type = "int",
+                         default = DEFAULT_SCRUB_INTERVAL,
+                         help = "Re-verify each file every SECONDS while scrubbing [default: %default]",
+                         metavar = "SECONDS")
+  addScrubOptions(server.parser)
+  addRuleOptions(server.parser)
+  server.parser.add_option("--query-socket",
+                         dest = "querySocket",
+                         help = "Answer checksum lookups on a Unix socket at PATH (see sha1query.py)",
+                         metavar = "PATH")
+  server.parser.add_option("--query-cache-ttl",
+                         dest = "queryCacheTtl",
+                         type = "float",
+                         default = DEFAULT_CACHE_TTL,
+                         help = "Cache socket lookups for SECONDS; only worth it if the database is on "
+                                "slow storage [default: %default]",
+                         metavar = "SECONDS")
+  server.parser.add_option("--lazy-threshold",
+                         dest = "lazyThreshold",
+                         default = "0",
+                         help = "Hash files larger than SIZE (e.g. 1G) in the background when the mount is "
+                                "idle, rather than when they are closed [default: never]",
+                         metavar = "SIZE")
+
+  server.parser.add_option("--shards",
+                         dest = "shards",
+                         type = "int",
+                         default = 1,
+                         help = "Split a new database into COUNT files, so that writers in different "
+                                "directories don't wait on each other (see sha1db.py --reshard for "
+                                "existing ones) [default: %default]",
+                         metavar = "COUNT")
+  server.parser.add_option("--shard-depth",
+                         dest = "shardDepth",
+                         type = "int",
+                         help = "Route the entries of a new sharded database by the first DEPTH "
+                                "components of their directory [default: the whole directory]",
+                         metavar = "DEPTH")
+  server.parser.add_option("--backend",
+                         dest = "backend",
+                         default = "sqlite",
+                         help = "Keep the entries of a new database in BACKEND stores: sqlite, or log "
+                                "for an append-only log held in memory, which commits faster "
+                                "(see sha1store.py) [default: %default]",
+                         metavar = "BACKEND")
+
+  server.parser.add_option("--watch",
+                         action = "store_true",
+                         dest = "watch",
+                         default = False,
+                         help = "Follow changes made to the root directly, not through the mount, with "
+                                "inotify")
+
+  server.parser.add_option("--trace",
+                         action = "store_true",
+                         dest = "trace",
+                         default = False,
+                         help = "Count and time every operation, logging latency percentiles and the time "
+                                "spent hashing, in SQLite and waiting for locks at unmount")
+
+  server.parser.add_option("--profile-dir",
+                         dest = "profileDir",
+                         default = tempfile.gettempdir(),
+                         help = "Write profiles (started with SIGUSR2 or through /.sha1fs/control) to DIR "
+                                "[default: %default]",
+                         metavar = "DIR")
+
+  server.parser.add_option("--attr-cache-ttl",
+                         dest = "attrCacheTtl",
+                         type = "float",
+                         default = DEFAULT_ATTR_CACHE_TTL,
+                         help = "Cache file attributes for SECONDS; 0 disables the cache [default: %default]",
+                         metavar = "SECONDS")
+  server.parser.add_option("--attr-cache-size",
+                         dest = "attrCacheSize",
+                         type = "int",
+                         default = DEFAULT_ATTR_CACHE_SIZE,
+                         help = "Cache the attributes of at most COUNT paths [default: %default]",
+                         metavar = "COUNT")
+  server.parser.add_option("--entry-timeout",
+                         dest = "entryTimeout",
+                         type = "float",
+                         default = DEFAULT_KERNEL_TIMEOUT,
+                         help = "Let the kernel cache name lookups for SECONDS [default: %default]",
+                         metavar = "SECONDS")
+  server.parser.add_option("--attr-timeout",
+                         dest = "attrTimeout",
+                         type = "float",
+                         default = DEFAULT_KERNEL_TIMEOUT,
+                         help = "Let the kernel cache file attributes for SECONDS [default: %default]",
+                         metavar = "SECONDS")
+  server.parser.add_option("--keep-cache",
+                         action = "store_true",
+                         dest = "keepCache",
+                         default = False,
+                         help = "Keep file contents in the page cache across opens.  Only safe if files "
+                                "are not changed outside of the mount.")
+  server.parser.add_option("--readdir-prime",
+                         action = "store_true",
+                         dest = "readdirPrime",
+                         default = False,
+                         help = "Stat directory entries while listing them to fill the attribute cache "
+                                "(an lstat per entry; pays off when listings are mostly followed by "
+                                "stats, as with ls -l).")
+
   server.parse(values=server, errex=1)
   if not server.fuse_args.mountpoint:
     server.parser.print_help()
@@ -538,6 +1287,18 @@ Userspace SHA1 checksum FS: mirror the filesystem tree, adding and updating file
     print >> sys.stderr, "Error: Missing root filesystem."
     sys.exit(2)
 
+  # every operation works on absolute paths built from the root (see Sha1FS._real)
+  server.root = os.path.abspath(server.root)
+  if None != server.querySocket:
+    server.querySocket = os.path.abspath(server.querySocket)
+  server.profileDir = os.path.abspath(server.profileDir)
+  
+  # -o entry_timeout=N / attr_timeout=N given directly still win
+  if not "entry_timeout" in server.fuse_args.optdict:
+    server.fuse_args.add("entry_timeout", str(server.entryTimeout))
+  if not "attr_timeout" in server.fuse_args.optdict:
+    server.fuse_args.add("attr_timeout", str(server.attrTimeout))
+
   try:
     if server.fuse_args.mount_expected():
       #print "Mounting", server.root, "at", server.fuse_args.mountpoint
@@ -0,0 +1,114 @@
+# Reading and writing checksum manifests in the format of sha1sum/md5sum
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+# A manifest has one line per file: the hex checksum, a space, " " (text mode) or "*" (binary mode)
+# and the file name, e.g.
+#
+#   f572d396fae9206628714fb2ce00f72e94f2258f  photos/2010/img_0001.jpg
+#
+# Names containing a backslash, newline or carriage return are escaped (\\, \n and \r) and their
+# line starts with a backslash, as coreutils does.  Names are relative to a root directory (the
+# directory sha1sum was run in) unless they are absolute.  Names are UTF-8.
+#
+
+import logging
+import os
+
+_ESCAPES = [("\\", "\\\\"), ("\n", "\\n"), ("\r", "\\r")]
+
+def formatManifestLine(chksum, name):
+  """Returns the manifest line (with its newline) for the file name with checksum chksum."""
+  if isinstance(name, unicode):
+    name = name.encode("utf-8")
+  escaped = name
+  for (char, escape) in _ESCAPES:
+    escaped = escaped.replace(char, escape)
+  return "%s%s  %s\n" % ("\\" if escaped != name else "", chksum, escaped)
+
+def escapeField(name):
+  """Returns name as UTF-8 with backslashes, newlines, carriage returns and tabs escaped, so it can
+  be written as one field of a line of tab separated fields."""
+  if isinstance(name, unicode):
+    name = name.encode("utf-8")
+  for (char, escape) in _ESCAPES + [("\t", "\\t")]:
+    name = name.replace(char, escape)
+  return name
+
+def parseManifestLine(line):
+  """Returns the (checksum, name) of a manifest line, the checksum in lower case and the name
+  unescaped and decoded.  Returns None for lines that aren't in the manifest format."""
+  line = line.rstrip("\r\n")
+  escaped = line.startswith("\\")
+  if escaped:
+    line = line[1:]
+  (chksum, sep, rest) = line.partition(" ")
+  if not sep or not chksum or chksum.strip("0123456789abcdefABCDEF") or rest[:1] not in (" ", "*"):
+    return None
+  name = rest[1:]
+  if escaped:
+    name = _unescape(name)
+    if None == name:
+      return None
+  if not name:
+    return None
+  try:
+    return (chksum.lower(), name.decode("utf-8"))
+  except UnicodeDecodeError:
+    return None
+
+# Undoes the escaping of formatManifestLine; None if name has an unknown escape
+def _unescape(name):
+  out = []
+  i = 0
+  while i < len(name):
+    c = name[i]
+    if "\\" == c:
+      out.append({"\\": "\\", "n": "\n", "r": "\r"}.get(name[i + 1:i + 2]))
+      if None == out[-1]:
+        return None
+      i += 2
+    else:
+      out.append(c)
+      i += 1
+  return "".join(out)
+
+class ManifestReader:
+  """Iterates over the (checksum, absolute path) entries of the manifest in the file f, resolving
+  relative names against root.  If digestLength is given, checksums of any other length (e.g. MD5
+  sums in a SHA1 database) are rejected.  Lines that can't be used are logged and counted in
+  malformed rather than stopping the import, like sha1sum --check does."""
+  def __init__(self, f, root, digestLength=None):
+    self.f = f
+    self.root = os.path.abspath(root)
+    self.digestLength = digestLength
+    self.malformed = 0
+
+  def __iter__(self):
+    for (lineno, line) in enumerate(self.f, 1):
+      entry = parseManifestLine(line)
+      if None != entry and None != self.digestLength and len(entry[0]) != self.digestLength:
+        entry = None
+      if None == entry:
+        if line.strip():
+          logging.warn("Ignoring line %d of the manifest: not a valid checksum line" % lineno)
+          self.malformed += 1
+        continue
+      (chksum, name) = entry
+      yield (chksum, os.path.normpath(os.path.join(self.root, name)))
+
+def writeManifest(f, entries, root):
+  """Writes the (checksum, absolute path) entries to the file f as a manifest, with the names of
+  paths under root relative to it (so that sha1sum --check can be run in root) and any others
+  absolute.  Returns the number of entries written."""
+  root = os.path.abspath(root).rstrip("/") + "/"
+  count = 0
+  for (chksum, path) in entries:
+    if path.startswith(root):
+      path = path[len(root):]
+    f.write(formatManifestLine(chksum, path))
+    count += 1
+  return count
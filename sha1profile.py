@@ -0,0 +1,186 @@
+# On demand profiling of a running filesystem: stack sampling and per-operation cProfile
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+# A SamplingProfiler looks at the Python stacks of all threads (the FUSE workers, the scrubber, the
+# pending hasher, the query server...) every few milliseconds for a while and writes how often each
+# stack was seen in the "collapsed" format flamegraph.pl and speedscope read:
+#
+#   Dummy-3;main (sha1fs.py);release (sha1fs.py);updatePath (sha1db.py) 12
+#
+# Threads waiting in C for their next FUSE request have no Python stack and aren't counted, so the
+# output shows where the time of requests and background work goes.  Nothing is slowed down except
+# by the sampling itself.
+#
+# An OpProfiler runs cProfile around every operation of one kind (e.g. release), and nothing else,
+# for a call-level profile of that operation without paying for profiling all the others.  ewrap
+# checks the module's opProfiler, which is None unless one is running.
+#
+
+import cProfile
+import fcntl
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+from errno import EINTR
+
+# the active OpProfiler, or None
+opProfiler = None
+
+# seconds between samples, and how long a sampling run lasts unless told otherwise
+DEFAULT_SAMPLE_INTERVAL = 0.01
+DEFAULT_SAMPLE_SECONDS = 30
+
+def frameName(frame):
+  """Returns the name a frame has in collapsed stacks: its function and file."""
+  code = frame.f_code
+  return ("%s (%s)" % (code.co_name, os.path.basename(code.co_filename))).replace(";", ":")
+
+class SamplingProfiler(threading.Thread):
+  """Samples the stacks of all other threads every interval seconds for duration seconds (or until
+  stop is called) and then writes them to the file output as collapsed stacks."""
+  def __init__(self, output, duration=DEFAULT_SAMPLE_SECONDS, interval=DEFAULT_SAMPLE_INTERVAL):
+    threading.Thread.__init__(self, name="sampling-profiler")
+    self.daemon = True
+    self.output = output
+    self.duration = duration
+    self.interval = interval
+    self.deadline = None
+    self.samples = 0
+    # how often each stack (threads' names first, innermost frame last) was seen
+    self.stacks = {}
+    self._stopped = False
+
+  def remaining(self):
+    """Returns the seconds left to sample (0 once done)."""
+    if None == self.deadline or self._stopped or not self.is_alive():
+      return 0
+    return max(0, self.deadline - time.time())
+
+  def stop(self):
+    """Ends sampling early; the stacks seen so far are still written."""
+    self._stopped = True
+
+  def run(self):
+    self.deadline = time.time() + self.duration
+    while not self._stopped and time.time() < self.deadline:
+      self.sample()
+      time.sleep(self.interval)
+    self.write()
+
+  def sample(self):
+    """Counts the current stack of every other thread."""
+    names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+    for (ident, frame) in sys._current_frames().iteritems():
+      if ident == self.ident:
+        continue
+      stack = []
+      while None != frame:
+        stack.append(frameName(frame))
+        frame = frame.f_back
+      stack.append(names.get(ident, "thread-%d" % ident).replace(";", ":"))
+      key = ";".join(reversed(stack))
+      self.stacks[key] = self.stacks.get(key, 0) + 1
+    self.samples += 1
+
+  def write(self):
+    with open(self.output, "w") as f:
+      for (stack, count) in sorted(self.stacks.iteritems()):
+        f.write("%s %d\n" % (stack, count))
+    logging.info("Wrote %d samples of %d stacks to %s" %
+                 (self.samples, len(self.stacks), self.output))
+
+class OpProfiler:
+  """Profiles every operation named opName with cProfile while it is the active opProfiler (see
+  start).  A cProfile.Profile can only follow one thread, so each thread gets its own and they are
+  merged when the results are written to the file output (in the format of pstats.Stats.dump_stats,
+  for python -m pstats, snakeviz or gprof2dot)."""
+  def __init__(self, opName, output):
+    self.opName = opName
+    self.output = output
+    self.ops = 0
+    self._profiles = []
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def start(self):
+    """Makes this the active opProfiler."""
+    global opProfiler
+    opProfiler = self
+
+  def stop(self):
+    """Stops profiling (if this is the active opProfiler) and writes the results."""
+    global opProfiler
+    if opProfiler is self:
+      opProfiler = None
+    stats = None
+    with self._lock:
+      for profile in self._profiles:
+        if None == stats:
+          stats = pstats.Stats(profile)
+        else:
+          stats.add(profile)
+    if None != stats:
+      stats.dump_stats(self.output)
+    logging.info("Wrote the profile of %d %s operations to %s" % (self.ops, self.opName, self.output))
+
+  def opStarted(self, name):
+    """Called by ewrap as operation name starts; returns the enabled profile of the calling thread if
+    name is profiled (ewrap disables it when the operation is done), otherwise None."""
+    if name != self.opName:
+      return None
+    profile = getattr(self._local, "profile", None)
+    if None == profile:
+      profile = self._local.profile = cProfile.Profile()
+      with self._lock:
+        self._profiles.append(profile)
+    with self._lock:
+      self.ops += 1
+    profile.enable()
+    return profile
+
+class SignalTrigger:
+  """Calls a function whenever the process gets the signal signum (e.g. SIGUSR2).
+
+  Python runs signal handlers on the main thread, between bytecodes, and the main thread of a FUSE
+  filesystem sits in libfuse's loop until it is unmounted, so an ordinary handler would only run
+  then.  The handler installed here does nothing; instead the signal is noticed through
+  signal.set_wakeup_fd, which is written to by the C level handler straight away, by a thread of its
+  own.  Other signals with Python handlers (e.g. SIGINT) write to the same descriptor, so they fire
+  the trigger too.
+
+  The constructor has to run on the main thread; start is separate so that the thread can be started
+  after daemonizing."""
+  def __init__(self, signum):
+    (self._readFd, writeFd) = os.pipe()
+    flags = fcntl.fcntl(writeFd, fcntl.F_GETFL)
+    fcntl.fcntl(writeFd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    signal.signal(signum, lambda signum, frame: None)
+    signal.set_wakeup_fd(writeFd)
+
+  def start(self, function):
+    thread = threading.Thread(target=self._run, args=(function, ), name="signal-trigger")
+    thread.daemon = True
+    thread.start()
+
+  def _run(self, function):
+    while True:
+      try:
+        if not os.read(self._readFd, 1):
+          return
+      except OSError, e:
+        # the signal itself may interrupt the read
+        if EINTR == e.errno:
+          continue
+        raise
+      try:
+        function()
+      except Exception, e:
+        logging.error("!! Exception in signal trigger: %s" % e)
@@ -0,0 +1,267 @@
+# Checksum lookups over a Unix domain socket, served from inside the fuse-sha1 process
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+# Services that need to look checksums up all the time shouldn't each open the SQLite database,
+# competing with the filesystem for its locks.  QueryServer answers batches of lookups over a Unix
+# socket instead, using the filesystem's Sha1DB and a cache, and QueryClient is the other end.
+#
+# Every message is a frame: a 4 byte big-endian length followed by that many bytes.
+#
+#   request:  op (1 byte), arg (uint32), count (uint32), then count strings
+#   response: "o", count (uint32), count row counts (uint32 each), then the (path, checksum) rows 
+#             of each result in request order, as strings
+#             or "e" followed by an error message
+#
+# Integers are big-endian.  Strings are UTF-8, separated by NUL bytes (which can't appear in paths
+# or checksums), so that a whole batch is packed and unpacked with one join or split.  The ops are:
+#
+#   "c" - the strings are checksums; each result lists the files with that checksum (none if it
+#         isn't in the database).  Files that failed verification are left out.
+#   "p" - the strings are paths (in the root, as stored in the database); each result is the
+#         path's entry, or no rows.  The checksum of a file that is still pending is empty; that
+#         of a file imported from a manifest may not have been verified yet.
+#   "x" - one string, a path prefix; the single result lists up to arg entries (0 for
+#         DEFAULT_PREFIX_LIMIT) under the prefix, in path order.
+#
+
+import os
+import socket
+import struct
+import threading
+import SocketServer
+from stat import S_ISSOCK
+
+from fusesha1util import LruCache
+
+OP_CHECKSUMS = "c"
+OP_PATHS = "p"
+OP_PREFIX = "x"
+STATUS_OK = "o"
+STATUS_ERROR = "e"
+
+# frames bigger than this are refused, so a bad client can't make us allocate arbitrary memory
+MAX_FRAME_SIZE = 16 << 20
+DEFAULT_PREFIX_LIMIT = 10000
+# lookups can be cached in memory (see QueryServer), but aren't by default: with the database in the
+# page cache, an indexed lookup on the server's warm connection costs about as much as a hit in
+# LruCache, so caching only pays off when the database is on slow storage
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_CACHE_TTL = 0
+
+_LENGTH = struct.Struct("!I")
+_HEADER = struct.Struct("!cII")
+
+class ProtocolError(Exception):
+  """Raised for malformed frames, on either end."""
+  pass
+
+def _packStrings(strings):
+  return "\0".join(string.encode("utf-8") if isinstance(string, unicode) else string 
+                   for string in strings)
+
+# Returns the count strings packed in data at offset
+def _unpackStrings(data, offset, count):
+  if 0 == count:
+    return []
+  strings = data[offset:].split("\0")
+  if len(strings) != count:
+    raise ProtocolError("expected %d strings, found %d" % (count, len(strings)))
+  return strings
+
+def _sendFrame(sock, parts):
+  body = "".join(parts)
+  sock.sendall(_LENGTH.pack(len(body)) + body)
+
+# Reads exactly size bytes; returns None if the connection was closed before the first byte
+def _recvExact(sock, size):
+  chunks = []
+  remaining = size
+  while remaining > 0:
+    chunk = sock.recv(min(remaining, 1 << 20))
+    if not chunk:
+      if remaining == size:
+        return None
+      raise ProtocolError("connection closed in the middle of a frame")
+    chunks.append(chunk)
+    remaining -= len(chunk)
+  return "".join(chunks)
+
+# Returns the body of the next frame, or None at the end of the stream
+def _recvFrame(sock):
+  header = _recvExact(sock, _LENGTH.size)
+  if None == header:
+    return None
+  (length, ) = _LENGTH.unpack(header)
+  if length > MAX_FRAME_SIZE:
+    raise ProtocolError("frame of %d bytes is too big" % length)
+  return _recvExact(sock, length) or ""
+
+class QueryHandler(SocketServer.BaseRequestHandler):
+  """Serves one client connection, answering requests until the client hangs up.  Each connection
+  gets its own thread, and with it its own warm database connection."""
+  def handle(self):
+    try:
+      self._serve()
+    except socket.error:
+      # the client went away
+      pass
+
+  def _serve(self):
+    while True:
+      try:
+        frame = _recvFrame(self.request)
+      except ProtocolError as einst:
+        # we can't tell where the next frame starts; give up on this client
+        try:
+          _sendFrame(self.request, [STATUS_ERROR, "bad frame: %s" % einst])
+        except socket.error:
+          pass
+        return
+      if None == frame:
+        return
+        
+      try:
+        (op, arg, count) = _HEADER.unpack_from(frame)
+        keys = _unpackStrings(frame, _HEADER.size, count)
+        results = self.server.lookup(op, arg, [key.decode("utf-8") for key in keys])
+      except (ProtocolError, struct.error, UnicodeDecodeError) as einst:
+        _sendFrame(self.request, [STATUS_ERROR, "bad request: %s" % einst])
+        continue
+      except Exception as einst:
+        _sendFrame(self.request, [STATUS_ERROR, str(einst)])
+        continue
+
+      out = [STATUS_OK, _LENGTH.pack(len(results)), 
+             struct.pack("!%dI" % len(results), *[len(rows) for rows in results]),
+             _packStrings(string for rows in results for row in rows for string in row)]
+      _sendFrame(self.request, out)
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """Answers lookups from sha1db on the Unix socket at path (see the top of this file for the
+  protocol).  All the keys of a batch are looked up with one query (per MAX_SQL_VARIABLES keys) on
+  the connection of the thread serving the client.  If cache (an LruCache) is enabled, checksum and
+  path lookups are cached, so repeated lookups don't touch the database at all but may lag behind
+  changes by the cache's TTL.  The socket is only accessible by the user running the filesystem."""
+  daemon_threads = True
+
+  def __init__(self, path, sha1db, cache=None):
+    # a socket left behind by a filesystem that wasn't shut down cleanly
+    if os.path.exists(path) and S_ISSOCK(os.lstat(path).st_mode):
+      os.unlink(path)
+    SocketServer.UnixStreamServer.__init__(self, path, QueryHandler)
+    os.chmod(path, 0600)
+    self.path = path
+    self.sha1db = sha1db
+    self.cache = cache if None != cache else LruCache(DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL)
+    self.thread = None
+    self.requests = 0
+    self.lookups = 0
+    self.statsLock = threading.Lock()
+
+  def start(self):
+    """Starts serving in a background thread."""
+    self.thread = threading.Thread(target=self.serve_forever, name="query server")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    """Stops serving and removes the socket."""
+    self.shutdown()
+    self.server_close()
+    try:
+      os.unlink(self.path)
+    except OSError:
+      pass
+
+  def lookup(self, op, arg, keys):
+    """Returns the results for one request: a list of (path, checksum) rows per key."""
+    with self.statsLock:
+      self.requests += 1
+      self.lookups += len(keys)
+    if OP_PREFIX == op:
+      if len(keys) != 1:
+        raise ProtocolError("a prefix lookup takes exactly one prefix")
+      return [self.sha1db.entriesUnderPrefix(keys[0], arg or DEFAULT_PREFIX_LIMIT)]
+    if OP_CHECKSUMS == op:
+      fetch = self.sha1db.entriesForChecksums
+    elif OP_PATHS == op:
+      fetch = self.sha1db.entriesForPaths
+    else:
+      raise ProtocolError("unknown op %r" % op)
+
+    results = dict((key, rows) for ((op, key), rows) in 
+                   self.cache.getMany([(op, key) for key in keys]).iteritems())
+    misses = [key for key in keys if not key in results]
+    if misses:
+      found = fetch(misses)
+      for key in misses:
+        results[key] = found.get(key, [])
+      self.cache.putMany(((op, key), results[key]) for key in misses)
+    return [results[key] for key in keys]
+
+class QueryClient:
+  """The client end of QueryServer.  Keeps its connection open between requests; use one client
+  per thread.  Paths and checksums are returned as (UTF-8) byte strings.
+
+    client = QueryClient("/run/fuse-sha1.sock")
+    client.checksums(["f572d396fae9206628714fb2ce00f72e94f2258f"])
+  """
+  def __init__(self, path, timeout=None):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(timeout)
+    self.sock.connect(path)
+
+  def close(self):
+    self.sock.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, trace):
+    self.close()
+
+  def checksums(self, chksums):
+    """Returns a dict mapping each of chksums to the list of paths with that checksum (empty if
+    there are none)."""
+    chksums = list(chksums)
+    results = self._request(OP_CHECKSUMS, 0, chksums)
+    return dict((chksum, [path for (path, ignored) in rows]) for (chksum, rows) in zip(chksums, results))
+
+  def paths(self, paths):
+    """Returns a dict mapping each of paths to its checksum, None if it isn't in the database or ""
+    if its checksum is still pending."""
+    paths = list(paths)
+    results = self._request(OP_PATHS, 0, paths)
+    return dict((path, rows[0][1] if rows else None) for (path, rows) in zip(paths, results))
+
+  def prefix(self, prefix, limit=0):
+    """Returns up to limit (default: the server's limit) (path, checksum) pairs for the entries
+    under prefix, in path order."""
+    return self._request(OP_PREFIX, limit, [prefix])[0]
+
+  def _request(self, op, arg, keys):
+    _sendFrame(self.sock, [_HEADER.pack(op, arg, len(keys)), _packStrings(keys)])
+
+    frame = _recvFrame(self.sock)
+    if None == frame:
+      raise ProtocolError("server closed the connection")
+    if frame[:1] != STATUS_OK:
+      raise ProtocolError(frame[1:])
+    try:
+      (count, ) = _LENGTH.unpack_from(frame, 1)
+      offset = 1 + _LENGTH.size
+      counts = struct.unpack_from("!%dI" % count, frame, offset)
+    except struct.error:
+      raise ProtocolError("truncated response")
+    strings = _unpackStrings(frame, offset + 4 * count, 2 * sum(counts))
+    rows = zip(strings[0::2], strings[1::2])
+    results = []
+    start = 0
+    for nrows in counts:
+      results.append(rows[start:start + nrows])
+      start += nrows
+    return results
@@ -0,0 +1,218 @@
+# Include/exclude rules deciding which files get checksummed
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import re
+import threading
+
+from fusesha1util import parseSize
+
+# always excluded unless --no-default-excludes is given
+DEFAULT_EXCLUDES = [".Trash*"]
+
+def globToRegex(glob):
+  """Translates a shell glob into a regex (without anchors).  * and ? don't match "/", ** matches
+  anything including "/", and [...] is a character class ([!...] negated)."""
+  i = 0
+  n = len(glob)
+  out = []
+  while i < n:
+    c = glob[i]
+    i += 1
+    if c == "*":
+      if i < n and glob[i] == "*":
+        i += 1
+        out.append(".*")
+      else:
+        out.append("[^/]*")
+    elif c == "?":
+      out.append("[^/]")
+    elif c == "[":
+      j = i
+      if j < n and glob[j] in "!^":
+        j += 1
+      if j < n and glob[j] == "]":
+        j += 1
+      j = glob.find("]", j)
+      if j < 0:
+        out.append("\\[")
+      else:
+        chars = glob[i:j].replace("\\", "\\\\")
+        if chars[0] in "!^":
+          chars = "^" + chars[1:]
+        out.append("[" + chars + "]")
+        i = j + 1
+    else:
+      out.append(re.escape(c))
+  return "".join(out)
+
+# Turns a glob into a regex for the (absolute) paths the rules are matched against.  A glob without
+# a "/" matches any single path component, so a matching directory covers everything below it.
+# A glob starting with "/" is matched from the start of the path, and any other glob containing a
+# "/" against any run of whole path components (e.g. ".git/objects").
+def _pathRegex(glob):
+  if glob.startswith("/"):
+    return "^" + globToRegex(glob.rstrip("/")) + "(?=/|$)"
+  return "(?:^|/)" + globToRegex(glob.strip("/")) + "(?=/|$)"
+
+# Combines regexes into a single compiled alternation, or None if there are none
+def _combine(regexes):
+  if not regexes:
+    return None
+  return re.compile("|".join("(?:%s)" % regex for regex in regexes))
+
+class ExcludeRules:
+  """Decides which files are left out of the checksum database.  All of the glob, regex and prefix
+  rules are compiled into a single regex when the rules are created, so checking a path is one
+  regex search no matter how many rules there are.  Include rules win over exclude rules.  Size
+  limits only apply to paths that are not explicitly included.
+
+  Paths are always the absolute paths in the root filesystem (i.e. what's in the database), so
+  the same rules give the same answer for the mount, rescans, vacuum and dedup.
+
+  skippedFiles/skippedBytes count the files left unhashed because of the rules, once per event
+  that would otherwise have hashed them: every rescan that comes across a file, and every release
+  of a handle that wrote to one (or truncate) through the mount, so a file written three times 
+  counts three times.  Directories a
+  rescan doesn't go into are counted in skippedDirectories; what is below them isn't looked at, so 
+  it isn't counted.  Checking a path with excluded or excludedPath counts nothing.
+
+    excludes, includes - globs (see _pathRegex)
+    excludeRegexes, includeRegexes - regexes, searched for anywhere in the path
+    excludePrefixes - paths; the prefix and everything below it is excluded
+    minSize, maxSize - exclude files smaller/larger than this many bytes (0 for no limit)
+  """
+  def __init__(self, excludes=(), excludeRegexes=(), excludePrefixes=(), includes=(),
+               includeRegexes=(), minSize=0, maxSize=0):
+    self.excludeMatcher = _combine([_pathRegex(glob) for glob in excludes] + list(excludeRegexes) +
+      ["^" + re.escape(prefix.rstrip("/")) + "(?=/|$)" for prefix in excludePrefixes])
+    self.includeMatcher = _combine([_pathRegex(glob) for glob in includes] + list(includeRegexes))
+    self.minSize = minSize
+    self.maxSize = maxSize
+
+    self.skippedFiles = 0
+    self.skippedBytes = 0
+    self.skippedDirectories = 0
+    self._lock = threading.Lock()
+
+  def excludedPath(self, path):
+    """True if path is excluded by the path rules alone.  Used to prune directories from walks."""
+    if None != self.includeMatcher and self.includeMatcher.search(path):
+      return False
+    return None != self.excludeMatcher and None != self.excludeMatcher.search(path)
+
+  def excluded(self, path, size=None):
+    """True if the file at path should not be checksummed.  size is the file's size if the
+    caller knows it; otherwise it is looked up only if a size limit needs it."""
+    if None != self.includeMatcher and self.includeMatcher.search(path):
+      return False
+    if None != self.excludeMatcher and None != self.excludeMatcher.search(path):
+      return True
+    if self.minSize > 0 or self.maxSize > 0:
+      size = self._size(path, size)
+      return ((self.minSize > 0 and size < self.minSize) or
+              (self.maxSize > 0 and size > self.maxSize))
+    return False
+
+  def skipped(self, files=0, nbytes=0, directories=0):
+    """Adds to the skipped counts, for an event that left files (of nbytes in all) and directories 
+    unhashed because of the rules."""
+    with self._lock:
+      self.skippedFiles += files
+      self.skippedBytes += nbytes
+      self.skippedDirectories += directories
+
+  def _size(self, path, size):
+    if None != size:
+      return size
+    try:
+      return os.lstat(path).st_size
+    except OSError:
+      return 0
+
+def addRuleOptions(parser):
+  """Adds the include/exclude options (shared by sha1db.py and sha1fs.py) to an OptionParser."""
+  parser.add_option("--exclude",
+                    action = "append",
+                    dest = "excludes",
+                    help = "Don't checksum files matching GLOB (may be repeated).  A GLOB without a / "
+                           "matches any path component, e.g. '*.part' or '.git'",
+                    metavar = "GLOB")
+  parser.add_option("--exclude-regex",
+                    action = "append",
+                    dest = "excludeRegexes",
+                    help = "Don't checksum files whose path matches REGEX (may be repeated)",
+                    metavar = "REGEX")
+  parser.add_option("--exclude-prefix",
+                    action = "append",
+                    dest = "excludePrefixes",
+                    help = "Don't checksum anything under PATH in the root (may be repeated)",
+                    metavar = "PATH")
+  parser.add_option("--include",
+                    action = "append",
+                    dest = "includes",
+                    help = "Always checksum files matching GLOB, even if excluded (may be repeated)",
+                    metavar = "GLOB")
+  parser.add_option("--include-regex",
+                    action = "append",
+                    dest = "includeRegexes",
+                    help = "Always checksum files whose path matches REGEX (may be repeated)",
+                    metavar = "REGEX")
+  parser.add_option("--exclude-from",
+                    dest = "excludeFrom",
+                    help = "Read rules from FILE: one glob per line, or regex:, prefix:, include: "
+                           "or include-regex: followed by the rule.  # starts a comment",
+                    metavar = "FILE")
+  parser.add_option("--min-size",
+                    dest = "minSize",
+                    default = "0",
+                    help = "Don't checksum files smaller than SIZE, e.g. 1K",
+                    metavar = "SIZE")
+  parser.add_option("--max-size",
+                    dest = "maxSize",
+                    default = "0",
+                    help = "Don't checksum files larger than SIZE, e.g. 10G",
+                    metavar = "SIZE")
+  parser.add_option("--no-default-excludes",
+                    action = "store_false",
+                    dest = "defaultExcludes",
+                    default = True,
+                    help = "Checksum trash directories (%s) too" % ", ".join(DEFAULT_EXCLUDES))
+
+# rule file prefixes, mapped to the rulesFromOptions lists they add to
+RULE_FILE_KINDS = {
+  "regex": "excludeRegexes",
+  "prefix": "excludePrefixes",
+  "include": "includes",
+  "include-regex": "includeRegexes",
+}
+
+def rulesFromOptions(options):
+  """Creates ExcludeRules from the options added by addRuleOptions.  options may be any object;
+  missing attributes are treated as not given."""
+  rules = {}
+  for name in ("excludes", "excludeRegexes", "excludePrefixes", "includes", "includeRegexes"):
+    rules[name] = list(getattr(options, name, None) or [])
+  if getattr(options, "defaultExcludes", True):
+    rules["excludes"].extend(DEFAULT_EXCLUDES)
+
+  excludeFrom = getattr(options, "excludeFrom", None)
+  if None != excludeFrom:
+    with open(excludeFrom) as f:
+      for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+          continue
+        (kind, sep, rule) = line.partition(":")
+        if sep and kind in RULE_FILE_KINDS:
+          rules[RULE_FILE_KINDS[kind]].append(rule)
+        else:
+          rules["excludes"].append(line)
+
+  return ExcludeRules(minSize=parseSize(getattr(options, "minSize", 0) or 0),
+                      maxSize=parseSize(getattr(options, "maxSize", 0) or 0), **rules)
@@ -0,0 +1,276 @@
+# Background scrubbing: re-verifies stored checksums against the files on disk
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import logging
+import threading
+import time
+
+from fusesha1util import fileChecksum, parseSize
+
+# how many rows the scrubber pulls out of the database at a time
+SCRUB_BATCH_SIZE = 100
+# how long the scrubber sleeps when there is nothing left to verify
+SCRUB_IDLE_SLEEP = 60.0
+# bounds for the exponential backoff used while the filesystem is busy
+BUSY_BACKOFF_MIN = 0.1
+BUSY_BACKOFF_MAX = 5.0
+
+# by default the background scrubber re-verifies each file once a week
+DEFAULT_SCRUB_INTERVAL = 7 * 24 * 60 * 60
+# how long the pending hasher waits before retrying a file it couldn't hash (e.g. still being written)
+PENDING_RETRY_DELAY = 60
+
+def addScrubOptions(parser):
+  """Adds the scrub rate limit options (shared by sha1db.py and sha1fs.py) to an OptionParser."""
+  parser.add_option("--scrub-rate",
+                    dest = "scrubRate",
+                    default = "0",
+                    help = "Limit scrubbing to RATE bytes/sec, e.g. 20M (default: unlimited)",
+                    metavar = "RATE")
+  parser.add_option("--scrub-iops",
+                    dest = "scrubIops",
+                    type = "int",
+                    default = 0,
+                    help = "Limit scrubbing to IOPS reads/sec (default: unlimited)",
+                    metavar = "IOPS")
+                    
+def scrubberFromOptions(sha1db, options, minAge=0, busy=None):
+  """Creates a Scrubber for sha1db using the options added by addScrubOptions."""
+  return Scrubber(sha1db, parseSize(options.scrubRate), options.scrubIops, minAge, busy)
+
+def pendingHasherFromOptions(sha1db, options, busy=None):
+  """Creates a PendingHasher for sha1db using the options added by addScrubOptions."""
+  return PendingHasher(sha1db, parseSize(options.scrubRate), options.scrubIops, PENDING_RETRY_DELAY,
+                       busy)
+
+class RateLimiter:
+  """Token bucket style limiter for bytes/sec and I/O operations/sec.  A limit of 0 means
+  unlimited.  Only the last second or so of history is kept, so idle time is not banked as a burst."""
+  window = 1.0
+
+  def __init__(self, bytesPerSec=0, iops=0):
+    self.bytesPerSec = bytesPerSec
+    self.iops = iops
+    self._reset(time.time())
+
+  def _reset(self, now):
+    self._start = now
+    self._bytes = 0
+    self._ops = 0
+
+  def throttle(self, nbytes, nops=1):
+    """Accounts for nbytes read in nops operations, sleeping as long as needed to stay within
+    the limits."""
+    now = time.time()
+    if now - self._start > self.window:
+      self._reset(now)
+    self._bytes += nbytes
+    self._ops += nops
+
+    elapsed = now - self._start
+    delay = 0.0
+    if self.bytesPerSec > 0:
+      delay = max(delay, self._bytes / float(self.bytesPerSec) - elapsed)
+    if self.iops > 0:
+      delay = max(delay, self._ops / float(self.iops) - elapsed)
+    if delay > 0:
+      time.sleep(delay)
+
+class ActivityMonitor:
+  """Tracks when the filesystem last served a request, so that background work can get out of
+  the way of clients."""
+  def __init__(self, idleSeconds=1.0):
+    self.idleSeconds = idleSeconds
+    self.lastActivity = 0.0
+
+  def touch(self):
+    self.lastActivity = time.time()
+
+  def busy(self):
+    return (time.time() - self.lastActivity) < self.idleSeconds
+
+class ScrubStopped(Exception):
+  """Raised through fileChecksum by the throttle of a Scrubber that was stopped, so that the file it
+  was hashing is abandoned rather than read to the end."""
+  pass
+
+class Scrubber(threading.Thread):
+  """Walks the database least-recently-verified first, re-hashing each file and recording the
+  result with Sha1DB.recordVerification.  Mismatches are logged and flagged in the database but
+  the stored checksum is kept, since it is the known good value.
+
+    sha1db - the Sha1DB to scrub
+    bytesPerSec, iops - rate limits for reading files (0 for unlimited)
+    minAge - files verified less than minAge seconds ago are skipped
+    busy - optional callable; while it returns true the scrubber backs off
+  """
+  def __init__(self, sha1db, bytesPerSec=0, iops=0, minAge=0, busy=None):
+    threading.Thread.__init__(self, name="scrubber")
+    self.daemon = True
+    self.sha1db = sha1db
+    self.limiter = RateLimiter(bytesPerSec, iops)
+    self.minAge = minAge
+    self.busy = busy
+    self.stopped = threading.Event()
+
+    self.filesVerified = 0
+    self.bytesVerified = 0
+    self.mismatches = 0
+
+  def stop(self):
+    """Asks the thread to stop; it does so as soon as it reads the next chunk of a file, so callers
+    can join it without waiting for a large file to be hashed."""
+    self.stopped.set()
+
+  def run(self):
+    logging.info("%s started" % self.name)
+    while not self.stopped.is_set():
+      try:
+        if self.scrubBatch() <= 0:
+          self.stopped.wait(SCRUB_IDLE_SLEEP)
+      except ScrubStopped:
+        break
+      except Exception as einst:
+        logging.error("%s failed: %s" % (self.name, einst))
+        self.stopped.wait(SCRUB_IDLE_SLEEP)
+    logging.info("%s stopped" % self.name)
+
+  def scrubPass(self):
+    """Verifies every entry that is due once, returning the number of files verified.  Used by
+    sha1db.py --scrub."""
+    passStart = time.time()
+    total = 0
+    while not self.stopped.is_set():
+      try:
+        count = self.scrubBatch(passStart)
+      except ScrubStopped:
+        break
+      if count <= 0:
+        break
+      total += count
+    return total
+
+  def scrubBatch(self, verifiedBefore=None):
+    """Verifies the next batch of entries that were last verified before verifiedBefore (default:
+    minAge seconds ago).  Returns the number of entries looked at."""
+    if None == verifiedBefore:
+      verifiedBefore = time.time() - self.minAge
+    rows = self.sha1db.scrubCandidates(SCRUB_BATCH_SIZE, verifiedBefore)
+    for (path, chksum) in rows:
+      if self.stopped.is_set():
+        break
+      self.verify(path, chksum)
+    return len(rows)
+
+  def verify(self, path, chksum):
+    """Re-hashes path and compares it against chksum.  Returns True/False for a match/mismatch
+    or None if the file could not be verified.  A file whose size or mtime no longer match its
+    entry was changed since it was hashed, so its entry is updated instead of being flagged."""
+    started = time.time()
+    self._throttle(0)
+    try:
+      actual = fileChecksum(path, self.sha1db.checksum, dropCache=True, throttle=self._throttle)
+    except (IOError, OSError) as einst:
+      # most likely deleted outside of the mount; that's for vacuum to deal with.  Mark it as
+      # looked at anyway so it doesn't block the head of the queue
+      logging.warn("Unable to scrub %s: %s" % (path, einst))
+      self.sha1db.recordVerification(path, chksum, None)
+      return None
+
+    matched = (actual == chksum)
+    if not matched:
+      try:
+        st = os.stat(path)
+      except OSError:
+        st = None
+      if None == st or st.st_mtime >= started:
+        # written to while we were hashing it; release will update the checksum
+        logging.info("Skipping verification of %s; modified during scrub" % path)
+        self.sha1db.recordVerification(path, chksum, None)
+        return None
+      entry = self.sha1db.getEntry(path)
+      if None != entry and None != entry[4] and (st.st_size, st.st_mtime) != (entry[4], entry[5]):
+        # changed (outside of the mount) since it was hashed, so the entry is stale rather than
+        # the file corrupt; what we just hashed is its new content
+        logging.info("Updating checksum of %s; modified since it was hashed" % path)
+        self.sha1db.updateChecksum(path, actual)
+        return None
+      logging.error("Checksum mismatch for %s: expected %s, found %s" % (path, chksum, actual))
+      self.mismatches += 1
+
+    self.sha1db.recordVerification(path, chksum, matched)
+    self.filesVerified += 1
+    return matched
+
+  # passed to fileChecksum; applies the rate limits and backs off while clients are busy.  Raises
+  # ScrubStopped once the thread was stopped
+  def _throttle(self, nbytes):
+    self.bytesVerified += nbytes
+    self.limiter.throttle(nbytes)
+    if None != self.busy:
+      backoff = BUSY_BACKOFF_MIN
+      while self.busy() and not self.stopped.is_set():
+        time.sleep(backoff)
+        backoff = min(backoff * 2, BUSY_BACKOFF_MAX)
+    if self.stopped.is_set():
+      raise ScrubStopped()
+
+class PendingHasher(Scrubber):
+  """Hashes the files whose checksum was left pending (see Sha1DB.lazyThreshold), with the same rate
+  limits and backoff as the scrubber, so large files get hashed while the filesystem is idle.  Files
+  that can't be hashed are retried after minAge seconds.  filesVerified counts the files hashed."""
+  def __init__(self, sha1db, bytesPerSec=0, iops=0, minAge=PENDING_RETRY_DELAY, busy=None):
+    Scrubber.__init__(self, sha1db, bytesPerSec, iops, minAge, busy)
+    self.name = "pending hasher"
+
+  def scrubBatch(self, verifiedBefore=None):
+    """Hashes the next batch of pending files that weren't attempted since verifiedBefore (default:
+    minAge seconds ago).  Returns the number of files looked at."""
+    if None == verifiedBefore:
+      verifiedBefore = time.time() - self.minAge
+    rows = self.sha1db.pendingFiles(SCRUB_BATCH_SIZE, verifiedBefore)
+    for (path, size) in rows:
+      if self.stopped.is_set():
+        break
+      # wait for the filesystem to go idle before starting on a file
+      self._throttle(0)
+      if None != self.sha1db.hashPending(path, self._throttle):
+        self.filesVerified += 1
+    return len(rows)
+
+class ReadVerifier:
+  """Keeps a running checksum of the data a client reads through a file handle, as long as the
+  reads are sequential from offset 0.  If the client reads the whole file this way, the result can 
+  be checked against the stored checksum without reading the file again."""
+  def __init__(self, checksum_func):
+    self.digest = checksum_func()
+    self.offset = 0
+    self.openedAt = time.time()
+    # the kernel may send several reads for one handle at once
+    self.lock = threading.Lock()
+
+  def update(self, offset, data):
+    """Feeds data read at offset into the checksum.  Re-reads of data that was already hashed 
+    are fine; skipping ahead means the file can't be verified from this handle."""
+    with self.lock:
+      if None == self.digest:
+        return
+      end = offset + len(data)
+      if offset > self.offset:
+        self.digest = None
+      elif end > self.offset:
+        self.digest.update(data[self.offset - offset:])
+        self.offset = end
+
+  def complete(self, size):
+    """Returns true if exactly size bytes were hashed from the start of the file."""
+    return None != self.digest and self.offset == size
+
+  def hexdigest(self):
+    return self.digest.hexdigest()
@@ -0,0 +1,177 @@
+# Spreading the entries of a Sha1DB over several stores (shards)
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+# Every store (see sha1store) has a single write lock, and the index pages of one very large SQLite
+# files table stop fitting in the cache.  A sharded Sha1DB keeps its entries in several stores: the
+# shard of an entry is picked by a ShardRouter from the entry's parent directory, so writers in
+# different directories rarely wait on each other and each shard's indexes stay small.  Lookups by
+# checksum have to ask every shard; a FanOut asks them all at once, each from a thread of its own.
+#
+# A unit of work that writes to several shards (e.g. hashing a file and marking the copies it was
+# linked to) goes through ShardTransactions, which commits each shard separately: shards are not
+# updated atomically together, and every such change is made so that a crash in between leaves
+# entries that are out of date rather than lost.
+#
+
+import logging
+import Queue
+import sys
+import threading
+import zlib
+
+# how many threads a FanOut runs at most
+MAX_FAN_OUT_THREADS = 8
+
+def shardFile(prefix, shard):
+  """Returns the file name of shard (1 and up; shard 0 is the main database itself) of a database
+  whose shard files are named after prefix."""
+  return "%s.shard%d" % (prefix, shard)
+
+class ShardRouter:
+  """Decides which of shards shards holds the entry of a path.  Entries are routed by their parent
+  directory, so a directory's files are all in one shard.  With depth, only the first depth
+  components of the parent directory count (e.g. the top level directories for 1, if the paths are
+  relative to /), so that whole subtrees share a shard: renaming a directory below that depth then
+  stays within a shard, and so do queries for the entries under it, at the price of an uneven
+  spread."""
+  def __init__(self, shards=1, depth=None):
+    self.shards = shards
+    self.depth = depth
+
+  def shardOf(self, path):
+    """Returns the shard of the entry of path."""
+    if 1 == self.shards:
+      return 0
+    return self._shardOfDirectory(path[:path.rfind("/")])
+
+  def shardsFor(self, prefix):
+    """Returns the shards that can hold entries whose path starts with prefix, in order: just one
+    if the directory above prefix is at least depth deep, otherwise all of them."""
+    if 1 == self.shards:
+      return [0]
+    directory = prefix[:prefix.rfind("/")]
+    if None != self.depth and directory.count("/") >= self.depth:
+      return [self._shardOfDirectory(directory)]
+    return range(self.shards)
+
+  def _shardOfDirectory(self, directory):
+    if None != self.depth:
+      directory = "/".join(directory.split("/")[:self.depth + 1])
+    if isinstance(directory, unicode):
+      directory = directory.encode("utf-8")
+    return (zlib.crc32(directory) & 0xffffffff) % self.shards
+
+class ShardTransactions:
+  """The transactions of one unit of work on the shards of a database, used with the 'with'
+  keyword.  transaction opens one on a shard the first time it is asked for it; write makes a change
+  in a shard's transaction if one is open, and otherwise queues it until the open ones are
+  committed, to be made in a transaction of its own.  That way a thread never waits for one shard's
+  write lock while holding another's, which two threads writing to each other's shards would
+  otherwise do until SQLite gave up (or forever, with logs).  The open shards are committed in order
+  when the block succeeds, and rolled back if it raises.
+
+    openTransaction - callable returning a transaction context manager for a shard
+                      (Sha1DB._transaction)
+  """
+  def __init__(self, openTransaction):
+    self.openTransaction = openTransaction
+    self.contexts = {}
+    self.transactions = {}
+    self.deferred = []
+
+  def transaction(self, shard):
+    """Returns the transaction of shard, opening it if there is none yet."""
+    transaction = self.transactions.get(shard)
+    if None == transaction:
+      context = self.openTransaction(shard)
+      transaction = context.__enter__()
+      self.contexts[shard] = context
+      self.transactions[shard] = transaction
+    return transaction
+
+  def isOpen(self, shard):
+    return shard in self.transactions
+
+  def write(self, shard, change):
+    """Calls change with the transaction of shard, now if it is open and otherwise after commit."""
+    if self.isOpen(shard):
+      change(self.transactions[shard])
+    else:
+      self.deferred.append((shard, change))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    contexts = self.contexts
+    self.contexts = {}
+    self.transactions = {}
+    error = None
+    for shard in sorted(contexts):
+      try:
+        # commits, or rolls back if the block or an earlier commit failed
+        if None == excType:
+          contexts[shard].__exit__(None, None, None)
+        else:
+          contexts[shard].__exit__(excType, excValue, traceback)
+      except:
+        if None == excType:
+          (excType, excValue, traceback) = error = sys.exc_info()
+    if None != error:
+      raise error[0], error[1], error[2]
+    if None == excType:
+      for (shard, change) in self.deferred:
+        with self.openTransaction(shard) as transaction:
+          change(transaction)
+    self.deferred = []
+    return False
+
+class FanOut:
+  """A fixed set of daemon threads running a function for each of a list of arguments at once (see
+  map).  The threads are started on first use and live as long as the process, so the database
+  connections each of them opens are reused from one call to the next."""
+  def __init__(self, threads):
+    self.threads = threads
+    self.queue = Queue.Queue()
+    self.started = False
+    self.lock = threading.Lock()
+
+  def map(self, function, args):
+    """Returns [function(arg) for arg in args], with the calls made concurrently.  If any of them
+    raises, the first exception (in the order of args) is raised once all of them are done."""
+    self._start()
+    results = [None] * len(args)
+    errors = [None] * len(args)
+    done = threading.Semaphore(0)
+    for (index, arg) in enumerate(args):
+      self.queue.put((function, arg, index, results, errors, done))
+    for arg in args:
+      done.acquire()
+    for error in errors:
+      if None != error:
+        raise error[0], error[1], error[2]
+    return results
+
+  def _start(self):
+    with self.lock:
+      if self.started:
+        return
+      for i in xrange(self.threads):
+        thread = threading.Thread(target=self._work, name="fan-out-%d" % i)
+        thread.daemon = True
+        thread.start()
+      self.started = True
+
+  def _work(self):
+    while True:
+      (function, arg, index, results, errors, done) = self.queue.get()
+      try:
+        results[index] = function(arg)
+      except:
+        errors[index] = sys.exc_info()
+        logging.debug("Fanned out call failed: %s" % (errors[index][1], ))
+      done.release()
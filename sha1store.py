@@ -0,0 +1,1700 @@
+# Where a Sha1DB keeps its entries: the storage interface and its two backends
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+# A Sha1DB (or each of its shards; see sha1shard) keeps its entries in a store, and does everything
+# with them through the store's transactions (see Transaction), so a backend can keep them however
+# suits it.  The backend is picked when the database is created:
+#   sqlite - an SQLite database (SqliteStore), the default.  Its indexes live on disk, so memory use
+#            doesn't grow with the number of entries, and several processes can use it at once
+#            (e.g. sha1fs and sha1db.py --scrub)
+#   log - an append-only file of checksummed records (LogStore), with the entries and their indexes
+#         held in memory.  A commit is a single append, with no B-tree or index pages to rewrite, so
+#         it suits mounts that write a lot, as long as their entries fit in memory (about a
+#         kilobyte each).  Only one process can have it open
+#
+
+import fcntl
+import hashlib
+import logging
+import marshal
+import os
+import struct
+import threading
+import time
+import zlib
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from contextlib import contextmanager
+from heapq import heappush, heappop, heapify
+
+from fusesha1util import ThreadConnections
+
+# an entry, as a row of the files table
+FILES_COLUMNS = ["path", "chksum", "symlink", "link", "last_verified", "mismatch", "size", "mtime",
+                 "pending"]
+Entry = namedtuple("Entry", FILES_COLUMNS)
+# everything but the path and checksum defaults to what the files table does
+Entry.__new__.__defaults__ = (0, 0, None, 0, None, None, 0)
+# the columns that make an update a change worth journaling
+JOURNALED_COLUMNS = ["chksum", "pending", "mismatch", "symlink"]
+# what is counted of the trusted entries (neither pending nor failing verification) of a checksum,
+# as a row of the checksums table: copies are the files with space of their own, linked the
+# symlinks and files linked to a copy, size the size of the file, occupied the space the copies
+# take up and reclaimable what linking all of them to one would free
+CHECKSUM_COLUMNS = ["chksum", "size", "copies", "linked", "occupied", "reclaimable"]
+ChecksumStats = namedtuple("ChecksumStats", CHECKSUM_COLUMNS)
+# the digest of the entries below a directory (see below), as a hex string, and how many there are
+DIRECTORY_COLUMNS = ["path", "digest", "files"]
+DirectoryDigest = namedtuple("DirectoryDigest", DIRECTORY_COLUMNS)
+
+BACKENDS = ["sqlite", "log"]
+SQLITE_MAGIC = "SQLite format 3\0"
+LOG_MAGIC = "SHA1LOG1"
+
+def storeBackend(path):
+  """Returns the backend of the store at path, going by its first bytes, or None if there is no
+  store there (yet, or at all)."""
+  try:
+    with open(path, "rb") as f:
+      head = f.read(len(SQLITE_MAGIC))
+  except IOError:
+    return None
+  if head.startswith(LOG_MAGIC):
+    return "log"
+  if SQLITE_MAGIC == head:
+    return "sqlite"
+  return None
+
+# Directory digests.  The digest of a directory is the sum, modulo TREE_MODULUS, of a term for every
+# entry below it: the SHA-1 of the entry's path relative to the directory and its checksum (empty
+# while it is pending).  Directories holding the same names with the same checksums have the same
+# digest wherever they are.  Since the terms just add up, a change to an entry changes the digests of
+# the directories above it by taking its old term out and putting its new one in, without reading
+# anything else, and the digests the shards of a database keep of one directory add up to that of
+# the whole directory (see sumDigests)
+TREE_MODULUS = 1 << 160
+EMPTY_DIGEST = "0" * 40
+
+def sumDigests(digests):
+  """Returns the digest of the entries that the directory digests digests are of together."""
+  return _digestText(sum(int(digest, 16) for digest in digests))
+
+def _digestText(value):
+  return "%040x" % (value % TREE_MODULUS)
+
+def _utf8(text):
+  return text.encode("utf-8") if isinstance(text, unicode) else text
+
+# the directory above directory, or None for the root
+def _parentDirectory(directory):
+  end = directory.rfind("/")
+  if end < 0 or "/" == directory:
+    return None
+  return directory[:end] or "/"
+
+# Adds the terms of the (path, checksum, sign) changes, taken out for a sign of -1, to the
+# [digest value, files] deltas of the directories above their paths, keyed by directory
+def _treeDeltas(changes, deltas):
+  for (path, chksum, sign) in changes:
+    suffix = "\0" + _utf8(chksum)
+    end = path.rfind("/")
+    while end >= 0:
+      directory = path[:end] or "/"
+      term = int(hashlib.sha1(_utf8(path[end + 1:]) + suffix).hexdigest(), 16)
+      delta = deltas.get(directory)
+      if None == delta:
+        delta = deltas[directory] = [0, 0]
+      delta[0] += sign * term
+      delta[1] += sign
+      end = path.rfind("/", 0, end)
+  return deltas
+
+def openStore(path, backend="sqlite", metadata=None):
+  """Opens the store at path, or creates one with backend and metadata (a dict, see
+  Store.metadata) if there is none.  An existing store keeps its backend."""
+  backend = storeBackend(path) or backend
+  if "log" == backend:
+    return _openLog(path, metadata)
+  if "sqlite" == backend:
+    return SqliteStore(path, metadata)
+  raise ValueError("Unknown storage backend %s" % backend)
+
+class Store:
+  """The entries of a database (or of one shard of it).  A store is shared by all threads.
+
+    database - the path of its (main) file
+    backend - one of BACKENDS
+  """
+  def transaction(self):
+    """Returns a context manager providing a Transaction, committed if the block succeeds and
+    rolled back if it raises.  Can be used with the Python 'with' keyword."""
+    raise NotImplementedError()
+
+  def metadata(self):
+    """Returns the dict of settings kept with the entries: the checksum type (chksum_type) and, for
+    sharded databases, the layout (shards, depth, file_prefix and generation; see Sha1DB)."""
+    raise NotImplementedError()
+
+  def setMetadata(self, metadata):
+    """Replaces the settings returned by metadata."""
+    raise NotImplementedError()
+
+  def commits(self):
+    """Returns the number of transactions that changed something, for the stats."""
+    raise NotImplementedError()
+
+  def flush(self):
+    """Makes sure everything committed is in the store's file, and on disk."""
+    raise NotImplementedError()
+
+  def close(self):
+    """Lets go of what the store holds open, on every thread."""
+    raise NotImplementedError()
+
+class Transaction:
+  """What can be done with the entries of a store, within one transaction.  Entries are Entry
+  tuples; entries read through a transaction include its own changes.  Lists of entries come in no
+  particular order unless said otherwise.
+
+  Every change is journaled, numbered by seq, so that other programs can follow along (see
+  Sha1DB.changesSince), as a (seq, op, path, old path, checksum, time) tuple whose op is one of:
+    insert - a new entry
+    update - the checksum, pending/mismatch flag or symlink flag of an entry changed (checksum is
+             PENDING_CHECKSUM while the file waits to be hashed)
+    rename - an entry moved from old path to path
+    delete - an entry was removed
+  Other changes (e.g. re-verifying a file that still matches) are not journaled."""
+  def get(self, path):
+    """Returns the entry of path, or None."""
+    raise NotImplementedError()
+
+  def withPaths(self, paths):
+    """Returns the entries of those of paths that have one."""
+    raise NotImplementedError()
+
+  def withChecksums(self, chksums):
+    """Returns the entries whose checksum is one of chksums."""
+    raise NotImplementedError()
+
+  def pathRange(self, low, high=None, after=None, limit=-1):
+    """Returns up to limit (-1 for all) entries whose path is at least low, below high (if not None)
+    and after after (if not None), in path order."""
+    raise NotImplementedError()
+
+  def linked(self):
+    """Returns the entries of files that were linked to a copy, leaving out symlinks and entries
+    that are pending or failed verification."""
+    raise NotImplementedError()
+
+  def mismatches(self):
+    """Returns the entries of files that failed their last verification, in path order."""
+    raise NotImplementedError()
+
+  def pendingQueue(self, before, limit):
+    """Returns up to limit (-1 for all) entries whose checksum is pending and that weren't attempted
+    since before, least recently attempted (never attempted) first."""
+    raise NotImplementedError()
+
+  def scrubQueue(self, before, limit):
+    """Returns up to limit entries of files (not symlinks) whose checksum isn't pending and that
+    weren't verified since before, least recently verified (never verified) first."""
+    raise NotImplementedError()
+
+  def pendingBacklog(self):
+    """Returns the number of entries whose checksum is pending and their total size."""
+    raise NotImplementedError()
+
+  def checksumStats(self, chksums):
+    """Returns the ChecksumStats of those of chksums that have trusted entries."""
+    raise NotImplementedError()
+
+  def duplicates(self, after=None, limit=-1):
+    """Returns up to limit (-1 for all) ChecksumStats of duplicated checksums, those with more than
+    one trusted entry of which some take up space (occupied > 0), most reclaimable first and then
+    in checksum order, starting after the (reclaimable, checksum) pair after if given."""
+    raise NotImplementedError()
+
+  def occupying(self, after=None, limit=-1):
+    """Returns up to limit (-1 for all) ChecksumStats of the checksums whose copies take up space,
+    most occupied first and then in checksum order, starting after the (occupied, checksum) pair
+    after if given."""
+    raise NotImplementedError()
+
+  def directories(self, paths):
+    """Returns the DirectoryDigests of those of paths (directories, without a trailing slash) that
+    have entries below them."""
+    raise NotImplementedError()
+
+  def subdirectories(self, path):
+    """Returns the DirectoryDigests of the directories directly in the directory path that have
+    entries below them, in path order."""
+    raise NotImplementedError()
+
+  def put(self, entry):
+    """Stores entry, replacing the one with the same path if there is one."""
+    raise NotImplementedError()
+
+  def putIfAbsent(self, entries):
+    """Stores those of entries whose path has no entry yet, returning how many that was."""
+    raise NotImplementedError()
+
+  def update(self, path, changes, expect=None):
+    """Sets the columns of the entry of path to the values in the dict changes, if it has the values
+    in the dict expect.  Returns whether there was such an entry."""
+    raise NotImplementedError()
+
+  def remove(self, path):
+    """Removes the entry of path, if there is one."""
+    raise NotImplementedError()
+
+  def removeRange(self, low, high):
+    """Removes the entries whose path is at least low and below high."""
+    raise NotImplementedError()
+
+  def rename(self, pairs):
+    """Moves the entries of the old paths of the (new path, old path) pairs to the new ones."""
+    raise NotImplementedError()
+
+  def renamePrefix(self, old, new):
+    """Moves the entry of old, and those of the paths below it (starting with old + "/"), to new.
+    An old ending in "/" is a directory, whose own path has no entry.  Paths that merely start with
+    old (/ab when renaming /a) are left alone."""
+    raise NotImplementedError()
+
+  def load(self, entries, journal=True):
+    """Stores entries as they are, replacing any with the same paths.  Without journal, they are
+    left out of the journal; that is for filling a new store that nothing else is using."""
+    raise NotImplementedError()
+
+  def lastSequence(self):
+    """Returns the sequence number of the latest journal entry, or 0 if nothing was ever
+    journaled."""
+    raise NotImplementedError()
+
+  def firstSequence(self):
+    """Returns the sequence number of the oldest journal entry still kept, or None if there is
+    none."""
+    raise NotImplementedError()
+
+  def changes(self, after, limit):
+    """Returns up to limit journal entries after sequence number after, oldest first."""
+    raise NotImplementedError()
+
+  def compactJournal(self, before=None, maxEntries=None):
+    """Deletes the journal entries made before the time before and all but the latest maxEntries,
+    returning how many were deleted."""
+    raise NotImplementedError()
+
+  def startJournalAfter(self, seq):
+    """Makes the journal of a store whose journal is empty carry on numbering after seq."""
+    raise NotImplementedError()
+
+# The SQLite backend.  Entries are written with an update, followed by an insert if there was
+# nothing to update (see put), rather than with "insert or replace": its implicit delete would leave
+# the journal triggers unable to tell new files from changed ones.  The path comes last
+ENTRY_UPDATE = "update files set %s where path = ?;" % ", ".join("%s = ?" % column
+                                                               for column in FILES_COLUMNS[1:])
+ENTRY_INSERT = "insert into files(%s, path) values(%s);" % (", ".join(FILES_COLUMNS[1:]),
+                                                           ", ".join("?" * len(FILES_COLUMNS)))
+ENTRY_SELECT = "select %s from files" % ", ".join(FILES_COLUMNS)
+FILES_COPY = "insert into files(%s) values(%s);" % (", ".join(FILES_COLUMNS),
+                                                    ", ".join("?" * len(FILES_COLUMNS)))
+# new prefix, old prefix, and the range of the paths starting with the old prefix
+PATH_UPDATE = ("update files set path = ? || substr(path, length(?) + 1) "
+               "where path >= ? and path < ?;")
+FILES_SCHEMA = """create table if not exists files(
+path varchar not null primary key,
+chksum varchar not null,
+symlink boolean default 0,
+link boolean default 0,
+last_verified real,
+mismatch boolean default 0,
+size integer,
+mtime real,
+pending boolean default 0);"""
+# the layout of sharded databases (see sha1shard): the number of shards, how many components of
+# the parent directory route an entry (null for all of them), what the shard files are named after
+# and how many times the database was resharded
+SHARDING_SCHEMA = """create table if not exists sharding(
+shards integer not null,
+depth integer,
+file_prefix varchar not null,
+generation integer not null);"""
+SHARDING_COLUMNS = ["shards", "depth", "file_prefix", "generation"]
+# how many values are bound into one "in (...)" query; SQLite allows 999 variables by default
+MAX_SQL_VARIABLES = 500
+
+# The journal (see Transaction) is filled by triggers, so every change is journaled in the same
+# transaction as the change itself, however it was made
+JOURNAL_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+JOURNAL_SCHEMA = [
+"""create table if not exists journal(
+seq integer primary key autoincrement,
+op varchar not null,
+path varchar not null,
+old_path varchar,
+chksum varchar,
+changed_at real not null);""",
+"""create trigger if not exists journal_insert after insert on files begin
+insert into journal(op, path, chksum, changed_at) values('insert', new.path, new.chksum, %s);
+end;""" % JOURNAL_NOW,
+"""create trigger if not exists journal_update after update on files
+when old.path = new.path and (old.chksum is not new.chksum or old.pending is not new.pending or
+old.mismatch is not new.mismatch or old.symlink is not new.symlink) begin
+insert into journal(op, path, chksum, changed_at) values('update', new.path, new.chksum, %s);
+end;""" % JOURNAL_NOW,
+"""create trigger if not exists journal_rename after update on files when old.path != new.path begin
+insert into journal(op, path, old_path, chksum, changed_at)
+values('rename', new.path, old.path, new.chksum, %s);
+end;""" % JOURNAL_NOW,
+"""create trigger if not exists journal_delete after delete on files begin
+insert into journal(op, path, chksum, changed_at) values('delete', old.path, old.chksum, %s);
+end;""" % JOURNAL_NOW,
+]
+JOURNAL_TRIGGERS = ["journal_insert", "journal_update", "journal_rename", "journal_delete"]
+
+# The checksum counts (see ChecksumStats) are kept up to date by triggers too.  Duplicated checksums
+# are ranked by the space they would free by an index of their own, so listing the biggest
+# duplicates reads just those, and the space taken up by every checksum by another, for sharded
+# databases (see Sha1DB.duplicateGroups)
+CHECKSUM_SELECT = "select %s from checksums" % ", ".join(CHECKSUM_COLUMNS)
+DUPLICATED = "occupied > 0 and copies + linked > 1"
+# counting an entry (new or old) in or out of the counts of its checksum, if it is trusted, working
+# out the space columns from the new counts as it goes
+CHECKSUM_OWN = "(coalesce(%(row)s.symlink, 0) = 0 and coalesce(%(row)s.link, 0) = 0)"
+CHECKSUM_TRUSTED = "%(row)s.pending = 0 and %(row)s.mismatch = 0"
+CHECKSUM_SPACE = "occupied = %(size)s * (%(copies)s), reclaimable = %(size)s * max(%(copies)s - 1, 0)"
+CHECKSUM_COUNT_IN = ("""insert or ignore into checksums(%s)
+select new.chksum, 0, 0, 0, 0, 0 where %s;
+update checksums set size = coalesce(new.size, size), copies = copies + %s,
+linked = linked + 1 - %s, %s where chksum = new.chksum and %s;""" % (", ".join(CHECKSUM_COLUMNS),
+  CHECKSUM_TRUSTED, CHECKSUM_OWN, CHECKSUM_OWN, CHECKSUM_SPACE % {
+    "size": "coalesce(new.size, size)", "copies": "copies + %s" % CHECKSUM_OWN},
+  CHECKSUM_TRUSTED)) % {"row": "new"}
+CHECKSUM_COUNT_OUT = ("""update checksums set copies = copies - %s, linked = linked - 1 + %s, %s
+where chksum = old.chksum and %s;
+delete from checksums where chksum = old.chksum and copies = 0 and linked = 0;""" % (
+  CHECKSUM_OWN, CHECKSUM_OWN, CHECKSUM_SPACE % {"size": "size", "copies": "copies - %s" %
+                                                CHECKSUM_OWN}, CHECKSUM_TRUSTED)) % {"row": "old"}
+CHECKSUMS_SCHEMA = [
+"""create table if not exists checksums(
+chksum varchar not null primary key,
+size integer not null,
+copies integer not null,
+linked integer not null,
+occupied integer not null,
+reclaimable integer not null);""",
+"create index if not exists duplicates_idx on checksums(reclaimable desc, chksum) where %s;" %
+  DUPLICATED,
+"create index if not exists occupied_idx on checksums(occupied desc, chksum) where occupied > 0;",
+"""create trigger if not exists checksums_insert after insert on files begin
+%s
+end;""" % CHECKSUM_COUNT_IN,
+"""create trigger if not exists checksums_update
+after update of chksum, symlink, link, mismatch, pending, size on files
+when old.chksum is not new.chksum or old.symlink is not new.symlink or old.link is not new.link or
+old.mismatch is not new.mismatch or old.pending is not new.pending or old.size is not new.size begin
+%s
+%s
+end;""" % (CHECKSUM_COUNT_OUT, CHECKSUM_COUNT_IN),
+"""create trigger if not exists checksums_delete after delete on files begin
+%s
+end;""" % CHECKSUM_COUNT_OUT,
+]
+# counts the entries of a database made before there were checksum counts
+CHECKSUMS_FILL = ["""insert into checksums(%s)
+select chksum, max(coalesce(size, 0)), sum(%s), sum(1 - %s), 0, 0 from files
+where pending = 0 and mismatch = 0 group by chksum;""" % (", ".join(CHECKSUM_COLUMNS),
+  CHECKSUM_OWN % {"row": "files"}, CHECKSUM_OWN % {"row": "files"}),
+  "update checksums set %s;" % CHECKSUM_SPACE % {"size": "size", "copies": "copies"}]
+
+# The directory digests take two steps, since SQLite can't hash: triggers note every entry that comes
+# or goes in tree_changes (a change of path or checksum being both), and the transaction adds their
+# terms to the digests of the directories above them before it commits (see _settleTree).  Changes
+# made by anything else, e.g. the sqlite3 shell, are added up by the next transaction to read or
+# change the digests
+TREE_SCHEMA = [
+"""create table if not exists tree_changes(
+id integer primary key,
+path varchar not null,
+chksum varchar not null,
+sign integer not null);""",
+"""create table if not exists directories(
+path varchar not null primary key,
+parent varchar,
+digest varchar not null,
+files integer not null);""",
+"create index if not exists directories_parent_idx on directories(parent, path);",
+"""create trigger if not exists tree_insert after insert on files begin
+insert into tree_changes(path, chksum, sign) values(new.path, new.chksum, 1);
+end;""",
+"""create trigger if not exists tree_update after update of path, chksum on files
+when old.path != new.path or old.chksum != new.chksum begin
+insert into tree_changes(path, chksum, sign) values(old.path, old.chksum, -1);
+insert into tree_changes(path, chksum, sign) values(new.path, new.chksum, 1);
+end;""",
+"""create trigger if not exists tree_delete after delete on files begin
+insert into tree_changes(path, chksum, sign) values(old.path, old.chksum, -1);
+end;""",
+]
+DIRECTORY_SELECT = "select %s from directories" % ", ".join(DIRECTORY_COLUMNS)
+# adds up the entries of a database made before there were directory digests
+TREE_FILL = "insert into tree_changes(path, chksum, sign) select path, chksum, 1 from files;"
+# how many noted changes _settleTree reads at a time
+TREE_BATCH_SIZE = 10000
+
+# columns added to the files table after its first release, with the DDL needed to add them to an
+# older database
+FILES_UPGRADE_COLUMNS = [
+  ("link", "link boolean default 0"),
+  ("last_verified", "last_verified real"),
+  ("mismatch", "mismatch boolean default 0"),
+  ("size", "size integer"),
+  ("mtime", "mtime real"),
+  ("pending", "pending boolean default 0"),
+]
+
+class SqliteStore(Store):
+  """A store kept in the SQLite database at database, through one connection per thread (see
+  ThreadConnections).  The tables are created if they don't exist, along with metadata if given,
+  and those of databases made by older versions are upgraded, so existing databases keep working
+  without running db-convert.sql by hand."""
+  backend = "sqlite"
+
+  def __init__(self, database, metadata=None):
+    self.database = database
+    self.connections = ThreadConnections(database)
+    with self.connections.cursor() as cursor:
+      cursor.execute(FILES_SCHEMA)
+      cursor.execute("create index if not exists csum_idx on files(chksum);")
+    if None != metadata:
+      logging.info("Created SQLite store %s" % database)
+      self.setMetadata(metadata)
+    self._upgradeSchema()
+
+  @contextmanager
+  def transaction(self):
+    with self.connections.cursor() as cursor:
+      changes = cursor.connection.total_changes
+      transaction = SqliteTransaction(cursor)
+      yield transaction
+      if cursor.connection.total_changes != changes:
+        transaction._settleTree()
+
+  def metadata(self):
+    metadata = {}
+    with self.connections.cursor() as cursor:
+      tables = self._tables(cursor)
+      if "versioning" in tables:
+        cursor.execute("select chksum_type from versioning;")
+        for (chksumType, ) in cursor.fetchall():
+          metadata["chksum_type"] = chksumType
+      if "sharding" in tables:
+        cursor.execute("select %s from sharding;" % ", ".join(SHARDING_COLUMNS))
+        metadata.update(zip(SHARDING_COLUMNS, cursor.fetchone()))
+    return metadata
+
+  def setMetadata(self, metadata):
+    with self.connections.cursor() as cursor:
+      if "chksum_type" in metadata:
+        cursor.execute("create table if not exists versioning(chksum_type varchar not null);")
+        cursor.execute("delete from versioning;")
+        cursor.execute("insert into versioning(chksum_type) values(?);", (metadata["chksum_type"], ))
+      if "shards" in metadata:
+        cursor.execute(SHARDING_SCHEMA)
+        cursor.execute("delete from sharding;")
+        cursor.execute("insert into sharding(%s) values(?, ?, ?, ?);" % ", ".join(SHARDING_COLUMNS),
+          [metadata.get(column) for column in SHARDING_COLUMNS])
+
+  def commits(self):
+    return self.connections.commits
+
+  def flush(self):
+    with self.connections.cursor() as cursor:
+      cursor.execute("pragma wal_checkpoint(truncate);")
+
+  def close(self):
+    self.connections.close()
+
+  def _tables(self, cursor):
+    cursor.execute("select name from sqlite_master where type = 'table';")
+    return [name for (name, ) in cursor.fetchall()]
+
+  def _upgradeSchema(self):
+    with self.connections.cursor() as cursor:
+      cursor.execute("pragma table_info(files);")
+      columns = [row[1] for row in cursor.fetchall()]
+      for (column, ddl) in FILES_UPGRADE_COLUMNS:
+        if not column in columns:
+          logging.info("Adding column %s to %s" % (column, self.database))
+          cursor.execute("alter table files add column %s;" % ddl)
+      cursor.execute("create index if not exists verified_idx on files(last_verified);")
+      # the pending queue, in the order the pending hasher works through it.  This is a partial
+      # index so that it can only be used by queries for pending = 1; a plain index on pending
+      # would look attractive to the planner for every "pending = 0" query, even ones that the
+      # checksum index serves far better
+      cursor.execute("drop index if exists pending_idx;")
+      for ddl in JOURNAL_SCHEMA:
+        cursor.execute(ddl)
+      counted = "checksums" in self._tables(cursor)
+      for ddl in CHECKSUMS_SCHEMA:
+        cursor.execute(ddl)
+      if not counted:
+        logging.info("Counting the copies of every checksum in %s" % self.database)
+        for sql in CHECKSUMS_FILL:
+          cursor.execute(sql)
+      digested = "directories" in self._tables(cursor)
+      for ddl in TREE_SCHEMA:
+        cursor.execute(ddl)
+      if not digested:
+        logging.info("Adding up the directory digests of %s" % self.database)
+        cursor.execute(TREE_FILL)
+        SqliteTransaction(cursor)._settleTree()
+      cursor.execute("""create index if not exists pending_queue_idx on files(last_verified)
+where pending = 1;""")
+
+class SqliteTransaction(Transaction):
+  """A Transaction on a cursor of a SqliteStore."""
+  def __init__(self, cursor):
+    self.cursor = cursor
+
+  def get(self, path):
+    self.cursor.execute(ENTRY_SELECT + " where path = ?;", (_text(path), ))
+    row = self.cursor.fetchone()
+    return Entry._make(row) if None != row else None
+
+  def withPaths(self, paths):
+    return self._selectIn("path", [_text(path) for path in paths])
+
+  def withChecksums(self, chksums):
+    return self._selectIn("chksum", chksums)
+
+  def pathRange(self, low, high=None, after=None, limit=-1):
+    (low, high, after) = [_text(path) for path in (low, high, after)]
+    sql = ENTRY_SELECT + " where path >= ?"
+    args = [low]
+    if None != high:
+      sql += " and path < ?"
+      args.append(high)
+    if None != after:
+      sql += " and path > ?"
+      args.append(after)
+    return self._select(sql + " order by path limit ?;", args + [limit])
+
+  def linked(self):
+    return self._select(ENTRY_SELECT + """
+where symlink = 0 and mismatch = 0 and pending = 0 and link = 1;""")
+
+  def mismatches(self):
+    return self._select(ENTRY_SELECT + " where mismatch = 1 order by path;")
+
+  def pendingQueue(self, before, limit):
+    return self._select(ENTRY_SELECT + """
+where pending = 1 and (last_verified is null or last_verified < ?) order by last_verified limit ?;""",
+      (before, limit))
+
+  def scrubQueue(self, before, limit):
+    return self._select(ENTRY_SELECT + """
+where symlink = 0 and pending != 1 and (last_verified is null or last_verified < ?)
+order by last_verified limit ?;""", (before, limit))
+
+  def pendingBacklog(self):
+    self.cursor.execute("select count(*), coalesce(sum(size), 0) from files where pending = 1;")
+    return tuple(self.cursor.fetchone())
+
+  def checksumStats(self, chksums):
+    chksums = list(chksums)
+    found = []
+    for start in xrange(0, len(chksums), MAX_SQL_VARIABLES):
+      batch = chksums[start:start + MAX_SQL_VARIABLES]
+      found.extend(self._selectChecksums(CHECKSUM_SELECT + " where chksum in (%s);" %
+                                         ",".join("?" * len(batch)), batch))
+    return found
+
+  def duplicates(self, after=None, limit=-1):
+    return self._ranked("reclaimable", DUPLICATED, after, limit)
+
+  def occupying(self, after=None, limit=-1):
+    return self._ranked("occupied", "occupied > 0", after, limit)
+
+  def directories(self, paths):
+    self._settleTree()
+    return self._directoriesIn([_text(path) for path in paths])
+
+  def subdirectories(self, path):
+    self._settleTree()
+    self.cursor.execute(DIRECTORY_SELECT + " where parent = ? order by path;", (_text(path), ))
+    return [DirectoryDigest._make(row) for row in self.cursor.fetchall()]
+
+  def put(self, entry):
+    args = tuple(entry[1:]) + (_text(entry.path), )
+    self.cursor.execute(ENTRY_UPDATE, args)
+    if self.cursor.rowcount <= 0:
+      self.cursor.execute(ENTRY_INSERT, args)
+
+  def putIfAbsent(self, entries):
+    self.cursor.executemany(FILES_COPY.replace("insert", "insert or ignore", 1), 
+                            (_textEntry(entry) for entry in entries))
+    return self.cursor.rowcount
+
+  def update(self, path, changes, expect=None):
+    expect = expect or {}
+    for column in list(changes) + list(expect):
+      if not column in FILES_COLUMNS:
+        raise ValueError("No column %s" % column)
+    self.cursor.execute("update files set %s where path = ?%s;" % (
+      ", ".join("%s = ?" % column for column in changes),
+      "".join(" and %s is ?" % column for column in expect)),
+      changes.values() + [_text(path)] + expect.values())
+    return self.cursor.rowcount > 0
+
+  def remove(self, path):
+    self.cursor.execute("delete from files where path = ?;", (_text(path), ))
+
+  def removeRange(self, low, high):
+    self.cursor.execute("delete from files where path >= ? and path < ?;", (_text(low), _text(high)))
+
+  def rename(self, pairs):
+    self.cursor.executemany("update files set path = ? where path = ?;", 
+                            ((_text(new), _text(old)) for (new, old) in pairs))
+
+  def renamePrefix(self, old, new):
+    (pair, oldBelow, newBelow) = splitRename(old, new)
+    if None != pair:
+      self.rename([pair])
+    self.cursor.execute(PATH_UPDATE, (newBelow, oldBelow, oldBelow, prefixEnd(oldBelow)))
+
+  def load(self, entries, journal=True):
+    entries = (_textEntry(entry) for entry in entries)
+    if journal:
+      # as put does, a batch at a time
+      entries = [tuple(entry) for entry in entries]
+      self.cursor.executemany(ENTRY_UPDATE, [entry[1:] + entry[:1] for entry in entries])
+      self.cursor.executemany(FILES_COPY.replace("insert", "insert or ignore", 1), entries)
+      return
+    # dropping the triggers commits, and so does recreating them; the next upgrade recreates any
+    # that a crash in between leaves out
+    entries = list(entries)
+    for trigger in JOURNAL_TRIGGERS:
+      self.cursor.execute("drop trigger if exists %s;" % trigger)
+    # the entries replaced are deleted first: "or replace" would delete them without firing the
+    # triggers keeping the checksum counts, and would override the conflict clauses of those
+    self.cursor.executemany("delete from files where path = ?;", [(entry[0], ) for entry in entries])
+    self.cursor.executemany(FILES_COPY, entries)
+    for ddl in JOURNAL_SCHEMA[1:]:
+      self.cursor.execute(ddl)
+
+  def lastSequence(self):
+    self.cursor.execute("select seq from sqlite_sequence where name = 'journal';")
+    row = self.cursor.fetchone()
+    return row[0] if None != row else 0
+
+  def firstSequence(self):
+    self.cursor.execute("select min(seq) from journal;")
+    return self.cursor.fetchone()[0]
+
+  def changes(self, after, limit):
+    self.cursor.execute("""select seq, op, path, old_path, chksum, changed_at from journal
+where seq > ? order by seq limit ?;""", (after, limit))
+    return [tuple(row) for row in self.cursor.fetchall()]
+
+  def compactJournal(self, before=None, maxEntries=None):
+    deleted = 0
+    if None != before:
+      self.cursor.execute("delete from journal where changed_at < ?;", (before, ))
+      deleted += self.cursor.rowcount
+    if None != maxEntries:
+      self.cursor.execute("delete from journal where seq <= (select max(seq) from journal) - ?;",
+        (maxEntries, ))
+      deleted += self.cursor.rowcount
+    return deleted
+
+  def startJournalAfter(self, seq):
+    self.cursor.execute("delete from sqlite_sequence where name = 'journal';")
+    self.cursor.execute("insert into sqlite_sequence(name, seq) values('journal', ?);", (seq, ))
+
+  def _select(self, sql, args=()):
+    self.cursor.execute(sql, args)
+    return [Entry._make(row) for row in self.cursor.fetchall()]
+
+  def _selectChecksums(self, sql, args=()):
+    self.cursor.execute(sql, args)
+    return [ChecksumStats._make(row) for row in self.cursor.fetchall()]
+
+  # The checksum counts matching where (the condition of the index on column), in descending
+  # column order, after the (value, checksum) pair after; the first condition on after starts the
+  # index scan at value
+  def _ranked(self, column, where, after, limit):
+    sql = CHECKSUM_SELECT + " where " + where
+    args = []
+    if None != after:
+      sql += " and %s <= ? and (%s < ? or chksum > ?)" % (column, column)
+      args = [after[0], after[0], after[1]]
+    return self._selectChecksums(sql + " order by %s desc, chksum limit ?;" % column, args + [limit])
+
+  # Adds the changes noted in tree_changes to the directory digests, and forgets them
+  def _settleTree(self):
+    deltas = {}
+    (last, noted) = (0, 0)
+    while True:
+      self.cursor.execute("""select id, path, chksum, sign from tree_changes where id > ?
+order by id limit ?;""", (last, TREE_BATCH_SIZE))
+      rows = self.cursor.fetchall()
+      _treeDeltas([row[1:] for row in rows], deltas)
+      noted += len(rows)
+      if len(rows) < TREE_BATCH_SIZE:
+        break
+      last = rows[-1][0]
+    if 0 == noted:
+      return
+    self.cursor.execute("delete from tree_changes;")
+    (inserts, updates, deletes) = ([], [], [])
+    found = dict((row.path, row) for row in self._directoriesIn(deltas.keys()))
+    for (directory, (value, files)) in deltas.iteritems():
+      row = found.get(directory)
+      if None != row:
+        (value, files) = (value + int(row.digest, 16), files + row.files)
+      if files <= 0:
+        if None != row:
+          deletes.append((directory, ))
+      elif None != row:
+        updates.append((_digestText(value), files, directory))
+      else:
+        inserts.append((directory, _parentDirectory(directory), _digestText(value), files))
+    self.cursor.executemany("delete from directories where path = ?;", deletes)
+    self.cursor.executemany("update directories set digest = ?, files = ? where path = ?;", updates)
+    self.cursor.executemany("""insert into directories(path, parent, digest, files)
+values(?, ?, ?, ?);""", inserts)
+
+  # the directory digests of those of paths that have one, looked up MAX_SQL_VARIABLES at a time
+  def _directoriesIn(self, paths):
+    paths = list(paths)
+    found = []
+    for start in xrange(0, len(paths), MAX_SQL_VARIABLES):
+      batch = paths[start:start + MAX_SQL_VARIABLES]
+      self.cursor.execute(DIRECTORY_SELECT + " where path in (%s);" % ",".join("?" * len(batch)),
+        batch)
+      found.extend(DirectoryDigest._make(row) for row in self.cursor.fetchall())
+    return found
+
+  # the entries whose column is one of values, looked up MAX_SQL_VARIABLES at a time
+  def _selectIn(self, column, values):
+    values = list(values)
+    entries = []
+    for start in xrange(0, len(values), MAX_SQL_VARIABLES):
+      batch = values[start:start + MAX_SQL_VARIABLES]
+      entries.extend(self._select(ENTRY_SELECT + " where %s in (%s);" % (column,
+        ",".join("?" * len(batch))), batch))
+    return entries
+
+# The log backend.  The log is LOG_MAGIC followed by records: a RECORD_HEADER (the length and
+# CRC-32 of the payload) and a payload, a marshalled (kind, body) pair.  The kinds are:
+#   meta - body is the metadata
+#   ops - a committed transaction; body is a list of operations and a dict of the settings it
+#         changed (meta, base or floor).  An operation is a journal entry (seq, op, path, old path,
+#         checksum, time), with a seq and op of 0 and None if it isn't journaled, followed by the
+#         new entry of path as a tuple (None if it was removed).  The entry of old path, if any,
+#         was removed
+#   snapshot - body is a list of entries, as tuples, written by compaction
+#   history - body is a list of journal entries, the ones a compaction kept
+# and the settings are base, the seq the journal numbering carries on from, and floor, the oldest
+# seq that wasn't deleted by compactJournal.  Every commit is one record, so a crash can at worst
+# tear the last one, which is cut off when the log is next opened.
+RECORD_HEADER = struct.Struct(">II")
+META = "meta"
+OPS = "ops"
+SNAPSHOT = "snapshot"
+HISTORY = "history"
+# a log is compacted once it holds COMPACT_RATIO times as many entry records as there are entries,
+# and at least COMPACT_MIN_RECORDS; compaction writes entries and journal entries this many per record
+COMPACT_RATIO = 4
+COMPACT_MIN_RECORDS = 100000
+COMPACT_BATCH_SIZE = 10000
+# how often (in seconds) commits are synced to disk.  Like SQLite's normal sync with WAL, a power
+# loss can lose the last commits but not damage the log
+SYNC_INTERVAL = 1.0
+# the position of a record holding journal entries is kept every this many journal entries, so
+# that reading the journal from any point only reads records from about there on
+JOURNAL_INDEX_INTERVAL = 1024
+# the verification time sort key of entries that were never verified, which come first
+NEVER = float("-inf")
+
+# the LogStores open in this process, keyed by real path; a log can only be opened once (see
+# _openLog)
+_logs = {}
+_logsLock = threading.Lock()
+
+def _openLog(path, metadata):
+  # a process opening a log twice would have two copies of its entries drifting apart, so it gets
+  # the same LogStore each time, unless the file was replaced
+  with _logsLock:
+    key = os.path.realpath(path)
+    store = _logs.get(key)
+    if None != store and store.isFile(path):
+      store.users += 1
+      return store
+    store = _logs[key] = LogStore(path, metadata)
+    return store
+
+# path as unicode, which is how both backends return paths; str paths are UTF-8 (and SQLite won't
+# take them unless they are ASCII)
+def _text(path):
+  return path.decode("utf-8") if isinstance(path, str) else path
+
+def _textEntry(entry):
+  return entry._replace(path=_text(entry.path)) if isinstance(entry.path, str) else entry
+
+def prefixEnd(prefix):
+  """Returns the smallest string bigger than every string starting with prefix (unicode), which is
+  where a path range over the prefix ends."""
+  return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+def splitRename(old, new):
+  """Splits renaming old to new (see Transaction.renamePrefix) into the (new, old) pair of the path
+  itself, None if old ends in "/", and the prefixes of the paths below old and new, which end in
+  "/" so that renaming /a leaves /ab alone.  The paths are returned as unicode."""
+  (old, new) = (_text(old), _text(new))
+  (oldBelow, newBelow) = (old.rstrip("/") + "/", new.rstrip("/") + "/")
+  return ((new, old) if old != oldBelow else None, oldBelow, newBelow)
+
+def _timeKey(verified):
+  return NEVER if None == verified else verified
+
+# the ranking keys of checksum counts (see _Ranking)
+def _duplicateKey(stats):
+  if stats.occupied > 0 and stats.copies + stats.linked > 1:
+    return (-stats.reclaimable, stats.chksum)
+  return None
+
+def _occupiedKey(stats):
+  if stats.occupied > 0:
+    return (-stats.occupied, stats.chksum)
+  return None
+
+# the ranking key following the (value, checksum) pair after
+def _rankingKey(after):
+  return (-after[0], after[1]) if None != after else None
+
+def _checksumStats(chksum, size, copies, linked):
+  return ChecksumStats(chksum, size, copies, linked, size * copies, size * max(copies - 1, 0))
+
+class _Ranking:
+  """The keys (ending with the checksum) of the checksum counts in counts that key gives one,
+  sorted when they are read, like LogStore.paths: the keys of checksums changed since the last read
+  are taken out and put back in again.  Nothing is kept until the first read."""
+  def __init__(self, counts, key):
+    self.counts = counts
+    self.key = key
+    self.keys = None
+    self.changed = set()
+
+  def touch(self, chksum):
+    if None != self.keys:
+      self.changed.add(chksum)
+
+  def after(self, after, limit):
+    """Returns up to limit (-1 for all) keys after the key after (if not None), in order."""
+    if None == self.keys:
+      self.keys = sorted(key for key in (self.key(stats) for stats in self.counts.itervalues())
+                         if None != key)
+    elif self.changed:
+      changed = self.changed
+      keys = [key for key in self.keys if not key[-1] in changed]
+      for chksum in changed:
+        stats = self.counts.get(chksum)
+        key = self.key(stats) if None != stats else None
+        if None != key:
+          keys.append(key)
+      keys.sort()
+      (self.keys, self.changed) = (keys, set())
+    start = bisect_right(self.keys, after) if None != after else 0
+    return self.keys[start:start + limit] if limit >= 0 else self.keys[start:]
+
+def _isPending(entry):
+  return 1 == entry.pending
+
+def _isScrubbed(entry):
+  return 0 == entry.symlink and 1 != entry.pending
+
+class LogStore(Store):
+  """A store kept in the append-only log at database (see above), with every entry in memory,
+  indexed by path (a dict, plus a list sorted when a range is read), checksum, verification time
+  (heaps for the pending and scrub queues) and mismatch, along with the counts of every checksum
+  (ranked by _Rankings) and the directory digests.  The log is read back when the store is opened;
+  an incomplete or damaged last record, left by a crash, is cut off.  Damage anywhere else raises an
+  exception rather than throwing away the records after it.  Once the log holds mostly
+  replaced entries it is compacted: rewritten with just the live entries and the journal.
+
+  Transactions take the store's write lock at their first change and apply their changes to the
+  entries right away (undoing them if they roll back), so other threads can see changes before they
+  are committed.  Opening a log locks it (with flock) against other processes; use openStore, which
+  hands out the same LogStore to everything in the process."""
+  backend = "log"
+
+  def __init__(self, database, metadata=None):
+    self.database = database
+    self.meta = {}
+    self.entries = {}
+    # paths keyed by checksum: a path, or a set of them for checksums with copies
+    self.byChecksum = {}
+    # the paths, sorted when a range is read; paths added since go to newPaths, and paths removed
+    # stay until there are removedPaths of them
+    self.paths = []
+    self.newPaths = []
+    self.removedPaths = 0
+    # heaps of (verification time key, path); entries whose time or queue changed leave theirs
+    # behind, which are skipped and cleared out now and then
+    self.queues = {_isPending: [], _isScrubbed: []}
+    self.pendingCount = 0
+    self.pendingBytes = 0
+    self.mismatched = set()
+    # the counts of every checksum with trusted entries (see ChecksumStats), and their rankings
+    self.checksums = {}
+    self.rankings = {"duplicates": _Ranking(self.checksums, _duplicateKey),
+                     "occupying": _Ranking(self.checksums, _occupiedKey)}
+    # the digests of the directories with entries below them, as [digest value, files] lists keyed
+    # by path, and the paths of the subdirectories of each directory, keyed by its path; like the
+    # rankings, nothing is kept until the first read
+    self.tree = None
+    self.subdirectories = None
+    self.lastSeq = 0
+    self.base = 0
+    self.floor = 1
+    # the first seq of records with journal entries, and where they start (see _indexJournal)
+    self.journalSeqs = array("l")
+    self.journalOffsets = array("l")
+    # entry records in the log, to decide when to compact
+    self.records = 0
+    self.commitCount = 0
+    self.users = 1
+    # guards the entries and indexes for a moment at a time
+    self.lock = threading.RLock()
+    # held by the transaction changing the entries, from its first change until it's done
+    self.writeLock = threading.RLock()
+    # guards the file, its size and the journal index
+    self.fileLock = threading.RLock()
+    self.local = threading.local()
+    self.fd = self._openFile(database, 0)
+    try:
+      if 0 == os.fstat(self.fd).st_size:
+        logging.info("Created log store %s" % database)
+        self.meta = dict(metadata or {})
+        os.write(self.fd, LOG_MAGIC + self._record(META, self.meta))
+        self.size = os.fstat(self.fd).st_size
+      else:
+        self._recover()
+    except:
+      os.close(self.fd)
+      raise
+    self.lastSync = time.time()
+
+  @contextmanager
+  def transaction(self):
+    transaction = getattr(self.local, "transaction", None)
+    if None != transaction:
+      # part of the thread's enclosing transaction, and committed with it
+      yield transaction
+      return
+    transaction = self.local.transaction = LogTransaction(self)
+    try:
+      yield transaction
+    except:
+      self.local.transaction = None
+      transaction.rollback()
+      raise
+    self.local.transaction = None
+    transaction.commit()
+
+  def metadata(self):
+    return dict(self.meta)
+
+  def setMetadata(self, metadata):
+    with self.transaction() as transaction:
+      transaction.changeSettings(meta=dict(metadata))
+
+  def commits(self):
+    return self.commitCount
+
+  def flush(self):
+    with self.fileLock:
+      os.fsync(self.fd)
+      self.lastSync = time.time()
+
+  def close(self):
+    with _logsLock:
+      self.users -= 1
+      if self.users > 0:
+        return
+      if _logs.get(os.path.realpath(self.database)) is self:
+        del _logs[os.path.realpath(self.database)]
+    with self.fileLock:
+      os.fsync(self.fd)
+      os.close(self.fd)
+
+  def isFile(self, path):
+    """Returns whether path is (still) the file this store has open."""
+    try:
+      st = os.stat(path)
+    except OSError:
+      return False
+    own = os.fstat(self.fd)
+    return (st.st_dev, st.st_ino) == (own.st_dev, own.st_ino)
+
+  def compact(self):
+    """Rewrites the log with just the entries and the journal entries that are kept, replacing it
+    with a rename once the new one is on disk.  Changes wait meanwhile."""
+    with self.writeLock:
+      started = time.time()
+      path = self.database + ".compact"
+      fd = self._openFile(path, os.O_TRUNC)
+      try:
+        (size, journalSeqs, journalOffsets) = self._writeCompacted(fd)
+        os.fsync(fd)
+        with self.fileLock:
+          os.rename(path, self.database)
+          self._syncDirectory()
+          os.close(self.fd)
+          (self.fd, self.size) = (fd, size)
+          (self.journalSeqs, self.journalOffsets) = (journalSeqs, journalOffsets)
+      except:
+        os.close(fd)
+        if os.path.exists(path):
+          os.remove(path)
+        raise
+      self.records = len(self.entries)
+      logging.info("Compacted %s to %d bytes in %.1fs" % (self.database, size,
+        time.time() - started))
+
+  # Writes the compacted log to fd, returning its size and journal index
+  def _writeCompacted(self, fd):
+    first = self._firstSequence()
+    out = _RecordWriter(fd)
+    out.write(META, self.meta)
+    # the journal carries on from the entries kept
+    out.write(OPS, ([], {"base": first - 1 if None != first else self.lastSeq}))
+    entries = self.entries.values()
+    for start in xrange(0, len(entries), COMPACT_BATCH_SIZE):
+      out.write(SNAPSHOT, [tuple(entry) for entry in entries[start:start + COMPACT_BATCH_SIZE]])
+    last = (first or 1) - 1
+    while None != first:
+      changes = self._changes(last, COMPACT_BATCH_SIZE)
+      if not changes:
+        break
+      out.write(HISTORY, changes)
+      last = changes[-1][0]
+    return (out.size, out.journalSeqs, out.journalOffsets)
+
+  # Opens path for appending, locked against other processes
+  def _openFile(self, path, flags):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND | flags, 0644)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      os.close(fd)
+      raise Exception("%s is in use by another process" % path)
+    return fd
+
+  def _syncDirectory(self):
+    fd = os.open(os.path.dirname(os.path.abspath(self.database)), os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  def _record(self, kind, body):
+    payload = marshal.dumps((kind, body))
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+  # Reads the log back, cutting off a torn last record
+  def _recover(self):
+    started = time.time()
+    with open(self.database, "rb") as f:
+      if f.read(len(LOG_MAGIC)) != LOG_MAGIC:
+        raise Exception("%s is not a checksum log" % self.database)
+      end = os.fstat(f.fileno()).st_size
+      offset = len(LOG_MAGIC)
+      for (record, size) in _readRecords(f, end):
+        if None == record:
+          if offset + size < end:
+            raise Exception("%s is damaged at byte %d" % (self.database, offset))
+          logging.warn("Cutting off the last %d bytes of %s: an incomplete record" % (
+            end - offset, self.database))
+          os.ftruncate(self.fd, offset)
+          break
+        self._replay(record, offset)
+        offset += size
+    self.size = offset
+    logging.info("Read %d entries from %s in %.1fs" % (len(self.entries), self.database,
+      time.time() - started))
+
+  def _replay(self, (kind, body), offset):
+    if META == kind:
+      self.meta = body
+    elif OPS == kind:
+      (ops, settings) = body
+      for op in ops:
+        if None != op[3]:
+          self._put(op[3], None)
+        self._put(op[2], Entry._make(op[6]) if None != op[6] else None)
+      self._settle(settings)
+      self._indexJournal(ops, offset)
+    elif SNAPSHOT == kind:
+      for row in body:
+        entry = Entry._make(row)
+        self._put(entry.path, entry)
+    elif HISTORY == kind:
+      self._indexJournal(body, offset)
+
+  # Applies the settings of an ops record
+  def _settle(self, settings):
+    if "meta" in settings:
+      self.meta = settings["meta"]
+    if "base" in settings:
+      self.base = max(self.base, settings["base"])
+      self.lastSeq = max(self.lastSeq, self.base)
+    if "floor" in settings:
+      self.floor = max(self.floor, settings["floor"])
+
+  # Notes where the journal entries (or operations) in the record at offset start, if it is time
+  def _indexJournal(self, changes, offset):
+    seqs = [change[0] for change in changes if change[0]]
+    if not seqs:
+      return
+    self.lastSeq = max(self.lastSeq, seqs[-1])
+    if not self.journalSeqs or seqs[0] >= self.journalSeqs[-1] + JOURNAL_INDEX_INTERVAL:
+      self.journalSeqs.append(seqs[0])
+      self.journalOffsets.append(offset)
+
+  # Appends a record to the log
+  def _append(self, kind, body):
+    data = self._record(kind, body)
+    with self.fileLock:
+      offset = self.size
+      try:
+        written = 0
+        while written < len(data):
+          written += os.write(self.fd, buffer(data, written))
+      except:
+        # a partial record would hide everything after it
+        os.ftruncate(self.fd, offset)
+        raise
+      self.size += len(data)
+      if OPS == kind:
+        self._indexJournal(body[0], offset)
+      if time.time() - self.lastSync >= SYNC_INTERVAL:
+        os.fdatasync(self.fd)
+        self.lastSync = time.time()
+
+  # Writes a transaction's changes to the log, compacting it if it is time
+  def _commit(self, transaction):
+    if not transaction.ops and not transaction.settings:
+      return
+    self._append(OPS, (transaction.ops, transaction.settings))
+    self.commitCount += 1
+    if self.records > max(COMPACT_RATIO * len(self.entries), COMPACT_MIN_RECORDS):
+      try:
+        self.compact()
+      except (IOError, OSError) as einst:
+        logging.error("Unable to compact %s: %s" % (self.database, einst))
+
+  # Sets the entry of path to entry (None removes it), keeping the indexes up to date; returns the
+  # entry it replaced
+  def _put(self, path, entry):
+    with self.lock:
+      old = self.entries.get(path)
+      if None != self.tree and (None == old or None == entry or old.chksum != entry.chksum):
+        self._countTree(old, entry)
+      if None != old:
+        self._unindex(old)
+      if None != entry:
+        if None == old:
+          self.newPaths.append(path)
+        self.entries[path] = entry
+        self._index(entry, old)
+      elif None != old:
+        del self.entries[path]
+        self.removedPaths += 1
+      self.records += 1
+      return old
+
+  def _index(self, entry, old):
+    path = entry.path
+    paths = self.byChecksum.get(entry.chksum)
+    if None == paths:
+      self.byChecksum[entry.chksum] = path
+    elif isinstance(paths, set):
+      paths.add(path)
+    elif paths != path:
+      self.byChecksum[entry.chksum] = set([paths, path])
+    if _isPending(entry):
+      self.pendingCount += 1
+      self.pendingBytes += entry.size or 0
+    if 1 == entry.mismatch:
+      self.mismatched.add(path)
+    self._count(entry, 1)
+    for (inQueue, heap) in self.queues.iteritems():
+      if inQueue(entry) and (None == old or not inQueue(old) or
+                             old.last_verified != entry.last_verified):
+        heappush(heap, (_timeKey(entry.last_verified), path))
+        if len(heap) > 2 * len(self.entries) + COMPACT_BATCH_SIZE:
+          heap[:] = [(_timeKey(e.last_verified), e.path) for e in self.entries.itervalues()
+                     if inQueue(e)]
+          heapify(heap)
+
+  def _unindex(self, entry):
+    path = entry.path
+    paths = self.byChecksum.get(entry.chksum)
+    if isinstance(paths, set):
+      paths.discard(path)
+      if 1 == len(paths):
+        self.byChecksum[entry.chksum] = paths.pop()
+    elif paths == path:
+      del self.byChecksum[entry.chksum]
+    if _isPending(entry):
+      self.pendingCount -= 1
+      self.pendingBytes -= entry.size or 0
+    self.mismatched.discard(path)
+    self._count(entry, -1)
+
+  # Counts a trusted entry in (sign 1) or out (-1) of the counts of its checksum
+  def _count(self, entry, sign):
+    if 0 != entry.pending or 0 != entry.mismatch:
+      return
+    chksum = entry.chksum
+    stats = self.checksums.get(chksum)
+    (size, copies, linked) = stats[1:4] if None != stats else (0, 0, 0)
+    if 1 == sign and None != entry.size:
+      size = entry.size
+    if not entry.symlink and not entry.link:
+      copies += sign
+    else:
+      linked += sign
+    if copies or linked:
+      self.checksums[chksum] = _checksumStats(chksum, size, copies, linked)
+    else:
+      del self.checksums[chksum]
+    for ranking in self.rankings.itervalues():
+      ranking.touch(chksum)
+
+  # Takes the term of the entry old out of the digests of the directories above it and puts that of
+  # new in (either can be None)
+  def _countTree(self, old, new):
+    changes = [(entry.path, entry.chksum, sign) for (entry, sign) in ((old, -1), (new, 1))
+               if None != entry]
+    self._addToTree(_treeDeltas(changes, {}))
+
+  def _addToTree(self, deltas):
+    for (directory, (value, files)) in deltas.iteritems():
+      counts = self.tree.get(directory)
+      parent = _parentDirectory(directory)
+      if None == counts:
+        counts = self.tree[directory] = [0, 0]
+        if None != parent:
+          self.subdirectories.setdefault(parent, set()).add(directory)
+      counts[0] = (counts[0] + value) % TREE_MODULUS
+      counts[1] += files
+      if counts[1] <= 0:
+        del self.tree[directory]
+        siblings = self.subdirectories.get(parent)
+        if None != siblings:
+          siblings.discard(directory)
+          if not siblings:
+            del self.subdirectories[parent]
+
+  # The DirectoryDigests of those of paths that have one, adding up the digests of every entry if
+  # this is the first read
+  def _directories(self, paths):
+    with self.lock:
+      if None == self.tree:
+        (self.tree, self.subdirectories) = ({}, {})
+        self._addToTree(_treeDeltas(((entry.path, entry.chksum, 1) for entry in
+                                     self.entries.itervalues()), {}))
+      directories = [_text(path) for path in paths]
+      return [DirectoryDigest(directory, _digestText(self.tree[directory][0]),
+                              self.tree[directory][1])
+              for directory in directories if directory in self.tree]
+
+  def _subdirectories(self, path):
+    with self.lock:
+      self._directories([])
+      return self._directories(sorted(self.subdirectories.get(_text(path), ())))
+
+  # The checksum counts of the first limit keys of ranking after the key after
+  def _ranked(self, ranking, after, limit):
+    with self.lock:
+      return [self.checksums[key[-1]] for key in self.rankings[ranking].after(after, limit)]
+
+  # the paths, sorted
+  def _sortedPaths(self):
+    if self.removedPaths > len(self.entries) / 2 + COMPACT_BATCH_SIZE:
+      self.paths = sorted(self.entries)
+      self.newPaths = []
+      self.removedPaths = 0
+    elif self.newPaths:
+      # sorting a sorted list with a few paths appended is about linear
+      self.paths.extend(self.newPaths)
+      self.paths.sort()
+      self.newPaths = []
+    return self.paths
+
+  def _range(self, low, high, after, limit):
+    (low, high, after) = [_text(path) for path in (low, high, after)]
+    entries = []
+    with self.lock:
+      paths = self._sortedPaths()
+      start = bisect_left(paths, low)
+      if None != after:
+        start = max(start, bisect_right(paths, after))
+      previous = None
+      for index in xrange(start, len(paths)):
+        path = paths[index]
+        if None != high and path >= high:
+          break
+        entry = self.entries.get(path)
+        # removed paths are left in the list, and a path added again is in it twice
+        if None == entry or path == previous:
+          continue
+        previous = path
+        entries.append(entry)
+        if len(entries) == limit:
+          break
+    return entries
+
+  # The first limit (-1 for all) entries of the queue that holds the entries inQueue accepts whose
+  # time key is below before, found by walking the heap smallest first without taking anything
+  # off it
+  def _queue(self, inQueue, before, limit):
+    entries = []
+    seen = set()
+    with self.lock:
+      heap = self.queues[inQueue]
+      candidates = [(heap[0], 0)] if heap else []
+      while candidates and len(entries) != limit:
+        ((key, path), index) = heappop(candidates)
+        if key >= before:
+          break
+        entry = self.entries.get(path)
+        if (None != entry and inQueue(entry) and key == _timeKey(entry.last_verified) and
+            not path in seen):
+          seen.add(path)
+          entries.append(entry)
+        for child in (2 * index + 1, 2 * index + 2):
+          if child < len(heap):
+            heappush(candidates, (heap[child], child))
+    return entries
+
+  def _firstSequence(self):
+    first = max(self.floor, self.base + 1)
+    return first if first <= self.lastSeq else None
+
+  # The journal entries after seq, up to limit of them, read from the log starting at the last
+  # indexed record that can't be past the first one wanted
+  def _changes(self, after, limit):
+    first = self._firstSequence()
+    if None == first:
+      return []
+    after = max(after, first - 1)
+    with self.fileLock:
+      index = bisect_right(self.journalSeqs, after + 1) - 1
+      if index < 0:
+        return []
+      offset = self.journalOffsets[index]
+      end = self.size
+      # opened while the file can't be swapped by a compaction
+      f = open(self.database, "rb")
+    changes = []
+    with f:
+      f.seek(offset)
+      for (record, size) in _readRecords(f, end - offset):
+        if None == record:
+          raise Exception("%s is damaged at byte %d" % (self.database, f.tell()))
+        (kind, body) = record
+        if OPS == kind:
+          changes.extend(op[:6] for op in body[0] if op[0] > after)
+        elif HISTORY == kind:
+          changes.extend(change for change in body if change[0] > after)
+        if len(changes) >= limit:
+          break
+    return changes[:limit]
+
+# Yields the (record, size) of the records in the next length bytes of f, with a record of None
+# for a damaged or incomplete one (and then stops)
+def _readRecords(f, length):
+  read = 0
+  while read < length:
+    header = f.read(RECORD_HEADER.size)
+    record = None
+    size = RECORD_HEADER.size
+    if len(header) == RECORD_HEADER.size:
+      (payloadLength, crc) = RECORD_HEADER.unpack(header)
+      size += payloadLength
+      payload = f.read(payloadLength)
+      if len(payload) == payloadLength and crc == zlib.crc32(payload) & 0xffffffff:
+        try:
+          record = marshal.loads(payload)
+        except (EOFError, ValueError, TypeError):
+          pass
+    yield (record, size)
+    if None == record:
+      return
+    read += size
+
+class _RecordWriter:
+  """Writes records to a new log on fd (see LogStore), keeping its journal index."""
+  def __init__(self, fd):
+    self.fd = fd
+    self.size = 0
+    self.journalSeqs = array("l")
+    self.journalOffsets = array("l")
+    self._write(LOG_MAGIC)
+
+  def write(self, kind, body):
+    if HISTORY == kind and (not self.journalSeqs or
+                            body[0][0] >= self.journalSeqs[-1] + JOURNAL_INDEX_INTERVAL):
+      self.journalSeqs.append(body[0][0])
+      self.journalOffsets.append(self.size)
+    payload = marshal.dumps((kind, body))
+    self._write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+
+  def _write(self, data):
+    written = 0
+    while written < len(data):
+      written += os.write(self.fd, buffer(data, written))
+    self.size += len(data)
+
+class LogTransaction(Transaction):
+  """A Transaction on a LogStore (see there for how they work)."""
+  def __init__(self, store):
+    self.store = store
+    self.ops = []
+    self.settings = {}
+    # (path, entry) pairs to put back, and the store's journal state, if it rolls back
+    self.undo = []
+    self.saved = None
+    self.locked = False
+
+  def get(self, path):
+    return self.store.entries.get(_text(path))
+
+  def withPaths(self, paths):
+    entries = self.store.entries
+    with self.store.lock:
+      return [entry for entry in (entries.get(_text(path)) for path in paths) if None != entry]
+
+  def withChecksums(self, chksums):
+    store = self.store
+    found = []
+    with store.lock:
+      for chksum in chksums:
+        paths = store.byChecksum.get(chksum)
+        if isinstance(paths, set):
+          found.extend(store.entries[path] for path in paths)
+        elif None != paths:
+          found.append(store.entries[paths])
+    return found
+
+  def pathRange(self, low, high=None, after=None, limit=-1):
+    return self.store._range(low, high, after, limit)
+
+  def linked(self):
+    return [entry for entry in self.store.entries.values() if 1 == entry.link and
+            0 == entry.symlink and 0 == entry.mismatch and 0 == entry.pending]
+
+  def mismatches(self):
+    store = self.store
+    with store.lock:
+      return [store.entries[path] for path in sorted(store.mismatched)]
+
+  def pendingQueue(self, before, limit):
+    return self.store._queue(_isPending, before, limit)
+
+  def scrubQueue(self, before, limit):
+    return self.store._queue(_isScrubbed, before, limit)
+
+  def pendingBacklog(self):
+    with self.store.lock:
+      return (self.store.pendingCount, self.store.pendingBytes)
+
+  def checksumStats(self, chksums):
+    checksums = self.store.checksums
+    with self.store.lock:
+      return [checksums[chksum] for chksum in chksums if chksum in checksums]
+
+  def duplicates(self, after=None, limit=-1):
+    return self.store._ranked("duplicates", _rankingKey(after), limit)
+
+  def occupying(self, after=None, limit=-1):
+    return self.store._ranked("occupying", _rankingKey(after), limit)
+
+  def directories(self, paths):
+    return self.store._directories(paths)
+
+  def subdirectories(self, path):
+    return self.store._subdirectories(path)
+
+  def put(self, entry):
+    self._change(entry._replace(path=_text(entry.path)))
+
+  def putIfAbsent(self, entries):
+    added = 0
+    for entry in entries:
+      entry = Entry._make(entry)
+      if None == self.get(entry.path):
+        self.put(entry)
+        added += 1
+    return added
+
+  def update(self, path, changes, expect=None):
+    entry = self.get(path)
+    if None == entry:
+      return False
+    for (column, value) in (expect or {}).iteritems():
+      if getattr(entry, column) != value:
+        return False
+    changed = entry._replace(**changes)
+    if changed != entry:
+      self._change(changed)
+    return True
+
+  def remove(self, path):
+    entry = self.get(path)
+    if None != entry:
+      self._change(entry, removed=True)
+
+  def removeRange(self, low, high):
+    for entry in self.store._range(low, high, None, -1):
+      self._change(entry, removed=True)
+
+  def rename(self, pairs):
+    for (new, old) in pairs:
+      entry = self.get(old)
+      if None != entry:
+        self._change(entry._replace(path=_text(new)), oldPath=entry.path)
+
+  def renamePrefix(self, old, new):
+    (pair, oldBelow, newBelow) = splitRename(old, new)
+    entries = self.store._range(oldBelow, prefixEnd(oldBelow), None, -1)
+    self.rename(([pair] if None != pair else []) + 
+                [(newBelow + entry.path[len(oldBelow):], entry.path) for entry in entries])
+
+  def load(self, entries, journal=True):
+    for entry in entries:
+      entry = Entry._make(entry)
+      self._change(entry._replace(path=_text(entry.path)), journal=journal)
+
+  def lastSequence(self):
+    return self.store.lastSeq
+
+  def firstSequence(self):
+    return self.store._firstSequence()
+
+  def changes(self, after, limit):
+    return self.store._changes(after, limit)
+
+  def compactJournal(self, before=None, maxEntries=None):
+    store = self.store
+    first = store._firstSequence()
+    if None == first:
+      return 0
+    floor = first
+    if None != maxEntries:
+      floor = max(floor, store.lastSeq - maxEntries + 1)
+    if None != before:
+      # the journal is in time order; find the first entry that is recent enough
+      while floor <= store.lastSeq:
+        changes = store._changes(floor - 1, COMPACT_BATCH_SIZE)
+        recent = [change[0] for change in changes if change[5] >= before]
+        if recent:
+          floor = recent[0]
+          break
+        floor = changes[-1][0] + 1 if changes else store.lastSeq + 1
+    if floor > first:
+      self.changeSettings(floor=floor)
+    return floor - first
+
+  def startJournalAfter(self, seq):
+    self.changeSettings(base=seq)
+
+  def changeSettings(self, **settings):
+    """Changes the store's metadata (meta), the seq its journal carries on from (base) or the
+    oldest journal entry kept (floor)."""
+    self._begin()
+    self.settings.update(settings)
+    with self.store.lock:
+      self.store._settle(settings)
+
+  def commit(self):
+    if not self.locked:
+      return
+    try:
+      self.store._commit(self)
+    except:
+      self._undo()
+      raise
+    finally:
+      self._release()
+
+  def rollback(self):
+    if not self.locked:
+      return
+    try:
+      self._undo()
+    finally:
+      self._release()
+
+  # Makes a change to the entry of entry.path (removing it if removed, or moving it from oldPath),
+  # journaling it unless journal is false
+  def _change(self, entry, removed=False, oldPath=None, journal=True):
+    store = self.store
+    self._begin()
+    with store.lock:
+      old = store.entries.get(entry.path)
+      if None != oldPath:
+        self.undo.append((oldPath, store._put(oldPath, None)))
+        op = "rename"
+      elif removed:
+        op = "delete"
+      elif None == old:
+        op = "insert"
+      elif [getattr(old, column) for column in JOURNALED_COLUMNS] != [getattr(entry, column) for
+                                                                      column in JOURNALED_COLUMNS]:
+        op = "update"
+      else:
+        op = None
+      self.undo.append((entry.path, store._put(entry.path, None if removed else entry)))
+      if None != op and journal:
+        store.lastSeq += 1
+        change = (store.lastSeq, op, entry.path, oldPath, entry.chksum, time.time())
+      else:
+        change = (0, None, entry.path, oldPath, None, None)
+      self.ops.append(change + (None if removed else tuple(entry), ))
+
+  def _begin(self):
+    if not self.locked:
+      self.store.writeLock.acquire()
+      self.locked = True
+      store = self.store
+      self.saved = (store.lastSeq, store.base, store.floor, store.meta)
+
+  def _undo(self):
+    store = self.store
+    with store.lock:
+      for (path, entry) in reversed(self.undo):
+        store._put(path, entry)
+      (store.lastSeq, store.base, store.floor, store.meta) = self.saved
+    self.undo = []
+    self.ops = []
+    self.settings = {}
+
+  def _release(self):
+    self.locked = False
+    self.undo = []
+    self.ops = []
+    self.settings = {}
+    self.store.writeLock.release()
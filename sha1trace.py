@@ -0,0 +1,201 @@
+# Per-operation tracing: counts, bytes and latency histograms for the filesystem operations
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+# Tracing is off unless enable() is called (sha1fs.py --trace).  The instrumented code (ewrap around
+# every filesystem operation, fileChecksum, ThreadConnections.cursor and TracedLock) checks the
+# module's tracer before reading the clock, so while tracing is off all it costs is that check.
+#
+# Every operation gets a series with its count, errors, bytes and a latency histogram.  Time spent
+# hashing, in SQLite transactions and waiting for locks is recorded in the "hash", "sqlite" and
+# "lock" series, and is also charged to the operation that was running on the thread at the time, so
+# each operation's latency can be broken down.  Waits for SQLite's own locks (busy waits) happen
+# inside SQLite and count as SQLite time.
+#
+
+import math
+import threading
+import time
+
+# the active Tracer, or None while tracing is off
+tracer = None
+
+# the categories operation time is broken down into
+HASH = "hash"
+SQLITE = "sqlite"
+LOCK = "lock"
+CATEGORIES = [HASH, SQLITE, LOCK]
+_CATEGORY_INDEX = dict((category, index) for (index, category) in enumerate(CATEGORIES))
+
+# Latencies are counted in buckets of a quarter octave (about 19% wide) from 1us up to about 2
+# minutes; longer ones go into the last bucket.  Percentiles are the upper bound of their bucket.
+BUCKETS_PER_OCTAVE = 4
+OCTAVES = 27
+
+def enable():
+  """Turns tracing on, returning the Tracer collecting the results.  Tracing that is already on
+  carries on with the same Tracer."""
+  global tracer
+  if None == tracer:
+    tracer = Tracer()
+  return tracer
+
+def disable():
+  """Turns tracing off, returning the Tracer that collected the results so far (or None)."""
+  global tracer
+  (previous, tracer) = (tracer, None)
+  return previous
+
+class Histogram:
+  """Counts latencies (in seconds) in logarithmic buckets, so that percentiles can be estimated in
+  constant memory."""
+  def __init__(self):
+    self.counts = [0] * (BUCKETS_PER_OCTAVE * OCTAVES)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def record(self, seconds):
+    us = seconds * 1e6
+    if us < 1.0:
+      index = 0
+    else:
+      # us = mantissa * 2 ** exponent with mantissa in [0.5, 1)
+      (mantissa, exponent) = math.frexp(us)
+      index = min((exponent - 1) * BUCKETS_PER_OCTAVE + int((mantissa * 2 - 1) * BUCKETS_PER_OCTAVE),
+                  len(self.counts) - 1)
+    self.counts[index] += 1
+    self.count += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  def percentile(self, pct):
+    """Returns (an upper bound for) the pct'th percentile (0-100) in seconds; 0 if empty."""
+    if 0 == self.count:
+      return 0.0
+    rank = max(1, int(math.ceil(pct / 100.0 * self.count)))
+    seen = 0
+    for (index, count) in enumerate(self.counts):
+      seen += count
+      if seen >= rank:
+        break
+    (octave, step) = divmod(index + 1, BUCKETS_PER_OCTAVE)
+    upper = (2 ** octave) * (1 + float(step) / BUCKETS_PER_OCTAVE) / 1e6
+    return min(upper, self.max)
+
+class Series:
+  """What was recorded under one name: count, errors, bytes, a latency histogram and (for
+  operations) the time spent in each of CATEGORIES."""
+  def __init__(self):
+    self.errors = 0
+    self.nbytes = 0
+    self.latency = Histogram()
+    # seconds per category, in the order of CATEGORIES
+    self.breakdown = [0.0] * len(CATEGORIES)
+
+  def summary(self, elapsed):
+    latency = self.latency
+    summary = {
+      "count": latency.count,
+      "errors": self.errors,
+      "bytes": self.nbytes,
+      "per_sec": latency.count / max(elapsed, 1e-9),
+      "total_ms": latency.total * 1000,
+      "p50_ms": latency.percentile(50) * 1000,
+      "p99_ms": latency.percentile(99) * 1000,
+      "max_ms": latency.max * 1000,
+    }
+    for (category, seconds) in zip(CATEGORIES, self.breakdown):
+      summary[category + "_ms"] = seconds * 1000
+    return summary
+
+class Tracer:
+  """Collects Series for the operations and categories recorded while it is the active tracer."""
+  def __init__(self):
+    self.series = {}
+    self.started = time.time()
+    self._lock = threading.Lock()
+    # per thread, the category times of the operations running on it (innermost last)
+    self._local = threading.local()
+
+  def opStarted(self):
+    """Marks the start of an operation on the calling thread; category time recorded until the
+    matching opFinished is charged to it."""
+    try:
+      self._local.ops.append([0.0] * len(CATEGORIES))
+    except AttributeError:
+      self._local.ops = [[0.0] * len(CATEGORIES)]
+
+  def opFinished(self, name, seconds, nbytes=0, error=False):
+    """Records an operation that took seconds, moving nbytes, started with opStarted."""
+    stack = getattr(self._local, "ops", None)
+    breakdown = stack.pop() if stack else None
+    with self._lock:
+      series = self._series(name)
+      series.latency.record(seconds)
+      series.nbytes += nbytes
+      if error:
+        series.errors += 1
+      if None != breakdown and any(breakdown):
+        series.breakdown = [total + spent for (total, spent) in zip(series.breakdown, breakdown)]
+
+  def category(self, category, seconds, nbytes=0):
+    """Records seconds spent in category (one of CATEGORIES), charging it to the operations running
+    on the calling thread."""
+    index = _CATEGORY_INDEX[category]
+    for breakdown in getattr(self._local, "ops", None) or []:
+      breakdown[index] += seconds
+    with self._lock:
+      series = self._series(category)
+      series.latency.record(seconds)
+      series.nbytes += nbytes
+
+  def snapshot(self):
+    """Returns a dict mapping each series name to a dict of its count, errors, bytes, per_sec and
+    total, p50, p99 and max latency and time per category (all times in milliseconds)."""
+    elapsed = time.time() - self.started
+    with self._lock:
+      return dict((name, series.summary(elapsed)) for (name, series) in self.series.iteritems())
+
+  def report(self):
+    """Returns the snapshot as lines of text, busiest series first."""
+    snapshot = self.snapshot()
+    lines = ["%-12s %9s %6s %12s %10s %10s %10s %10s %10s %10s" %
+             ("series", "count", "errors", "bytes", "p50 ms", "p99 ms", "max ms", "hash ms",
+              "sqlite ms", "lock ms")]
+    for (name, summary) in sorted(snapshot.iteritems(), key=lambda item: -item[1]["total_ms"]):
+      lines.append("%-12s %9d %6d %12d %10.3f %10.3f %10.3f %10.1f %10.1f %10.1f" %
+                   (name, summary["count"], summary["errors"], summary["bytes"], summary["p50_ms"],
+                    summary["p99_ms"], summary["max_ms"], summary["hash_ms"], summary["sqlite_ms"],
+                    summary["lock_ms"]))
+    return lines
+
+  def _series(self, name):
+    series = self.series.get(name)
+    if None == series:
+      series = self.series[name] = Series()
+    return series
+
+class TracedLock(object):
+  """A lock (used with the with statement) whose waits are recorded as LOCK time while tracing.
+  Taking it uncontended costs one non-blocking attempt, and the clock is only read if that fails."""
+  __slots__ = ("_lock", )
+
+  def __init__(self):
+    self._lock = threading.Lock()
+
+  def __enter__(self):
+    if not self._lock.acquire(False):
+      started = time.time()
+      self._lock.acquire()
+      current = tracer
+      if None != current:
+        current.category(LOCK, time.time() - started)
+    return self
+
+  def __exit__(self, type, value, trace):
+    self._lock.release()
@@ -0,0 +1,236 @@
+# Virtual files and directories served by the mount alongside the mirrored tree
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import os
+import json
+import time
+from errno import ENOENT, EROFS, EINVAL
+from stat import S_IFDIR, S_IFREG
+
+import fuse
+
+def virtualStat(mode, size=0, mtime=None):
+  """Returns a fuse.Stat for a virtual node with the given mode (including the S_IF* type), owned by
+  the user running the filesystem."""
+  if None == mtime:
+    mtime = time.time()
+  return fuse.Stat(st_mode=mode, st_ino=0, st_dev=0, st_nlink=(2 if mode & S_IFDIR else 1),
+                   st_uid=os.getuid(), st_gid=os.getgid(), st_size=size,
+                   st_atime=mtime, st_mtime=mtime, st_ctime=mtime)
+
+class VirtualHandle(object):
+  """The file handle for a virtual file: its contents are generated when it is opened and served
+  from memory.  direct_io tells the kernel not to trust the size getattr reported, since the
+  contents may have changed since."""
+  __slots__ = ("data", "flags", "mtime", "direct_io")
+
+  def __init__(self, data, flags):
+    self.data = data
+    self.flags = flags
+    self.mtime = time.time()
+    self.direct_io = True
+
+  def read(self, size, offset):
+    return self.data[offset:offset + size]
+
+  def write(self, buf, offset):
+    raise OSError(EROFS, os.strerror(EROFS))
+
+  def truncate(self, size):
+    raise OSError(EROFS, os.strerror(EROFS))
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+  def stat(self):
+    return virtualStat(S_IFREG | 0444, len(self.data), self.mtime)
+
+class ControlHandle(VirtualHandle):
+  """The file handle for a writable virtual file.  Reads see the contents it was opened with;
+  writes are collected and handed to apply when the handle is flushed (i.e. when it is closed), so
+  that an error from apply (an OSError) is returned by the writer's close()."""
+  __slots__ = ("written", "apply")
+
+  def __init__(self, data, flags, apply):
+    VirtualHandle.__init__(self, data, flags)
+    self.written = bytearray()
+    self.apply = apply
+
+  def write(self, buf, offset):
+    if offset > len(self.written):
+      self.written.extend("\0" * (offset - len(self.written)))
+    self.written[offset:offset + len(buf)] = buf
+    return len(buf)
+
+  def truncate(self, size):
+    del self.written[size:]
+
+  def flush(self):
+    if self.written:
+      (written, self.written) = (str(self.written), bytearray())
+      self.apply(written)
+
+  def stat(self):
+    return virtualStat(S_IFREG | 0600, len(self.data), self.mtime)
+
+class VirtualNamespace:
+  """A directory of virtual nodes mounted at prefix (e.g. "/.by-hash").  Nothing under it shows up
+  in readdir of its parent or exists in the root, so rescans never see it.  Nodes are either
+  synthetic (stat, open and listdir are answered by the namespace) or stand in for a real file,
+  in which case real gives its path and the filesystem serves it as usual, read-only."""
+  prefix = None
+
+  def contains(self, path):
+    return path == self.prefix or path.startswith(self.prefix + "/")
+
+  def synthetic(self, path):
+    """True if path is served by the namespace itself rather than by a real file."""
+    return True
+
+  def real(self, path):
+    """Returns the real path path stands in for.  Raises OSError(ENOENT) if there is none."""
+    raise OSError(ENOENT, os.strerror(ENOENT))
+
+  def writable(self, path):
+    """True if the synthetic node path can be opened for writing."""
+    return False
+
+  def truncate(self, path, size):
+    """Truncates the synthetic node path (for open with O_TRUNC).  Raises OSError(EROFS) unless
+    it is writable."""
+    raise OSError(EROFS, os.strerror(EROFS))
+
+  def stat(self, path):
+    raise OSError(ENOENT, os.strerror(ENOENT))
+
+  def open(self, path, flags):
+    raise OSError(ENOENT, os.strerror(ENOENT))
+
+  def listdir(self, path):
+    return []
+
+class ByHash(VirtualNamespace):
+  """/.by-hash/<hex> is the canonical file with checksum <hex> (looked up through the checksum
+  index), and /.by-hash/<hex>.paths lists the mount paths of every file with that checksum, one per
+  line.  The directory itself lists nothing; there would be one entry per distinct file.  Lookups
+  are cached in cache, an LruCache."""
+  prefix = "/.by-hash"
+  pathsSuffix = ".paths"
+
+  def __init__(self, sha1db, root, cache):
+    self.sha1db = sha1db
+    self.root = root
+    self.cache = cache
+    self.digestLength = 2 * sha1db.checksum().digest_size
+    self.mountedAt = time.time()
+
+  def synthetic(self, path):
+    return path == self.prefix or path.endswith(self.pathsSuffix)
+
+  def real(self, path):
+    chksum = self._checksum(path)
+    real = self.cache.get(chksum)
+    if None == real:
+      real = self.sha1db.canonicalPath(chksum) or ""
+      self.cache.put(chksum, real)
+    if not real:
+      raise OSError(ENOENT, os.strerror(ENOENT))
+    return real
+
+  def stat(self, path):
+    if path == self.prefix:
+      return virtualStat(S_IFDIR | 0555, mtime=self.mountedAt)
+    return virtualStat(S_IFREG | 0444, len(self._paths(path)), self.mountedAt)
+
+  def open(self, path, flags):
+    return VirtualHandle(self._paths(path), flags)
+
+  # The contents of a .paths file; only files under the root are listed
+  def _paths(self, path):
+    paths = self.sha1db.pathsForChecksum(self._checksum(path[:-len(self.pathsSuffix)]))
+    root = self.root.rstrip("/")
+    paths = [path[len(root):] for path in paths if path.startswith(root + "/")]
+    if not paths:
+      raise OSError(ENOENT, os.strerror(ENOENT))
+    return "".join(path + "\n" for path in paths).encode("utf-8")
+
+  # Returns the checksum named by /.by-hash/<hex>, if it looks like one
+  def _checksum(self, path):
+    chksum = path[len(self.prefix) + 1:].lower()
+    if len(chksum) != self.digestLength or chksum.strip("0123456789abcdef"):
+      raise OSError(ENOENT, os.strerror(ENOENT))
+    return chksum
+
+class ControlNamespace(VirtualNamespace):
+  """/.sha1fs: the stats file is a JSON document describing the running filesystem, produced by
+  stats (a function returning a dict) whenever it is opened.  The control file lists settings that
+  can be changed at runtime as "name=value" lines; settings is a dict of name to a (get, set) pair
+  of functions, where get returns the current value as a string and set takes the new one, raising
+  ValueError if it won't do.  Writing "name=value" lines to control applies them in order; an
+  unknown name or bad value fails the write (at close) with EINVAL."""
+  prefix = "/.sha1fs"
+  statsName = "stats"
+  controlName = "control"
+
+  def __init__(self, stats, settings):
+    self.stats = stats
+    self.settings = settings
+    self.mountedAt = time.time()
+
+  def writable(self, path):
+    return path == self._node(self.controlName)
+
+  def truncate(self, path, size):
+    if not self.writable(path):
+      raise OSError(EROFS, os.strerror(EROFS))
+
+  def stat(self, path):
+    if path == self.prefix:
+      return virtualStat(S_IFDIR | 0555, mtime=self.mountedAt)
+    if path == self._node(self.statsName):
+      # like /proc, the size is only known once the file is read
+      return virtualStat(S_IFREG | 0444, 0)
+    if path == self._node(self.controlName):
+      return virtualStat(S_IFREG | 0600, len(self._settingsText()))
+    raise OSError(ENOENT, os.strerror(ENOENT))
+
+  def open(self, path, flags):
+    if path == self._node(self.statsName):
+      return VirtualHandle(json.dumps(self.stats(), indent=1, sort_keys=True) + "\n", flags)
+    if path == self._node(self.controlName):
+      return ControlHandle(self._settingsText(), flags, self._apply)
+    raise OSError(ENOENT, os.strerror(ENOENT))
+
+  def listdir(self, path):
+    if path == self.prefix:
+      return [self.statsName, self.controlName]
+    return []
+
+  def _node(self, name):
+    return self.prefix + "/" + name
+
+  def _settingsText(self):
+    return "".join("%s=%s\n" % (name, get()) for (name, (get, set)) in sorted(self.settings.items()))
+
+  # Applies the "name=value" lines written to the control file
+  def _apply(self, text):
+    for line in text.splitlines():
+      line = line.strip()
+      if not line or line.startswith("#"):
+        continue
+      (name, sep, value) = line.partition("=")
+      setting = self.settings.get(name.strip())
+      if not sep or None == setting:
+        raise OSError(EINVAL, "unknown setting %r" % name.strip())
+      try:
+        setting[1](value.strip())
+      except ValueError as einst:
+        raise OSError(EINVAL, "bad value for %s: %s" % (name.strip(), einst))
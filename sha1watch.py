@@ -0,0 +1,341 @@
+# Following changes made to the root directly (not through the mount) with inotify
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+# A Watcher puts an inotify watch on every directory under the root and turns what happens there
+# into the database updates the filesystem operations would have made: files that were created or
+# written are hashed once they have been left alone for a moment (like release does), moves become
+# Sha1DB.updatePath (like rename), deletions remove entries (like unlink) and new directories are
+# watched and synced.  Files whose size and mtime still match their entry aren't hashed again, so
+# changes made through the mount, which inotify reports too, cost a lookup rather than a rehash.
+#
+# If the kernel's event queue overflows, events were lost; the directories that had events in the
+# last minute are where the writers were, so only the smallest subtree holding all of them is
+# synced (see Sha1DB.syncTree), rather than the whole root.
+#
+# inotify is Linux only; it is called through ctypes, so nothing needs to be installed.
+#
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from errno import EINTR, ENOENT, ENOSPC
+from stat import S_ISREG
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 02000000
+
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+# wd, mask, cookie and length of the name that follows
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# seconds a file has to be left alone after being written before it is hashed
+DEFAULT_SETTLE_DELAY = 1.0
+# seconds to wait for the second half of a move; after that the file was moved out of the root
+MOVE_PAIR_DELAY = 0.5
+# directories with events in the last this many seconds are synced after an overflow
+RECENT_WINDOW = 60.0
+# how long the watcher waits for events at most, so that it notices being stopped
+IDLE_POLL = 1.0
+
+class Inotify:
+  """A minimal inotify binding: watches are added with addWatch and events read with read."""
+  def __init__(self):
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    self._addWatch = libc.inotify_add_watch
+    self._addWatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    self._rmWatch = libc.inotify_rm_watch
+    self._rmWatch.argtypes = [ctypes.c_int, ctypes.c_int]
+    self.fd = libc.inotify_init1(IN_CLOEXEC)
+    if self.fd < 0:
+      raise self._error()
+
+  def addWatch(self, path, mask=WATCH_MASK):
+    """Watches path (a directory), returning the watch descriptor.  Watching a directory again
+    returns its existing descriptor."""
+    if isinstance(path, unicode):
+      path = path.encode(sys.getfilesystemencoding() or "utf-8")
+    wd = self._addWatch(self.fd, path, mask)
+    if wd < 0:
+      raise self._error(path)
+    return wd
+
+  def removeWatch(self, wd):
+    # fails if the watch is already gone, which is fine
+    self._rmWatch(self.fd, wd)
+
+  def read(self, timeout):
+    """Returns the (wd, mask, cookie, name) of the events that arrived, waiting up to timeout
+    seconds for some; an empty list if there were none."""
+    try:
+      (ready, w, x) = select.select([self.fd], [], [], timeout)
+      if not ready:
+        return []
+      data = os.read(self.fd, READ_SIZE)
+    except (OSError, select.error) as einst:
+      if EINTR == einst.args[0]:
+        return []
+      raise
+    events = []
+    offset = 0
+    while offset < len(data):
+      (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+      offset += EVENT_HEADER.size
+      events.append((wd, mask, cookie, data[offset:offset + length].rstrip("\0")))
+      offset += length
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+  def _error(self, path=None):
+    errno = ctypes.get_errno()
+    return OSError(errno, os.strerror(errno), path) if None != path else OSError(errno, os.strerror(errno))
+
+class Watcher(threading.Thread):
+  """Follows the changes made under root, keeping sha1db up to date (see the top of the file).
+
+    sha1db - the Sha1DB to update; its exclude rules decide what is watched
+    root - the directory to watch
+    settleDelay - seconds a written file must be left alone before it is hashed
+    changed - optional callable, called with the path of every file or directory that changed and
+              whether it is a directory (everything below which may have changed too), e.g. to
+              drop cached attributes
+  """
+  def __init__(self, sha1db, root, settleDelay=DEFAULT_SETTLE_DELAY, changed=None):
+    threading.Thread.__init__(self, name="watcher")
+    self.daemon = True
+    self.sha1db = sha1db
+    self.root = os.path.abspath(root)
+    self.settleDelay = settleDelay
+    self.changed = changed
+    self.stopped = threading.Event()
+    # set once the whole tree is watched
+    self.ready = threading.Event()
+    self.inotify = None
+    # the watched directories by watch descriptor, and the other way round
+    self.paths = {}
+    self.watches = {}
+    # written files, with the time they may be hashed
+    self.dirty = {}
+    # the first halves of moves, by cookie: (path, is directory, time)
+    self.moves = {}
+    # the time of the last event of each directory that had one recently
+    self.recent = {}
+
+    self.filesUpdated = 0
+    self.entriesRemoved = 0
+    self.moved = 0
+    self.overflows = 0
+
+  def stop(self):
+    self.stopped.set()
+
+  def run(self):
+    logging.info("%s started on %s" % (self.name, self.root))
+    self.inotify = Inotify()
+    try:
+      self._watchTree(self.root)
+      self.ready.set()
+      while not self.stopped.is_set():
+        for (wd, mask, cookie, name) in self.inotify.read(self._timeout()):
+          try:
+            self._handle(wd, mask, cookie, name)
+          except Exception as einst:
+            logging.error("%s failed to handle %s in %s: %s" %
+              (self.name, name, self.paths.get(wd), einst))
+        try:
+          self._flush()
+        except Exception as einst:
+          logging.error("%s failed: %s" % (self.name, einst))
+    finally:
+      self.inotify.close()
+    logging.info("%s stopped" % self.name)
+
+  # Seconds until the next settled file or unpaired move is due
+  def _timeout(self):
+    now = time.time()
+    due = [now + IDLE_POLL] + self.dirty.values() + [moved + MOVE_PAIR_DELAY
+                                                     for (path, isdir, moved) in self.moves.values()]
+    return max(0, min(due) - now)
+
+  def _handle(self, wd, mask, cookie, name):
+    if mask & IN_Q_OVERFLOW:
+      self._overflow()
+      return
+    directory = self.paths.get(wd)
+    if None == directory or mask & (IN_IGNORED | IN_DELETE_SELF):
+      # the watch is gone with its directory, whose parent reported it
+      if mask & IN_IGNORED:
+        self._forget(wd)
+      return
+    path = os.path.join(directory, name)
+    isdir = bool(mask & IN_ISDIR)
+    self.recent[directory] = time.time()
+    if (self.sha1db.rules.excludedPath(path) if isdir else self.sha1db.rules.excluded(path)):
+      return
+    if mask & IN_MOVED_FROM:
+      self.moves[cookie] = (path, isdir, time.time())
+    elif mask & IN_MOVED_TO:
+      moved = self.moves.pop(cookie, None)
+      if None != moved:
+        self._moved(moved[0], path, isdir)
+      else:
+        self._arrived(path, isdir)
+    elif mask & IN_CREATE:
+      self._arrived(path, isdir)
+    elif mask & (IN_MODIFY | IN_CLOSE_WRITE):
+      self._written(path)
+    elif mask & IN_DELETE:
+      self._removed(path, isdir)
+
+  # Hashes the files that were left alone for settleDelay, and takes moves whose other half didn't
+  # turn up as moves out of the root
+  def _flush(self):
+    now = time.time()
+    for (cookie, (path, isdir, moved)) in self.moves.items():
+      if now - moved >= MOVE_PAIR_DELAY:
+        del self.moves[cookie]
+        self._removed(path, isdir)
+    for (path, due) in self.dirty.items():
+      if due <= now:
+        del self.dirty[path]
+        self._update(path)
+    for (directory, seen) in self.recent.items():
+      if now - seen > RECENT_WINDOW:
+        del self.recent[directory]
+
+  def _written(self, path):
+    self.dirty[path] = time.time() + self.settleDelay
+    self._changed(path, False)
+
+  def _arrived(self, path, isdir):
+    if isdir:
+      self._watchTree(path)
+      self._sync(path)
+    else:
+      self._written(path)
+
+  def _moved(self, old, new, isdir):
+    logging.info("%s moved to %s outside of the mount" % (old, new))
+    if isdir:
+      self.sha1db.updatePath(old + "/", new + "/")
+      for (directory, wd) in self.watches.items():
+        if directory == old or directory.startswith(old + "/"):
+          self._watched(new + directory[len(old):], wd)
+    else:
+      self.sha1db.updatePath(old, new)
+    for path in self.dirty.keys():
+      if path == old or path.startswith(old + "/"):
+        self.dirty[new + path[len(old):]] = self.dirty.pop(path)
+    self.moved += 1
+    self._changed(old, isdir)
+    self._changed(new, isdir)
+
+  def _removed(self, path, isdir):
+    logging.info("%s removed outside of the mount" % path)
+    self.dirty.pop(path, None)
+    if isdir:
+      # moved out of the root, or deleted (in which case its watches are already going away)
+      for (directory, wd) in self.watches.items():
+        if directory == path or directory.startswith(path + "/"):
+          self.inotify.removeWatch(wd)
+          self._forget(wd)
+      self.sha1db.removeTree(path)
+    else:
+      self.sha1db.removeChecksum(path)
+    self.entriesRemoved += 1
+    self._changed(path, isdir)
+
+  # Hashes a file that was written, unless its entry is up to date already (e.g. because it was
+  # written through the mount)
+  def _update(self, path):
+    try:
+      st = os.lstat(path)
+    except OSError:
+      # gone again; its deletion is reported separately
+      return
+    if not S_ISREG(st.st_mode):
+      return
+    entry = self.sha1db.getEntry(path)
+    if None != entry and (entry[4], entry[5]) == (st.st_size, st.st_mtime):
+      return
+    logging.info("%s changed outside of the mount" % path)
+    self.sha1db.updateChecksum(path)
+    self.filesUpdated += 1
+
+  # Syncs the subtree of the directories that had events lately: that's where the lost events were,
+  # unless something changed somewhere quiet in the same moment
+  def _overflow(self):
+    self.overflows += 1
+    now = time.time()
+    directories = [directory for (directory, seen) in self.recent.items()
+                   if now - seen <= RECENT_WINDOW]
+    tree = self.root
+    if directories:
+      common = os.path.commonprefix([directory + "/" for directory in directories])
+      common = common[:common.rfind("/")]
+      if common.startswith(self.root):
+        tree = common
+    logging.warn("%s lost events; syncing %s" % (self.name, tree))
+    self._watchTree(tree)
+    self._sync(tree)
+
+  def _sync(self, tree):
+    (updated, removed) = self.sha1db.syncTree(tree)
+    self.filesUpdated += updated
+    self.entriesRemoved += removed
+    self._changed(tree, True)
+
+  # Watches top and every directory below it that isn't excluded
+  def _watchTree(self, top):
+    for (root, dirs, files) in os.walk(top):
+      dirs[:] = [name for name in dirs if not self.sha1db.rules.excludedPath(os.path.join(root, name))]
+      try:
+        self._watched(root, self.inotify.addWatch(root))
+      except OSError as einst:
+        if ENOSPC == einst.errno:
+          logging.error("Out of inotify watches; raise fs.inotify.max_user_watches.  Changes under %s "
+                        "won't be noticed" % root)
+        elif ENOENT != einst.errno:
+          logging.error("Unable to watch %s: %s" % (root, einst))
+
+  def _watched(self, directory, wd):
+    old = self.paths.get(wd)
+    if None != old and self.watches.get(old) == wd:
+      del self.watches[old]
+    self.paths[wd] = directory
+    self.watches[directory] = wd
+
+  def _forget(self, wd):
+    directory = self.paths.pop(wd, None)
+    if None != directory and self.watches.get(directory) == wd:
+      del self.watches[directory]
+
+  def _changed(self, path, isdir):
+    if None != self.changed:
+      self.changed(path, isdir)
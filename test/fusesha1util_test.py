@@ -10,6 +10,7 @@ import unittest
 import sys
 import os
 import hashlib
+import errno
 
 sys.path.append("../")
 import fusesha1util as fsu
@@ -50,6 +51,76 @@ class TestSha1FuseUtil(unittest.TestCase):
 		self.assertEqual("9519b846c2b3a933bd348cc983f3796180ad2761", fsu.fileChecksum(self._sha1file))
 		self.assertEqual("5af12c8f98e305b8ecfd91a4d5d0a302", fsu.fileChecksum(self._sha1file, hashlib.md5))
 		
+	def testParseSize(self):
+		self.assertEqual(512, fsu.parseSize("512"))
+		self.assertEqual(64 * 1024, fsu.parseSize("64K"))
+		self.assertEqual(10 * 1024 * 1024, fsu.parseSize("10m"))
+		self.assertEqual(10 * 1024 * 1024, fsu.parseSize("10MB"))
+		self.assertEqual(3 * 512 * 1024 * 1024, fsu.parseSize("1.5G"))
+		self.assertEqual(0, fsu.parseSize(0))
+		
+	def testParseSizeBad(self):
+		self.assertRaises(ValueError, lambda: fsu.parseSize(None))
+		self.assertRaises(ValueError, lambda: fsu.parseSize(""))
+		self.assertRaises(ValueError, lambda: fsu.parseSize("lots"))
+		
+	def testLruCache(self):
+		cache = fsu.LruCache(2, 60)
+		cache.put("/a", 1)
+		cache.put("/b", 2)
+		self.assertEqual(1, cache.get("/a"))
+		# /b is now the least recently used entry
+		cache.put("/c", 3)
+		self.assertEqual(None, cache.get("/b"))
+		self.assertEqual(1, cache.get("/a"))
+		cache.invalidate("/a")
+		self.assertEqual(None, cache.get("/a"))
+		self.assertEqual(3, cache.get("/c"))
+		
+	def testLruCachePrefix(self):
+		cache = fsu.LruCache(10, 60)
+		for key in ("/dir", "/dir/a", "/dir/sub/b", "/dirx"):
+			cache.put(key, key)
+		cache.invalidatePrefix("/dir")
+		self.assertEqual(None, cache.get("/dir"))
+		self.assertEqual(None, cache.get("/dir/a"))
+		self.assertEqual(None, cache.get("/dir/sub/b"))
+		self.assertEqual("/dirx", cache.get("/dirx"))
+		
+	def testLruCacheMany(self):
+		cache = fsu.LruCache(3, 60)
+		cache.putMany([("a", 1), ("b", 2)])
+		self.assertEqual({"a": 1}, cache.getMany(["a", "c"]))
+		self.assertEqual(1, cache.hits)
+		self.assertEqual(1, cache.misses)
+		# "a" was used most recently, so "b" is the one to go
+		cache.putMany([("c", 3), ("d", 4)])
+		self.assertEqual({"a": 1, "c": 3, "d": 4}, cache.getMany(["a", "b", "c", "d"]))
+		
+	def testLruCacheDisabled(self):
+		cache = fsu.LruCache(10, 0)
+		cache.put("/a", 1)
+		self.assertEqual(None, cache.get("/a"))
+		
+	def testXattr(self):
+		try:
+			fsu.setxattr(self._sha1file, "user.fusesha1test", "value")
+		except OSError as einst:
+			if einst.errno in (errno.ENOTSUP, errno.EPERM):
+				return # the filesystem the tests run on has no user xattrs
+			raise
+		try:
+			self.assertEqual("value", fsu.getxattr(self._sha1file, "user.fusesha1test"))
+			self.assertTrue("user.fusesha1test" in fsu.listxattr(self._sha1file))
+		finally:
+			fsu.removexattr(self._sha1file, "user.fusesha1test")
+		self.assertFalse("user.fusesha1test" in fsu.listxattr(self._sha1file))
+		try:
+			fsu.getxattr(self._sha1file, "user.fusesha1test")
+			self.fail("getxattr of a removed attribute")
+		except OSError as einst:
+			self.assertEqual(errno.ENODATA, einst.errno)
+		
 	def testLinkFileBad(self):
 		self.assertRaises(OSError, lambda: fsu.linkFile(None, None))
 		self.assertRaises(OSError, lambda: fsu.linkFile("", ""))
@@ -0,0 +1,378 @@
+# Tests for the checksum database
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+
+sys.path.append("../")
+import fusesha1util
+import sha1db
+from sha1db import Sha1DB, JournalGap, diffDatabases
+from sha1rules import ExcludeRules
+from sha1scrub import Scrubber
+from sha1store import Entry
+
+def write(path, data):
+	with open(path, "wb") as f:
+		f.write(data)
+
+def sha1(data):
+	return hashlib.sha1(data).hexdigest()
+
+class TestRescan(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmpdir, "root")
+		os.makedirs(os.path.join(self.root, "sub"))
+		# created out of name order, so that name and inode order differ
+		self.names = ["e", "b", "d", "a", "c"]
+		for name in self.names:
+			write(os.path.join(self.root, "sub", name), name * 10)
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"))
+		self.hashed = []
+		self.fileChecksum = sha1db.fileChecksum
+		self.posixFadvise = fusesha1util._posixFadvise
+		def recordingChecksum(path, *args, **kw):
+			self.hashed.append(path)
+			return self.fileChecksum(path, *args, **kw)
+		sha1db.fileChecksum = recordingChecksum
+
+	def tearDown(self):
+		sha1db.fileChecksum = self.fileChecksum
+		fusesha1util._posixFadvise = self.posixFadvise
+		self.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	def paths(self):
+		return [os.path.join(self.root, "sub", name) for name in self.names]
+
+	def assertChecksums(self):
+		for path in self.paths():
+			self.assertEqual(sha1(os.path.basename(path) * 10), self.sha1db.getChecksum(path))
+
+	def testInodeOrder(self):
+		self.sha1db.updateAllChecksums(self.root, inodeOrder=True)
+		self.assertEqual(sorted(self.paths(), key=lambda path: os.lstat(path).st_ino), self.hashed)
+		self.assertChecksums()
+
+	def testInodeOrderVanished(self):
+		# a file removed between listing and sorting sorts first rather than failing the rescan
+		self.assertEqual(0, sha1db._inodeOf(os.path.join(self.root, "missing")))
+		self.assertEqual(os.lstat(self.paths()[0]).st_ino, sha1db._inodeOf(self.paths()[0]))
+
+	def testFadvise(self):
+		advice = []
+		fusesha1util._posixFadvise = lambda fd, offset, length, hint: advice.append(hint)
+		self.sha1db.updateAllChecksums(self.root)
+		self.assertEqual([fusesha1util.POSIX_FADV_SEQUENTIAL, fusesha1util.POSIX_FADV_DONTNEED] *
+			len(self.names), advice)
+		self.assertChecksums()
+
+	def testWithoutFadvise(self):
+		fusesha1util._posixFadvise = None
+		self.sha1db.updateAllChecksums(self.root, inodeOrder=True)
+		self.assertEqual(len(self.names), len(self.hashed))
+		self.assertChecksums()
+
+	def testFadviseFailing(self):
+		def failing(fd, offset, length, hint):
+			raise OSError(22, "Invalid argument")
+		fusesha1util._posixFadvise = failing
+		self.sha1db.updateAllChecksums(self.root)
+		self.assertChecksums()
+
+class TestSkipped(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmpdir, "root")
+		os.makedirs(os.path.join(self.root, ".git", "objects"))
+		write(os.path.join(self.root, "kept"), "kept")
+		write(os.path.join(self.root, "download.part"), "partial")
+		write(os.path.join(self.root, ".git", "objects", "ab"), "object")
+		self.rules = ExcludeRules(excludes=["*.part", ".git"])
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"), rules=self.rules)
+
+	def tearDown(self):
+		self.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	def skipped(self):
+		return (self.rules.skippedFiles, self.rules.skippedBytes, self.rules.skippedDirectories)
+
+	def testRescan(self):
+		self.sha1db.updateAllChecksums(self.root)
+		# the files below .git aren't looked at, so only the directory counts
+		self.assertEqual((1, len("partial"), 1), self.skipped())
+		self.assertEqual(None, self.sha1db.getChecksum(os.path.join(self.root, "download.part")))
+		self.assertEqual(sha1("kept"), self.sha1db.getChecksum(os.path.join(self.root, "kept")))
+		# counted again by every rescan
+		self.sha1db.updateAllChecksums(self.root, inodeOrder=True)
+		self.assertEqual((2, 2 * len("partial"), 2), self.skipped())
+
+	def testSyncTree(self):
+		self.sha1db.syncTree(self.root)
+		self.assertEqual((1, len("partial"), 1), self.skipped())
+
+	def testChecksNotCounted(self):
+		self.sha1db.updateAllChecksums(self.root)
+		self.sha1db.vacuum()
+		self.assertEqual((1, len("partial"), 1), self.skipped())
+
+class TestThreads(unittest.TestCase):
+	threads = 8
+	files = 20
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"))
+
+	def tearDown(self):
+		self.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	# Hashes, rehashes and reads back its own files, on its own connection
+	def client(self, n, errors):
+		try:
+			for i in range(self.files):
+				path = os.path.join(self.tmpdir, "file%d-%d" % (n, i))
+				write(path, path)
+				self.sha1db.updateChecksum(path)
+				self.assertEqual(sha1(path), self.sha1db.getChecksum(path))
+				write(path, path + " changed")
+				self.sha1db.updateChecksum(path)
+				self.assertEqual(sha1(path + " changed"), self.sha1db.getChecksum(path))
+		except Exception as einst:
+			errors.append(einst)
+
+	def testConcurrentClients(self):
+		errors = []
+		threads = [threading.Thread(target=self.client, args=(n, errors)) for n in range(self.threads)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		# in particular, no "database is locked"
+		self.assertEqual([], errors)
+		paths = [os.path.join(self.tmpdir, "file%d-%d" % (n, i)) 
+			for n in range(self.threads) for i in range(self.files)]
+		self.assertEqual(sorted((path, sha1(path + " changed")) for path in paths), 
+			sorted(self.sha1db.entriesUnderPrefix(self.tmpdir + "/", len(paths))))
+		connections = list(self.sha1db.shards[0].connections._connections)
+		self.assertEqual(self.threads + 1, len(connections))
+		# every thread's connection, not just the calling thread's
+		self.sha1db.close()
+		self.assertEqual(set(), self.sha1db.shards[0].connections._connections)
+		for connection in connections:
+			self.assertRaises(fusesha1util.sqlite.ProgrammingError, connection.execute, "select 1;")
+		# still usable afterwards, on a new connection
+		self.assertEqual(sha1(paths[0] + " changed"), self.sha1db.getChecksum(paths[0]))
+
+class TestRename(unittest.TestCase):
+	backend = "sqlite"
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"), backend=self.backend)
+		self.sha1db.addEntries([Entry(path, sha1(path)) for path in ("/r/a", "/r/a/x", "/r/a/r/a", 
+			"/r/ab", "/r/abc/y", "/r/A/z", "/r/b/y")])
+
+	def tearDown(self):
+		self.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	def paths(self):
+		return dict((path, chksum) for (path, chksum) in self.sha1db.entriesUnderPrefix("/", 100))
+
+	def testRename(self):
+		# as the mount renames, without a trailing "/": the path itself and everything below it, but
+		# not the siblings it is a prefix of, the other case, or the old name further down
+		self.sha1db.updatePath("/r/a", "/r/z")
+		self.assertEqual({"/r/z": sha1("/r/a"), "/r/z/x": sha1("/r/a/x"), "/r/z/r/a": sha1("/r/a/r/a"), 
+			"/r/ab": sha1("/r/ab"), "/r/abc/y": sha1("/r/abc/y"), "/r/A/z": sha1("/r/A/z"), 
+			"/r/b/y": sha1("/r/b/y")}, self.paths())
+
+	def testRenameDirectory(self):
+		# a trailing "/" only moves what is below
+		self.sha1db.updatePath("/r/a/", "/r/b/")
+		self.assertEqual(["/r/A/z", "/r/a", "/r/ab", "/r/abc/y", "/r/b/r/a", "/r/b/x", "/r/b/y"], 
+			sorted(self.paths()))
+
+	def testRenameFile(self):
+		self.sha1db.updatePath("/r/b/y", "/r/y")
+		self.assertEqual(sha1("/r/b/y"), self.paths()["/r/y"])
+		self.assertFalse("/r/b/y" in self.paths())
+
+class TestLogRename(TestRename):
+	backend = "log"
+
+class TestJournal(unittest.TestCase):
+	backend = "sqlite"
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpdir, "file")
+		write(self.path, "original")
+		os.utime(self.path, (1000000000, 1000000000))
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"), backend=self.backend)
+		self.sha1db.updateChecksum(self.path)
+
+	def tearDown(self):
+		self.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	def changes(self, seq=0):
+		return [change[1:5] for change in self.sha1db.changesSince(seq)]
+
+	def testRehash(self):
+		write(self.path, "changed")
+		self.sha1db.updateChecksum(self.path)
+		# one update, not a delete and an insert
+		self.assertEqual([("insert", self.path, None, sha1("original")), 
+			("update", self.path, None, sha1("changed"))], self.changes())
+
+	def testRehashUnchanged(self):
+		self.sha1db.updateChecksum(self.path)
+		self.assertEqual(1, len(self.changes()))
+
+	def testReverify(self):
+		self.assertTrue(Scrubber(self.sha1db).verify(self.path, sha1("original")))
+		self.sha1db.recordVerification(self.path, sha1("original"), True)
+		self.assertEqual(1, self.sha1db.lastSequence())
+		# a mismatch is a change worth following
+		self.sha1db.recordVerification(self.path, sha1("original"), False)
+		self.assertEqual([("update", self.path, None, sha1("original"))], self.changes(1))
+
+	def testGap(self):
+		other = os.path.join(self.tmpdir, "other")
+		write(other, "other")
+		self.sha1db.updateChecksum(other)
+		self.sha1db.removeChecksum(self.path)
+		self.assertEqual(3, self.sha1db.lastSequence())
+		self.assertEqual(1, self.sha1db.compactJournal(maxEntries=2))
+		self.assertRaises(JournalGap, self.sha1db.changesSince, 0)
+		self.assertEqual([("insert", other, None, sha1("other")), 
+			("delete", self.path, None, sha1("original"))], self.changes(1))
+		self.assertEqual([], self.changes(3))
+		# an empty journal only has a gap before the last sequence number
+		self.assertEqual(2, self.sha1db.compactJournal(maxEntries=0))
+		self.assertRaises(JournalGap, self.sha1db.changesSince, 2)
+		self.assertEqual([], self.changes(3))
+
+	def testCompactByAge(self):
+		time.sleep(0.01)
+		compactedBefore = time.time()
+		time.sleep(0.01)
+		write(self.path, "changed")
+		self.sha1db.updateChecksum(self.path)
+		self.assertEqual(1, self.sha1db.compactJournal(before=compactedBefore))
+		self.assertEqual([2], [change[0] for change in self.sha1db.changesSince(1)])
+		self.assertEqual(0, self.sha1db.compactJournal(before=compactedBefore))
+		# both limits at once
+		self.sha1db.removeChecksum(self.path)
+		self.assertEqual(1, self.sha1db.compactJournal(before=compactedBefore, maxEntries=1))
+		self.assertEqual([3], [change[0] for change in self.sha1db.changesSince(2)])
+
+class TestLogJournal(TestJournal):
+	backend = "log"
+
+class TestDiff(unittest.TestCase):
+	backend = "sqlite"
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"), backend=self.backend)
+		self.otherPath = os.path.join(self.tmpdir, "other.db")
+		self.other = Sha1DB(self.otherPath, backend=self.backend)
+		self.sha1db.addEntries(self.entries("/a/", [("same", "s1"), ("sub/changed", "c1"), 
+			("gone", "g1"), ("sub/moved", "m1"), ("lazy", ""), ("lazy old", "")]))
+		# shares the string prefix, but isn't below /a/
+		self.sha1db.addEntries(self.entries("/ab/", [("outside", "o1")]))
+		self.other.addEntries(self.entries("/b/", [("same", "s1"), ("sub/changed", "c2"), 
+			("renamed", "m1"), ("sub/new", "n1"), ("lazy", "l1"), ("lazy new", "")]))
+		self.expected = [("remove", "g1", "gone", None), ("add", "", "lazy new", None),
+			("remove", "", "lazy old", None), ("move", "m1", "renamed", "sub/moved"),
+			("change", "c2", "sub/changed", "c1"), ("add", "n1", "sub/new", None)]
+
+	def tearDown(self):
+		self.sha1db.close()
+		self.other.close()
+		shutil.rmtree(self.tmpdir)
+
+	def entries(self, prefix, files):
+		return [Entry(prefix + name, chksum, pending=int("" == chksum)) for (name, chksum) in files]
+
+	def testDiff(self):
+		self.assertEqual(self.expected, list(self.sha1db.diff(self.other, "/a/", "/b/")))
+		self.assertEqual([], list(self.sha1db.diff(self.sha1db, "/a/")))
+		self.assertEqual([], list(self.other.diff(self.other, "/b/")))
+
+	def testMerged(self):
+		# prefixes that aren't directories are read in full and merged, and match everything that 
+		# starts with them
+		self.assertEqual([(op, chksum, "/" + name, "/" + detail if "move" == op else detail)
+			for (op, chksum, name, detail) in self.expected] + [("remove", "o1", "b/outside", None)], 
+			list(self.sha1db.diff(self.other, "/a", "/b")))
+
+	def testSameDatabase(self):
+		self.sha1db.addEntries(self.entries("/c/", [("same", "s1"), ("sub/changed", "c3"), 
+			("sub/gone", "g1")]))
+		self.assertEqual([("remove", "", "lazy", None), ("remove", "", "lazy old", None), 
+			("change", "c3", "sub/changed", "c1"), ("move", "g1", "sub/gone", "gone"),
+			("remove", "m1", "sub/moved", None)], list(self.sha1db.diff(self.sha1db, "/a/", "/c/")))
+		self.assertEqual([], list(self.sha1db.diff(self.sha1db, "/a/", "/a/")))
+
+	def testPending(self):
+		# a checksum that is pending on either side is only compared by name, and never moved
+		self.assertEqual([], [name for (op, chksum, name, detail) in 
+			self.sha1db.diff(self.other, "/a/", "/b/") if "lazy" == name])
+		self.assertEqual(["lazy new", "lazy old"], sorted(name for (op, chksum, name, detail) in 
+			self.sha1db.diff(self.other, "/a/", "/b/") if "" == chksum))
+		# once hashed, it is compared like any other
+		self.sha1db.addEntries(self.entries("/a/", [("lazy", "l2")]))
+		self.assertEqual([("change", "l1", "lazy", "l2")], [change for change in 
+			self.sha1db.diff(self.other, "/a/", "/b/") if "lazy" == change[2]])
+
+	def diffDatabases(self, other, root, otherRoot=None):
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			diffDatabases(self.sha1db, other, root, otherRoot)
+			return sys.stdout.getvalue().splitlines()
+		finally:
+			sys.stdout = stdout
+
+	def testDiffDatabases(self):
+		self.assertEqual(["\t".join(field for field in change if None != field) 
+			for change in self.expected], self.diffDatabases(self.otherPath, "/a", "/b"))
+		self.assertEqual(["remove\tc1\tchanged", "remove\tm1\tmoved"], 
+			self.diffDatabases(self.otherPath, "/a/sub", "/b/nothing"))
+
+	def testDiffManifest(self):
+		manifest = os.path.join(self.tmpdir, "manifest")
+		with open(manifest, "w") as f:
+			f.write("%s  same\n%s  sub/moved\n%s  new\n" % (sha1("same"), sha1("moved"), sha1("new")))
+		self.sha1db.addEntries(self.entries("/m/", [("same", sha1("same")), ("sub/moved", sha1("moved")),
+			("changed", sha1("old"))]))
+		self.assertEqual(["remove\t%s\tchanged" % sha1("old"), "add\t%s\tnew" % sha1("new")], 
+			self.diffDatabases(manifest, "/m"))
+		# the manifest's names are relative to otherRoot
+		self.assertEqual(["remove\t%s\tchanged" % sha1("old"), "add\t%s\tnew" % sha1("new")],
+			self.diffDatabases(manifest, "/m", "/elsewhere"))
+
+class TestLogDiff(TestDiff):
+	backend = "log"
+
+if __name__ == '__main__':
+	unittest.main()
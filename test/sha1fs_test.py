@@ -0,0 +1,576 @@
+# Tests for the filesystem operations, called directly rather than through a mount
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import errno
+import hashlib
+import logging
+import shutil
+import tempfile
+import time
+from stat import S_IFREG, S_IFDIR, S_ISDIR, S_ISLNK
+
+sys.path.append("../")
+import sha1fs
+import sha1store
+from sha1fs import Sha1FS, Sha1Handle
+from sha1scrub import ReadVerifier, scrubberFromOptions, pendingHasherFromOptions
+
+def write(path, data):
+	with open(path, "wb") as f:
+		f.write(data)
+
+def read(path):
+	with open(path, "rb") as f:
+		return f.read()
+
+def sha1(data):
+	return hashlib.sha1(data).hexdigest()
+
+# Sets up a Sha1FS serving a small tree, without mounting it; the operations are called directly
+class Sha1FSTestCase(unittest.TestCase):
+	# set on the Sha1FS before the database is opened, like command line options
+	options = {}
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmpdir, "root")
+		os.makedirs(os.path.join(self.root, "dir"))
+		write(os.path.join(self.root, "file"), "file")
+		write(os.path.join(self.root, "dir", "inner"), "inner")
+		self.fs = Sha1FS()
+		self.fs.root = self.root
+		self.fs.database = os.path.join(self.tmpdir, "test.db")
+		for (name, value) in self.options.items():
+			setattr(self.fs, name, value)
+		self.fs.initDB()
+		self.fs.sha1db.updateAllChecksums(self.root)
+
+	def tearDown(self):
+		self.fs.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	def real(self, path):
+		return self.root + path
+
+	def checksum(self, path):
+		return self.fs.getxattr(path, self.fs.xattrName, 1024)
+
+class TestSha1Handle(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpdir, "file")
+		write(self.path, "0123456789")
+		self.pwrite = sha1fs.pwrite
+
+	def tearDown(self):
+		sha1fs.pwrite = self.pwrite
+		shutil.rmtree(self.tmpdir)
+
+	def open(self, flags=os.O_RDWR):
+		return Sha1Handle(os.open(self.path, flags), flags, ReadVerifier(hashlib.sha1))
+
+	def testRead(self):
+		fh = self.open(os.O_RDONLY)
+		self.assertEqual("345", fh.read(3, 3))
+		self.assertEqual("", fh.read(3, 10))
+		self.assertFalse(fh.dirty)
+		fh.close()
+
+	def testReadVerifier(self):
+		fh = self.open(os.O_RDONLY)
+		self.assertEqual("01234", fh.read(5, 0))
+		self.assertEqual("56789", fh.read(5, 5))
+		self.assertTrue(fh.verifier.complete(10))
+		self.assertEqual(hashlib.sha1("0123456789").hexdigest(), fh.verifier.hexdigest())
+		fh.close()
+
+	def testWrite(self):
+		fh = self.open()
+		self.assertEqual(3, fh.write("abc", 4))
+		self.assertTrue(fh.dirty)
+		self.assertEqual(None, fh.verifier)
+		# reads don't need a verifier
+		self.assertEqual("3abc7", fh.read(5, 3))
+		fh.close()
+		self.assertEqual("0123abc789", read(self.path))
+
+	def testShortWrites(self):
+		sha1fs.pwrite = lambda fd, data, offset: self.pwrite(fd, data[:2], offset)
+		fh = self.open()
+		self.assertEqual(5, fh.write("abcde", 8))
+		fh.close()
+		self.assertEqual("01234567abcde", read(self.path))
+
+	def testWriteNoProgress(self):
+		sha1fs.pwrite = lambda fd, data, offset: 0
+		fh = self.open()
+		try:
+			fh.write("abc", 0)
+			self.fail("write should have failed")
+		except IOError as einst:
+			self.assertEqual(errno.EIO, einst.errno)
+		self.assertTrue(fh.dirty)
+		fh.close()
+
+	def testTruncate(self):
+		fh = self.open()
+		fh.truncate(4)
+		self.assertTrue(fh.dirty)
+		self.assertEqual(None, fh.verifier)
+		self.assertEqual(4, os.fstat(fh.fd).st_size)
+		fh.close()
+		self.assertEqual("0123", read(self.path))
+
+	def testOpenTruncated(self):
+		fh = self.open(os.O_WRONLY | os.O_TRUNC)
+		self.assertTrue(fh.dirty)
+		fh.close()
+		self.assertEqual("", read(self.path))
+
+	def testClose(self):
+		fh = self.open(os.O_RDONLY)
+		fh.close()
+		self.assertRaises(OSError, lambda: os.fstat(fh.fd))
+
+class TestReadVerification(Sha1FSTestCase):
+	def setUp(self):
+		Sha1FSTestCase.setUp(self)
+		# hashed well before it is opened, so it doesn't look like it changed while being read
+		os.utime(self.real("/file"), (1000000000, 1000000000))
+		self.fs.sha1db.updateChecksum(self.real("/file"))
+		self.errors = []
+		self.handler = logging.Handler(logging.ERROR)
+		self.handler.emit = lambda record: self.errors.append(record.getMessage())
+		logging.getLogger().addHandler(self.handler)
+		self.verifications = []
+		recordVerification = self.fs.sha1db.recordVerification
+		def recordingVerification(path, chksum, matched, *args):
+			self.verifications.append((path, chksum, matched))
+			return recordVerification(path, chksum, matched, *args)
+		self.fs.sha1db.recordVerification = recordingVerification
+
+	def tearDown(self):
+		logging.getLogger().removeHandler(self.handler)
+		Sha1FSTestCase.tearDown(self)
+
+	# Reads path through a handle at the given (offset, size) pairs
+	def readAt(self, path, reads):
+		fh = self.fs.open(path, os.O_RDONLY)
+		data = [self.fs.read(path, size, offset, fh) for (offset, size) in reads]
+		self.fs.release(path, os.O_RDONLY, fh)
+		return data
+
+	def verified(self, path):
+		return self.fs.sha1db.getEntry(self.real(path))[3]
+
+	def testVerified(self):
+		before = self.verified("/file")
+		self.assertEqual(["fi", "le", ""], self.readAt("/file", [(0, 2), (2, 2), (4, 2)]))
+		self.assertEqual((1, 0), (self.fs.readsVerified, self.fs.readMismatches))
+		self.assertEqual([(self.real("/file"), sha1("file"), True)], self.verifications)
+		self.assertTrue(self.verified("/file") > before)
+		self.assertEqual("ok", self.fs.getxattr("/file", self.fs.xattrName + ".state", 1024))
+		# re-reads of data already hashed don't spoil it
+		self.readAt("/file", [(0, 3), (0, 2), (2, 2)])
+		self.assertEqual(2, self.fs.readsVerified)
+		self.assertEqual([], self.errors)
+
+	def testMismatch(self):
+		# the contents rotted behind the database's back, keeping the size and mtime
+		write(self.real("/file"), "fill")
+		os.utime(self.real("/file"), (1000000000, 1000000000))
+		self.assertEqual(["fill"], self.readAt("/file", [(0, 8)]))
+		self.assertEqual((0, 1), (self.fs.readsVerified, self.fs.readMismatches))
+		self.assertEqual([(self.real("/file"), sha1("file"), False)], self.verifications)
+		self.assertEqual([self.real("/file")], [path for (path, chksum) in self.fs.sha1db.mismatches()])
+		self.assertEqual(1, len(self.errors))
+		self.assertTrue(self.real("/file") in self.errors[0] and sha1("fill") in self.errors[0])
+		self.assertEqual("mismatch", self.fs.getxattr("/file", self.fs.xattrName + ".state", 1024))
+		# the stored checksum is kept
+		self.assertEqual(sha1("file"), self.checksum("/file"))
+
+	def testPartial(self):
+		before = self.verified("/file")
+		self.readAt("/file", [(0, 2)])
+		# skipping ahead, or reading from the middle
+		self.readAt("/file", [(0, 1), (2, 2)])
+		self.readAt("/file", [(2, 2), (0, 2)])
+		self.assertEqual((0, 0), (self.fs.readsVerified, self.fs.readMismatches))
+		self.assertEqual([], self.verifications)
+		self.assertEqual(before, self.verified("/file"))
+		self.assertEqual([], self.errors)
+
+	def testModifiedWhileOpen(self):
+		# changed after the handle was opened, so what was read can't be trusted either way
+		fh = self.fs.open("/file", os.O_RDONLY)
+		self.fs.read("/file", 8, 0, fh)
+		# ahead of the clock, as mtimes can lag behind time.time() by a tick
+		os.utime(self.real("/file"), (time.time() + 60, time.time() + 60))
+		self.fs.release("/file", os.O_RDONLY, fh)
+		self.assertEqual((0, 0), (self.fs.readsVerified, self.fs.readMismatches))
+		self.assertEqual([], self.verifications)
+
+class TestCacheInvalidation(Sha1FSTestCase):
+	# Caches the attributes and database entries of paths (and the attributes of their parents)
+	def prime(self, *paths):
+		for path in paths:
+			self.fs.getattr(path)
+			self.fs.getattr(os.path.dirname(path))
+			self.fs.getxattr(path, self.fs.xattrName, 0)
+			self.assertTrue(self.cached(path))
+
+	def cached(self, path, cache=None):
+		cache = cache or self.fs.attrCache
+		return path in cache.getMany([path])
+
+	def assertDropped(self, path, parent=True):
+		self.assertFalse(self.cached(path))
+		self.assertFalse(self.cached(path, self.fs.entryCache))
+		self.assertEqual(not parent, self.cached(os.path.dirname(path)))
+
+	def testWrite(self):
+		fh = self.fs.open("/file", os.O_RDWR)
+		self.prime("/file")
+		# a getattr racing with the write must not cache the size from before it
+		pwrite = sha1fs.pwrite
+		sha1fs.pwrite = lambda fd, data, offset: (self.fs.getattr("/file"), 
+			pwrite(fd, data, offset))[1]
+		try:
+			self.assertEqual(6, self.fs.write("/file", "longer", 0, fh))
+		finally:
+			sha1fs.pwrite = pwrite
+		self.assertDropped("/file", parent=False)
+		self.assertEqual(6, self.fs.getattr("/file").st_size)
+		self.fs.release("/file", os.O_RDWR, fh)
+		self.assertEqual(sha1("longer"), self.checksum("/file"))
+
+	def testTruncate(self):
+		self.prime("/file")
+		self.fs.truncate("/file", 2)
+		self.assertDropped("/file", parent=False)
+		self.assertEqual(2, self.fs.getattr("/file").st_size)
+		self.assertEqual(sha1("fi"), self.checksum("/file"))
+
+	def testFtruncate(self):
+		fh = self.fs.open("/file", os.O_RDWR)
+		self.prime("/file")
+		self.fs.ftruncate("/file", 1, fh)
+		self.assertDropped("/file", parent=False)
+		self.assertEqual(1, self.fs.getattr("/file").st_size)
+		self.fs.release("/file", os.O_RDWR, fh)
+		self.assertEqual(sha1("f"), self.checksum("/file"))
+
+	def testRenameFile(self):
+		self.prime("/file", "/dir/inner")
+		prefixes = []
+		self.fs.attrCache.invalidatePrefix = prefixes.append
+		self.fs.rename("/file", "/dir/moved")
+		# a file has nothing cached below it, so the cache isn't scanned
+		self.assertEqual([], prefixes)
+		self.assertDropped("/file")
+		self.assertDropped("/dir/moved")
+		self.assertTrue(self.cached("/dir/inner"))
+		self.assertEqual(-errno.ENOENT, self.fs.getattr("/file"))
+		self.assertEqual(sha1("file"), self.checksum("/dir/moved"))
+
+	def testRenameDirectory(self):
+		self.prime("/dir/inner", "/file")
+		self.fs.getattr("/moved/inner")
+		self.fs.rename("/dir", "/moved")
+		self.assertDropped("/dir")
+		self.assertDropped("/moved")
+		self.assertFalse(self.cached("/dir/inner"))
+		self.assertFalse(self.cached("/dir/inner", self.fs.entryCache))
+		self.assertFalse(self.cached("/moved/inner"))
+		self.assertTrue(self.cached("/file"))
+		self.assertEqual(-errno.ENOENT, self.fs.getattr("/dir/inner"))
+		self.assertEqual(sha1("inner"), self.checksum("/moved/inner"))
+
+	def testUnlink(self):
+		self.prime("/dir/inner")
+		self.fs.unlink("/dir/inner")
+		self.assertDropped("/dir/inner")
+		self.assertEqual(-errno.ENOENT, self.fs.getattr("/dir/inner"))
+		self.assertEqual(None, self.fs.sha1db.getEntry(self.real("/dir/inner")))
+
+	def testRmdir(self):
+		self.fs.unlink("/dir/inner")
+		self.prime("/dir")
+		self.fs.rmdir("/dir")
+		self.assertDropped("/dir")
+		self.assertEqual(-errno.ENOENT, self.fs.getattr("/dir"))
+
+	def testChmodChown(self):
+		self.prime("/file")
+		self.fs.chmod("/file", 0600)
+		self.assertDropped("/file", parent=False)
+		self.assertEqual(0600, self.fs.getattr("/file").st_mode & 0777)
+		self.prime("/file")
+		st = os.lstat(self.real("/file"))
+		self.fs.chown("/file", st.st_uid, st.st_gid)
+		self.assertDropped("/file", parent=False)
+
+	def testUtime(self):
+		self.prime("/file")
+		self.fs.utime("/file", (1000000000, 1000000000))
+		self.assertDropped("/file", parent=False)
+		self.assertEqual(1000000000, self.fs.getattr("/file").st_mtime)
+
+	def testCreate(self):
+		# lookups of missing paths are cached as well
+		for path in ("/new", "/newdir", "/symlink", "/hardlink"):
+			self.assertEqual(-errno.ENOENT, self.fs.getattr(path))
+		self.fs.getattr("/")
+		self.fs.mknod("/new", S_IFREG | 0644, 0)
+		self.assertDropped("/new")
+		self.assertEqual(0, self.fs.getattr("/new").st_size)
+		self.fs.getattr("/")
+		self.fs.mkdir("/newdir", 0755)
+		self.assertDropped("/newdir")
+		self.assertTrue(S_ISDIR(self.fs.getattr("/newdir").st_mode))
+		self.fs.getattr("/")
+		self.fs.symlink("file", "/symlink")
+		self.assertDropped("/symlink")
+		self.assertTrue(S_ISLNK(self.fs.getattr("/symlink").st_mode))
+		self.prime("/file")
+		self.fs.link("/file", "/hardlink")
+		# the link count of the target changed too
+		self.assertDropped("/file")
+		self.assertDropped("/hardlink")
+		self.assertEqual(2, self.fs.getattr("/file").st_nlink)
+
+class TestReaddir(Sha1FSTestCase):
+	count = 500
+
+	def setUp(self):
+		Sha1FSTestCase.setUp(self)
+		os.mkdir(self.real("/big"))
+		self.names = ["f%04d" % i for i in range(self.count)]
+		for name in self.names:
+			write(self.real("/big/" + name), name)
+		self.fs.attrCache.clear()
+
+	# Lists path the way the kernel does, taking at most batch entries per call.  If lastFits is false
+	# the last entry of each call doesn't fit into the kernel's buffer, so it asks again from the
+	# offset of the one before.  Returns the names listed and how many calls carried on from the
+	# cursor the call before left
+	def listdir(self, path, batch, lastFits=False):
+		names = []
+		resumed = 0
+		offset = 0
+		while True:
+			if offset > 0 and (path, offset) in self.fs.dirCursors.getMany([(path, offset)]):
+				resumed += 1
+			entries = self.fs.readdir(path, offset)
+			taken = []
+			for entry in entries:
+				taken.append(entry)
+				if len(taken) == batch:
+					break
+			entries.close()
+			if len(taken) < batch:
+				names.extend(entry.name for entry in taken)
+				return (names, resumed)
+			if not lastFits:
+				taken.pop()
+			names.extend(entry.name for entry in taken)
+			offset = taken[-1].offset
+
+	def testOffsets(self):
+		entries = list(self.fs.readdir("/big", 0))
+		self.assertEqual(range(1, self.count + 1), [entry.offset for entry in entries])
+		self.assertEqual(sorted(self.names), sorted(entry.name for entry in entries))
+
+	@unittest.skipIf(None == sha1fs.scandir, "needs scandir")
+	def testTypes(self):
+		entries = list(self.fs.readdir("/", 0))
+		self.assertEqual({"file": S_IFREG, "dir": S_IFDIR, "big": S_IFDIR}, 
+			dict((entry.name, entry.type) for entry in entries))
+		self.assertTrue(all(entry.ino == os.lstat(self.real("/" + entry.name)).st_ino 
+			for entry in entries))
+
+	def testCursors(self):
+		listing = [entry.name for entry in self.fs.readdir("/big", 0)]
+		(names, resumed) = self.listdir("/big", 64)
+		self.assertEqual(listing, names)
+		# every call after the first carried on from the cursor the one before left
+		self.assertEqual(self.count / 63, resumed)
+		self.assertEqual(0, len(self.fs.dirCursors))
+
+	def testLastEntryTaken(self):
+		listing = [entry.name for entry in self.fs.readdir("/big", 0)]
+		# the kernel asked from somewhere we didn't expect, so the directory is read again
+		(names, resumed) = self.listdir("/big", 64, lastFits=True)
+		self.assertEqual(listing, names)
+		self.assertEqual(0, resumed)
+
+	@unittest.skipIf(None == sha1fs.scandir, "needs scandir")
+	def testPrime(self):
+		self.fs.readdirPrime = True
+		self.listdir("/big", 100)
+		self.assertTrue(all(self.cached(name) for name in self.names))
+		self.assertEqual(len("f0000"), self.fs.getattr("/big/f0000").st_size)
+
+	@unittest.skipIf(None == sha1fs.scandir, "needs scandir")
+	def testTypesWithoutStat(self):
+		# the types come from the directory entries, not from stat'ing them
+		lstat = os.lstat
+		stats = []
+		os.lstat = lambda path: (stats.append(path), lstat(path))[1]
+		try:
+			self.assertEqual(S_IFREG, dict((entry.name, entry.type) for entry in self.fs.readdir("/", 0))["file"])
+		finally:
+			os.lstat = lstat
+		self.assertEqual([], stats)
+
+	def testNoPrime(self):
+		# the default
+		self.assertFalse(self.fs.readdirPrime)
+		listing = [entry.name for entry in self.fs.readdir("/big", 0)]
+		(names, resumed) = self.listdir("/big", 100)
+		self.assertEqual(listing, names)
+		self.assertEqual(sorted(self.names), sorted(names))
+		self.assertFalse(any(self.cached(name) for name in self.names))
+
+	def cached(self, name):
+		path = "/big/" + name
+		return path in self.fs.attrCache.getMany([path])
+
+# The same listings without scandir, from os.listdir
+class TestListdirReaddir(TestReaddir):
+	def setUp(self):
+		TestReaddir.setUp(self)
+		self.scandir = sha1fs.scandir
+		sha1fs.scandir = None
+
+	def tearDown(self):
+		sha1fs.scandir = self.scandir
+		TestReaddir.tearDown(self)
+
+	def testTypes(self):
+		# left for the kernel to look up
+		entries = list(self.fs.readdir("/", 0))
+		self.assertEqual({"file": 0, "dir": 0, "big": 0}, dict((entry.name, entry.type) for entry in entries))
+
+	def testTypesWithoutStat(self):
+		pass
+
+	def testPrime(self):
+		self.fs.readdirPrime = True
+		(names, resumed) = self.listdir("/big", 100)
+		self.assertEqual(sorted(self.names), sorted(names))
+		self.assertFalse(any(self.cached(name) for name in self.names))
+
+class TestExcludedRelease(Sha1FSTestCase):
+	options = {"excludes": ["*.part"]}
+
+	def writeFile(self, path, data):
+		fh = self.fs.open(path, os.O_WRONLY | os.O_CREAT)
+		self.fs.write(path, data, 0, fh)
+		self.fs.release(path, os.O_WRONLY, fh)
+
+	def skipped(self):
+		rules = self.fs.sha1db.rules
+		return (rules.skippedFiles, rules.skippedBytes)
+
+	def testSkipped(self):
+		self.fs.mknod("/download.part", S_IFREG | 0644, 0)
+		lstat = os.lstat
+		stats = []
+		os.lstat = lambda path: (stats.append(path), lstat(path))[1]
+		try:
+			self.writeFile("/download.part", "partial")
+		finally:
+			os.lstat = lstat
+		# the size comes from the handle
+		self.assertEqual([], stats)
+		self.assertEqual((1, len("partial")), self.skipped())
+		self.assertEqual(None, self.fs.sha1db.getEntry(self.real("/download.part")))
+		# once per write
+		self.writeFile("/download.part", "partial, more")
+		self.fs.truncate("/download.part", 3)
+		self.assertEqual((3, len("partial") + len("partial, more") + 3), self.skipped())
+		# reading hashes nothing, so skips nothing either
+		fh = self.fs.open("/download.part", os.O_RDONLY)
+		self.fs.read("/download.part", 100, 0, fh)
+		self.fs.release("/download.part", os.O_RDONLY, fh)
+		self.assertEqual(3, self.skipped()[0])
+		self.assertEqual(3, self.fs._stats()["hashing"]["skipped_files"])
+
+	def testIncluded(self):
+		self.writeFile("/file", "changed")
+		self.assertEqual((0, 0), self.skipped())
+		self.assertEqual(sha1("changed"), self.checksum("/file"))
+
+class TestLazyRelease(Sha1FSTestCase):
+	options = {"lazyThreshold": "8"}
+
+	def create(self, path, data):
+		self.fs.mknod(path, S_IFREG | 0644, 0)
+		fh = self.fs.open(path, os.O_WRONLY)
+		self.fs.write(path, data, 0, fh)
+		self.fs.release(path, os.O_WRONLY, fh)
+
+	def readAll(self, path, size):
+		fh = self.fs.open(path, os.O_RDONLY)
+		for offset in range(0, size, 4):
+			self.fs.read(path, 4, offset, fh)
+		self.fs.release(path, os.O_RDONLY, fh)
+
+	def state(self, path):
+		return self.fs.getxattr(path, self.fs.xattrName + ".state", 1024)
+
+	def testPending(self):
+		self.create("/large", "larger than 8")
+		self.assertEqual("pending", self.state("/large"))
+		self.assertEqual(-errno.ENODATA, self.checksum("/large"))
+		self.assertEqual((1, len("larger than 8")), self.fs.sha1db.pendingBacklog())
+		# small files are still hashed on release
+		self.create("/small", "small")
+		self.assertEqual(sha1("small"), self.checksum("/small"))
+
+	def testReadPending(self):
+		self.create("/large", "larger than 8")
+		# the client reading it all does the pending hasher's work
+		self.readAll("/large", len("larger than 8"))
+		self.assertEqual("ok", self.state("/large"))
+		self.assertEqual(sha1("larger than 8"), self.checksum("/large"))
+		self.assertEqual((0, 0), self.fs.sha1db.pendingBacklog())
+
+	def testPartialReadPending(self):
+		self.create("/large", "larger than 8")
+		self.readAll("/large", 4)
+		self.assertEqual("pending", self.state("/large"))
+
+class TestDestroy(Sha1FSTestCase):
+	options = {"backend": "log", "lazyThreshold": "1M"}
+
+	def tearDown(self):
+		# fsdestroy closed the database
+		shutil.rmtree(self.tmpdir)
+
+	def testDestroy(self):
+		# both stuck backing off for a busy filesystem
+		self.fs.scrubber = scrubberFromOptions(self.fs.sha1db, self.fs, 0, lambda: True)
+		self.fs.pendingHasher = pendingHasherFromOptions(self.fs.sha1db, self.fs, lambda: True)
+		self.fs.scrubber.start()
+		self.fs.pendingHasher.start()
+		stores = list(self.fs.sha1db.shards)
+		self.fs.fsdestroy()
+		self.assertFalse(self.fs.scrubber.is_alive())
+		self.assertFalse(self.fs.pendingHasher.is_alive())
+		self.assertFalse(any(store in sha1store._logs.values() for store in stores))
+		reopened = sha1fs.Sha1DB(self.fs.database)
+		self.assertEqual(sha1("file"), reopened.getChecksum(self.real("/file")))
+		reopened.close()
+
+if __name__ == '__main__':
+	unittest.main()
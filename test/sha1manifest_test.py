@@ -0,0 +1,57 @@
+# Tests for reading and writing sha1sum manifests
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import StringIO
+
+sys.path.append("../")
+import sha1manifest
+
+CHKSUM = "f572d396fae9206628714fb2ce00f72e94f2258f"
+
+class TestSha1Manifest(unittest.TestCase):
+	def testParseLine(self):
+		self.assertEqual((CHKSUM, u"dir/file name"), 
+			sha1manifest.parseManifestLine("%s  dir/file name\n" % CHKSUM))
+		self.assertEqual((CHKSUM, u"file"), sha1manifest.parseManifestLine("%s *file\r\n" % CHKSUM.upper()))
+		self.assertEqual((CHKSUM, u"new\nline\\"), 
+			sha1manifest.parseManifestLine("\\%s  new\\nline\\\\\n" % CHKSUM))
+		self.assertEqual((CHKSUM, u"caf\xe9"), sha1manifest.parseManifestLine("%s  caf\xc3\xa9\n" % CHKSUM))
+		for line in ["", "garbage\n", "%s file\n" % CHKSUM, "xyz  file\n", "%s  \n" % CHKSUM,
+		             "\\%s  bad\\escape\n" % CHKSUM, "%s  caf\xe9\n" % CHKSUM]:
+			self.assertEqual(None, sha1manifest.parseManifestLine(line))
+	
+	def testFormatLine(self):
+		self.assertEqual("%s  dir/file\n" % CHKSUM, sha1manifest.formatManifestLine(CHKSUM, "dir/file"))
+		self.assertEqual("\\%s  a\\nb\\\\c\n" % CHKSUM, sha1manifest.formatManifestLine(CHKSUM, "a\nb\\c"))
+		self.assertEqual("%s  caf\xc3\xa9\n" % CHKSUM, sha1manifest.formatManifestLine(CHKSUM, u"caf\xe9"))
+		for name in ["plain", "new\nline", "back\\slash", "cr\r", u"caf\xe9"]:
+			line = sha1manifest.formatManifestLine(CHKSUM, name)
+			self.assertEqual((CHKSUM, name), sha1manifest.parseManifestLine(line))
+	
+	def testEscapeField(self):
+		self.assertEqual("a\\tb\\nc\\\\d", sha1manifest.escapeField("a\tb\nc\\d"))
+		self.assertEqual("caf\xc3\xa9", sha1manifest.escapeField(u"caf\xe9"))
+	
+	def testReader(self):
+		manifest = StringIO.StringIO("%s  rel/file\n%s  /abs/file\n\nbroken line\n%s  short\n" % 
+			(CHKSUM, CHKSUM, CHKSUM[:32]))
+		reader = sha1manifest.ManifestReader(manifest, "/data/root/", 40)
+		self.assertEqual([(CHKSUM, "/data/root/rel/file"), (CHKSUM, "/abs/file")], list(reader))
+		self.assertEqual(2, reader.malformed)
+	
+	def testWriteManifest(self):
+		out = StringIO.StringIO()
+		count = sha1manifest.writeManifest(out, [(CHKSUM, u"/data/root/a"), (CHKSUM, u"/elsewhere/b")],
+			"/data/root")
+		self.assertEqual(2, count)
+		self.assertEqual("%s  a\n%s  /elsewhere/b\n" % (CHKSUM, CHKSUM), out.getvalue())
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,109 @@
+# Tests for the sampling and per-operation profilers
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import os
+import pstats
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append("../")
+import sha1profile
+from sha1profile import SamplingProfiler, OpProfiler, SignalTrigger
+from fusesha1util import ewrap
+
+def spin(stop):
+	while not stop.is_set():
+		sum(xrange(1000))
+
+def work():
+	return sum(xrange(1000))
+
+class TestSha1Profile(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+	
+	def tearDown(self):
+		sha1profile.opProfiler = None
+		shutil.rmtree(self.tmpdir)
+	
+	def testSamplingProfiler(self):
+		stop = threading.Event()
+		worker = threading.Thread(target=spin, args=(stop, ), name="busy;worker")
+		worker.start()
+		output = os.path.join(self.tmpdir, "stacks")
+		sampler = SamplingProfiler(output, 0.2, 0.005)
+		sampler.start()
+		self.assertTrue(sampler.remaining() <= 0.2)
+		sampler.join()
+		stop.set()
+		worker.join()
+		self.assertEqual(0, sampler.remaining())
+		self.assertTrue(sampler.samples > 0)
+		lines = open(output).read().splitlines()
+		# thread name first, innermost frame last, and no stray separators
+		busy = [line for line in lines if line.startswith("busy:worker;")]
+		self.assertTrue(busy)
+		(stack, count) = busy[0].rsplit(" ", 1)
+		self.assertTrue(int(count) > 0)
+		self.assertTrue(stack.endswith(";spin (sha1profile_test.py)"))
+		self.assertFalse([line for line in lines if line.startswith("sampling-profiler")])
+	
+	def testStop(self):
+		output = os.path.join(self.tmpdir, "stacks")
+		sampler = SamplingProfiler(output, 60)
+		sampler.start()
+		time.sleep(0.05)
+		sampler.stop()
+		sampler.join(5)
+		self.assertFalse(sampler.is_alive())
+		self.assertTrue(os.path.exists(output))
+	
+	def testOpProfiler(self):
+		output = os.path.join(self.tmpdir, "release.pstats")
+		profiler = OpProfiler("release", output)
+		profiler.start()
+		self.assertTrue(sha1profile.opProfiler is profiler)
+		def release():
+			with ewrap("release"):
+				work()
+		def getattr():
+			with ewrap("getattr"):
+				sum(xrange(10))
+		release()
+		getattr()
+		thread = threading.Thread(target=release)
+		thread.start()
+		thread.join()
+		profiler.stop()
+		self.assertEqual(None, sha1profile.opProfiler)
+		self.assertEqual(2, profiler.ops)
+		# release ran twice (on two threads), getattr wasn't profiled
+		functions = dict(((name, func), stats) 
+		                 for ((filename, line, func), stats) in pstats.Stats(output).stats.iteritems()
+		                 for name in [os.path.basename(filename)])
+		self.assertFalse(("sha1profile_test.py", "getattr") in functions)
+		self.assertEqual(2, functions[("sha1profile_test.py", "work")][0])
+		# ewrap works as before once profiling stops
+		release()
+		self.assertEqual(2, profiler.ops)
+	
+	def testSignalTrigger(self):
+		fired = threading.Event()
+		trigger = SignalTrigger(signal.SIGUSR2)
+		trigger.start(fired.set)
+		os.kill(os.getpid(), signal.SIGUSR2)
+		fired.wait(5)
+		self.assertTrue(fired.is_set())
+
+if __name__ == '__main__':
+	unittest.main()
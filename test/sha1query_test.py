@@ -0,0 +1,68 @@
+# Tests for the query socket
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import shutil
+import socket
+import tempfile
+
+sys.path.append("../")
+import sha1query
+from sha1db import Sha1DB
+from sha1store import Entry
+
+class TestSha1Query(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"))
+		self.sha1db.addEntries([Entry(path, chksum, last_verified=0, size=0, mtime=0) for (path, chksum)
+			in [("/r/a", "aa"), ("/r/b", "aa"), ("/r/c/d", "cc"), ("/s", "dd"), (u"/\xe9/e", "ee")]])
+		self.path = os.path.join(self.tmpdir, "query.sock")
+		self.server = sha1query.QueryServer(self.path, self.sha1db)
+		self.server.start()
+		self.client = sha1query.QueryClient(self.path)
+	
+	def tearDown(self):
+		self.client.close()
+		self.server.stop()
+		shutil.rmtree(self.tmpdir)
+	
+	def testChecksums(self):
+		self.assertEqual({"aa": ["/r/a", "/r/b"], "bb": [], "cc": ["/r/c/d"]}, 
+			self.client.checksums(["aa", "bb", "cc"]))
+		self.assertEqual({}, self.client.checksums([]))
+	
+	def testPaths(self):
+		self.assertEqual({"/r/a": "aa", "/r/x": None}, self.client.paths(["/r/a", "/r/x"]))
+	
+	def testPrefix(self):
+		self.assertEqual([("/r/a", "aa"), ("/r/b", "aa"), ("/r/c/d", "cc")], self.client.prefix("/r/"))
+		self.assertEqual([("/r/a", "aa")], self.client.prefix("/r/", 1))
+	
+	def testNonAsciiPrefix(self):
+		# paths go over the socket as UTF-8
+		self.assertEqual([("/\xc3\xa9/e", "ee")], self.client.prefix(u"/\xe9/"))
+		self.assertEqual([[(u"/\xe9/e", "ee")]], self.server.lookup(sha1query.OP_PREFIX, 0, ["/\xc3\xa9/"]))
+
+	def testBadRequests(self):
+		self.assertRaises(sha1query.ProtocolError, lambda: self.client._request("z", 0, ["aa"]))
+		self.assertRaises(sha1query.ProtocolError, lambda: self.client._request("x", 0, ["a", "b"]))
+		# the connection survives bad requests
+		self.assertEqual({"/s": "dd"}, self.client.paths(["/s"]))
+	
+	def testCache(self):
+		self.server.cache = sha1query.LruCache(10, 60)
+		self.client.checksums(["aa", "bb"])
+		self.sha1db.removeChecksum("/r/a")
+		self.assertEqual({"aa": ["/r/a", "/r/b"], "bb": []}, self.client.checksums(["aa", "bb"]))
+		self.assertEqual(2, self.server.cache.hits)
+
+if __name__ == '__main__':
+	unittest.main()
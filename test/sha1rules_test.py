@@ -0,0 +1,96 @@
+# Tests for the include/exclude rules
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import re
+import tempfile
+
+sys.path.append("../")
+import sha1rules
+
+class TestSha1Rules(unittest.TestCase):
+	def testGlobToRegex(self):
+		self.assertTrue(re.match("^" + sha1rules.globToRegex("*.part") + "$", "movie.part"))
+		self.assertFalse(re.match("^" + sha1rules.globToRegex("*.part") + "$", "dir/movie.part"))
+		self.assertTrue(re.match("^" + sha1rules.globToRegex("a/**/b") + "$", "a/x/y/b"))
+		self.assertTrue(re.match("^" + sha1rules.globToRegex("file?.[!a]") + "$", "file1.b"))
+		self.assertFalse(re.match("^" + sha1rules.globToRegex("file?.[!a]") + "$", "file1.a"))
+		self.assertTrue(re.match("^" + sha1rules.globToRegex("[x") + "$", "[x"))
+	
+	def testExcludeGlobs(self):
+		rules = sha1rules.ExcludeRules(excludes=[".git", "*.tmp", "/data/cache"])
+		self.assertTrue(rules.excludedPath("/data/src/.git"))
+		self.assertTrue(rules.excludedPath("/data/src/.git/objects/ab"))
+		self.assertFalse(rules.excludedPath("/data/src/.gitignore"))
+		self.assertTrue(rules.excludedPath("/data/x/file.tmp"))
+		self.assertTrue(rules.excludedPath("/data/cache/file"))
+		self.assertFalse(rules.excludedPath("/other/data/cache/file"))
+	
+	def testIncludeWins(self):
+		rules = sha1rules.ExcludeRules(excludes=["*.log"], excludePrefixes=["/data/tmp/"], 
+			includes=["keep.log"])
+		self.assertTrue(rules.excluded("/data/a.log", 10))
+		self.assertFalse(rules.excluded("/data/keep.log", 10))
+		self.assertTrue(rules.excluded("/data/tmp/x", 10))
+		self.assertFalse(rules.excluded("/data/tmpfile", 10))
+	
+	def testSkipped(self):
+		rules = sha1rules.ExcludeRules(excludes=["*.part"])
+		lstat = os.lstat
+		stats = []
+		os.lstat = lambda path: (stats.append(path), lstat(path))[1]
+		try:
+			# checking a path neither counts it nor looks up its size
+			self.assertTrue(rules.excluded("/data/a.part"))
+			self.assertTrue(rules.excluded("/data/a.part"))
+		finally:
+			os.lstat = lstat
+		self.assertEqual([], stats)
+		self.assertEqual((0, 0, 0), (rules.skippedFiles, rules.skippedBytes, rules.skippedDirectories))
+		rules.skipped(1, 10)
+		rules.skipped(2, 30, 1)
+		self.assertEqual((3, 40, 1), (rules.skippedFiles, rules.skippedBytes, rules.skippedDirectories))
+	
+	def testSizeLimits(self):
+		rules = sha1rules.ExcludeRules(minSize=10, maxSize=100, includes=["big"])
+		self.assertTrue(rules.excluded("/a", 5))
+		self.assertFalse(rules.excluded("/a", 50))
+		self.assertTrue(rules.excluded("/a", 500))
+		self.assertFalse(rules.excluded("/big", 500))
+		# size rules don't prune directories
+		self.assertFalse(rules.excludedPath("/a"))
+	
+	def testRulesFromOptions(self):
+		(fd, ruleFile) = tempfile.mkstemp()
+		try:
+			os.write(fd, "# comment\n\n*.iso\nregex:\\.bak$\nprefix:/mnt/scratch\ninclude:good.iso\n")
+			os.close(fd)
+			class Options:
+				excludeFrom = ruleFile
+				maxSize = "1K"
+			rules = sha1rules.rulesFromOptions(Options())
+		finally:
+			os.unlink(ruleFile)
+		self.assertTrue(rules.excluded("/a/b.iso", 1))
+		self.assertFalse(rules.excluded("/a/good.iso", 1))
+		self.assertTrue(rules.excluded("/a/b.bak", 1))
+		self.assertTrue(rules.excluded("/mnt/scratch/x", 1))
+		self.assertTrue(rules.excluded("/home/.Trash-1000/x", 1))
+		self.assertTrue(rules.excluded("/a/b", 2048))
+		self.assertFalse(rules.excluded("/a/b", 1024))
+	
+	def testNoDefaultExcludes(self):
+		class Options:
+			defaultExcludes = False
+		self.assertFalse(sha1rules.rulesFromOptions(Options()).excluded("/home/.Trash-1000/x", 1))
+		self.assertTrue(sha1rules.rulesFromOptions(None).excluded("/home/.Trash-1000/x", 1))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,215 @@
+# Tests for background scrubbing
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import hashlib
+import shutil
+import tempfile
+import threading
+import time
+
+sys.path.append("../")
+from sha1db import Sha1DB
+from sha1db import PENDING_CHECKSUM
+from sha1scrub import RateLimiter, ActivityMonitor, Scrubber, PendingHasher, ScrubStopped
+
+def write(path, data):
+	with open(path, "wb") as f:
+		f.write(data)
+
+def sha1(data):
+	return hashlib.sha1(data).hexdigest()
+
+def timed(func, *args):
+	started = time.time()
+	func(*args)
+	return time.time() - started
+
+class TestThrottling(unittest.TestCase):
+	def testUnlimited(self):
+		limiter = RateLimiter()
+		self.assertTrue(timed(lambda: [limiter.throttle(1 << 30) for i in range(100)]) < 0.1)
+
+	def testBytesPerSec(self):
+		limiter = RateLimiter(bytesPerSec=10000)
+		# 3000 bytes at 10000 bytes/sec
+		elapsed = timed(lambda: [limiter.throttle(1000, 0) for i in range(3)])
+		self.assertTrue(0.25 < elapsed < 1.0, elapsed)
+
+	def testIops(self):
+		limiter = RateLimiter(iops=20)
+		elapsed = timed(lambda: [limiter.throttle(0) for i in range(5)])
+		self.assertTrue(0.2 < elapsed < 1.0, elapsed)
+
+	def testIdleNotBanked(self):
+		limiter = RateLimiter(bytesPerSec=10000)
+		limiter.throttle(1000)
+		time.sleep(RateLimiter.window + 0.1)
+		# a new window starts rather than allowing a burst of everything saved up while idle
+		self.assertTrue(timed(limiter.throttle, 1000) > 0.05)
+
+	def testActivityMonitor(self):
+		activity = ActivityMonitor(0.1)
+		self.assertFalse(activity.busy())
+		activity.touch()
+		self.assertTrue(activity.busy())
+		time.sleep(0.15)
+		self.assertFalse(activity.busy())
+
+	def testBackoff(self):
+		answers = [True, True, False]
+		scrubber = Scrubber(None, busy=lambda: answers.pop(0))
+		elapsed = timed(scrubber._throttle, 100)
+		self.assertEqual([], answers)
+		# backed off twice, doubling the wait
+		self.assertTrue(0.25 < elapsed < 1.0, elapsed)
+		self.assertEqual(100, scrubber.bytesVerified)
+
+	def testBackoffStopped(self):
+		scrubber = Scrubber(None, busy=lambda: True)
+		threading.Timer(0.2, scrubber.stop).start()
+		started = time.time()
+		self.assertRaises(ScrubStopped, scrubber._throttle, 0)
+		self.assertTrue(time.time() - started < 2.0)
+
+class TestScrubber(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpdir, "file")
+		write(self.path, "original")
+		# well in the past, so the file doesn't look like it changed while it was scrubbed
+		os.utime(self.path, (1000000000, 1000000000))
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"))
+		self.sha1db.updateChecksum(self.path)
+		self.scrubber = Scrubber(self.sha1db)
+
+	def tearDown(self):
+		self.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	def entry(self):
+		(chksum, pending, mismatch, verified, size, mtime) = self.sha1db.getEntry(self.path)
+		return (chksum, mismatch)
+
+	def testMatch(self):
+		self.assertTrue(self.scrubber.verify(self.path, sha1("original")))
+		self.assertEqual((sha1("original"), 0), self.entry())
+		self.assertEqual((1, len("original"), 0),
+			(self.scrubber.filesVerified, self.scrubber.bytesVerified, self.scrubber.mismatches))
+
+	def testMismatch(self):
+		# the same size and mtime as when it was hashed: the contents rotted underneath us
+		write(self.path, "corruptd")
+		os.utime(self.path, (1000000000, 1000000000))
+		self.assertEqual(False, self.scrubber.verify(self.path, sha1("original")))
+		self.assertEqual((sha1("original"), 1), self.entry())
+		self.assertEqual([self.path], [path for (path, chksum) in self.sha1db.mismatches()])
+		self.assertEqual(1, self.scrubber.mismatches)
+
+	def testModifiedOutside(self):
+		# edited directly in the root before the scrub began
+		write(self.path, "edited outside")
+		os.utime(self.path, (1000000100, 1000000100))
+		self.assertEqual(None, self.scrubber.verify(self.path, sha1("original")))
+		self.assertEqual((sha1("edited outside"), 0), self.entry())
+		self.assertEqual(0, self.scrubber.mismatches)
+		# same size, only the mtime tells
+		write(self.path, "edited inside!")
+		os.utime(self.path, (1000000200, 1000000200))
+		self.assertEqual(None, self.scrubber.verify(self.path, sha1("edited outside")))
+		self.assertEqual((sha1("edited inside!"), 0), self.entry())
+		self.assertEqual([], list(self.sha1db.mismatches()))
+
+	def testModifiedDuringScrub(self):
+		write(self.path, "still being written")
+		os.utime(self.path, (time.time() + 60, time.time() + 60))
+		self.assertEqual(None, self.scrubber.verify(self.path, sha1("original")))
+		# left for release to update
+		self.assertEqual((sha1("original"), 0), self.entry())
+		self.assertEqual(0, self.scrubber.mismatches)
+
+	def testMissing(self):
+		os.unlink(self.path)
+		self.assertEqual(None, self.scrubber.verify(self.path, sha1("original")))
+		self.assertEqual((sha1("original"), 0), self.entry())
+
+	def testScrubPass(self):
+		other = os.path.join(self.tmpdir, "other")
+		write(other, "other")
+		os.utime(other, (1000000000, 1000000000))
+		self.sha1db.updateChecksum(other)
+		self.assertEqual(2, self.scrubber.scrubPass())
+		self.assertEqual(2, self.scrubber.filesVerified)
+		# nothing is due again for a while
+		self.assertEqual(0, Scrubber(self.sha1db, minAge=60).scrubBatch())
+
+	def testStopped(self):
+		# a file being hashed is abandoned, without recording anything
+		write(self.path, "corruptd")
+		os.utime(self.path, (1000000000, 1000000000))
+		self.scrubber.stop()
+		self.assertRaises(ScrubStopped, self.scrubber.verify, self.path, sha1("original"))
+		self.assertEqual((sha1("original"), 0), self.entry())
+		self.assertEqual(0, self.scrubber.scrubPass())
+
+	def testThread(self):
+		# stuck backing off for a busy filesystem
+		scrubber = Scrubber(self.sha1db, busy=lambda: True)
+		scrubber.start()
+		time.sleep(0.1)
+		scrubber.stop()
+		scrubber.join(2.0)
+		self.assertFalse(scrubber.is_alive())
+		self.assertEqual(0, scrubber.filesVerified)
+
+class TestPendingHasher(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"), lazyThreshold=4)
+		self.paths = [os.path.join(self.tmpdir, name) for name in ("large", "larger", "tiny")]
+		for path in self.paths:
+			write(path, os.path.basename(path))
+			self.sha1db.updateChecksum(path)
+		self.hasher = PendingHasher(self.sha1db)
+
+	def tearDown(self):
+		self.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	def testHash(self):
+		self.assertEqual(PENDING_CHECKSUM, self.sha1db.getChecksum(self.paths[0], hashPending=False))
+		self.assertEqual(sha1("tiny"), self.sha1db.getChecksum(self.paths[2]))
+		self.assertEqual((2, len("large") + len("larger")), self.sha1db.pendingBacklog())
+		self.assertEqual(2, self.hasher.scrubBatch())
+		self.assertEqual(2, self.hasher.filesVerified)
+		for path in self.paths:
+			(chksum, pending, mismatch, verified, size, mtime) = self.sha1db.getEntry(path)
+			self.assertEqual((sha1(os.path.basename(path)), 0), (chksum, pending))
+		self.assertEqual((0, 0), self.sha1db.pendingBacklog())
+		self.assertEqual(0, self.hasher.scrubBatch())
+
+	def testRetry(self):
+		os.unlink(self.paths[0])
+		self.assertEqual(2, self.hasher.scrubBatch())
+		self.assertEqual(1, self.hasher.filesVerified)
+		# still pending, but not retried until minAge seconds later
+		self.assertEqual(PENDING_CHECKSUM, self.sha1db.getChecksum(self.paths[0], hashPending=False))
+		self.assertEqual(0, self.hasher.scrubBatch())
+		write(self.paths[0], "large")
+		self.assertEqual(1, self.hasher.scrubBatch(time.time()))
+		self.assertEqual(sha1("large"), self.sha1db.getChecksum(self.paths[0], hashPending=False))
+
+	def testStopped(self):
+		self.hasher.stop()
+		self.assertEqual(0, self.hasher.scrubPass())
+		self.assertEqual((2, len("large") + len("larger")), self.sha1db.pendingBacklog())
+
+if __name__ == '__main__':
+	unittest.main()
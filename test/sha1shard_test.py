@@ -0,0 +1,347 @@
+# Tests for sharded checksum databases
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import hashlib
+import shutil
+import tempfile
+import time
+import StringIO
+
+sys.path.append("../")
+from sha1db import Sha1DB, JournalGap, reshard, printDuplicateReport
+from sha1shard import ShardRouter, FanOut
+from sha1store import Entry
+
+def write(path, data):
+	directory = os.path.dirname(path)
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+	with open(path, "wb") as f:
+		f.write(data)
+
+def sha1(data):
+	return hashlib.sha1(data).hexdigest()
+
+class TestShardRouter(unittest.TestCase):
+	def testParentDirectory(self):
+		router = ShardRouter(8)
+		self.assertEqual(router.shardOf("/r/a/x"), router.shardOf("/r/a/y"))
+		self.assertEqual(8, len(set(router.shardOf("/r/%d/x" % i) for i in xrange(200))))
+		self.assertEqual(router.shardOf(u"/r/\xe9/x"), router.shardOf(u"/r/\xe9/x".encode("utf-8")))
+		self.assertEqual(range(8), router.shardsFor("/r/a/"))
+
+	def testDepth(self):
+		router = ShardRouter(8, 2)
+		self.assertEqual(router.shardOf("/r/a/x"), router.shardOf("/r/a/b/c/y"))
+		self.assertEqual([router.shardOf("/r/a/x")], router.shardsFor("/r/a/b/"))
+		self.assertEqual([router.shardOf("/r/a/x")], router.shardsFor("/r/a/"))
+		self.assertEqual([router.shardOf("/r/a/x")], router.shardsFor("/r/a/pre"))
+		self.assertEqual(range(8), router.shardsFor("/r/a"))
+		self.assertEqual(range(8), router.shardsFor("/r/"))
+
+	def testOneShard(self):
+		router = ShardRouter()
+		self.assertEqual(0, router.shardOf("/r/a/x"))
+		self.assertEqual([0], router.shardsFor("/"))
+
+class TestShardTransactions(unittest.TestCase):
+	backend = "sqlite"
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"), shards=2, backend=self.backend)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def count(self, shard):
+		with self.sha1db._transaction(shard) as transaction:
+			return len(transaction.pathRange(""))
+
+	def add(self, transaction, path):
+		transaction.put(Entry(path, "aa"))
+
+	def testDeferredWrites(self):
+		with self.sha1db._transactions() as transactions:
+			self.add(transactions.transaction(0), "/a")
+			transactions.write(0, lambda transaction: self.add(transaction, "/b"))
+			transactions.write(1, lambda transaction: self.add(transaction, "/c"))
+			# the write to the shard that isn't open waits for the commit
+			self.assertEqual(0, self.count(1))
+		self.assertEqual(2, self.count(0))
+		self.assertEqual(1, self.count(1))
+
+	def testRollback(self):
+		try:
+			with self.sha1db._transactions() as transactions:
+				self.add(transactions.transaction(0), "/a")
+				self.add(transactions.transaction(1), "/b")
+				transactions.write(1, lambda transaction: transaction.remove("/b"))
+				raise ValueError()
+		except ValueError:
+			pass
+		self.assertEqual(0, self.count(0))
+		self.assertEqual(0, self.count(1))
+
+class TestLogShardTransactions(TestShardTransactions):
+	backend = "log"
+
+class TestFanOut(unittest.TestCase):
+	def testMap(self):
+		fanOut = FanOut(3)
+		self.assertEqual([0, 1, 4, 9, 16], fanOut.map(lambda x: x * x, range(5)))
+		self.assertRaises(ZeroDivisionError, fanOut.map, lambda x: 1 / x, [1, 0, 2])
+		self.assertEqual([1], fanOut.map(lambda x: x, [1]))
+
+class TestShardedSha1DB(unittest.TestCase):
+	backend = "sqlite"
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmpdir, "root")
+		self.database = os.path.join(self.tmpdir, "test.db")
+		# enough directories that the copies land in several shards
+		for i in xrange(8):
+			write(self.path("d%d" % i, "dup"), "dup")
+			write(self.path("d%d" % i, "own"), "own %d" % i)
+		self.sha1db = Sha1DB(self.database, shards=4, backend=self.backend)
+		self.sha1db.updateAllChecksums(self.root)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def path(self, *names):
+		return os.path.join(self.root, *names)
+
+	def shardsUsed(self, paths):
+		return set(self.sha1db.router.shardOf(path) for path in paths)
+
+	def testLayout(self):
+		self.assertEqual(4, len(self.sha1db.shards))
+		self.assertTrue(os.path.exists(self.database + ".shard3"))
+		reopened = Sha1DB(self.database)
+		self.assertEqual(4, len(reopened.shards))
+		self.assertEqual(sha1("own 3"), reopened.getChecksum(self.path("d3", "own")))
+		os.remove(self.database + ".shard2")
+		self.assertRaises(Exception, Sha1DB, self.database)
+
+	def testLinksAcrossShards(self):
+		dups = [self.path("d%d" % i, "dup") for i in xrange(8)]
+		self.assertTrue(len(self.shardsUsed(dups)) > 1)
+		self.assertEqual(1, len(set(os.stat(path).st_ino for path in dups)))
+		entries = self.sha1db.entriesForChecksums([sha1("dup"), sha1("own 1")])
+		self.assertEqual(sorted(dups), sorted(path for (path, chksum) in entries[sha1("dup")]))
+		self.assertEqual(sorted(dups), self.sha1db.pathsForChecksum(sha1("dup")))
+		self.assertTrue(self.sha1db.canonicalPath(sha1("dup")) in dups)
+
+	def testPrefixAndManifest(self):
+		entries = self.sha1db.entriesUnderPrefix(self.root + "/", 5)
+		self.assertEqual(sorted(entries), entries)
+		self.assertEqual((self.path("d0", "dup"), sha1("dup")), entries[0])
+		self.assertEqual(5, len(entries))
+		self.assertEqual(16, len(list(self.sha1db.manifestEntries(self.root + "/"))))
+		self.assertEqual([self.path("d2", "own")],
+			self.sha1db.entriesForPaths([self.path("d2", "own"), self.path("nothing")]).keys())
+
+	def testRenameAcrossShards(self):
+		os.rename(self.path("d1"), self.path("moved"))
+		self.sha1db.updatePath(self.path("d1") + "/", self.path("moved") + "/")
+		self.assertEqual(sha1("own 1"), self.sha1db.getChecksum(self.path("moved", "own")))
+		self.assertEqual(None, self.sha1db.getEntry(self.path("d1", "own")))
+		self.assertEqual(16, len(list(self.sha1db.manifestEntries())))
+		# and back, one file at a time, between every pair of shards
+		for i in xrange(8):
+			old = self.path("moved", "own")
+			new = self.path("d%d" % i, "own1")
+			self.sha1db.updatePath(old, new)
+			self.assertEqual(sha1("own 1"), self.sha1db.getChecksum(new))
+			self.assertEqual(None, self.sha1db.getEntry(old))
+			self.sha1db.updatePath(new, old)
+
+	def testRenameNextToSibling(self):
+		# renamed the way the mount does, without a trailing "/"; d10 only shares the prefix
+		write(self.path("d10", "own"), "own 10")
+		write(self.path("d2", "owner"), "owner")
+		self.sha1db.updateAllChecksums(self.root)
+		os.rename(self.path("d1"), self.path("z1"))
+		self.sha1db.updatePath(self.path("d1"), self.path("z1"))
+		self.assertEqual(sha1("own 1"), self.sha1db.getChecksum(self.path("z1", "own")))
+		self.assertEqual(sha1("dup"), self.sha1db.getChecksum(self.path("z1", "dup")))
+		self.assertEqual(sha1("own 10"), self.sha1db.getChecksum(self.path("d10", "own")))
+		self.assertEqual(None, self.sha1db.getEntry(self.path("z10", "own")))
+		self.assertEqual([], self.sha1db.entriesUnderPrefix(self.path("d1") + "/", 10))
+		# a file next to one its name is a prefix of
+		self.sha1db.updatePath(self.path("d2", "own"), self.path("d5", "mine"))
+		self.assertEqual(sha1("own 2"), self.sha1db.getChecksum(self.path("d5", "mine")))
+		self.assertEqual(None, self.sha1db.getEntry(self.path("d2", "own")))
+		self.assertEqual(sha1("owner"), self.sha1db.getChecksum(self.path("d2", "owner")))
+		self.assertEqual(None, self.sha1db.getEntry(self.path("d5", "miner")))
+		self.assertEqual(18, len(list(self.sha1db.manifestEntries())))
+
+	def testRemoveTree(self):
+		self.sha1db.removeTree(self.path("d1"))
+		self.assertEqual(None, self.sha1db.getEntry(self.path("d1", "own")))
+		self.assertEqual(14, len(list(self.sha1db.manifestEntries())))
+
+	def testDedup(self):
+		dupdir = os.path.join(self.tmpdir, "dups")
+		self.sha1db.dedup(dupdir, False)
+		remaining = [path for path in (self.path("d%d" % i, "dup") for i in xrange(8))
+			if os.path.exists(path)]
+		self.assertEqual(1, len(remaining))
+		self.assertEqual(remaining, self.sha1db.pathsForChecksum(sha1("dup")))
+
+	def testJournals(self):
+		self.assertEqual(16, sum(len(list(self.sha1db.changesSince(0, shard=shard)))
+			for shard in xrange(4)))
+		self.assertEqual(16, self.sha1db.compactJournal(maxEntries=0))
+
+	def testPending(self):
+		sha1db = Sha1DB(os.path.join(self.tmpdir, "lazy.db"), lazyThreshold=2, shards=4,
+			backend=self.backend)
+		sha1db.updateAllChecksums(self.root)
+		self.assertEqual((16, 3 * 8 + sum(len("own %d" % i) for i in xrange(8))),
+			sha1db.pendingBacklog())
+		self.assertEqual(5, len(sha1db.pendingFiles(5)))
+		self.assertEqual(16, sha1db.hashAllPending())
+		self.assertEqual((0, 0), sha1db.pendingBacklog())
+		self.assertEqual(16, len(sha1db.scrubCandidates(100, time.time() + 1)))
+
+	def testDuplicateGroups(self):
+		# the same entries in one shard and in four make the same groups, in the same order
+		single = Sha1DB(os.path.join(self.tmpdir, "single.db"), backend=self.backend)
+		for shard in self.sha1db.shards:
+			with shard.transaction() as transaction:
+				single.addEntries(transaction.pathRange(""))
+		entries = [Entry(self.path("e%d" % (i % 13), "f%d" % i), sha1(str(i % 17)), size=i % 17 % 5,
+			link=int(0 == i % 7)) for i in xrange(200)]
+		for sha1db in (single, self.sha1db):
+			sha1db.addEntries(entries)
+		groups = list(single.duplicateGroups())
+		self.assertEqual(14, len(groups))
+		self.assertEqual(groups, list(self.sha1db.duplicateGroups(batchSize=3)))
+		after = (groups[4].reclaimable, groups[4].chksum)
+		self.assertEqual(groups[5:], list(self.sha1db.duplicateGroups(after, batchSize=2)))
+		self.assertEqual((sha1("dup"), 3, 1, 7, 0), groups[-1])
+		self.assertEqual(single.duplicatesByDirectory(1), self.sha1db.duplicatesByDirectory(1))
+
+	def testDuplicateReport(self):
+		out = StringIO.StringIO()
+		printDuplicateReport(self.sha1db, out=out)
+		lines = [line.split("\t") for line in out.getvalue().splitlines()]
+		self.assertEqual(["total", "0", "0", "21", "7"], lines[0])
+		self.assertEqual(["group", "0", "3", "1", "7", sha1("dup")], lines[1])
+		self.assertEqual(["keep"] + ["link"] * 7, [line[0] for line in lines[2:10]])
+		self.assertEqual(sorted(self.path("d%d" % i, "dup") for i in xrange(8)),
+			sorted(line[1] for line in lines[2:10]))
+		self.assertEqual(7, len([line for line in lines[10:] if "directory" == line[0]]))
+		self.sha1db.addEntries([Entry(self.path("d0", "copy"), sha1("own 1"), size=5)])
+		out = StringIO.StringIO()
+		printDuplicateReport(self.sha1db, 1, 1, out)
+		self.assertEqual(["total", "5", "1", "21", "7"], out.getvalue().splitlines()[0].split("\t"))
+		self.assertEqual(["directory", "5", "1", "21", "7", "/" + self.root.split("/")[1]],
+			out.getvalue().splitlines()[-1].split("\t"))
+
+	def testDirectoryDigests(self):
+		# a directory's entries are spread over the shards, whose digests add up to the same
+		single = Sha1DB(os.path.join(self.tmpdir, "single.db"), backend=self.backend)
+		single.addEntries(Entry(path, chksum) for (chksum, path) in self.sha1db.manifestEntries())
+		self.assertEqual(single.directoryDigest(self.root), self.sha1db.directoryDigest(self.root + "/"))
+		self.assertEqual(16, self.sha1db.directoryDigest(self.root)[1])
+		self.assertEqual(("0" * 40, 0), self.sha1db.directoryDigest(self.path("nothing")))
+		subdirectories = self.sha1db.subdirectoryDigests(self.root)
+		self.assertEqual(["d%d" % i for i in xrange(8)], sorted(subdirectories))
+		self.assertEqual(single.subdirectoryDigests(self.root), subdirectories)
+		self.assertEqual(subdirectories["d3"], self.sha1db.directoryDigest(self.path("d3")))
+		self.sha1db.addEntries([Entry(self.path("d3", "own"), sha1("own 0"))])
+		self.assertEqual(self.sha1db.directoryDigest(self.path("d0")),
+			self.sha1db.directoryDigest(self.path("d3")))
+		self.assertNotEqual(single.directoryDigest(self.root), self.sha1db.directoryDigest(self.root))
+
+	def testNonAscii(self):
+		# paths from the mount and the command line are UTF-8 str, paths from the database unicode
+		for name in ("caf\xc3\xa9", "na\xc3\xafve"):
+			write(self.path(name, "\xc3\xa9t\xc3\xa9"), name)
+			self.sha1db.updateChecksum(self.path(name, "\xc3\xa9t\xc3\xa9"))
+		prefix = self.path("caf\xc3\xa9") + "/"
+		expected = [(self.path("caf\xc3\xa9", "\xc3\xa9t\xc3\xa9").decode("utf-8"), sha1("caf\xc3\xa9"))]
+		self.assertEqual(expected, self.sha1db.entriesUnderPrefix(prefix, 10))
+		self.assertEqual([(chksum, path) for (path, chksum) in expected], 
+			list(self.sha1db.manifestEntries(prefix)))
+		self.assertEqual(2, len(self.sha1db.entriesUnderPrefix(self.root + "/", 100)) - 16)
+		self.assertEqual(self.sha1db.directoryDigest(prefix.decode("utf-8")), 
+			self.sha1db.directoryDigest(prefix))
+		self.assertEqual(1, self.sha1db.directoryDigest(prefix)[1])
+		self.assertTrue(u"caf\xe9" in self.sha1db.subdirectoryDigests(self.root))
+		change = [("change", sha1("na\xc3\xafve"), u"\xe9t\xe9", sha1("caf\xc3\xa9"))]
+		self.assertEqual(change, list(self.sha1db.diff(self.sha1db, prefix, 
+			self.path("na\xc3\xafve") + "/")))
+		self.assertEqual([change[0][:2] + (u"t\xe9", ) + change[0][3:]], 
+			list(self.sha1db.diff(self.sha1db, prefix + "\xc3\xa9", self.path("na\xc3\xafve", "\xc3\xa9"))))
+		moved = self.path("caf\xc3\xa9 moved")
+		os.rename(self.path("caf\xc3\xa9"), moved)
+		self.sha1db.updatePath(prefix, moved + "/")
+		self.assertEqual(sha1("caf\xc3\xa9"), self.sha1db.getChecksum(moved + "/\xc3\xa9t\xc3\xa9"))
+		self.assertEqual([], self.sha1db.entriesUnderPrefix(prefix, 10))
+
+	def testDiff(self):
+		other = Sha1DB(os.path.join(self.tmpdir, "other.db"), backend=self.backend)
+		otherRoot = os.path.join(self.tmpdir, "copy")
+		other.addEntries(Entry(otherRoot + path[len(self.root):], chksum)
+			for (chksum, path) in self.sha1db.manifestEntries())
+		self.assertEqual([], list(self.sha1db.diff(other, self.root + "/", otherRoot + "/")))
+		other.addEntries([Entry(otherRoot + "/d1/own", sha1("changed")),
+			Entry(otherRoot + "/d2/deeper/new", sha1("new")), Entry(otherRoot + "/d3.new", sha1("own 3")),
+			Entry(otherRoot + "/d5/pending", "", pending=1)])
+		other.removeChecksum(otherRoot + "/d3/own")
+		other.removeChecksum(otherRoot + "/d4/dup")
+		self.sha1db.addEntries([Entry(self.path("d5", "pending"), "", pending=1)])
+		expected = [("change", sha1("changed"), "d1/own", sha1("own 1")),
+			("add", sha1("new"), "d2/deeper/new", None), ("move", sha1("own 3"), "d3.new", "d3/own"),
+			("remove", sha1("dup"), "d4/dup", None)]
+		self.assertEqual(expected, list(self.sha1db.diff(other, self.root + "/", otherRoot + "/")))
+		# the same, read in full without the digests
+		self.assertEqual([(op, chksum, name[1:], detail[1:] if "move" == op else detail)
+			for (op, chksum, name, detail) in expected],
+			list(self.sha1db.diff(other, self.root + "/d", otherRoot + "/d")))
+
+	def testReshard(self):
+		last = max(self.sha1db.lastSequence(shard) for shard in xrange(4))
+		self.assertEqual(16, reshard(self.database, 3, 1))
+		resharded = Sha1DB(self.database)
+		self.assertEqual(3, len(resharded.shards))
+		self.assertFalse(os.path.exists(self.database + ".shard3"))
+		self.assertEqual(16, len(list(resharded.manifestEntries())))
+		self.assertEqual(sha1("own 5"), resharded.getChecksum(self.path("d5", "own")))
+		self.assertRaises(JournalGap, resharded.changesSince, last - 1)
+		self.assertEqual([], list(resharded.changesSince(last)))
+
+		self.assertEqual(16, reshard(self.database, 1))
+		merged = Sha1DB(self.database)
+		self.assertEqual(1, len(merged.shards))
+		self.assertEqual([self.database], [path for path in
+			(os.path.join(self.tmpdir, name) for name in os.listdir(self.tmpdir))
+			if path.startswith(self.database) and not path[-4:] in ("-wal", "-shm")])
+		self.assertEqual(16, len(list(merged.manifestEntries())))
+		self.assertEqual(self.backend, merged.backend)
+
+class TestLogShardedSha1DB(TestShardedSha1DB):
+	backend = "log"
+
+	def testReshardIntoSqlite(self):
+		self.assertEqual(16, reshard(self.database, 2, backend="sqlite"))
+		resharded = Sha1DB(self.database)
+		self.assertEqual("sqlite", resharded.backend)
+		self.assertEqual(sha1("own 5"), resharded.getChecksum(self.path("d5", "own")))
+		self.assertEqual(16, len(list(resharded.manifestEntries())))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,404 @@
+# Tests for the storage backends of Sha1DB
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import shutil
+import sqlite3
+import tempfile
+
+sys.path.append("../")
+import sha1store
+from sha1store import Entry, ChecksumStats, openStore, storeBackend, EMPTY_DIGEST
+
+class TestSqliteStore(unittest.TestCase):
+	backend = "sqlite"
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpdir, "test.db")
+		self.store = openStore(self.path, self.backend, {"chksum_type": "md5"})
+
+	def tearDown(self):
+		self.store.close()
+		shutil.rmtree(self.tmpdir)
+
+	def fill(self, *entries):
+		with self.store.transaction() as transaction:
+			for entry in entries:
+				transaction.put(entry)
+
+	def paths(self, entries):
+		return [entry.path for entry in entries]
+
+	def reopen(self):
+		self.store.close()
+		self.store = openStore(self.path)
+
+	def testPutAndUpdate(self):
+		self.assertEqual(self.backend, storeBackend(self.path))
+		self.fill(Entry("/a", "aa", size=1), Entry("/b", "aa"), Entry("/c", "cc"))
+		with self.store.transaction() as transaction:
+			self.assertEqual(Entry("/a", "aa", size=1), transaction.get("/a"))
+			self.assertEqual(None, transaction.get("/x"))
+			self.assertEqual(["/a", "/b"], sorted(self.paths(transaction.withChecksums(["aa", "xx"]))))
+			self.assertEqual(["/a", "/c"], sorted(self.paths(transaction.withPaths(["/a", "/c", "/x"]))))
+			self.assertFalse(transaction.update("/a", {"link": 1}, {"chksum": "bb"}))
+			self.assertTrue(transaction.update("/a", {"link": 1}, {"chksum": "aa"}))
+			self.assertFalse(transaction.update("/x", {"link": 1}))
+			transaction.put(Entry("/b", "bb"))
+		with self.store.transaction() as transaction:
+			self.assertEqual(1, transaction.get("/a").link)
+			self.assertEqual(["/a"], self.paths(transaction.withChecksums(["aa"])))
+			self.assertEqual(["/a"], self.paths(transaction.linked()))
+		self.assertEqual("md5", self.store.metadata()["chksum_type"])
+
+	def testRanges(self):
+		self.fill(*[Entry(path, "aa") for path in ["/d/a", "/d/b", "/d/c/e", "/d0", "/e"]])
+		with self.store.transaction() as transaction:
+			self.assertEqual(["/d/a", "/d/b", "/d/c/e"], self.paths(transaction.pathRange("/d/", "/d0")))
+			self.assertEqual(["/d/b"], self.paths(transaction.pathRange("/d/", "/d0", "/d/a", 1)))
+			self.assertEqual(5, len(transaction.pathRange("")))
+			transaction.renamePrefix("/d/", "/f/")
+			transaction.rename([("/g", "/e")])
+		with self.store.transaction() as transaction:
+			self.assertEqual(["/d0", "/f/a", "/f/b", "/f/c/e", "/g"], self.paths(transaction.pathRange("")))
+			transaction.removeRange("/f/", "/f0")
+			transaction.remove("/g")
+		with self.store.transaction() as transaction:
+			self.assertEqual(["/d0"], self.paths(transaction.pathRange("")))
+
+	def testQueues(self):
+		self.fill(Entry("/p1", "", pending=1, size=10, last_verified=5.0),
+			Entry("/p2", "", pending=1, size=20),
+			Entry("/s1", "aa", last_verified=3.0), Entry("/s2", "aa", last_verified=1.0),
+			Entry("/s3", "aa", symlink=1), Entry("/s4", "aa", pending=2),
+			Entry("/m", "aa", mismatch=1, last_verified=9.0))
+		with self.store.transaction() as transaction:
+			self.assertEqual(["/p2", "/p1"], self.paths(transaction.pendingQueue(10.0, -1)))
+			self.assertEqual(["/p2"], self.paths(transaction.pendingQueue(5.0, -1)))
+			self.assertEqual(["/s4", "/s2", "/s1"], self.paths(transaction.scrubQueue(9.0, 10)))
+			self.assertEqual(["/s4", "/s2"], self.paths(transaction.scrubQueue(9.0, 2)))
+			self.assertEqual((2, 30), transaction.pendingBacklog())
+			self.assertEqual(["/m"], self.paths(transaction.mismatches()))
+			transaction.update("/p2", {"pending": 0, "chksum": "bb", "last_verified": 2.0})
+			transaction.update("/s2", {"last_verified": 4.0})
+		with self.store.transaction() as transaction:
+			self.assertEqual(["/p1"], self.paths(transaction.pendingQueue(10.0, -1)))
+			self.assertEqual(["/s4", "/p2", "/s1", "/s2"], self.paths(transaction.scrubQueue(9.0, 10)))
+			self.assertEqual((1, 10), transaction.pendingBacklog())
+
+	def testJournal(self):
+		self.fill(Entry("/a", "aa"))
+		with self.store.transaction() as transaction:
+			transaction.update("/a", {"last_verified": 1.0})
+			transaction.update("/a", {"chksum": "bb"})
+			transaction.rename([("/b", "/a")])
+			transaction.remove("/b")
+			transaction.load([Entry("/c", "cc")], journal=False)
+		with self.store.transaction() as transaction:
+			changes = transaction.changes(0, 10)
+			self.assertEqual([(1, "insert", "/a", None, "aa"), (2, "update", "/a", None, "bb"),
+				(3, "rename", "/b", "/a", "bb"), (4, "delete", "/b", None, "bb")],
+				[change[:5] for change in changes])
+			self.assertEqual(changes[2:], transaction.changes(2, 10))
+			self.assertEqual(changes[1:2], transaction.changes(1, 1))
+			self.assertEqual(4, transaction.lastSequence())
+			self.assertEqual(1, transaction.firstSequence())
+			self.assertEqual(["/c"], self.paths(transaction.pathRange("")))
+		with self.store.transaction() as transaction:
+			self.assertEqual(3, transaction.compactJournal(maxEntries=1))
+		with self.store.transaction() as transaction:
+			self.assertEqual(4, transaction.firstSequence())
+			self.assertEqual(1, transaction.compactJournal(before=changes[-1][5] + 1))
+		with self.store.transaction() as transaction:
+			self.assertEqual(None, transaction.firstSequence())
+			self.assertEqual(4, transaction.lastSequence())
+			transaction.put(Entry("/d", "dd"))
+		with self.store.transaction() as transaction:
+			self.assertEqual([5], [change[0] for change in transaction.changes(0, 10)])
+
+	def testRenamePrefix(self):
+		self.fill(*[Entry(path, path) for path in ["/a", "/a/x", "/a/a", "/ab", "/abc/y", "/A/z"]])
+		with self.store.transaction() as transaction:
+			transaction.renamePrefix("/a", "/z")
+		with self.store.transaction() as transaction:
+			# the siblings sharing the prefix, and the other case, stay where they are
+			self.assertEqual([("/A/z", "/A/z"), ("/ab", "/ab"), ("/abc/y", "/abc/y"), ("/z", "/a"), 
+				("/z/a", "/a/a"), ("/z/x", "/a/x")], 
+				[(entry.path, entry.chksum) for entry in transaction.pathRange("")])
+			transaction.renamePrefix("/z/", "/b/")
+		with self.store.transaction() as transaction:
+			self.assertEqual(["/A/z", "/ab", "/abc/y", "/b/a", "/b/x", "/z"], 
+				self.paths(transaction.pathRange("")))
+
+	def testNonAsciiPaths(self):
+		with self.store.transaction() as transaction:
+			transaction.put(Entry(u"/\xe9/a", "aa"))
+			# UTF-8 str paths are the same paths
+			transaction.put(Entry("/\xc3\xa9/b", "bb"))
+		with self.store.transaction() as transaction:
+			self.assertEqual("aa", transaction.get("/\xc3\xa9/a").chksum)
+			self.assertEqual([u"/\xe9/a", u"/\xe9/b"], self.paths(transaction.pathRange("/\xc3\xa9/", u"/\xe90")))
+			self.assertEqual([u"/\xe9/b"], self.paths(transaction.pathRange(u"/\xe9/", "/\xc3\xa90", "/\xc3\xa9/a")))
+			self.assertEqual([u"/\xe9/a", u"/\xe9/b"], sorted(path for (path, chksum) in 
+				[(entry.path, entry.chksum) for entry in transaction.withChecksums(["aa", "bb"])]))
+
+	def testStartJournalAfter(self):
+		with self.store.transaction() as transaction:
+			transaction.startJournalAfter(41)
+		with self.store.transaction() as transaction:
+			self.assertEqual(41, transaction.lastSequence())
+			self.assertEqual(None, transaction.firstSequence())
+			transaction.put(Entry("/a", "aa"))
+		with self.store.transaction() as transaction:
+			self.assertEqual(42, transaction.firstSequence())
+
+	def testRollback(self):
+		self.fill(Entry("/a", "aa"))
+		try:
+			with self.store.transaction() as transaction:
+				transaction.put(Entry("/b", "bb"))
+				transaction.rename([("/c", "/a")])
+				raise ValueError()
+		except ValueError:
+			pass
+		with self.store.transaction() as transaction:
+			self.assertEqual(["/a"], self.paths(transaction.pathRange("")))
+			self.assertEqual(["/a"], self.paths(transaction.withChecksums(["aa", "bb"])))
+			self.assertEqual(1, transaction.lastSequence())
+			self.assertEqual(["aa"], [row.chksum for row in transaction.checksumStats(["aa", "bb"])])
+
+	def testChecksumCounts(self):
+		self.fill(Entry("/a", "c1", size=10), Entry("/b", "c1", size=10), Entry("/c", "c1", link=1),
+			Entry("/d", "c1", symlink=1), Entry("/e", "c1", pending=1), Entry("/f", "c1", mismatch=1),
+			Entry("/g", "c2", size=5), Entry("/h", "c3", size=0), Entry("/i", "c3", size=0),
+			Entry("/j", "c4", size=7), Entry("/k", "c4", size=7))
+		with self.store.transaction() as transaction:
+			self.assertEqual([ChecksumStats("c1", 10, 2, 2, 20, 10), ChecksumStats("c2", 5, 1, 0, 5, 0)],
+				sorted(transaction.checksumStats(["c1", "c2", "x"])))
+			self.assertEqual(["c1", "c4"], [row.chksum for row in transaction.duplicates()])
+			self.assertEqual(["c4"], [row.chksum for row in transaction.duplicates((10, "c1"))])
+			self.assertEqual(["c1"], [row.chksum for row in transaction.duplicates(limit=1)])
+			self.assertEqual([("c1", 20), ("c4", 14), ("c2", 5)],
+				[(row.chksum, row.occupied) for row in transaction.occupying()])
+			self.assertEqual(["c2"], [row.chksum for row in transaction.occupying((14, "c4"), 5)])
+			transaction.update("/b", {"link": 1})
+			transaction.rename([("/z", "/a")])
+			transaction.remove("/j")
+		with self.store.transaction() as transaction:
+			self.assertEqual([ChecksumStats("c1", 10, 1, 3, 10, 0)], transaction.checksumStats(["c1"]))
+			self.assertEqual(["c1"], [row.chksum for row in transaction.duplicates()])
+			transaction.update("/f", {"mismatch": 0})
+			transaction.load([Entry("/k", "c5", size=7), Entry("/l", "c5", size=7)], journal=False)
+		with self.store.transaction() as transaction:
+			self.assertEqual(["c1", "c5"], [row.chksum for row in transaction.duplicates()])
+			self.assertEqual([], transaction.checksumStats(["c4"]))
+		self.reopen()
+		with self.store.transaction() as transaction:
+			self.assertEqual([ChecksumStats("c1", 10, 2, 3, 20, 10), ChecksumStats("c5", 7, 2, 0, 14, 7)],
+				transaction.duplicates())
+
+	def digests(self, store, *paths):
+		with store.transaction() as transaction:
+			return dict((row.path, (row.digest, row.files)) for row in transaction.directories(paths))
+
+	def testDirectoryDigests(self):
+		self.fill(Entry("/r/a/x", "c1"), Entry("/r/a/y", "c2"), Entry("/r/b/x", "c1"),
+			Entry("/s/a/x", "c1"), Entry("/s/a/y", "c2", pending=1), Entry(u"/s/\xe9/x", "c3"))
+		digests = self.digests(self.store, "/r/a", "/s/a", "/r/b", "/r", "/", "/none")
+		self.assertEqual(["/", "/r", "/r/a", "/r/b", "/s/a"], sorted(digests))
+		self.assertEqual(digests["/r/a"], digests["/s/a"])
+		self.assertEqual((3, 6), (digests["/r"][1], digests["/"][1]))
+		self.assertNotEqual(digests["/r/a"][0], digests["/r/b"][0])
+		self.assertNotEqual(EMPTY_DIGEST, digests["/r/b"][0])
+		with self.store.transaction() as transaction:
+			self.assertEqual(["/r/a", "/r/b"], [row.path for row in transaction.subdirectories("/r")])
+			self.assertEqual(["/s/a", u"/s/\xe9"], [row.path for row in transaction.subdirectories("/s")])
+			self.assertEqual([], transaction.subdirectories("/r/a"))
+			transaction.update("/r/a/y", {"chksum": "c3"})
+			# only checksums and names count
+			transaction.update("/s/a/x", {"mismatch": 1, "last_verified": 5.0})
+		self.assertNotEqual(digests["/r/a"], self.digests(self.store, "/r/a")["/r/a"])
+		self.assertEqual(digests["/s/a"], self.digests(self.store, "/s/a")["/s/a"])
+		with self.store.transaction() as transaction:
+			transaction.update("/r/a/y", {"chksum": "c2"})
+			transaction.rename([("/r/c/x", "/r/b/x")])
+			transaction.renamePrefix("/s/a/", "/t/u/")
+		moved = self.digests(self.store, "/r/a", "/r/b", "/r/c", "/s", "/t/u", "/")
+		self.assertEqual(digests["/r/a"], moved["/r/a"])
+		self.assertEqual(digests["/r/b"], moved["/r/c"])
+		self.assertEqual(digests["/s/a"], moved["/t/u"])
+		self.assertEqual(1, moved["/s"][1])
+		self.assertFalse("/r/b" in moved)
+		self.assertEqual(6, moved["/"][1])
+		try:
+			with self.store.transaction() as transaction:
+				transaction.removeRange("/r/", "/r0")
+				raise ValueError()
+		except ValueError:
+			pass
+		self.assertEqual(moved, self.digests(self.store, *moved))
+		with self.store.transaction() as transaction:
+			transaction.remove("/r/c/x")
+			transaction.load([Entry("/r/b/x", "c1")], journal=False)
+		self.reopen()
+		self.assertEqual(digests["/r/b"], self.digests(self.store, "/r/b")["/r/b"])
+		# the same entries put in anew, in another order, add up to the same digests
+		other = openStore(os.path.join(self.tmpdir, "other.db"), self.backend, {})
+		try:
+			with self.store.transaction() as transaction:
+				entries = transaction.pathRange("")
+			with other.transaction() as transaction:
+				transaction.load(reversed(entries))
+			paths = ["/", "/r", "/r/a", "/r/b", "/s", u"/s/\xe9", "/t", "/t/u"]
+			self.assertEqual(self.digests(self.store, *paths), self.digests(other, *paths))
+			self.assertEqual(8, len(self.digests(other, *paths)))
+		finally:
+			other.close()
+
+	def testReopen(self):
+		self.fill(Entry("/a", "aa", size=1, mtime=2.0), Entry("/b", "bb", pending=1))
+		with self.store.transaction() as transaction:
+			transaction.remove("/b")
+		self.reopen()
+		with self.store.transaction() as transaction:
+			self.assertEqual([Entry("/a", "aa", size=1, mtime=2.0)], transaction.pathRange(""))
+			self.assertEqual(3, transaction.lastSequence())
+			self.assertEqual(3, len(transaction.changes(0, 10)))
+			self.assertEqual((0, 0), transaction.pendingBacklog())
+		self.assertEqual("md5", self.store.metadata()["chksum_type"])
+
+class TestSqliteUpgrade(unittest.TestCase):
+	def testChecksumCounts(self):
+		tmpdir = tempfile.mkdtemp()
+		try:
+			path = os.path.join(tmpdir, "old.db")
+			with openStore(path, "sqlite", {"chksum_type": "sha1"}).transaction() as transaction:
+				transaction.load([Entry("/a", "aa", size=3), Entry("/b", "aa", size=3),
+					Entry("/c", "aa", link=1, size=3), Entry("/d", "bb", pending=1)])
+			connection = sqlite3.connect(path)
+			for trigger in ("checksums_insert", "checksums_update", "checksums_delete"):
+				connection.execute("drop trigger %s;" % trigger)
+			connection.execute("drop table checksums;")
+			connection.commit()
+			connection.close()
+			with openStore(path).transaction() as transaction:
+				self.assertEqual([ChecksumStats("aa", 3, 2, 1, 6, 3)], transaction.duplicates())
+				transaction.remove("/b")
+				self.assertEqual([ChecksumStats("aa", 3, 1, 1, 3, 0)], transaction.duplicates(limit=5))
+				self.assertEqual(transaction.duplicates(), transaction.occupying())
+		finally:
+			shutil.rmtree(tmpdir)
+
+	def testDirectoryDigests(self):
+		tmpdir = tempfile.mkdtemp()
+		try:
+			path = os.path.join(tmpdir, "old.db")
+			with openStore(path, "sqlite", {"chksum_type": "sha1"}).transaction() as transaction:
+				transaction.load([Entry("/r/a/x", "aa"), Entry("/r/b/x", "aa")])
+			connection = sqlite3.connect(path)
+			for trigger in ("tree_insert", "tree_update", "tree_delete"):
+				connection.execute("drop trigger %s;" % trigger)
+			connection.execute("drop table directories;")
+			connection.execute("insert into files(path, chksum) values('/r/c/x', 'aa');")
+			connection.commit()
+			connection.close()
+			with openStore(path).transaction() as transaction:
+				rows = transaction.directories(["/r", "/r/a", "/r/b", "/r/c"])
+				self.assertEqual([3, 1, 1, 1], [row.files for row in rows])
+				self.assertEqual(1, len(set(row.digest for row in rows[1:])))
+			# changes made without this module are added up by the next transaction to read them
+			connection = sqlite3.connect(path)
+			connection.execute("delete from files where path = '/r/c/x';")
+			connection.commit()
+			connection.close()
+			with openStore(path).transaction() as transaction:
+				self.assertEqual(["/r/a", "/r/b"], [row.path for row in transaction.subdirectories("/r")])
+		finally:
+			shutil.rmtree(tmpdir)
+
+class TestLogStore(TestSqliteStore):
+	backend = "log"
+
+	def size(self):
+		return os.path.getsize(self.path)
+
+	def testOneStorePerProcess(self):
+		store = openStore(self.path)
+		self.assertTrue(store is self.store)
+		store.close()
+
+	def testTornRecord(self):
+		self.fill(Entry("/a", "aa"))
+		size = self.size()
+		self.fill(Entry("/b", "bb"))
+		with open(self.path, "rb") as f:
+			data = f.read()
+		self.store.close()
+		for end in (size + 3, len(data) - 1):
+			with open(self.path, "wb") as f:
+				f.write(data[:end])
+			self.store = openStore(self.path)
+			with self.store.transaction() as transaction:
+				self.assertEqual(["/a"], self.paths(transaction.pathRange("")))
+			self.assertEqual(size, self.size())
+			self.store.close()
+		self.store = openStore(self.path)
+
+	def testDamage(self):
+		self.fill(Entry("/a", "aa"))
+		size = self.size()
+		self.fill(Entry("/b", "bb"))
+		self.store.close()
+		with open(self.path, "r+b") as f:
+			f.seek(size - 1)
+			f.write("x")
+		self.assertRaises(Exception, openStore, self.path)
+		self.store = openStore(os.path.join(self.tmpdir, "other.db"), "log")
+
+	def testCompaction(self):
+		self.fill(*[Entry("/d/%d" % i, "aa") for i in xrange(10)])
+		for i in xrange(20):
+			self.fill(Entry("/d/0", "c%d" % i))
+		with self.store.transaction() as transaction:
+			transaction.compactJournal(maxEntries=5)
+			changes = transaction.changes(0, 100)
+		size = self.size()
+		self.store.compact()
+		self.assertTrue(self.size() < size)
+		for i in xrange(2):
+			with self.store.transaction() as transaction:
+				self.assertEqual(10, len(transaction.pathRange("/d/")))
+				self.assertEqual(["/d/0"], self.paths(transaction.withChecksums(["c19"])))
+				self.assertEqual(changes, transaction.changes(0, 100))
+				self.assertEqual(30, transaction.lastSequence())
+			self.reopen()
+		self.fill(Entry("/e", "ee"))
+		with self.store.transaction() as transaction:
+			self.assertEqual(31, transaction.changes(29, 10)[-1][0])
+
+	def testAutomaticCompaction(self):
+		minRecords = sha1store.COMPACT_MIN_RECORDS
+		sha1store.COMPACT_MIN_RECORDS = 50
+		try:
+			for i in xrange(100):
+				self.fill(Entry("/a", "c%d" % i))
+		finally:
+			sha1store.COMPACT_MIN_RECORDS = minRecords
+		self.assertTrue(self.store.records <= 50)
+		self.reopen()
+		with self.store.transaction() as transaction:
+			self.assertEqual("c99", transaction.get("/a").chksum)
+			self.assertEqual([ChecksumStats("c99", 0, 1, 0, 0, 0)],
+				transaction.checksumStats(["c98", "c99"]))
+			self.assertEqual(100, len(transaction.changes(0, 1000)))
+
+if __name__ == '__main__':
+	unittest.main()
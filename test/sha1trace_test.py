@@ -0,0 +1,94 @@
+# Tests for operation tracing
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import threading
+import time
+
+sys.path.append("../")
+import sha1trace
+from fusesha1util import ewrap
+
+class TestSha1Trace(unittest.TestCase):
+	def tearDown(self):
+		sha1trace.disable()
+	
+	def testHistogram(self):
+		histogram = sha1trace.Histogram()
+		self.assertEqual(0.0, histogram.percentile(50))
+		for i in xrange(1, 101):
+			histogram.record(i / 1000.0)
+		self.assertEqual(100, histogram.count)
+		self.assertEqual(0.1, histogram.max)
+		# buckets are less than 20% wide, and percentiles are their upper bounds
+		self.assertTrue(0.050 <= histogram.percentile(50) < 0.050 * 1.2)
+		self.assertTrue(0.099 <= histogram.percentile(99) <= 0.1)
+		self.assertEqual(0.1, histogram.percentile(100))
+		histogram.record(0.0)
+		histogram.record(1e6)
+		self.assertEqual(102, histogram.count)
+	
+	def testDisabled(self):
+		self.assertEqual(None, sha1trace.tracer)
+		with ewrap("getattr") as op:
+			op.nbytes = 10
+		self.assertEqual(None, sha1trace.disable())
+	
+	def testOperations(self):
+		tracer = sha1trace.enable()
+		self.assertTrue(tracer is sha1trace.enable())
+		with ewrap("read") as op:
+			tracer.category(sha1trace.SQLITE, 0.002)
+			with ewrap("getattr"):
+				tracer.category(sha1trace.HASH, 0.001, 4096)
+			op.nbytes = 100
+		try:
+			with ewrap("unlink"):
+				raise OSError("gone")
+		except OSError:
+			pass
+		# outside of any operation, e.g. the scrubber
+		tracer.category(sha1trace.HASH, 0.003, 8192)
+		
+		snapshot = tracer.snapshot()
+		self.assertEqual(1, snapshot["read"]["count"])
+		self.assertEqual(100, snapshot["read"]["bytes"])
+		self.assertAlmostEqual(2.0, snapshot["read"]["sqlite_ms"])
+		self.assertAlmostEqual(1.0, snapshot["read"]["hash_ms"])
+		self.assertAlmostEqual(1.0, snapshot["getattr"]["hash_ms"])
+		self.assertAlmostEqual(0.0, snapshot["getattr"]["sqlite_ms"])
+		self.assertEqual(1, snapshot["unlink"]["errors"])
+		self.assertEqual(2, snapshot["hash"]["count"])
+		self.assertEqual(12288, snapshot["hash"]["bytes"])
+		self.assertEqual(len(snapshot) + 1, len(tracer.report()))
+		self.assertTrue(tracer is sha1trace.disable())
+	
+	def testTracedLock(self):
+		tracer = sha1trace.enable()
+		lock = sha1trace.TracedLock()
+		with lock:
+			pass
+		self.assertFalse(sha1trace.LOCK in tracer.snapshot())
+		
+		def hold():
+			with lock:
+				time.sleep(0.05)
+		thread = threading.Thread(target=hold)
+		thread.start()
+		time.sleep(0.01)
+		with ewrap("write"):
+			with lock:
+				pass
+		thread.join()
+		snapshot = tracer.snapshot()
+		self.assertEqual(1, snapshot[sha1trace.LOCK]["count"])
+		self.assertTrue(snapshot["write"]["lock_ms"] > 10)
+
+if __name__ == '__main__':
+	unittest.main()
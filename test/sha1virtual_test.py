@@ -0,0 +1,157 @@
+# Tests for the virtual files served inside the mount
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import json
+import hashlib
+import shutil
+import tempfile
+from errno import EINVAL, ENOENT, EROFS
+from stat import S_ISDIR, S_ISREG
+
+sys.path.append("../")
+import sha1virtual
+from sha1fs import Sha1FS
+
+def write(path, data):
+	with open(path, "wb") as f:
+		f.write(data)
+
+def sha1(data):
+	return hashlib.sha1(data).hexdigest()
+
+def assertRaisesErrno(test, errno, func, *args):
+	try:
+		func(*args)
+	except OSError as einst:
+		test.assertEqual(errno, einst.errno)
+	else:
+		test.fail("no OSError raised")
+
+class TestControlNamespace(unittest.TestCase):
+	def setUp(self):
+		self.rate = "0"
+		def setRate(value):
+			self.rate = str(int(value))
+		self.namespace = sha1virtual.ControlNamespace(lambda: {"uptime": 1.5},
+			{"rate": (lambda: self.rate, setRate)})
+	
+	def testStats(self):
+		handle = self.namespace.open("/.sha1fs/stats", os.O_RDONLY)
+		self.assertEqual({"uptime": 1.5}, json.loads(handle.read(4096, 0)))
+		self.assertEqual(["stats", "control"], self.namespace.listdir("/.sha1fs"))
+		self.assertFalse(self.namespace.writable("/.sha1fs/stats"))
+		self.assertRaisesErrno(EROFS, handle.write, "x", 0)
+		self.assertRaisesErrno(ENOENT, self.namespace.stat, "/.sha1fs/other")
+	
+	def testControl(self):
+		self.assertTrue(self.namespace.writable("/.sha1fs/control"))
+		self.assertEqual("rate=0\n", self.namespace.open("/.sha1fs/control", os.O_RDONLY).read(4096, 0))
+		
+		handle = self.namespace.open("/.sha1fs/control", os.O_WRONLY)
+		handle.write("# comment\nrate=", 0)
+		handle.write("25\n", 15)
+		# nothing is applied before the handle is flushed
+		self.assertEqual("0", self.rate)
+		handle.flush()
+		self.assertEqual("25", self.rate)
+		handle.flush()
+		
+		for text in ["speed=1\n", "rate\n", "rate=fast\n"]:
+			handle = self.namespace.open("/.sha1fs/control", os.O_WRONLY)
+			handle.write(text, 0)
+			self.assertRaisesErrno(EINVAL, handle.flush)
+		self.assertEqual("25", self.rate)
+	
+	def assertRaisesErrno(self, errno, func, *args):
+		assertRaisesErrno(self, errno, func, *args)
+
+# /.by-hash, through the filesystem operations of a Sha1FS that isn't mounted
+class TestByHash(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmpdir, "root")
+		os.makedirs(os.path.join(self.root, "dir"))
+		write(os.path.join(self.root, "a"), "same")
+		write(os.path.join(self.root, "dir", "b"), "same")
+		write(os.path.join(self.root, "other"), "other")
+		self.fs = Sha1FS()
+		self.fs.root = self.root
+		self.fs.database = os.path.join(self.tmpdir, "test.db")
+		self.fs.initDB()
+		self.fs.sha1db.updateAllChecksums(self.root)
+
+	def tearDown(self):
+		self.fs.sha1db.close()
+		shutil.rmtree(self.tmpdir)
+
+	def read(self, path):
+		fh = self.fs.open(path, os.O_RDONLY)
+		try:
+			return self.fs.read(path, 4096, 0, fh)
+		finally:
+			self.fs.release(path, os.O_RDONLY, fh)
+
+	def testCanonical(self):
+		path = "/.by-hash/" + sha1("same")
+		canonical = self.fs.sha1db.canonicalPath(sha1("same"))
+		self.assertTrue(canonical in (self.root + "/a", self.root + "/dir/b"))
+		self.assertEqual(os.lstat(canonical).st_ino, self.fs.getattr(path).st_ino)
+		self.assertEqual("same", self.read(path))
+		# hex digits in either case
+		self.assertEqual("other", self.read("/.by-hash/" + sha1("other").upper()))
+
+	def testPaths(self):
+		path = "/.by-hash/" + sha1("same") + ".paths"
+		self.assertEqual("/a\n/dir/b\n", self.read(path))
+		st = self.fs.getattr(path)
+		self.assertTrue(S_ISREG(st.st_mode))
+		self.assertEqual(len("/a\n/dir/b\n"), st.st_size)
+		self.assertEqual("/other\n", self.read("/.by-hash/" + sha1("other") + ".paths"))
+
+	def testUnknown(self):
+		for name in (sha1("missing"), sha1("missing") + ".paths", "z" * 40, "z" * 40 + ".paths", 
+				sha1("same")[:20], sha1("same")[:20] + ".paths", sha1("same") + "0", "dir/" + sha1("same")):
+			path = "/.by-hash/" + name
+			self.assertEqual(-ENOENT, self.fs.getattr(path), name)
+			assertRaisesErrno(self, ENOENT, self.fs.open, path, os.O_RDONLY)
+
+	def testStale(self):
+		# rewritten since, so nothing has the old checksum any more
+		write(os.path.join(self.root, "other"), "changed")
+		self.fs.sha1db.updateChecksum(os.path.join(self.root, "other"))
+		for path in ("/.by-hash/" + sha1("other"), "/.by-hash/" + sha1("other") + ".paths"):
+			self.assertEqual(-ENOENT, self.fs.getattr(path))
+			assertRaisesErrno(self, ENOENT, self.fs.open, path, os.O_RDONLY)
+		self.assertEqual("changed", self.read("/.by-hash/" + sha1("changed")))
+
+	def testReadOnly(self):
+		path = "/.by-hash/" + sha1("other")
+		for flags in (os.O_WRONLY, os.O_RDWR, os.O_RDONLY | os.O_TRUNC):
+			assertRaisesErrno(self, EROFS, self.fs.open, path, flags)
+			self.assertEqual(-EROFS, self.fs.open(path + ".paths", flags))
+		assertRaisesErrno(self, EROFS, self.fs.unlink, path)
+		assertRaisesErrno(self, EROFS, self.fs.truncate, path + ".paths", 0)
+		self.assertEqual("other", open(os.path.join(self.root, "other")).read())
+
+	def testListings(self):
+		self.assertTrue(S_ISDIR(self.fs.getattr("/.by-hash").st_mode))
+		self.assertEqual([], [entry.name for entry in self.fs.readdir("/.by-hash", 0)])
+		self.assertEqual(["a", "dir", "other"], sorted(entry.name for entry in self.fs.readdir("/", 0)))
+
+	def testRescan(self):
+		self.read("/.by-hash/" + sha1("same"))
+		self.fs.sha1db.updateAllChecksums(self.root)
+		self.fs.sha1db.syncTree(self.root)
+		self.assertEqual([self.root + "/a", self.root + "/dir/b", self.root + "/other"], 
+			[path for (path, chksum) in self.fs.sha1db.entriesUnderPrefix("/", 100)])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,148 @@
+# Tests for following changes made outside of the mount
+# Copyright (C) 2009-2011 Chris Bouzek  <bouzekc@gmail.com>
+#
+#
+#    This program can be distributed under the terms of the GNU LGPL.
+#    See the file COPYING.
+#
+
+import unittest
+import sys
+import os
+import hashlib
+import shutil
+import tempfile
+import time
+
+sys.path.append("../")
+from sha1db import Sha1DB
+from sha1rules import ExcludeRules
+from sha1watch import Watcher
+
+def write(path, data):
+	with open(path, "wb") as f:
+		f.write(data)
+
+def sha1(data):
+	return hashlib.sha1(data).hexdigest()
+
+class TestSha1Watch(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.root = os.path.join(self.tmpdir, "root")
+		os.makedirs(os.path.join(self.root, "sub", "deeper"))
+		write(os.path.join(self.root, "sub", "deeper", "old"), "old")
+		self.sha1db = Sha1DB(os.path.join(self.tmpdir, "test.db"), 
+			rules=ExcludeRules(["*.tmp"]))
+		self.sha1db.updateAllChecksums(self.root)
+		self.changed = []
+		self.watcher = Watcher(self.sha1db, self.root, 0.05, 
+			lambda path, isdir: self.changed.append((path, isdir)))
+		self.watcher.start()
+		self.assertTrue(self.watcher.ready.wait(5))
+	
+	def tearDown(self):
+		self.watcher.stop()
+		self.watcher.join(5)
+		shutil.rmtree(self.tmpdir)
+	
+	def path(self, *names):
+		return os.path.join(self.root, *names)
+	
+	def checksum(self, path):
+		return self.sha1db.getChecksum(path)
+	
+	# waits for the watcher to get the database to where condition is true
+	def waitFor(self, condition):
+		deadline = time.time() + 5
+		while not condition() and time.time() < deadline:
+			time.sleep(0.02)
+		self.assertTrue(condition())
+	
+	def testCreateAndModify(self):
+		write(self.path("new"), "one")
+		self.waitFor(lambda: sha1("one") == self.checksum(self.path("new")))
+		write(self.path("new"), "two")
+		self.waitFor(lambda: sha1("two") == self.checksum(self.path("new")))
+		self.assertTrue((self.path("new"), False) in self.changed)
+		# excluded files are left alone
+		write(self.path("x.tmp"), "tmp")
+		write(self.path("marker"), "marker")
+		self.waitFor(lambda: None != self.checksum(self.path("marker")))
+		self.assertEqual(None, self.sha1db.getEntry(self.path("x.tmp")))
+	
+	def testUpToDate(self):
+		write(self.path("through-mount"), "data")
+		# as if release had already hashed it
+		self.sha1db.updateChecksum(self.path("through-mount"))
+		hashed = self.sha1db.filesHashed
+		write(self.path("marker"), "marker")
+		self.waitFor(lambda: None != self.checksum(self.path("marker")))
+		self.assertEqual(hashed + 1, self.sha1db.filesHashed)
+		self.assertEqual(1, self.watcher.filesUpdated)
+	
+	def testMoveAndDelete(self):
+		old = self.path("sub", "deeper", "old")
+		os.rename(old, self.path("sub", "renamed"))
+		self.waitFor(lambda: sha1("old") == self.checksum(self.path("sub", "renamed")))
+		self.assertEqual(None, self.sha1db.getEntry(old))
+		os.rename(self.path("sub"), self.path("moved"))
+		self.waitFor(lambda: sha1("old") == self.checksum(self.path("moved", "renamed")))
+		self.assertTrue((self.path("sub"), True) in self.changed)
+		# the watches moved along
+		write(self.path("moved", "deeper", "later"), "later")
+		self.waitFor(lambda: sha1("later") == self.checksum(self.path("moved", "deeper", "later")))
+		os.unlink(self.path("moved", "renamed"))
+		self.waitFor(lambda: None == self.sha1db.getEntry(self.path("moved", "renamed")))
+		# moved out of the root
+		os.rename(self.path("moved"), os.path.join(self.tmpdir, "outside"))
+		self.waitFor(lambda: None == self.sha1db.getEntry(self.path("moved", "deeper", "later")))
+		self.assertEqual([], self.sha1db.entriesUnderPrefix(self.root + "/", 10))
+	
+	def testNewDirectory(self):
+		staging = os.path.join(self.tmpdir, "staging")
+		os.makedirs(os.path.join(staging, "inner"))
+		write(os.path.join(staging, "inner", "file"), "file")
+		os.rename(staging, self.path("arrived"))
+		self.waitFor(lambda: sha1("file") == self.checksum(self.path("arrived", "inner", "file")))
+		# and it is watched
+		write(self.path("arrived", "inner", "second"), "second")
+		self.waitFor(lambda: sha1("second") == self.checksum(self.path("arrived", "inner", "second")))
+	
+	def testOverflow(self):
+		# changes whose events were lost, in a directory that was busy
+		write(self.path("sub", "deeper", "busy"), "busy")
+		self.waitFor(lambda: None != self.checksum(self.path("sub", "deeper", "busy")))
+		self.watcher.stop()
+		self.watcher.join(5)
+		write(self.path("sub", "deeper", "lost"), "lost")
+		os.unlink(self.path("sub", "deeper", "old"))
+		write(self.path("elsewhere"), "elsewhere")
+		self.watcher.inotify = type("Stub", (object, ), {"addWatch": lambda self, path: 1})()
+		self.watcher._overflow()
+		self.assertEqual(1, self.watcher.overflows)
+		self.assertEqual(sha1("lost"), self.checksum(self.path("sub", "deeper", "lost")))
+		self.assertEqual(None, self.sha1db.getEntry(self.path("sub", "deeper", "old")))
+		# only the busy subtree was synced
+		self.assertEqual(None, self.sha1db.getEntry(self.path("elsewhere")))
+	
+	def testSyncTree(self):
+		self.watcher.stop()
+		self.watcher.join(5)
+		write(self.path("sub", "added"), "added")
+		os.unlink(self.path("sub", "deeper", "old"))
+		write(self.path("subway"), "not below sub")
+		hashed = self.sha1db.filesHashed
+		self.assertEqual((1, 1), self.sha1db.syncTree(self.path("sub")))
+		self.assertEqual(hashed + 1, self.sha1db.filesHashed)
+		self.assertEqual(sha1("added"), self.checksum(self.path("sub", "added")))
+		self.assertEqual(None, self.sha1db.getEntry(self.path("subway")))
+		# nothing changed since
+		self.assertEqual((0, 0), self.sha1db.syncTree(self.path("sub")))
+		self.sha1db.updateChecksum(self.path("subway"))
+		self.sha1db.removeTree(self.path("sub"))
+		self.assertEqual([(self.path("subway"), sha1("not below sub"))], 
+			self.sha1db.entriesUnderPrefix(self.root + "/", 10))
+
+if __name__ == '__main__':
+	unittest.main()